@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measure the cost of polling many encryptors.
+
+Starts brkt_cli.metavisor_simulator in a separate process, so that only
+the poller is measured, and waits for all simulated encryptors with
+either an EncryptorMonitor or one wait_for_encryption() thread per
+encryptor.  Reports the CPU time, peak memory, thread count, request
+rate and the delay between each encryptor finishing and the poller
+noticing.
+
+    $ python bench_status_polling.py --count 200 --encrypt-seconds 60
+"""
+
+import argparse
+import json
+import logging
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+from brkt_cli import encryptor_monitor, encryptor_service, util
+
+MODE_MONITOR = 'monitor'
+MODE_THREADS = 'threads'
+
+
+def _start_simulator(values):
+    args = [
+        sys.executable, '-m', 'brkt_cli.metavisor_simulator',
+        '--count', str(values.count),
+        '--encrypt-seconds', str(values.encrypt_seconds),
+        '--failure-rate', str(values.failure_rate),
+        '--latency', str(values.latency),
+        '--reset-probability', str(values.reset_probability),
+        '--stall-probability', str(values.stall_probability),
+    ]
+    proc = subprocess.Popen(
+        args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    encryptors = json.loads(proc.stdout.readline())['encryptors']
+    return proc, encryptors
+
+
+def _run_monitor(services, values):
+    """ :return a dictionary that maps the index to the detection time """
+    detected = {}
+
+    def _on_event(event):
+        if event.event_type in (encryptor_monitor.EVENT_FINISHED,
+                                encryptor_monitor.EVENT_FAILED):
+            detected[event.name] = time.time()
+
+    monitor = encryptor_monitor.EncryptorMonitor(
+        max_workers=values.max_workers,
+        max_requests_per_second=values.max_requests_per_second)
+    monitor.subscribe(_on_event)
+    for i, svc in enumerate(services):
+        monitor.watch(i, svc)
+    monitor.wait_all()
+    threads = threading.active_count()
+    monitor.close()
+    return detected, threads
+
+
+def _run_threads(services, values):
+    detected = {}
+
+    def _wait(i):
+        try:
+            encryptor_service.wait_for_encryption(services[i])
+        except encryptor_service.EncryptionError:
+            pass
+        detected[i] = time.time()
+
+    threads = [
+        threading.Thread(target=_wait, args=(i,))
+        for i in xrange(len(services))
+    ]
+    for t in threads:
+        t.start()
+    thread_count = threading.active_count()
+    for t in threads:
+        t.join()
+    return detected, thread_count
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the cost of polling many encryptors')
+    parser.add_argument(
+        '--mode', choices=[MODE_MONITOR, MODE_THREADS], default=MODE_MONITOR)
+    parser.add_argument('--count', type=int, default=200)
+    parser.add_argument('--encrypt-seconds', type=float, default=60)
+    parser.add_argument('--failure-rate', type=float, default=0)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--reset-probability', type=float, default=0)
+    parser.add_argument('--stall-probability', type=float, default=0)
+    parser.add_argument(
+        '--max-workers', type=int,
+        default=encryptor_monitor.DEFAULT_MAX_WORKERS)
+    parser.add_argument(
+        '--max-requests-per-second', type=float,
+        default=encryptor_monitor.DEFAULT_MAX_REQUESTS_PER_SECOND)
+    values = parser.parse_args()
+    logging.basicConfig(level=logging.WARN)
+
+    proc, encryptors = _start_simulator(values)
+    try:
+        services = [
+            encryptor_service.EncryptorService(['127.0.0.1'], port=e['port'])
+            for e in encryptors
+        ]
+        usage_before = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.time()
+        if values.mode == MODE_MONITOR:
+            detected, threads = _run_monitor(services, values)
+        else:
+            detected, threads = _run_threads(services, values)
+        elapsed = time.time() - start
+        usage_after = resource.getrusage(resource.RUSAGE_SELF)
+        requests = sum(svc.requests for svc in services)
+    finally:
+        proc.stdin.close()
+        proc.wait()
+
+    cpu = (usage_after.ru_utime - usage_before.ru_utime +
+           usage_after.ru_stime - usage_before.ru_stime)
+    delays = [
+        max(0, detected[i] - e['finish_time'])
+        for i, e in enumerate(encryptors) if i in detected
+    ]
+    rows = [
+        ['mode', values.mode],
+        ['encryptors', str(len(encryptors))],
+        ['elapsed', '%.1f s' % elapsed],
+        ['cpu', '%.2f s' % cpu],
+        # Kilobytes on Linux, bytes on macOS.
+        ['max_rss', str(usage_after.ru_maxrss)],
+        ['threads', str(threads)],
+        ['requests', str(requests)],
+        ['requests_per_second', '%.1f' % (requests / elapsed)],
+        ['detection_p50', '%.2f s' % _percentile(delays, 0.5)],
+        ['detection_p95', '%.2f s' % _percentile(delays, 0.95)],
+        ['detection_max', '%.2f s' % max(delays or [0])],
+    ]
+    print util.render_table_rows(rows)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,10 +11,12 @@
 # CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and
 # limitations under the License.
+import copy
 import json
 import logging
 import re
 import tempfile
+import time
 import urllib2
 import os
 
@@ -25,13 +27,24 @@ import brkt_cli
 from brkt_cli import encryptor_service, util, mv_version
 from brkt_cli import instance_config_args
 from brkt_cli.aws import (
+    ami_index,
     aws_service,
+    aws_waiter,
     encrypt_ami,
     encrypt_ami_args,
+    encrypt_batch,
+    encrypt_batch_args,
+    rate_limiter,
+    replicate,
+    session_journal,
     wrap_image,
     wrap_image_args,
     share_logs,
     share_logs_args,
+    sweep,
+    sweep_args,
+    update_batch,
+    update_batch_args,
     update_encrypted_ami_args,
     boto3_tag,
     wrap_instance_args
@@ -170,6 +183,19 @@ def run_share_logs(values):
     return 0
 
 
+def _make_resource_waiter(values):
+    """ Return a ResourceWaiter that polls the state of many resources in
+    the region with batched describe calls.  The waiter has its own
+    AWSService, since it polls from a background thread.
+    """
+    waiter_svc = aws_service.AWSService(
+        None,
+        retry_timeout=values.retry_timeout,
+        retry_initial_sleep_seconds=values.retry_initial_sleep_seconds)
+    waiter_svc.connect(values.region)
+    return aws_waiter.ResourceWaiter(waiter_svc)
+
+
 @_handle_aws_errors
 def run_wrap_image(values, config):
     nonce = util.make_nonce()
@@ -227,6 +253,26 @@ def run_wrap_image(values, config):
         brkt_env=brkt_env,
         launch_token=lt)
 
+    if values.count > 1:
+        aws_svc.waiter = _make_resource_waiter(values)
+        jobs = wrap_image.launch_wrapped_images(
+            aws_svc,
+            guest_image.id,
+            metavisor_ami,
+            values.count,
+            wrapped_instance_name=values.wrapped_instance_name,
+            subnet_id=values.subnet_id,
+            security_group_ids=values.security_group_ids,
+            instance_type=values.instance_type,
+            instance_config=instance_config,
+            iam=values.iam,
+            max_parallel=values.max_parallel
+        )
+        print wrap_image.render_results(jobs)
+        if any(job.error for job in jobs):
+            return 1
+        return 0
+
     instance = wrap_image.launch_wrapped_image(
         aws_svc=aws_svc,
         image_id=guest_image.id,
@@ -259,15 +305,31 @@ def run_wrap_instance(values, config):
 
     aws_svc.connect(values.region)
 
-    # Make sure that the instance exists.
-    try:
-        aws_svc.get_instance(values.instance_id, retry=False)
-    except ClientError as e:
-        code, _ = aws_service.get_code_and_message(e)
-        if code == 'InvalidInstanceID.NotFound':
+    instance_ids = list(values.instance_ids)
+    if values.instance_tags:
+        tags = brkt_cli.parse_tags(values.instance_tags)
+        instances = aws_svc.get_instances_by_tags(tags)
+        if not instances:
             raise ValidationError(
-                'No instance with id %s' % values.instance_id)
-        raise
+                'No instances have the tags %s' %
+                ', '.join(values.instance_tags))
+        instance_ids += [
+            i.id for i in instances if i.id not in instance_ids]
+    if not instance_ids:
+        raise ValidationError(
+            'Specify an instance ID or --instance-tag')
+    fleet = len(instance_ids) > 1 or bool(values.instance_tags)
+
+    if not fleet:
+        # Make sure that the instance exists.
+        try:
+            aws_svc.get_instance(instance_ids[0], retry=False)
+        except ClientError as e:
+            code, _ = aws_service.get_code_and_message(e)
+            if code == 'InvalidInstanceID.NotFound':
+                raise ValidationError(
+                    'No instance with id %s' % instance_ids[0])
+            raise
 
     if values.encryptor_ami:
         metavisor_ami = values.encryptor_ami
@@ -288,9 +350,23 @@ def run_wrap_instance(values, config):
         brkt_env=brkt_env,
         launch_token=lt)
 
+    if fleet:
+        aws_svc.waiter = _make_resource_waiter(values)
+        jobs = wrap_image.wrap_instances(
+            aws_svc,
+            instance_ids,
+            metavisor_ami,
+            instance_config=instance_config,
+            max_parallel=values.max_parallel
+        )
+        print wrap_image.render_results(jobs)
+        if any(job.error for job in jobs):
+            return 1
+        return 0
+
     instance = wrap_image.wrap_instance(
         aws_svc,
-        values.instance_id,
+        instance_ids[0],
         metavisor_ami,
         instance_config
     )
@@ -352,7 +428,7 @@ def get_centos_ami_id(stock_image_version, aws_svc):
 
 @_handle_aws_errors
 def run_encrypt(values, config, verbose=False):
-    session_id = util.make_nonce()
+    session_id = values.resume or util.make_nonce()
 
     aws_svc = aws_service.AWSService(
         session_id,
@@ -362,10 +438,7 @@ def run_encrypt(values, config, verbose=False):
               aws_svc.retry_timeout, aws_svc.retry_initial_sleep_seconds)
 
     aws_svc.connect(values.region, key_name=values.key_name)
-
-    if values.validate:
-        # Validate the region before connecting.
-        _validate_region(aws_svc, values.region)
+    _validate_replicate_regions(aws_svc, values)
 
     # Keywords check
     if values.ami == 'ubuntu':
@@ -374,37 +447,80 @@ def run_encrypt(values, config, verbose=False):
     elif values.ami == 'centos':
         values.ami = get_centos_ami_id(values.stock_image_version, aws_svc)
 
+    if values.single_disk is None:
+        values.single_disk = True if values.encryptor_ami else False
+
+    index = None
+    if values.skip_if_exists and not values.resume:
+        index = ami_index.EncryptedImageIndex()
+        # Keep the encryptor AMI, so that it's not fetched again when the
+        # encryptor image is validated.
+        if not values.encryptor_ami:
+            values.encryptor_ami = _get_encryptor_ami(
+                values.region, values.metavisor_version)
+        existing_id = ami_index.find_encrypted_image(
+            aws_svc, values.ami, values.encryptor_ami, values.crypto,
+            index=index)
+        if existing_id:
+            log.info('%s was already encrypted as %s', values.ami, existing_id)
+            if values.replicate_regions:
+                aws_svc.default_tags = encrypt_ami.get_default_tags(
+                    session_id, values.encryptor_ami, source_ami=values.ami,
+                    crypto_policy=values.crypto)
+                return _replicate_image(aws_svc, values, existing_id)
+            print existing_id
+            return 0
+
+    journal = None
+    if values.resume:
+        journal = _load_session_journal(values, 'encrypt')
+
     if values.validate:
-        guest_image = _validate_guest_ami(aws_svc, values.ami)
+        validate_guest = _validate_guest_ami
     else:
-        guest_image = _validate_ami(aws_svc, values.ami)
+        validate_guest = _validate_ami
+    checks = [
+        _check(validate_guest, aws_svc, values.ami),
+        _check(_get_encryptor_image, aws_svc, values)
+    ]
+    if values.validate:
+        checks += [
+            _check(_validate_region, aws_svc, values.region),
+            _check(brkt_cli.validate_ntp_servers, values.ntp_servers)
+        ]
+        checks += _get_validation_checks(
+            aws_svc,
+            encrypted_ami_name=values.encrypted_ami_name,
+            key_name=values.key_name,
+            subnet_id=values.subnet_id,
+            security_group_ids=values.security_group_ids
+        )
+    guest_image, encryptor_image = _run_validations(checks)[:2]
+    values.encryptor_ami = encryptor_image.id
 
     if not values.encrypted_ami_name:
         suffix = NAME_ENCRYPTED_IMAGE_SUFFIX % {'nonce': make_nonce()}
         values.encrypted_ami_name = \
             append_suffix(guest_image.name, suffix,
                           max_length=AMI_NAME_MAX_LENGTH)
+        if values.validate:
+            aws_service.validate_image_name(values.encrypted_ami_name)
+
+    if not journal:
+        journal = session_journal.create(
+            session_id, 'encrypt', values.region,
+            _get_session_values(
+                values, 'ami', 'encryptor_ami', 'encrypted_ami_name',
+                'single_disk', 'guestless', 'encryptor_volume_type')
+        )
 
-    if values.single_disk is None:
-        values.single_disk = True if values.encryptor_ami else False
-
-    if not values.encryptor_ami:
-        values.encryptor_ami = _get_encryptor_ami(values.region,
-                                                  values.metavisor_version)
-
-    aws_tags = encrypt_ami.get_default_tags(session_id,
-                                            values.encryptor_ami)
+    aws_tags = encrypt_ami.get_default_tags(
+        session_id, values.encryptor_ami, source_ami=values.ami,
+        crypto_policy=values.crypto)
     command_line_tags = brkt_cli.parse_tags(values.aws_tags)
     aws_tags.update(command_line_tags)
     aws_svc.default_tags = aws_tags
 
-    if values.validate:
-        _validate(aws_svc, values.encryptor_ami,
-                  encrypted_ami_name=values.encrypted_ami_name,
-                  key_name=values.key_name, subnet_id=values.subnet_id,
-                  security_group_ids=values.security_group_ids)
-        brkt_cli.validate_ntp_servers(values.ntp_servers)
-
     brkt_env = brkt_cli.brkt_env_from_values(values, config)
     lt = instance_config_args.get_launch_token(values, config)
     instance_config = instance_config_from_values(values,
@@ -420,7 +536,15 @@ def run_encrypt(values, config, verbose=False):
 
     encrypted_image_id = encrypt_ami.encrypt(
         aws_svc=aws_svc, enc_svc_cls=encryptor_service.EncryptorService,
-        values=values, instance_config=instance_config)
+        values=values, instance_config=instance_config, journal=journal)
+    log.debug('EC2 resource cache: %s', aws_svc.cache)
+    log.debug('EC2 API usage: %s', aws_svc.limiter)
+    if index:
+        index.put(values.region, values.ami, values.encryptor_ami,
+                  values.crypto, encrypted_image_id)
+
+    if values.replicate_regions:
+        return _replicate_image(aws_svc, values, encrypted_image_id)
 
     # Print the AMI ID to stdout, in case the caller wants to process
     # the output.  Log messages go to stderr.
@@ -428,9 +552,133 @@ def run_encrypt(values, config, verbose=False):
     return 0
 
 
+@_handle_aws_errors
+def run_encrypt_batch(values, config, verbose=False):
+    entries = encrypt_batch.read_manifest(values.manifest)
+
+    if values.validate:
+        # Validate the region before connecting.
+        _validate_region(aws_service.AWSService(None), values.region)
+
+    if values.single_disk is None:
+        values.single_disk = True if values.encryptor_ami else False
+
+    if not values.encryptor_ami:
+        values.encryptor_ami = _get_encryptor_ami(values.region,
+                                                  values.metavisor_version)
+    if values.validate:
+        brkt_cli.validate_ntp_servers(values.ntp_servers)
+
+    brkt_env = brkt_cli.brkt_env_from_values(values, config)
+    lt = instance_config_args.get_launch_token(values, config)
+    command_line_tags = brkt_cli.parse_tags(values.aws_tags)
+
+    # Poll the state of every session's resources with a single set of
+    # describe calls, instead of one set per session.
+    waiter = _make_resource_waiter(values)
+
+    # Validate every AMI before starting any encryption.  Each AMI gets its
+    # own session, so that its resources can be identified and cleaned up
+    # independently.
+    index = None
+    if values.skip_if_exists:
+        index = ami_index.EncryptedImageIndex()
+
+    jobs = []
+    for entry in entries:
+        session_id = util.make_nonce()
+        aws_svc = aws_service.AWSService(
+            session_id,
+            retry_timeout=values.retry_timeout,
+            retry_initial_sleep_seconds=values.retry_initial_sleep_seconds)
+        aws_svc.connect(values.region, key_name=values.key_name)
+        aws_svc.waiter = waiter
+
+        job_values = copy.copy(values)
+        job_values.ami = entry.ami
+        if index:
+            existing_id = ami_index.find_encrypted_image(
+                aws_svc, entry.ami, values.encryptor_ami, values.crypto,
+                index=index)
+            if existing_id:
+                log.info('%s was already encrypted as %s',
+                         entry.ami, existing_id)
+                existing = encrypt_batch.EncryptJob(aws_svc, job_values)
+                existing.encrypted_ami_id = existing_id
+                jobs.append(existing)
+                continue
+
+        # Run this AMI's checks concurrently, like run_encrypt().
+        if values.validate:
+            checks = [_check(_validate_guest_ami, aws_svc, entry.ami)]
+            checks += _get_validation_checks(
+                aws_svc,
+                encryptor_ami_id=values.encryptor_ami,
+                encrypted_ami_name=entry.encrypted_ami_name,
+                key_name=values.key_name,
+                subnet_id=values.subnet_id,
+                security_group_ids=values.security_group_ids
+            )
+        else:
+            checks = [_check(_validate_ami, aws_svc, entry.ami)]
+        guest_image = _run_validations(checks)[0]
+
+        job_values.encrypted_ami_name = entry.encrypted_ami_name
+        if not job_values.encrypted_ami_name:
+            suffix = NAME_ENCRYPTED_IMAGE_SUFFIX % {'nonce': make_nonce()}
+            job_values.encrypted_ami_name = \
+                append_suffix(guest_image.name, suffix,
+                              max_length=AMI_NAME_MAX_LENGTH)
+            if values.validate:
+                aws_service.validate_image_name(
+                    job_values.encrypted_ami_name)
+
+        aws_tags = encrypt_ami.get_default_tags(
+            session_id, values.encryptor_ami, source_ami=entry.ami,
+            crypto_policy=values.crypto)
+        aws_tags.update(command_line_tags)
+        aws_tags.update(entry.aws_tags)
+        aws_svc.default_tags = aws_tags
+
+        instance_config = instance_config_from_values(
+            job_values,
+            mode=INSTANCE_CREATOR_MODE,
+            brkt_env=brkt_env,
+            launch_token=lt)
+        log.info('Session %s will encrypt %s', session_id, entry.ami)
+        jobs.append(encrypt_batch.EncryptJob(
+            aws_svc, job_values, instance_config=instance_config))
+
+    pending = [job for job in jobs if not job.encrypted_ami_id]
+    if verbose and pending:
+        with tempfile.NamedTemporaryFile(prefix='user-data-',
+                                         delete=False) as f:
+            log.debug('Writing instance user data to %s', f.name)
+            f.write(pending[0].instance_config.make_userdata())
+
+    jobs = encrypt_batch.encrypt_many(
+        jobs,
+        encryptor_service.EncryptorService,
+        max_parallel=values.max_parallel
+    )
+    log.info('EC2 API usage: %s', rate_limiter.get_default())
+    if index:
+        for job in pending:
+            if job.encrypted_ami_id:
+                index.put(values.region, job.ami, values.encryptor_ami,
+                          values.crypto, job.encrypted_ami_id)
+
+    # Print the results to stdout, in case the caller wants to process
+    # the output.  Log messages go to stderr.
+    print encrypt_batch.render_results(jobs)
+    if any(job.error for job in jobs):
+        return 1
+    return 0
+
+
 @_handle_aws_errors
 def run_update(values, config, verbose=False):
-    nonce = util.make_nonce()
+    nonce = values.resume or util.make_nonce()
 
     aws_svc = aws_service.AWSService(
         nonce,
@@ -439,34 +687,47 @@ def run_update(values, config, verbose=False):
     log.debug('Retry timeout=%.02f, initial sleep seconds=%.02f',
               aws_svc.retry_timeout, aws_svc.retry_initial_sleep_seconds)
 
-    if values.validate:
-        # Validate the region before connecting.
-        _validate_region(aws_svc, values.region)
-
     aws_svc.connect(values.region, key_name=values.key_name)
-    encrypted_image = _validate_ami(aws_svc, values.ami)
+    _validate_replicate_regions(aws_svc, values)
 
-    if not values.encryptor_ami:
-        values.encryptor_ami = _get_encryptor_ami(values.region,
-                                                  values.metavisor_version)
+    journal = None
+    if values.resume:
+        journal = _load_session_journal(values, 'update')
+
+    checks = [
+        _check(_validate_ami, aws_svc, values.ami),
+        _check(_get_encryptor_image, aws_svc, values)
+    ]
+    if values.validate:
+        checks += [
+            _check(_validate_region, aws_svc, values.region),
+            _check(brkt_cli.validate_ntp_servers, values.ntp_servers)
+        ]
+        checks += _get_validation_checks(
+            aws_svc,
+            encrypted_ami_name=values.encrypted_ami_name,
+            key_name=values.key_name,
+            subnet_id=values.subnet_id,
+            security_group_ids=values.security_group_ids
+        )
+    else:
+        log.info('Skipping AMI validation.')
+        if values.encrypted_ami_name:
+            checks.append(_check(
+                _validate_image_name_available,
+                aws_svc, values.encrypted_ami_name
+            ))
+    encrypted_image, mv_image = _run_validations(checks)[:2]
+    values.encryptor_ami = mv_image.id
+
+    if values.validate:
+        _validate_encrypted_image_tags(encrypted_image, values.encryptor_ami)
 
     aws_tags = encrypt_ami.get_default_tags(nonce, values.encryptor_ami)
     command_line_tags = brkt_cli.parse_tags(values.aws_tags)
     aws_tags.update(command_line_tags)
     aws_svc.default_tags = aws_tags
 
-    if values.validate:
-        _validate_guest_encrypted_ami(aws_svc, values.ami,
-                                      values.encryptor_ami)
-        _validate(aws_svc, values.encryptor_ami,
-                  encrypted_ami_name=values.encrypted_ami_name,
-                  key_name=values.key_name, subnet_id=values.subnet_id,
-                  security_group_ids=values.security_group_ids)
-        brkt_cli.validate_ntp_servers(values.ntp_servers)
-    else:
-        log.info('Skipping AMI validation.')
-
-    mv_image = aws_svc.get_image(values.encryptor_ami)
     if (encrypted_image.virtualization_type != mv_image.virtualization_type):
         log.error(
             'Virtualization type mismatch.  %s is %s, but encryptor %s is '
@@ -478,18 +739,20 @@ def run_update(values, config, verbose=False):
         )
         return 1
 
-    if values.encrypted_ami_name:
-        # Check for name collision.
-        if aws_svc.get_images(name=values.encrypted_ami_name,
-                              owner_alias='self'):
-            raise ValidationError('You already own image named %s' %
-                                  values.encrypted_ami_name)
-    else:
+    if not values.encrypted_ami_name:
         values.encrypted_ami_name = _get_updated_image_name(
             encrypted_image.name, nonce)
         log.debug('Image name: %s', values.encrypted_ami_name)
         aws_service.validate_image_name(values.encrypted_ami_name)
 
+    if not journal:
+        journal = session_journal.create(
+            nonce, 'update', values.region,
+            _get_session_values(
+                values, 'ami', 'encryptor_ami', 'encrypted_ami_name',
+                'guestless')
+        )
+
     # Initial validation done
     log.info('Updating %s with new metavisor %s', values.ami,
              values.encryptor_ami)
@@ -511,11 +774,196 @@ def run_update(values, config, verbose=False):
             f.write(instance_config.make_userdata())
 
     updated_ami_id = update_ami(aws_svc, encryptor_service.EncryptorService,
-                                values, instance_config=instance_config)
+                                values, instance_config=instance_config,
+                                journal=journal)
+    log.debug('EC2 resource cache: %s', aws_svc.cache)
+    log.debug('EC2 API usage: %s', aws_svc.limiter)
+    if values.replicate_regions:
+        return _replicate_image(aws_svc, values, updated_ami_id)
     print(updated_ami_id)
     return 0
 
 
+def _validate_replicate_regions(aws_svc, values):
+    """ Check the regions specified with --replicate-region, and remove
+    duplicates.
+
+    :raise ValidationError if a region is invalid
+    """
+    region_names = None
+    if values.validate:
+        region_names = [r.name for r in aws_svc.get_regions()]
+    values.replicate_regions = replicate.validate_regions(
+        values.region, values.replicate_regions, region_names=region_names)
+
+
+def _replicate_image(aws_svc, values, image_id):
+    """ Copy the new AMI to the regions specified with --replicate-region,
+    and print the AMI ID in each region.
+
+    :return 0 if all of the copies succeeded, otherwise 1
+    """
+    def _connect(region):
+        svc = aws_service.AWSService(
+            aws_svc.session_id,
+            default_tags=aws_svc.default_tags,
+            retry_timeout=values.retry_timeout,
+            retry_initial_sleep_seconds=values.retry_initial_sleep_seconds)
+        svc.connect(region)
+        return svc
+
+    replicas = replicate.replicate_image(
+        aws_svc, image_id, values.replicate_regions, _connect)
+    print replicate.render_results(values.region, image_id, replicas)
+    if any(replica.error for replica in replicas):
+        return 1
+    return 0
+
+
+@_handle_aws_errors
+def run_update_batch(values, config, verbose=False):
+    entries = encrypt_batch.read_manifest(values.manifest)
+
+    aws_svc = aws_service.AWSService(
+        util.make_nonce(),
+        retry_timeout=values.retry_timeout,
+        retry_initial_sleep_seconds=values.retry_initial_sleep_seconds)
+    aws_svc.connect(values.region, key_name=values.key_name)
+    if values.validate:
+        _validate_region(aws_svc, values.region)
+        brkt_cli.validate_ntp_servers(values.ntp_servers)
+
+    mv_image = _get_encryptor_image(aws_svc, values)
+    values.encryptor_ami = mv_image.id
+    aws_svc.default_tags = encrypt_ami.get_default_tags(
+        aws_svc.session_id, values.encryptor_ami)
+
+    brkt_env = brkt_cli.brkt_env_from_values(values, config)
+    lt = instance_config_args.get_launch_token(values, config)
+    command_line_tags = brkt_cli.parse_tags(values.aws_tags)
+
+    # Poll the state of every session's resources with a single set of
+    # describe calls, instead of one set per session.
+    waiter = _make_resource_waiter(values)
+    aws_svc.waiter = waiter
+
+    # Validate every AMI before starting any update.  Each AMI gets its
+    # own session, so that its resources can be identified and cleaned up
+    # independently.
+    jobs = []
+    for entry in entries:
+        session_id = util.make_nonce()
+        job_svc = aws_service.AWSService(
+            session_id,
+            retry_timeout=values.retry_timeout,
+            retry_initial_sleep_seconds=values.retry_initial_sleep_seconds)
+        job_svc.connect(values.region, key_name=values.key_name)
+        job_svc.waiter = waiter
+
+        job_values = copy.copy(values)
+        job_values.ami = entry.ami
+        encrypted_image = _validate_ami(job_svc, entry.ami)
+        if values.validate:
+            _validate_encrypted_image_tags(
+                encrypted_image, values.encryptor_ami)
+        if (encrypted_image.virtualization_type !=
+                mv_image.virtualization_type):
+            raise ValidationError(
+                'Virtualization type mismatch.  %s is %s, but encryptor %s '
+                'is %s.' % (
+                    entry.ami, encrypted_image.virtualization_type,
+                    values.encryptor_ami, mv_image.virtualization_type)
+            )
+
+        job_values.encrypted_ami_name = entry.encrypted_ami_name
+        if not job_values.encrypted_ami_name:
+            job_values.encrypted_ami_name = _get_updated_image_name(
+                encrypted_image.name, session_id)
+        aws_service.validate_image_name(job_values.encrypted_ami_name)
+
+        aws_tags = encrypt_ami.get_default_tags(session_id,
+                                                values.encryptor_ami)
+        aws_tags.update(command_line_tags)
+        aws_tags.update(entry.aws_tags)
+        job_svc.default_tags = aws_tags
+
+        if values.validate:
+            _validate(job_svc, values.encryptor_ami,
+                      encrypted_ami_name=job_values.encrypted_ami_name,
+                      key_name=values.key_name, subnet_id=values.subnet_id,
+                      security_group_ids=values.security_group_ids)
+
+        instance_config = instance_config_from_values(
+            job_values,
+            mode=INSTANCE_UPDATER_MODE,
+            brkt_env=brkt_env,
+            launch_token=lt)
+        log.info('Session %s will update %s', session_id, entry.ami)
+        jobs.append(update_batch.UpdateJob(
+            job_svc, job_values, instance_config=instance_config))
+
+    if verbose:
+        with tempfile.NamedTemporaryFile(prefix='user-data-',
+                                         delete=False) as f:
+            log.debug('Writing instance user data to %s', f.name)
+            f.write(jobs[0].instance_config.make_userdata())
+
+    jobs = update_batch.update_many(
+        aws_svc,
+        jobs,
+        encryptor_service.EncryptorService,
+        max_parallel=values.max_parallel
+    )
+    log.info('EC2 API usage: %s', rate_limiter.get_default())
+
+    # Print the results to stdout, in case the caller wants to process
+    # the output.  Log messages go to stderr.
+    print encrypt_batch.render_results(jobs)
+    if any(job.error for job in jobs):
+        return 1
+    return 0
+
+
+@_handle_aws_errors
+def run_sweep(values):
+    aws_svc = aws_service.AWSService(
+        None,
+        retry_timeout=values.retry_timeout,
+        retry_initial_sleep_seconds=values.retry_initial_sleep_seconds)
+    region_names = [r.name for r in aws_svc.get_regions()]
+    regions = values.sweep_regions or sorted(region_names)
+    for region in regions:
+        if region not in region_names:
+            raise ValidationError(
+                '%s does not exist.  AWS regions are %s' %
+                (region, ', '.join(region_names))
+            )
+
+    def _connect(region):
+        svc = aws_service.AWSService(
+            None,
+            retry_timeout=values.retry_timeout,
+            retry_initial_sleep_seconds=values.retry_initial_sleep_seconds)
+        svc.connect(region)
+        return svc
+
+    if values.dry_run:
+        log.info('Dry run.  Orphaned resources will not be deleted.')
+    results = sweep.sweep(
+        regions,
+        _connect,
+        values.min_age_hours * 60 * 60,
+        dry_run=values.dry_run,
+        max_parallel=values.max_parallel
+    )
+    log.info('EC2 API usage: %s', rate_limiter.get_default())
+
+    print sweep.render_summary(results)
+    if any(result.error for result in results):
+        return 1
+    return 0
+
+
 class AWSSubcommand(Subcommand):
     def __init__(self):
         self.config = None
@@ -537,6 +985,11 @@ class AWSSubcommand(Subcommand):
             'The AWS security group to use when launching Metavisor during '
             'encryption, update, and wrap-image'
         )
+        config.register_option(
+            'aws.encryptor-instance-types',
+            'Comma-separated list of the instance types that '
+            '--encryptor-instance-type auto chooses from'
+        )
 
     def register(self, subparsers, parsed_config):
         self.config = parsed_config
@@ -550,7 +1003,10 @@ class AWSSubcommand(Subcommand):
         aws_subparsers = aws_parser.add_subparsers(
             dest='aws_subcommand',
             # Hardcode the list, so that we don't expose internal subcommands.
-            metavar='{encrypt,update,wrap-guest-image}'
+            metavar=(
+                '{encrypt,encrypt-batch,update,update-batch,wrap-guest-image,'
+                'gc}'
+            )
         )
 
         encrypt_ami_parser = aws_subparsers.add_parser(
@@ -565,6 +1021,21 @@ class AWSSubcommand(Subcommand):
                                    mode=INSTANCE_CREATOR_MODE)
         encrypt_ami_parser.set_defaults(aws_subcommand='encrypt')
 
+        encrypt_batch_parser = aws_subparsers.add_parser(
+            'encrypt-batch',
+            description=(
+                'Create encrypted AMIs from a list of existing AMIs, '
+                'encrypting several of them at the same time.'
+            ),
+            help='Encrypt a batch of AWS images',
+            formatter_class=brkt_cli.SortingHelpFormatter
+        )
+        encrypt_batch_args.setup_encrypt_batch_args(
+            encrypt_batch_parser, parsed_config)
+        setup_instance_config_args(encrypt_batch_parser, parsed_config,
+                                   mode=INSTANCE_CREATOR_MODE)
+        encrypt_batch_parser.set_defaults(aws_subcommand='encrypt-batch')
+
         share_logs_parser = aws_subparsers.add_parser(
             # Don't specify the help field.  This is an internal command
             # which shouldn't show up in usage output.
@@ -592,6 +1063,22 @@ class AWSSubcommand(Subcommand):
                                    mode=INSTANCE_UPDATER_MODE)
         update_encrypted_ami_parser.set_defaults(aws_subcommand='update')
 
+        update_batch_parser = aws_subparsers.add_parser(
+            'update-batch',
+            description=(
+                'Update a list of encrypted AMIs with the latest Metavisor '
+                'release.  The Metavisor root is built once and shared by '
+                'all of the AMIs.'
+            ),
+            help='Update a batch of encrypted AWS images',
+            formatter_class=brkt_cli.SortingHelpFormatter
+        )
+        update_batch_args.setup_update_batch_args(
+            update_batch_parser, parsed_config)
+        setup_instance_config_args(update_batch_parser, parsed_config,
+                                   mode=INSTANCE_UPDATER_MODE)
+        update_batch_parser.set_defaults(aws_subcommand='update-batch')
+
         wrap_image_parser = aws_subparsers.add_parser(
             'wrap-guest-image',
             description=(
@@ -619,17 +1106,38 @@ class AWSSubcommand(Subcommand):
         )
         wrap_instance_parser.set_defaults(aws_subcommand='wrap-instance')
 
+        sweep_parser = aws_subparsers.add_parser(
+            'gc',
+            description=(
+                'Delete the instances, volumes, snapshots and security '
+                'groups that were left behind by encrypt and update '
+                'sessions that did not clean up.'
+            ),
+            help='Delete resources left behind by interrupted sessions',
+            formatter_class=brkt_cli.SortingHelpFormatter
+        )
+        sweep_args.setup_sweep_args(sweep_parser)
+        sweep_parser.set_defaults(aws_subcommand='gc')
+
     def debug_log_to_temp_file(self, values):
-        return values.aws_subcommand in ('encrypt', 'update')
+        return values.aws_subcommand in (
+            'encrypt', 'encrypt-batch', 'update', 'update-batch', 'gc')
 
     def run(self, values):
+        if values.aws_subcommand == 'gc':
+            # gc scans all regions, unless they're specified with --region.
+            return run_sweep(values)
         if not values.region:
             raise ValidationError(
                 'Specify --region or set the aws.region config key')
         if values.aws_subcommand == 'encrypt':
             return run_encrypt(values, self.config, self.verbose)
+        if values.aws_subcommand == 'encrypt-batch':
+            return run_encrypt_batch(values, self.config, self.verbose)
         if values.aws_subcommand == 'update':
             return run_update(values, self.config, self.verbose)
+        if values.aws_subcommand == 'update-batch':
+            return run_update_batch(values, self.config, self.verbose)
         if values.aws_subcommand == 'share-logs':
             return run_share_logs(values)
         if values.aws_subcommand == 'wrap-guest-image':
@@ -753,7 +1261,16 @@ def _validate_guest_encrypted_ami(aws_svc, ami_id, encryptor_ami_id):
     :return: the Image object
     """
     ami = _validate_ami(aws_svc, ami_id)
+    _validate_encrypted_image_tags(ami, encryptor_ami_id)
+    return ami
 
+
+def _validate_encrypted_image_tags(ami, encryptor_ami_id):
+    """ Validate that the image was encrypted by Bracket, and not
+        already with the given encryptor AMI.
+
+    :raise: ValidationError if validation fails
+    """
     # Is this encrypted by Bracket?
     tags = boto3_tag.tags_to_dict(ami.tags)
     expected_tags = (TAG_ENCRYPTOR,
@@ -773,8 +1290,6 @@ def _validate_guest_encrypted_ami(aws_svc, ami_id, encryptor_ami_id):
         )
         raise ValidationError(msg)
 
-    return ami
-
 
 def _validate_encryptor_ami(aws_svc, ami_id):
     """ Validate that the image exists and is a Bracket encryptor image.
@@ -786,7 +1301,31 @@ def _validate_encryptor_ami(aws_svc, ami_id):
         raise ValidationError(
             '%s (%s) is not a Bracket Encryptor image' % (ami_id, image.name)
         )
-    return None
+    return image
+
+
+def _get_session_values(values, *names):
+    return {name: getattr(values, name) for name in names}
+
+
+def _load_session_journal(values, command):
+    """ Load the journal of the session being resumed, and restore the
+    values that the session was started with.
+
+    :return the SessionJournal
+    :raise ValidationError if the session was started with another AMI
+    """
+    journal = session_journal.load(values.resume, command, values.region)
+    ami = journal.values.get('ami')
+    if ami != values.ami:
+        raise ValidationError(
+            'Session %s was started with %s, not %s' %
+            (values.resume, ami, values.ami)
+        )
+    for name, value in journal.values.iteritems():
+        setattr(values, name, value)
+    log.info('Resuming session %s', values.resume)
+    return journal
 
 
 def _validate(aws_svc, encryptor_ami_id, encrypted_ami_name=None,
@@ -797,34 +1336,138 @@ def _validate(aws_svc, encryptor_ami_id, encrypted_ami_name=None,
     :param aws_svc: the BaseAWSService implementation
     :param values: object that was generated by argparse
     """
+    checks = _get_validation_checks(
+        aws_svc,
+        encryptor_ami_id=encryptor_ami_id,
+        encrypted_ami_name=encrypted_ami_name,
+        key_name=key_name,
+        subnet_id=subnet_id,
+        security_group_ids=security_group_ids,
+        instance_type=instance_type
+    )
+    _run_validations(checks)
+
+
+def _get_validation_checks(aws_svc, encryptor_ami_id=None,
+                           encrypted_ami_name=None, key_name=None,
+                           subnet_id=None, security_group_ids=None,
+                           instance_type=None):
+    """ Return the checks that validate command-line options, to be
+    passed to _run_validations().
+    """
+    checks = []
     if encrypted_ami_name:
-        aws_service.validate_image_name(encrypted_ami_name)
+        checks += [
+            _check(aws_service.validate_image_name, encrypted_ami_name),
+            _check(_validate_image_name_available,
+                   aws_svc, encrypted_ami_name)
+        ]
+    if instance_type:
+        checks.append(_check(_validate_instance_type, instance_type))
+    if key_name:
+        checks.append(_check(_get_key_pair, aws_svc, key_name))
+    checks.append(_check(
+        _validate_subnet_and_security_groups,
+        aws_svc, subnet_id, security_group_ids
+    ))
+    if encryptor_ami_id:
+        checks.append(
+            _check(_validate_encryptor_ami, aws_svc, encryptor_ami_id))
+    return checks
+
+
+def _get_key_pair(aws_svc, key_name):
+    return aws_svc.get_key_pair(key_name)
+
+
+def _check(function, *args):
+    """ Return a validation check that calls the given function and
+    reports a ClientError as a ValidationError.  The checks run in
+    separate threads, so BaseAWSService arguments are replaced with a
+    clone.
+    """
+    def _do_check():
+        call_args = [
+            arg.clone() if isinstance(arg, aws_service.BaseAWSService)
+            else arg
+            for arg in args
+        ]
+        try:
+            return function(*call_args)
+        except ClientError as e:
+            _, message = aws_service.get_code_and_message(e)
+            raise ValidationError(message)
+    return _do_check
 
-    if instance_type and (instance_type == 't2.nano' or
-                          instance_type == 't1.micro'):
-            raise ValidationError('Unsupported instance type %s' %
-                                  instance_type)
 
-    try:
-        if key_name:
-            aws_svc.get_key_pair(key_name)
-
-        _validate_subnet_and_security_groups(
-            aws_svc, subnet_id, security_group_ids)
-        _validate_encryptor_ami(aws_svc, encryptor_ami_id)
-
-        if encrypted_ami_name:
-            images = aws_svc.get_images(
-                name=encrypted_ami_name,
-                owner_alias='self')
-            if images:
-                raise ValidationError(
-                    'You already own an image named %s' %
-                    encrypted_ami_name
-                )
-    except ClientError as e:
-        _, message = aws_service.get_code_and_message(e)
-        raise ValidationError(message)
+def _run_validations(checks):
+    """ Run validation checks concurrently, so that their round trips to
+    AWS and S3 overlap.  All checks run to completion, so that every
+    problem is reported at once.
+
+    :param checks: a list of functions that take no arguments
+    :return: the values returned by the checks, in the same order
+    :raise ValidationError that describes every failed check, or the
+        first exception that isn't a ValidationError
+    """
+    def _call(check):
+        try:
+            return check(), None
+        except Exception as e:
+            log.debug('Validation check failed', exc_info=1)
+            return None, e
+
+    start = time.time()
+    results = util.parallel_map(_call, checks)
+    log.info('Validation completed in %.1f seconds', time.time() - start)
+
+    errors = [e for _, e in results if e]
+    validation_errors = [e for e in errors if isinstance(e, ValidationError)]
+    if len(errors) > len(validation_errors):
+        # Let the caller handle unexpected errors as it normally would.
+        for e in validation_errors:
+            log.error(e)
+        raise next(e for e in errors if not isinstance(e, ValidationError))
+    if len(validation_errors) == 1:
+        raise validation_errors[0]
+    if validation_errors:
+        raise ValidationError(
+            'Found %d problems:\n%s' % (
+                len(validation_errors),
+                '\n'.join('  ' + str(e) for e in validation_errors)
+            )
+        )
+    return [result for result, _ in results]
+
+
+def _validate_instance_type(instance_type):
+    if instance_type in ('t2.nano', 't1.micro'):
+        raise ValidationError('Unsupported instance type %s' % instance_type)
+
+
+def _validate_image_name_available(aws_svc, name):
+    """ Check that the caller doesn't already own an image with the given
+    name.
+
+    :raise ValidationError if the name is taken
+    """
+    if aws_svc.get_images(name=name, owner_alias='self'):
+        raise ValidationError('You already own an image named %s' % name)
+
+
+def _get_encryptor_image(aws_svc, values):
+    """ Look up the encryptor AMI for the region, unless it was specified
+    on the command line.
+
+    :return: the encryptor Image object
+    :raise ValidationError if the image doesn't exist, or isn't a Bracket
+        encryptor image
+    """
+    encryptor_ami = values.encryptor_ami or _get_encryptor_ami(
+        values.region, values.metavisor_version)
+    if values.validate:
+        return _validate_encryptor_ami(aws_svc, encryptor_ami)
+    return _validate_ami(aws_svc, encryptor_ami)
 
 
 def _validate_region(aws_svc, region_name):
@@ -0,0 +1,198 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Find AMIs that were already encrypted, for encrypt --skip-if-exists.
+
+An encrypted AMI is identified by its region, the guest AMI that it was
+encrypted from, the encryptor AMI and the crypto policy.  The last three
+are written as tags by encrypt_ami.get_default_tags().
+
+find_encrypted_image() first checks a local index in
+~/.brkt/encrypted_amis.json, which maps those values to the encrypted AMI
+ID in every region.  It only searches by tags when the index doesn't have
+an entry, so repeated checks only describe the indexed AMI.  If it was
+deregistered or is no longer available, the entry is removed and the
+search falls back to tags.  Entries also expire after INDEX_TTL seconds.
+"""
+
+import errno
+import json
+import logging
+import os
+import tempfile
+import time
+
+from botocore.exceptions import ClientError
+
+from brkt_cli.aws.aws_constants import (
+    TAG_CRYPTO_POLICY,
+    TAG_ENCRYPTOR_AMI,
+    TAG_SOURCE_AMI
+)
+from brkt_cli.aws.aws_service import get_code_and_message
+from brkt_cli.config import CONFIG_DIR
+
+log = logging.getLogger(__name__)
+
+INDEX_PATH = os.path.join(CONFIG_DIR, 'encrypted_amis.json')
+INDEX_TTL = 60 * 60 * 24
+
+
+def _make_key(region, source_ami, encryptor_ami, crypto_policy):
+    return '/'.join([region, source_ami, encryptor_ami, crypto_policy])
+
+
+class EncryptedImageIndex(object):
+    """ Maps the region, source AMI, encryptor AMI and crypto policy to
+    the encrypted AMI ID.  The index is loaded from path on first use, and
+    written back each time it changes.  If path is None, the index is only
+    kept in memory.
+    """
+
+    def __init__(self, path=INDEX_PATH, ttl=INDEX_TTL, clock=time):
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = None
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = self._load()
+        return self._entries
+
+    def _load(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                log.warn('Unable to read %s: %s', self.path, e)
+            return {}
+        except ValueError as e:
+            log.warn('Ignoring malformed index %s: %s', self.path, e)
+            return {}
+        if not isinstance(entries, dict):
+            log.warn('Ignoring malformed index %s', self.path)
+            return {}
+        return entries
+
+    def get(self, region, source_ami, encryptor_ami, crypto_policy):
+        """ Return the encrypted AMI ID, or None if there's no entry or
+        the entry has expired.
+        """
+        key = _make_key(region, source_ami, encryptor_ami, crypto_policy)
+        entry = self.entries.get(key)
+        if not entry:
+            return None
+        if self.clock.time() - entry.get('timestamp', 0) > self.ttl:
+            log.debug('Index entry for %s has expired', key)
+            return None
+        return entry.get('image_id')
+
+    def put(self, region, source_ami, encryptor_ami, crypto_policy,
+            image_id):
+        key = _make_key(region, source_ami, encryptor_ami, crypto_policy)
+        self.entries[key] = {
+            'image_id': image_id,
+            'timestamp': self.clock.time()
+        }
+        self.save()
+
+    def remove(self, region, source_ami, encryptor_ami, crypto_policy):
+        key = _make_key(region, source_ami, encryptor_ami, crypto_policy)
+        if self.entries.pop(key, None):
+            self.save()
+
+    def save(self):
+        """ Write the index to disk.  The file is replaced atomically, so
+        that concurrent brkt processes don't see a partial index.
+        """
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory, 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        f = tempfile.NamedTemporaryFile(
+            dir=directory, prefix='.index-', delete=False)
+        try:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+            f.close()
+            os.rename(f.name, self.path)
+        except:
+            try:
+                os.unlink(f.name)
+            except OSError:
+                pass
+            raise
+
+
+def _is_available(aws_svc, image_id):
+    """ Return True if the AMI exists and is available. """
+    try:
+        image = aws_svc.get_image(image_id)
+    except ClientError as e:
+        code, _ = get_code_and_message(e)
+        if code.startswith('InvalidAMIID'):
+            return False
+        raise
+    return image.state == 'available'
+
+
+def find_encrypted_image(aws_svc, source_ami, encryptor_ami, crypto_policy,
+                         index=None):
+    """ Find an AMI in the service's region that was encrypted from
+    source_ami with the given encryptor AMI and crypto policy.  If there's
+    more than one, return the newest.
+
+    :param index the EncryptedImageIndex to check first and update, or
+        None to always search by tags
+    :return the encrypted AMI ID, or None
+    """
+    region = aws_svc.region
+    if index:
+        image_id = index.get(
+            region, source_ami, encryptor_ami, crypto_policy)
+        if image_id:
+            if _is_available(aws_svc, image_id):
+                log.debug('Found %s in the local index', image_id)
+                return image_id
+            log.debug(
+                'Removing %s from the local index, since it is no longer '
+                'available', image_id)
+            index.remove(region, source_ami, encryptor_ami, crypto_policy)
+
+    tags = {
+        TAG_SOURCE_AMI: source_ami,
+        TAG_ENCRYPTOR_AMI: encryptor_ami,
+        TAG_CRYPTO_POLICY: crypto_policy
+    }
+    images = [
+        image for image in aws_svc.get_images(owner_alias='self', tags=tags)
+        if image.state == 'available'
+    ]
+    if not images:
+        return None
+
+    image = max(images, key=lambda i: getattr(i, 'creation_date', None) or '')
+    if index:
+        index.put(region, source_ami, encryptor_ami, crypto_policy, image.id)
+    return image.id
@@ -74,6 +74,19 @@ def add_aws_tag(parser):
     )
 
 
+def add_replicate_region(parser):
+    parser.add_argument(
+        '--replicate-region',
+        metavar='NAME',
+        dest='replicate_regions',
+        action='append',
+        help=(
+            'Copy the new AMI to this region when it is ready.  May be '
+            'specified multiple times.  The copies run concurrently.'
+        )
+    )
+
+
 def add_metavisor_version(parser):
     parser.add_argument(
         '--metavisor-version',
@@ -109,6 +122,18 @@ def add_encryptor_ami(parser):
     )
 
 
+def add_resume(parser):
+    parser.add_argument(
+        '--resume',
+        metavar='SESSION_ID',
+        help=(
+            'Resume an interrupted session from its last completed phase, '
+            'using the journal in ~/.brkt/sessions.  The other arguments '
+            'must match the interrupted command.'
+        )
+    )
+
+
 def add_retry_timeout(parser):
     # Optional arguments for changing the behavior of our retry logic.  We
     # use these options internally, to avoid intermittent AWS service failures
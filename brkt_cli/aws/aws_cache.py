@@ -0,0 +1,91 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Short-lived cache of EC2 resources.
+
+An encryption session looks up the same image, instance and volumes
+several times between state changes.  AWSService keeps the resources
+that it loads in a ResourceCache for a few seconds, so that repeated
+lookups don't each make a describe call.  Entries are invalidated by
+AWSService when it modifies a resource, and by the wait_for_* functions
+in aws_service each time they poll.
+"""
+
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Number of seconds that a resource is cached after it's loaded.
+DEFAULT_TTL = 10.0
+
+
+class ResourceCache(object):
+    """ Caches resources by id.  Since EC2 resource ids have a type
+    prefix (i-, vol-, snap-, ami-, sg-, subnet-), a single cache holds all
+    resource types.  A ttl of 0 disables caching.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, resource_id):
+        """ Return the cached resource, or None if it's not cached or has
+        expired.
+        """
+        with self._lock:
+            entry = self._entries.get(resource_id)
+            if entry:
+                resource, expires = entry
+                if time.time() < expires:
+                    self.hits += 1
+                    return resource
+                del self._entries[resource_id]
+            self.misses += 1
+            return None
+
+    def put(self, resource_id, resource):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[resource_id] = (resource, time.time() + self.ttl)
+
+    def get_or_load(self, resource_id, load):
+        """ Return the cached resource.  If it's not cached, call load()
+        and cache the result, unless it's None.
+        """
+        resource = self.get(resource_id)
+        if resource is None:
+            resource = load()
+            if resource is not None:
+                self.put(resource_id, resource)
+        return resource
+
+    def invalidate(self, *resource_ids):
+        with self._lock:
+            for resource_id in resource_ids:
+                self._entries.pop(resource_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __str__(self):
+        return '%d hits, %d misses' % (self.hits, self.misses)
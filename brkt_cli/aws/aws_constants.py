@@ -46,6 +46,7 @@ NAME_ORIGINAL_SNAPSHOT = 'Bracket encryptor original volume'
 DESCRIPTION_ORIGINAL_SNAPSHOT = \
     'Original unencrypted root volume from %(image_id)s'
 NAME_ENCRYPTED_ROOT_SNAPSHOT = 'Bracket encrypted root volume'
+NAME_ENCRYPTED_DATA_SNAPSHOT = 'Bracket encrypted data volume'
 NAME_METAVISOR_ROOT_SNAPSHOT = 'Bracket system root'
 DESCRIPTION_SNAPSHOT = 'Based on %(image_id)s'
 
@@ -58,6 +59,8 @@ NAME_METAVISOR_ROOT_VOLUME = 'Bracket system root'
 TAG_ENCRYPTOR = 'BrktEncryptor'
 TAG_ENCRYPTOR_SESSION_ID = 'BrktEncryptorSessionID'
 TAG_ENCRYPTOR_AMI = 'BrktEncryptorAMI'
+TAG_SOURCE_AMI = 'BrktSourceAMI'
+TAG_CRYPTO_POLICY = 'BrktCryptoPolicy'
 TAG_DESCRIPTION = 'Description'
 NAME_ENCRYPTED_IMAGE = '%(original_image_name)s %(encrypted_suffix)s'
 NAME_ENCRYPTED_IMAGE_SUFFIX = ' (encrypted %(nonce)s)'
@@ -15,17 +15,23 @@
 import abc
 import logging
 import re
+import socket
 import ssl
 import string
 import tempfile
+import threading
 import time
 from datetime import datetime
 
 import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import (
+    ClientError, ConnectionError as BotoConnectionError, HTTPClientError
+)
 
 from brkt_cli import util
-from brkt_cli.aws import boto3_device, boto3_tag
+from brkt_cli.aws import (
+    aws_cache, boto3_device, boto3_tag, ebs_performance, rate_limiter
+)
 from brkt_cli.aws.aws_constants import (
     NAME_ENCRYPTOR_SECURITY_GROUP,
     DESCRIPTION_ENCRYPTOR_SECURITY_GROUP, NAME_GUEST_CREATOR,
@@ -40,6 +46,14 @@ from brkt_cli.validation import ValidationError
 
 log = logging.getLogger(__name__)
 
+# Seconds to wait for Fast Snapshot Restore to be enabled.
+FAST_SNAPSHOT_RESTORE_TIMEOUT = 600
+
+# Images and snapshots are checked every WAIT_DELAY seconds, up to
+# WAIT_MAX_ATTEMPTS times.  Snapshots of large volumes can take hours.
+WAIT_DELAY = 5
+WAIT_MAX_ATTEMPTS = 6 * 60 * 60 / WAIT_DELAY
+
 EBS_OPTIMIZED_INSTANCES = ['c1.xlarge', 'c3.xlarge', 'c3.2xlarge',
                            'c3.4xlarge', 'c4.large', 'c4.xlarge',
                            'c4.2xlarge', 'c4.4xlarge', 'c4.8xlarge',
@@ -63,6 +77,17 @@ class BaseAWSService(object):
     def __init__(self, session_id):
         self.session_id = session_id
 
+        # An optional aws_waiter.ResourceWaiter.  When set, the wait_for_*
+        # functions in this module poll through it, so that waits from
+        # concurrent sessions are batched into a single describe call.
+        self.waiter = None
+
+    def clone(self):
+        """ Return a service with the same session, region, tags and
+        waiter, for use from another thread.
+        """
+        return self
+
     @abc.abstractmethod
     def get_regions(self):
         pass
@@ -90,14 +115,47 @@ class BaseAWSService(object):
     def get_instance(self, instance_id, retry=True):
         pass
 
+    @abc.abstractmethod
+    def get_instances(self, *instance_ids):
+        """ Return the instances with the given ids.  Instances that
+        are not visible yet are omitted.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_instances_by_tags(self, tags):
+        """ Return the instances that have all of the given tags, and
+        haven't been terminated.
+
+        :param tags a dictionary of tag keys and values
+        """
+        pass
+
     @abc.abstractmethod
     def create_tags(self, resource_id, name=None, description=None):
+        """ Apply the default tags, and the optional Name and Description
+        tags, to a resource.  resource_id can also be a list of ids, which
+        are all tagged with a single request.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_tagged_resources(self, tag_key):
+        """ Return all resources in the region that have a tag with the
+        given key, as a list of dictionaries with the ResourceId,
+        ResourceType and Value keys.
+        """
         pass
 
     @abc.abstractmethod
     def stop_instance(self, instance_id):
         pass
 
+    @abc.abstractmethod
+    def stop_instances(self, *instance_ids):
+        """ Stop the given instances with a single request. """
+        pass
+
     @abc.abstractmethod
     def start_instance(self, instance_id):
         pass
@@ -106,6 +164,11 @@ class BaseAWSService(object):
     def terminate_instance(self, instance_id):
         pass
 
+    @abc.abstractmethod
+    def terminate_instances(self, *instance_ids):
+        """ Terminate the given instances with a single request. """
+        pass
+
     @abc.abstractmethod
     def get_volume(self, volume_id):
         pass
@@ -115,11 +178,14 @@ class BaseAWSService(object):
         pass
 
     @abc.abstractmethod
-    def get_volumes(self, tag_key=None, tag_value=None):
+    def get_volumes(self, tag_key=None, tag_value=None, volume_ids=None):
         pass
 
     @abc.abstractmethod
     def get_snapshots(self, *snapshot_ids):
+        """ Return the snapshots with the given ids.  Snapshots that
+        are not visible yet are omitted.
+        """
         pass
 
     @abc.abstractmethod
@@ -151,13 +217,22 @@ class BaseAWSService(object):
         pass
 
     @abc.abstractmethod
-    def get_images(self, name=None, owner_alias=None, product_code=None):
+    def get_images(self, name=None, owner_alias=None, product_code=None,
+                   image_ids=None, tags=None):
+        """ Return the images that match all of the given filters.
+
+        :param tags: a dictionary of tag keys and values
+        """
         pass
 
     @abc.abstractmethod
     def delete_snapshot(self, snapshot_id):
         pass
 
+    @abc.abstractmethod
+    def deregister_image(self, image_id):
+        pass
+
     @abc.abstractmethod
     def create_security_group(self, name, description, vpc_id=None):
         pass
@@ -194,6 +269,25 @@ class BaseAWSService(object):
                      block_device_mapping=None):
         pass
 
+    @abc.abstractmethod
+    def register_image(self,
+                       block_device_mappings,
+                       name=None,
+                       description=None,
+                       root_device_name='/dev/sda1',
+                       ena_support=None,
+                       sriov_net_support=None):
+        pass
+
+    @abc.abstractmethod
+    def copy_image(self, source_region, source_image_id, name,
+                   description=None):
+        """ Copy an image from another region to this service's region.
+
+        :return: the id of the new image
+        """
+        pass
+
     @abc.abstractmethod
     def detach_volume(self, vol_id, instance_id, force=True):
         pass
@@ -211,6 +305,22 @@ class BaseAWSService(object):
                                   value, dry_run=False):
         pass
 
+    @abc.abstractmethod
+    def enable_fast_snapshot_restore(self, snapshot_id, zone):
+        pass
+
+    @abc.abstractmethod
+    def disable_fast_snapshot_restore(self, snapshot_id, zone):
+        pass
+
+    @abc.abstractmethod
+    def get_fast_snapshot_restore_state(self, snapshot_id, zone):
+        """ Return the Fast Snapshot Restore state of the snapshot in the
+        given zone (enabling, optimizing, enabled, disabling or disabled),
+        or None if it was never enabled.
+        """
+        pass
+
     @abc.abstractmethod
     def retry(self, function, error_code_regexp=None, timeout=None):
         pass
@@ -233,6 +343,9 @@ class BotoRetryExceptionChecker(util.RetryExceptionChecker):
         if error_code == '503':
             # This can happen when the AWS request limit has been exceeded.
             return True
+        if error_code in rate_limiter.THROTTLING_ERROR_CODES:
+            # The rate limiter has already lowered the request rate.
+            return True
 
         if self.error_code_regexp:
             m = re.match(self.error_code_regexp, error_code)
@@ -254,6 +367,26 @@ def retry_boto(function, error_code_regexp=None, timeout=10.0,
     )
 
 
+# AWS error codes for server-side failures that usually go away on their
+# own.
+TRANSIENT_ERROR_CODES = ('InternalError', 'ServiceUnavailable', 'Unavailable')
+
+
+def is_transient_error(exception):
+    """ Return True if the exception is a network error, or an AWS error
+    that is likely to go away if the same call is made later, such as
+    throttling after the retries have run out.
+    """
+    if isinstance(exception,
+                  (socket.error, BotoConnectionError, HTTPClientError)):
+        return True
+    if isinstance(exception, ClientError):
+        error_code, _ = get_code_and_message(exception)
+        if error_code in TRANSIENT_ERROR_CODES:
+            return True
+    return BotoRetryExceptionChecker().is_expected(exception)
+
+
 class AWSService(BaseAWSService):
 
     def __init__(
@@ -261,10 +394,19 @@ class AWSService(BaseAWSService):
             encryptor_session_id,
             default_tags=None,
             retry_timeout=10.0,
-            retry_initial_sleep_seconds=0.25):
+            retry_initial_sleep_seconds=0.25,
+            cache_ttl=aws_cache.DEFAULT_TTL,
+            limiter=None,
+            boto_session=None):
+        """ :param limiter: the RateLimiter for EC2 calls.  By default,
+            all AWSService objects share the same RateLimiter.
+        :param boto_session: the boto3 Session that creates the EC2 client
+            and resource, or None for the default session
+        """
         super(AWSService, self).__init__(encryptor_session_id)
 
         self.default_tags = default_tags or {}
+        self.cache = aws_cache.ResourceCache(ttl=cache_ttl)
         self.retry_timeout = retry_timeout
         self.retry_initial_sleep_seconds = retry_initial_sleep_seconds
 
@@ -272,9 +414,31 @@ class AWSService(BaseAWSService):
         self.key_name = None
         self.region = None
 
+        self.limiter = limiter or rate_limiter.get_default()
+        self.boto_session = boto_session or boto3
         self.ec2 = None
         # Hardcode us-east-1 for the purpose of getting the list of regions.
-        self.ec2client = boto3.client('ec2', region_name='us-east-1')
+        self.ec2client = self.boto_session.client(
+            'ec2', region_name='us-east-1')
+        self.limiter.install(self.ec2client)
+
+    def clone(self):
+        """ Return a new AWSService with its own boto3 session, client and
+        resource, since boto3 resources can't be shared between threads.
+        The cache, rate limiter and waiter are shared.
+        """
+        svc = AWSService(
+            self.session_id,
+            default_tags=dict(self.default_tags),
+            retry_timeout=self.retry_timeout,
+            retry_initial_sleep_seconds=self.retry_initial_sleep_seconds,
+            limiter=self.limiter,
+            boto_session=boto3.session.Session())
+        svc.cache = self.cache
+        svc.waiter = self.waiter
+        if self.region:
+            svc.connect(self.region, key_name=self.key_name)
+        return svc
 
     def get_regions(self):
         """ Return the available regions as a list of RegionInfo. """
@@ -287,8 +451,10 @@ class AWSService(BaseAWSService):
     def connect(self, region, key_name=None):
         self.region = region
         self.key_name = key_name
-        self.ec2 = boto3.resource('ec2', region_name=region)
-        self.ec2client = boto3.client('ec2', region_name=region)
+        self.ec2 = self.boto_session.resource('ec2', region_name=region)
+        self.ec2client = self.boto_session.client('ec2', region_name=region)
+        self.limiter.install(self.ec2.meta.client)
+        self.limiter.install(self.ec2client)
 
     def retry(self, function, error_code_regexp=None, timeout=None):
         """ Call the retry_boto function with this object's timeout and
@@ -340,6 +506,15 @@ class AWSService(BaseAWSService):
             if self.key_name:
                 kwargs['KeyName'] = self.key_name
 
+            # Tag the instance and its volumes when they're created, instead
+            # of making separate CreateTags calls.
+            tag_specs = self._make_tag_specifications(
+                instance=self._get_tags(name=name, description=description),
+                volume=self._get_tags()
+            )
+            if tag_specs:
+                kwargs['TagSpecifications'] = tag_specs
+
             if log.isEnabledFor(logging.DEBUG):
                 # User-data is long and can have binary content.
                 kwargs_for_log = dict(kwargs)
@@ -353,8 +528,6 @@ class AWSService(BaseAWSService):
             response = run_instances(**kwargs)
             instance_id = response['Instances'][0]['InstanceId']
             log.info('Launched %s based on %s', instance_id, image_id)
-
-            self.create_tags(instance_id, name=name, description=description)
             return self.get_instance(instance_id)
         except:
             if instance_id:
@@ -362,67 +535,157 @@ class AWSService(BaseAWSService):
             raise
 
     def get_instance(self, instance_id, retry=True):
-        instance = self.ec2.Instance(instance_id)
-        load = instance.load
-        if retry:
-            load = self.retry(
-                instance.load, r'InvalidInstanceID\.NotFound')
-        load()
-        return instance
+        def _load():
+            instance = self.ec2.Instance(instance_id)
+            load = instance.load
+            if retry:
+                load = self.retry(
+                    instance.load, r'InvalidInstanceID\.NotFound')
+            load()
+            return instance
+        return self.cache.get_or_load(instance_id, _load)
+
+    def get_instances(self, *instance_ids):
+        filters = [{'Name': 'instance-id', 'Values': list(instance_ids)}]
+
+        def _get_instances():
+            return list(self.ec2.instances.filter(Filters=filters))
+        return self._cache_all(self.retry(_get_instances)())
+
+    def get_instances_by_tags(self, tags):
+        filters = [
+            {'Name': 'tag:%s' % key, 'Values': [value]}
+            for key, value in sorted(tags.iteritems())
+        ]
+        filters.append({
+            'Name': 'instance-state-name',
+            'Values': ['pending', 'running', 'stopping', 'stopped']
+        })
+
+        def _get_instances():
+            return list(self.ec2.instances.filter(Filters=filters))
+        return self._cache_all(self.retry(_get_instances)())
+
+    def _cache_all(self, resources):
+        """ Cache the resources returned by a describe call, so that
+        subsequent lookups by id see the latest state.
+        """
+        for r in resources:
+            self.cache.put(r.id, r)
+        return resources
 
-    def create_tags(self, resource_id, name=None, description=None):
+    def _get_tags(self, name=None, description=None):
         d = dict(self.default_tags)
         if name:
             d['Name'] = name
         if description:
             d['Description'] = description
+        return d
+
+    def _make_tag_specifications(self, **tags_by_resource_type):
+        """ Return the TagSpecifications parameter for a create call.
+
+        :param tags_by_resource_type: a dictionary of tags for each resource
+            type, with underscores in place of dashes (security_group)
+        :return a list of tag specifications, or None if there are no tags
+        """
+        specs = [
+            {
+                'ResourceType': resource_type.replace('_', '-'),
+                'Tags': boto3_tag.dict_to_tags(d)
+            }
+            for resource_type, d in sorted(tags_by_resource_type.items())
+            if d
+        ]
+        return specs or None
+
+    def create_tags(self, resource_id, name=None, description=None):
+        if isinstance(resource_id, basestring):
+            resource_ids = [resource_id]
+        else:
+            resource_ids = list(resource_id)
+        d = self._get_tags(name=name, description=description)
         if not d:
-            log.debug('Not tagging %s.  No tags were specified.', resource_id)
+            log.debug(
+                'Not tagging %s.  No tags were specified.',
+                ', '.join(resource_ids)
+            )
             return
 
         log.debug(
-            'Tagging %s with %s', resource_id, pretty_print_json(d))
+            'Tagging %s with %s', ', '.join(resource_ids),
+            pretty_print_json(d)
+        )
+        self.cache.invalidate(*resource_ids)
         create_tags = self.retry(self.ec2client.create_tags, r'.*\.NotFound')
         create_tags(
-            Resources=[resource_id],
+            Resources=resource_ids,
             Tags=boto3_tag.dict_to_tags(d)
         )
 
+    def get_tagged_resources(self, tag_key):
+        filters = [{'Name': 'key', 'Values': [tag_key]}]
+
+        def _describe_tags():
+            paginator = self.ec2client.get_paginator('describe_tags')
+            tags = []
+            for page in paginator.paginate(Filters=filters):
+                tags.extend(page['Tags'])
+            return tags
+        return self.retry(_describe_tags)()
+
     def stop_instance(self, instance_id):
         log.info('Stopping %s', instance_id)
+        self.cache.invalidate(instance_id)
         stop_instances = self.retry(self.ec2client.stop_instances)
         stop_instances(InstanceIds=[instance_id])
 
+    def stop_instances(self, *instance_ids):
+        log.info('Stopping %s', ', '.join(instance_ids))
+        self.cache.invalidate(*instance_ids)
+        stop_instances = self.retry(self.ec2client.stop_instances)
+        stop_instances(InstanceIds=list(instance_ids))
+
     def start_instance(self, instance_id):
         log.info('Starting %s', instance_id)
+        self.cache.invalidate(instance_id)
         self.ec2client.start_instances(InstanceIds=[instance_id])
         return self.get_instance(instance_id)
 
     def terminate_instance(self, instance_id):
         log.info('Terminating %s', instance_id)
+        self.cache.invalidate(instance_id)
         terminate_instances = self.retry(self.ec2client.terminate_instances)
         terminate_instances(InstanceIds=[instance_id])
 
+    def terminate_instances(self, *instance_ids):
+        log.info('Terminating %s', ', '.join(instance_ids))
+        self.cache.invalidate(*instance_ids)
+        terminate_instances = self.retry(self.ec2client.terminate_instances)
+        terminate_instances(InstanceIds=list(instance_ids))
+
     def get_volume(self, volume_id):
-        volume = self.ec2.Volume(volume_id)
-        load = self.retry(
-            volume.load, r'InvalidVolume\.NotFound')
-        load()
-        return volume
+        def _load():
+            volume = self.ec2.Volume(volume_id)
+            load = self.retry(
+                volume.load, r'InvalidVolume\.NotFound')
+            load()
+            return volume
+        return self.cache.get_or_load(volume_id, _load)
 
-    def get_volumes(self, tag_key=None, tag_value=None):
+    def get_volumes(self, tag_key=None, tag_value=None, volume_ids=None):
         filters = list()
         if tag_key and tag_value:
-            filters = [{'Name': 'tag:%s' % tag_key, 'Values': [tag_value]}]
+            filters.append(
+                {'Name': 'tag:%s' % tag_key, 'Values': [tag_value]})
+        if volume_ids:
+            filters.append({'Name': 'volume-id', 'Values': list(volume_ids)})
 
-        f = self.retry(
-            self.ec2.volumes.filter, r'InvalidVolume\.NotFound')
-        volumes = f(Filters=filters)
-
-        for volume in volumes:
-            load = self.retry(volume.load, r'InvalidVolume\.NotFound')
-            load()
-        return list(volumes)
+        # The describe response already contains the volume attributes,
+        # so there's no need to load() each volume.
+        def _get_volumes():
+            return list(self.ec2.volumes.filter(Filters=filters))
+        return self._cache_all(self.retry(_get_volumes)())
 
     def iam_role_exists(self, role):
         try:
@@ -437,19 +700,21 @@ class AWSService(BaseAWSService):
         return True
 
     def get_snapshots(self, *snapshot_ids):
-        f = self.retry(
-            self.ec2.snapshots.filter, r'InvalidSnapshot\.NotFound')
-        snapshots = f(SnapshotIds=snapshot_ids)
-        for snapshot in snapshots:
-            load = self.retry(snapshot.load, r'InvalidSnapshot\.NotFound')
-            load()
-        return list(snapshots)
+        # Filter by id instead of passing SnapshotIds, so that a snapshot
+        # that isn't visible yet doesn't fail the whole call.
+        filters = [{'Name': 'snapshot-id', 'Values': list(snapshot_ids)}]
+
+        def _get_snapshots():
+            return list(self.ec2.snapshots.filter(Filters=filters))
+        return self._cache_all(self.retry(_get_snapshots)())
 
     def get_snapshot(self, snapshot_id):
-        snapshot = self.ec2.Snapshot(snapshot_id)
-        load = self.retry(snapshot.load, r'InvalidSnapshot\.NotFound')
-        load()
-        return snapshot
+        def _load():
+            snapshot = self.ec2.Snapshot(snapshot_id)
+            load = self.retry(snapshot.load, r'InvalidSnapshot\.NotFound')
+            load()
+            return snapshot
+        return self.cache.get_or_load(snapshot_id, _load)
 
     def create_snapshot(self, volume_id, name=None, description=None):
         create_snapshot = self.retry(self.ec2client.create_snapshot)
@@ -458,12 +723,15 @@ class AWSService(BaseAWSService):
         }
         if description:
             kwargs['Description'] = description
+        tag_specs = self._make_tag_specifications(
+            snapshot=self._get_tags(name=name))
+        if tag_specs:
+            kwargs['TagSpecifications'] = tag_specs
         snapshot_id = None
         try:
             response = create_snapshot(**kwargs)
             snapshot_id = response['SnapshotId']
             log.info('Creating %s based on %s', snapshot_id, volume_id)
-            self.create_tags(snapshot_id, name=name)
             return self.get_snapshot(snapshot_id)
         except:
             if snapshot_id:
@@ -488,6 +756,9 @@ class AWSService(BaseAWSService):
             kwargs['VolumeType'] = volume_type
         if encrypted:
             kwargs['Encrypted'] = encrypted
+        tag_specs = self._make_tag_specifications(volume=self._get_tags())
+        if tag_specs:
+            kwargs['TagSpecifications'] = tag_specs
 
         log.debug('Volume properties: %s', pretty_print_json(kwargs))
         volume_id = None
@@ -496,7 +767,6 @@ class AWSService(BaseAWSService):
             response = create_volume(**kwargs)
             volume_id = response['VolumeId']
             log.info('Creating %s based on %s', volume_id, snapshot_id)
-            self.create_tags(volume_id)
             return self.get_volume(volume_id)
         except:
             if volume_id:
@@ -505,6 +775,7 @@ class AWSService(BaseAWSService):
 
     def delete_volume(self, volume_id):
         log.info('Deleting %s', volume_id)
+        self.cache.invalidate(volume_id)
         try:
             delete_volume = self.retry(
                 self.ec2client.delete_volume, r'VolumeInUse')
@@ -516,40 +787,52 @@ class AWSService(BaseAWSService):
 
         return True
 
-    def get_images(self, name=None, owner_alias=None, product_code=None):
+    def get_images(self, name=None, owner_alias=None, product_code=None,
+                   image_ids=None, tags=None):
         filters = list()
         owners = []
         if name:
             filters.append({'Name': 'name', 'Values': [name]})
+        for key, value in (tags or {}).iteritems():
+            filters.append({'Name': 'tag:%s' % key, 'Values': [value]})
         if product_code:
             filters.append({'Name': 'product-code', 'Values': [product_code]})
+        if image_ids:
+            filters.append({'Name': 'image-id', 'Values': list(image_ids)})
         if owner_alias:
             owners.append(owner_alias)
 
         images = self.ec2.images.filter(Owners=owners, Filters=filters)
-        for image in images:
-            image.load()
-        return list(images)
+        return self._cache_all(list(images))
 
     def get_image(self, image_id, retry=False):
-        image = self.ec2.Image(image_id)
-        load = image.load
-        if retry:
-            load = self.retry(
-                image.load, r'InvalidAMIID\.NotFound')
+        def _load():
+            image = self.ec2.Image(image_id)
+            load = image.load
+            if retry:
+                load = self.retry(
+                    image.load, r'InvalidAMIID\.NotFound')
 
-        load()
-        try:
-            image.name
-        except AttributeError:
-            return None
+            load()
+            try:
+                image.name
+            except AttributeError:
+                return None
 
-        return image
+            return image
+        return self.cache.get_or_load(image_id, _load)
 
     def delete_snapshot(self, snapshot_id):
+        self.cache.invalidate(snapshot_id)
         delete_snapshot = self.retry(self.ec2client.delete_snapshot)
         return delete_snapshot(SnapshotId=snapshot_id)
 
+    def deregister_image(self, image_id):
+        log.info('Deregistering %s', image_id)
+        self.cache.invalidate(image_id)
+        deregister_image = self.retry(self.ec2client.deregister_image)
+        deregister_image(ImageId=image_id)
+
     def create_security_group(self, name, description, vpc_id=None):
         kwargs = {
             'Description': description,
@@ -557,6 +840,12 @@ class AWSService(BaseAWSService):
         }
         if vpc_id:
             kwargs['VpcId'] = vpc_id
+        tag_specs = self._make_tag_specifications(
+            security_group=self._get_tags(
+                name=name, description=description)
+        )
+        if tag_specs:
+            kwargs['TagSpecifications'] = tag_specs
 
         create_security_group = self.retry(
             self.ec2client.create_security_group)
@@ -574,17 +863,20 @@ class AWSService(BaseAWSService):
             raise
 
     def get_security_group(self, sg_id, retry=True):
-        sg = self.ec2.SecurityGroup(sg_id)
-        load = sg.load
-        if retry:
-            load = self.retry(
-                sg.load, r'InvalidGroup\.NotFound')
+        def _load():
+            sg = self.ec2.SecurityGroup(sg_id)
+            load = sg.load
+            if retry:
+                load = self.retry(
+                    sg.load, r'InvalidGroup\.NotFound')
 
-        load()
-        return sg
+            load()
+            return sg
+        return self.cache.get_or_load(sg_id, _load)
 
     def authorize_security_group_ingress(self, sg_id, port):
         log.info('Authorizing ingress to %s on port %d', sg_id, port)
+        self.cache.invalidate(sg_id)
         authorize = self.retry(
             self.ec2client.authorize_security_group_ingress)
         authorize(
@@ -597,6 +889,7 @@ class AWSService(BaseAWSService):
 
     def delete_security_group(self, sg_id):
         log.info('Deleting %s', sg_id)
+        self.cache.invalidate(sg_id)
         delete_security_group = self.retry(
             self.ec2client.delete_security_group,
             r'InvalidGroup\.InUse|DependencyViolation'
@@ -618,10 +911,12 @@ class AWSService(BaseAWSService):
             return None
 
     def get_subnet(self, subnet_id):
-        subnet = self.ec2.Subnet(subnet_id)
-        load = self.retry(subnet.load)
-        load()
-        return subnet
+        def _load():
+            subnet = self.ec2.Subnet(subnet_id)
+            load = self.retry(subnet.load)
+            load()
+            return subnet
+        return self.cache.get_or_load(subnet_id, _load)
 
     def create_image(self,
                      instance_id,
@@ -645,15 +940,77 @@ class AWSService(BaseAWSService):
             kwargs['NoReboot'] = no_reboot
         if block_device_mappings:
             kwargs['BlockDeviceMappings'] = block_device_mappings
+        tag_specs = self._make_tag_specifications(
+            image=self._get_tags(),
+            snapshot=self._get_tags()
+        )
+        if tag_specs:
+            kwargs['TagSpecifications'] = tag_specs
 
         response = create_image(**kwargs)
         image_id = response['ImageId']
         log.info('Creating %s based on %s', image_id, instance_id)
-        self.create_tags(image_id)
         return self.get_image(image_id)
 
+    def register_image(self,
+                       block_device_mappings,
+                       name=None,
+                       description=None,
+                       root_device_name='/dev/sda1',
+                       ena_support=None,
+                       sriov_net_support=None):
+        """ Register a new HVM image based on the snapshots referenced by
+        the given block device mappings.
+
+        :return: the image id
+        """
+        register_image = self.retry(
+            self.ec2client.register_image, r'InvalidSnapshot\.NotFound')
+        kwargs = {
+            'Name': name,
+            'Architecture': 'x86_64',
+            'VirtualizationType': 'hvm',
+            'RootDeviceName': root_device_name,
+            'BlockDeviceMappings': block_device_mappings
+        }
+        if description:
+            kwargs['Description'] = description
+        if ena_support is not None:
+            kwargs['EnaSupport'] = ena_support
+        if sriov_net_support:
+            kwargs['SriovNetSupport'] = sriov_net_support
+
+        log.debug('Registering image: %s', pretty_print_json(kwargs))
+        response = register_image(**kwargs)
+        image_id = response['ImageId']
+        log.info('Registered %s', image_id)
+
+        # RegisterImage doesn't support TagSpecifications.
+        self.create_tags(image_id)
+        return image_id
+
+    def copy_image(self, source_region, source_image_id, name,
+                   description=None):
+        copy_image = self.retry(self.ec2client.copy_image)
+        kwargs = {
+            'SourceRegion': source_region,
+            'SourceImageId': source_image_id,
+            'Name': name
+        }
+        if description:
+            kwargs['Description'] = description
+        response = copy_image(**kwargs)
+        image_id = response['ImageId']
+        log.info(
+            'Copying %s from %s to %s as %s',
+            source_image_id, source_region, self.region, image_id
+        )
+        self.create_tags(image_id)
+        return image_id
+
     def detach_volume(self, vol_id, instance_id, force=True):
         log.info('Detaching %s from %s', vol_id, instance_id)
+        self.cache.invalidate(vol_id, instance_id)
         detach_volume = self.retry(self.ec2client.detach_volume)
         kwargs = {
             'VolumeId': vol_id
@@ -669,6 +1026,7 @@ class AWSService(BaseAWSService):
     def attach_volume(self, vol_id, instance_id, device_name):
         log.info(
             'Attaching %s to %s at %s', vol_id, instance_id, device_name)
+        self.cache.invalidate(vol_id, instance_id)
         attach_volume = self.retry(
             self.ec2client.attach_volume, r'VolumeInUse')
         response = attach_volume(
@@ -692,6 +1050,7 @@ class AWSService(BaseAWSService):
                                   value, dry_run=False):
         modify_instance_attribute = self.retry(
             self.ec2client.modify_instance_attribute)
+        self.cache.invalidate(instance_id)
 
         if attribute == 'userData':
             log.info(
@@ -717,6 +1076,46 @@ class AWSService(BaseAWSService):
                 Value=value
             )
 
+    def enable_fast_snapshot_restore(self, snapshot_id, zone):
+        log.info(
+            'Enabling Fast Snapshot Restore for %s in %s', snapshot_id, zone)
+        enable = self.retry(self.ec2client.enable_fast_snapshot_restores)
+        response = enable(
+            AvailabilityZones=[zone], SourceSnapshotIds=[snapshot_id])
+        _raise_fast_snapshot_restore_error(response)
+
+    def disable_fast_snapshot_restore(self, snapshot_id, zone):
+        log.info(
+            'Disabling Fast Snapshot Restore for %s in %s', snapshot_id, zone)
+        disable = self.retry(self.ec2client.disable_fast_snapshot_restores)
+        response = disable(
+            AvailabilityZones=[zone], SourceSnapshotIds=[snapshot_id])
+        _raise_fast_snapshot_restore_error(response)
+
+    def get_fast_snapshot_restore_state(self, snapshot_id, zone):
+        describe = self.retry(
+            self.ec2client.describe_fast_snapshot_restores)
+        response = describe(Filters=[
+            {'Name': 'snapshot-id', 'Values': [snapshot_id]},
+            {'Name': 'availability-zone', 'Values': [zone]}
+        ])
+        for fsr in response.get('FastSnapshotRestores', []):
+            return fsr['State']
+        return None
+
+
+def _raise_fast_snapshot_restore_error(response):
+    """ The Fast Snapshot Restore calls report errors in the response,
+    instead of failing the call.
+    """
+    for item in response.get('Unsuccessful', []):
+        for error in item.get('FastSnapshotRestoreStateErrors', []):
+            raise BracketError(
+                'Unable to change Fast Snapshot Restore for %s in %s: %s' %
+                (item.get('SnapshotId'), error.get('AvailabilityZone'),
+                 error.get('Error', {}).get('Message'))
+            )
+
 
 def validate_image_name(name):
     """ Verify that the name is a valid EC2 image name.  Return the name
@@ -775,6 +1174,20 @@ class VolumeError(BracketError):
     pass
 
 
+def _get_waiter(aws_svc):
+    # Some callers pass in objects that don't extend BaseAWSService.
+    return getattr(aws_svc, 'waiter', None)
+
+
+def _invalidate(aws_svc, *resource_ids):
+    """ Remove the resources from the service's cache, so that the next
+    lookup returns the current state.
+    """
+    cache = getattr(aws_svc, 'cache', None)
+    if cache:
+        cache.invalidate(*resource_ids)
+
+
 def wait_for_volume(aws_svc, volume_id, timeout=600.0, state='available'):
     """ Wait for the volume to be in the specified state.
 
@@ -783,10 +1196,17 @@ def wait_for_volume(aws_svc, volume_id, timeout=600.0, state='available'):
     """
     log.info('Waiting for %s to be in the %s state', volume_id, state)
     log.debug('timeout=%.02f', timeout)
+    waiter = _get_waiter(aws_svc)
+    if waiter:
+        volume = waiter.wait_for_volume(
+            volume_id, timeout=timeout, state=state)
+        _invalidate(aws_svc, volume_id)
+        return volume
 
     deadline = Deadline(timeout)
     sleep_time = 0.5
     while not deadline.is_expired():
+        _invalidate(aws_svc, volume_id)
         volume = aws_svc.get_volume(volume_id)
         log.debug('Volume %s state=%s', volume.id, volume.state)
         if volume.state == state:
@@ -807,6 +1227,27 @@ class InstanceError(BracketError):
     pass
 
 
+def check_instance_state(instance, state):
+    """ Return True if the instance is in the given state.
+
+    :raises InstanceError if the instance is in an error state or was
+        unexpectedly terminated
+    """
+    log.debug('Instance %s state=%s', instance.id, instance.state['Name'])
+    if instance.state['Name'] == state:
+        return True
+    if instance.state['Name'] == 'error':
+        raise InstanceError(
+            'Instance %s is in an error state.  Cannot proceed.' %
+            instance.id
+        )
+    if state != 'terminated' and instance.state['Name'] == 'terminated':
+        raise InstanceError(
+            'Instance %s was unexpectedly terminated.' % instance.id
+        )
+    return False
+
+
 def wait_for_instance(
         aws_svc, instance_id, timeout=600, state='running'):
     """ Wait for up to timeout seconds for an instance to be in the
@@ -821,21 +1262,19 @@ def wait_for_instance(
         'Waiting for %s, timeout=%d, state=%s',
         instance_id, timeout, state)
 
+    waiter = _get_waiter(aws_svc)
+    if waiter:
+        instance = waiter.wait_for_instance(
+            instance_id, timeout=timeout, state=state)
+        _invalidate(aws_svc, instance_id)
+        return instance
+
     deadline = Deadline(timeout)
     while not deadline.is_expired():
+        _invalidate(aws_svc, instance_id)
         instance = aws_svc.get_instance(instance_id)
-        log.debug('Instance %s state=%s', instance.id, instance.state['Name'])
-        if instance.state['Name'] == state:
+        if check_instance_state(instance, state):
             return instance
-        if instance.state['Name'] == 'error':
-            raise InstanceError(
-                'Instance %s is in an error state.  Cannot proceed.' %
-                instance_id
-            )
-        if state != 'terminated' and instance.state['Name'] == 'terminated':
-            raise InstanceError(
-                'Instance %s was unexpectedly terminated.' % instance_id
-            )
         sleep(2)
     raise InstanceError(
         'Timed out waiting for %s to be in the %s state' %
@@ -855,20 +1294,128 @@ def stop_and_wait(aws_svc, instance_id):
             'Error while waiting for instance %s to stop', instance_id)
 
 
+def check_image_state(image):
+    """ Return True if the image is available.
+
+    :raises BracketError if the image is in the failed state
+    """
+    log.debug('%s: %s', image.id, image.state)
+    if image.state == 'failed':
+        raise BracketError('Image state became failed')
+    return image.state == 'available'
+
+
 def wait_for_image(aws_svc, image_id):
-    # Wait indefinitely for the image to become available
-    while True:
+    """ Wait for up to WAIT_MAX_ATTEMPTS * WAIT_DELAY seconds for the image
+    to become available.
+
+    :return the Image object
+    :raise BracketError if the image goes into the failed state or the
+        timeout is exceeded
+    """
+    timeout = WAIT_MAX_ATTEMPTS * WAIT_DELAY
+    waiter = _get_waiter(aws_svc)
+    if waiter:
+        image = waiter.wait_for_image(image_id, timeout=timeout)
+        _invalidate(aws_svc, image_id)
+        return image
+
+    deadline = Deadline(timeout)
+    while not deadline.is_expired():
         log.debug('Waiting for %s to become available.', image_id)
 
         # Log the above every 5 minutes
-        for i in range(60):
-            sleep(5)
+        for i in range(300 / WAIT_DELAY):
+            sleep(WAIT_DELAY)
+            _invalidate(aws_svc, image_id)
             image = aws_svc.get_image(image_id)
-            log.debug('%s: %s', image.id, image.state)
-            if image.state == 'available':
+            if check_image_state(image):
                 return image
-            if image.state == 'failed':
-                raise BracketError('Image state became failed')
+            if deadline.is_expired():
+                break
+    raise BracketError(
+        'Timed out waiting for %s to become available' % image_id)
+
+
+def enable_fast_snapshot_restore(aws_svc, snapshot_id, zone,
+                                 timeout=FAST_SNAPSHOT_RESTORE_TIMEOUT):
+    """ Enable Fast Snapshot Restore for the snapshot in the given zone,
+    and wait for it to be enabled.  Volumes created from the snapshot are
+    then fully initialized, instead of loading blocks from S3 on first
+    access.  If Fast Snapshot Restore can't be enabled, or isn't enabled
+    before the timeout, log a warning and continue.
+
+    If Fast Snapshot Restore is already enabled, for example because the
+    owner of the snapshot enabled it, leave it alone.
+
+    :return True if this call enabled Fast Snapshot Restore, and it must
+        be disabled when the snapshot is no longer needed.  This includes
+        the case where it's still optimizing after the timeout, since it's
+        billed from the time that it's enabled.
+    """
+    try:
+        state = aws_svc.get_fast_snapshot_restore_state(snapshot_id, zone)
+    except ClientError as e:
+        log.warn(
+            'Unable to get the Fast Snapshot Restore state of %s: %s.  '
+            'Continuing without it.', snapshot_id, e
+        )
+        return False
+    if state in ('enabling', 'optimizing', 'enabled'):
+        log.info(
+            'Fast Snapshot Restore is already %s for %s in %s.  It will not '
+            'be disabled.', state, snapshot_id, zone
+        )
+        return False
+
+    try:
+        aws_svc.enable_fast_snapshot_restore(snapshot_id, zone)
+    except (ClientError, BracketError) as e:
+        log.warn(
+            'Unable to enable Fast Snapshot Restore for %s: %s.  '
+            'Continuing without it.', snapshot_id, e
+        )
+        return False
+
+    deadline = Deadline(timeout)
+    state = None
+    while not deadline.is_expired():
+        state = aws_svc.get_fast_snapshot_restore_state(snapshot_id, zone)
+        log.debug('Fast Snapshot Restore for %s: %s', snapshot_id, state)
+        if state == 'enabled':
+            log.info(
+                'Fast Snapshot Restore is enabled for %s in %s',
+                snapshot_id, zone
+            )
+            return True
+        if state in (None, 'disabling', 'disabled'):
+            log.warn(
+                'Fast Snapshot Restore for %s is %s.  Continuing without it.',
+                snapshot_id, state
+            )
+            return False
+        sleep(10)
+
+    # Volumes created in the optimizing state get some of the benefit.
+    # Return True, so that the caller disables it when it's done.
+    log.warn(
+        'Fast Snapshot Restore for %s is still %s after %d seconds.  '
+        'Continuing.', snapshot_id, state, timeout
+    )
+    return True
+
+
+def disable_fast_snapshot_restore(aws_svc, snapshot_id, zone):
+    """ Disable Fast Snapshot Restore.  Log a warning on failure, since
+    Fast Snapshot Restore is billed for as long as it's enabled.
+    """
+    try:
+        aws_svc.disable_fast_snapshot_restore(snapshot_id, zone)
+    except Exception as e:
+        log.warn(
+            'Unable to disable Fast Snapshot Restore for %s in %s: %s',
+            snapshot_id, zone, e
+        )
 
 
 def create_encryptor_security_group(aws_svc, vpc_id=None, status_port=80):
@@ -886,16 +1433,16 @@ def create_encryptor_security_group(aws_svc, vpc_id=None, status_port=80):
             log.warn('Failed deleting temporary security group: %s', e2)
         raise
 
-    aws_svc.create_tags(sg.id)
     return sg
 
 
 def run_guest_instance(aws_svc, image_id, subnet_id=None,
-                       instance_type='m4.large'):
+                       instance_type='m4.large', block_device_mappings=None):
     return aws_svc.run_instance(
         image_id,
         subnet_id=subnet_id,
         instance_type=instance_type,
+        block_device_mappings=block_device_mappings,
         ebs_optimized=False,
         name=NAME_GUEST_CREATOR,
         description=DESCRIPTION_GUEST_CREATOR % {'image_id': image_id}
@@ -903,17 +1450,99 @@ def run_guest_instance(aws_svc, image_id, subnet_id=None,
 
 
 def clean_up(aws_svc, instance_ids=None, volume_ids=None,
-             snapshot_ids=None, security_group_ids=None):
+             snapshot_ids=None, security_group_ids=None, timeout=600):
     """ Clean up any resources that were created by the encryption process.
     Handle and log exceptions, to ensure that the script doesn't exit during
     cleanup.
+
+    Instances are terminated with a single request and snapshots are
+    deleted right away.  A volume or security group that is used by one of
+    the instances is deleted as soon as the instances that use it have
+    terminated.  Everything else is deleted immediately.  Deletes run
+    concurrently, each thread with its own clone of aws_svc.
     """
     instance_ids = instance_ids or []
     volume_ids = volume_ids or []
     snapshot_ids = snapshot_ids or []
     security_group_ids = security_group_ids or []
 
-    # Delete instances and snapshots.
+    terminated_instance_ids = _terminate_instances(aws_svc, instance_ids)
+    blockers = _get_teardown_blockers(
+        aws_svc, terminated_instance_ids, volume_ids, security_group_ids)
+
+    ready = [(_delete_snapshot, id) for id in snapshot_ids]
+    blocked = {}
+    for volume_id in volume_ids:
+        blocked[volume_id] = _delete_volume
+    for sg_id in security_group_ids:
+        blocked[sg_id] = _delete_security_group
+
+    # The deletes run in a thread pool, and boto3 resources can't be shared
+    # between threads, so each thread uses its own clone of the service.
+    thread_svcs = threading.local()
+
+    def _run(task):
+        function, resource_id = task
+        if not getattr(thread_svcs, 'aws_svc', None):
+            thread_svcs.aws_svc = aws_svc.clone()
+        function(thread_svcs.aws_svc, resource_id)
+
+    pending_instance_ids = set(terminated_instance_ids)
+    deadline = Deadline(timeout)
+    while True:
+        # Release the resources that are no longer blocked.
+        for resource_id in blocked.keys():
+            if not blockers.get(resource_id):
+                ready.append((blocked.pop(resource_id), resource_id))
+        if ready:
+            util.parallel_map(_run, ready)
+            ready = []
+
+        if not blocked:
+            return
+        if deadline.is_expired():
+            log.warn(
+                'Timed out waiting for %s to terminate',
+                ', '.join(sorted(pending_instance_ids))
+            )
+            blockers = {}
+            continue
+
+        if pending_instance_ids:
+            log.info(
+                'Waiting for %s to terminate.',
+                ', '.join(sorted(pending_instance_ids))
+            )
+        try:
+            gone = _get_terminated_instance_ids(aws_svc, pending_instance_ids)
+        except:
+            log.exception(
+                'An error occurred while waiting for instances to terminate')
+            gone = set(pending_instance_ids)
+        pending_instance_ids -= gone
+        for instance_ids in blockers.values():
+            instance_ids -= gone
+
+        if pending_instance_ids:
+            sleep(2)
+
+
+def _terminate_instances(aws_svc, instance_ids):
+    """ Terminate the given instances with a single request.  If the
+    request fails, fall back to terminating them one at a time.
+
+    :return the set of ids of the instances that are being terminated
+    """
+    if not instance_ids:
+        return set()
+    try:
+        aws_svc.terminate_instances(*instance_ids)
+        return set(instance_ids)
+    except ClientError as e:
+        log.warn('Unable to terminate %s: %s', ', '.join(instance_ids), e)
+    except:
+        log.exception('Unable to terminate %s', ', '.join(instance_ids))
+
     terminated_instance_ids = set()
     for instance_id in instance_ids:
         try:
@@ -923,47 +1552,93 @@ def clean_up(aws_svc, instance_ids=None, volume_ids=None,
             log.warn('Unable to terminate %s: %s', instance_id, e)
         except:
             log.exception('Unable to terminate %s', instance_id)
+    return terminated_instance_ids
 
-    for snapshot_id in snapshot_ids:
-        try:
-            aws_svc.delete_snapshot(snapshot_id)
-        except ClientError as e:
-            log.warn('Unable to delete %s: %s', snapshot_id, e)
-        except:
-            log.exception('Unable to delete %s', snapshot_id)
 
-    # Wait for instances to terminate before deleting security groups and
-    # volumes, to avoid dependency errors.
-    for id in terminated_instance_ids:
-        log.info('Waiting for %s to terminate.', id)
-        try:
-            wait_for_instance(aws_svc, id, state='terminated')
-        except (ClientError, InstanceError) as e:
-            log.warn(
-                'An error occurred while waiting for instance to '
-                'terminate: %s', e)
-        except:
-            log.exception(
-                'An error occurred while waiting for instance '
-                'to terminate'
-            )
+def _get_teardown_blockers(aws_svc, instance_ids, volume_ids,
+                           security_group_ids):
+    """ Find out which of the terminating instances use the given volumes
+    and security groups.
 
-    # Delete volumes and security groups.
-    for volume_id in volume_ids:
-        try:
-            aws_svc.delete_volume(volume_id)
-        except ClientError as e:
-            log.warn('Unable to delete volume %s: %s', volume_id, e)
-        except:
-            log.exception('Unable to delete volume %s', volume_id)
+    :return a dictionary that maps the volume or security group id to the
+        set of ids of the instances that must terminate before it can be
+        deleted
+    """
+    blockers = {}
+    if not instance_ids or not (volume_ids or security_group_ids):
+        return blockers
 
-    for sg_id in security_group_ids:
-        try:
-            aws_svc.delete_security_group(sg_id)
-        except ClientError as e:
-            log.warn('Unable to delete security group %s: %s', sg_id, e)
-        except:
-            log.exception('Unable to delete security group %s', sg_id)
+    try:
+        instances = aws_svc.get_instances(*instance_ids)
+    except:
+        # We don't know which resources are in use.  Wait for all of the
+        # instances before deleting anything.
+        log.debug('Unable to describe %s', instance_ids, exc_info=1)
+        for resource_id in list(volume_ids) + list(security_group_ids):
+            blockers[resource_id] = set(instance_ids)
+        return blockers
+
+    for instance in instances:
+        used_ids = [
+            boto3_device.get_volume_id(d)
+            for d in instance.block_device_mappings
+        ]
+        used_ids += [
+            sg['GroupId'] for sg in (instance.security_groups or [])
+        ]
+        for resource_id in used_ids:
+            if resource_id in volume_ids or \
+                    resource_id in security_group_ids:
+                blockers.setdefault(resource_id, set()).add(instance.id)
+    log.debug('Teardown dependencies: %s', blockers)
+    return blockers
+
+
+def _get_terminated_instance_ids(aws_svc, instance_ids):
+    """ Describe the given instances with a single request.
+
+    :return the set of ids of the instances that have terminated or no
+        longer exist
+    """
+    if not instance_ids:
+        return set()
+    instances = aws_svc.get_instances(*instance_ids)
+    gone = set(instance_ids) - set(i.id for i in instances)
+    for instance in instances:
+        state = instance.state['Name']
+        if state == 'terminated':
+            gone.add(instance.id)
+        elif state == 'error':
+            log.warn('Instance %s is in an error state', instance.id)
+            gone.add(instance.id)
+    return gone
+
+
+def _delete_snapshot(aws_svc, snapshot_id):
+    try:
+        aws_svc.delete_snapshot(snapshot_id)
+    except ClientError as e:
+        log.warn('Unable to delete %s: %s', snapshot_id, e)
+    except:
+        log.exception('Unable to delete %s', snapshot_id)
+
+
+def _delete_volume(aws_svc, volume_id):
+    try:
+        aws_svc.delete_volume(volume_id)
+    except ClientError as e:
+        log.warn('Unable to delete volume %s: %s', volume_id, e)
+    except:
+        log.exception('Unable to delete volume %s', volume_id)
+
+
+def _delete_security_group(aws_svc, sg_id):
+    try:
+        aws_svc.delete_security_group(sg_id)
+    except ClientError as e:
+        log.warn('Unable to delete security group %s: %s', sg_id, e)
+    except:
+        log.exception('Unable to delete security group %s', sg_id)
 
 
 def log_exception_console(aws_svc, e, id):
@@ -1035,10 +1710,17 @@ def wait_for_volume_attached(aws_svc, instance_id, device):
         instance_id
     )
 
+    waiter = _get_waiter(aws_svc)
+    if waiter:
+        instance = waiter.wait_for_volume_attached(instance_id, device)
+        _invalidate(aws_svc, instance_id)
+        return instance
+
     found = False
     instance = None
 
     for _ in xrange(20):
+        _invalidate(aws_svc, instance_id)
         instance = aws_svc.get_instance(instance_id)
         device_names = boto3_device.get_device_names(
             instance.block_device_mappings)
@@ -1075,20 +1757,34 @@ def _write_console_output(aws_svc, instance_id):
 
 
 def wait_for_snapshots(aws_svc, *snapshot_ids):
+    """ Wait for up to WAIT_MAX_ATTEMPTS * WAIT_DELAY seconds for all of the
+    given snapshots to complete.
 
+    :raise SnapshotError if a snapshot goes into the error state or the
+        timeout is exceeded
+    """
     log.info(
         'Waiting for status "completed" for %s', ', '.join(snapshot_ids))
+    timeout = WAIT_MAX_ATTEMPTS * WAIT_DELAY
+    waiter = _get_waiter(aws_svc)
+    if waiter:
+        waiter.wait_for_snapshots(snapshot_ids, timeout=timeout)
+        _invalidate(aws_svc, *snapshot_ids)
+        return
+
     last_progress_log = time.time()
+    deadline = Deadline(timeout)
 
     # Give AWS some time to propagate the snapshot creation.
     # If we create and get immediately, AWS may return 400.
     sleep(20)
 
-    while True:
+    while not deadline.is_expired():
         snapshots = aws_svc.get_snapshots(*snapshot_ids)
         log.debug('%s', {s.id: s.state for s in snapshots})
 
-        done = True
+        # Snapshots that aren't visible yet are not returned.
+        done = len(snapshots) == len(set(snapshot_ids))
         error_ids = []
         for snapshot in snapshots:
             if snapshot.state == 'error':
@@ -1112,7 +1808,9 @@ def wait_for_snapshots(aws_svc, *snapshot_ids):
             log.info(_get_snapshot_progress_text(snapshots))
             last_progress_log = now
 
-        sleep(5)
+        sleep(WAIT_DELAY)
+    raise SnapshotError(
+        'Timed out waiting for %s to complete' % ', '.join(snapshot_ids))
 
 
 def _get_snapshot_progress_text(snapshots):
@@ -1175,7 +1873,7 @@ def snapshot_root_volume(aws_svc, instance, image_id):
         raise
 
     iops = None
-    if vol.volume_type == 'io1':
+    if vol.volume_type in ebs_performance.PROVISIONED_IOPS_TYPES:
         iops = vol.iops
 
     ret_values = (
@@ -0,0 +1,387 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Batched polling of EC2 resource state.
+
+Each encryption session waits on its own instances, volumes, snapshots
+and images.  When many sessions run in the same process, polling each
+resource separately multiplies the describe calls and quickly runs into
+EC2 request throttling.  A ResourceWaiter collects every pending
+resource id and checks them with one describe call per resource type on
+each tick, then completes the waits whose resources reached the
+desired state.
+
+A waiter is attached to an AWSService by setting its waiter attribute.
+The wait_for_* functions in aws_service then delegate to it.
+"""
+
+import logging
+import threading
+import time
+
+from brkt_cli import util
+from brkt_cli.aws import boto3_device
+from brkt_cli.aws.aws_service import (
+    check_image_state, check_instance_state, InstanceError, SnapshotError,
+    VolumeError
+)
+from brkt_cli.util import BracketError
+
+log = logging.getLogger(__name__)
+
+INSTANCE = 'instance'
+VOLUME = 'volume'
+SNAPSHOT = 'snapshot'
+IMAGE = 'image'
+RESOURCE_TYPES = (INSTANCE, VOLUME, SNAPSHOT, IMAGE)
+
+# EC2 accepts up to 200 values in a single describe filter.
+MAX_IDS_PER_CALL = 200
+
+# Fail the pending waits for a resource type after this many
+# consecutive describe errors.
+MAX_DESCRIBE_ERRORS = 10
+
+# Event.wait() without a timeout can't be interrupted with Ctrl-C
+# in Python 2.
+_WAIT_FOREVER = 60 * 60 * 24 * 365
+
+
+class WaitRequest(object):
+    """ A wait for a single resource to reach a state.  The request is
+    completed by the ResourceWaiter polling thread.  If a callback is
+    specified, it is called with the request when it completes.
+    """
+
+    def __init__(self, resource_type, resource_id, is_done, callback=None):
+        self.resource_type = resource_type
+        self.resource_id = resource_id
+        self.is_done = is_done
+        self.callback = callback
+        self.resource = None
+        self.error = None
+        self._event = threading.Event()
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """ Block until the request completes.
+
+        :return True if the request completed, False if the timeout expired
+        """
+        if timeout is None:
+            timeout = _WAIT_FOREVER
+        self._event.wait(timeout)
+        return self._event.is_set()
+
+    def result(self):
+        """ Return the resource, or raise the exception that the request
+        completed with.
+        """
+        if self.error:
+            raise self.error
+        return self.resource
+
+    def _complete(self, resource=None, error=None):
+        self.resource = resource
+        self.error = error
+        self._event.set()
+        if self.callback:
+            try:
+                self.callback(self)
+            except:
+                log.exception(
+                    'Callback for %s %s failed',
+                    self.resource_type, self.resource_id
+                )
+
+
+class ResourceWaiter(object):
+    """ Polls the state of EC2 resources in batches.
+
+    All describe calls are made by a single background thread, using
+    the given AWSService.  Since boto3 resources are not thread-safe,
+    the AWSService must not be used by other threads.  The thread exits
+    when there are no pending requests, and is restarted when a new
+    request is submitted.  If background is False, no thread is started
+    and the caller is responsible for calling poll().
+    """
+
+    def __init__(self, aws_svc, poll_interval=5.0, background=True):
+        self.aws_svc = aws_svc
+        self.poll_interval = poll_interval
+        self.background = background
+        self.describe_calls = {t: 0 for t in RESOURCE_TYPES}
+        self._pending = {t: {} for t in RESOURCE_TYPES}
+        self._errors = {t: 0 for t in RESOURCE_TYPES}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_progress_log = time.time()
+
+    def submit(self, resource_type, resource_id, is_done, callback=None):
+        """ Start waiting for a resource.  is_done is called with the
+        resource each time it's polled.  It returns True when the resource
+        is in the desired state, and may raise an exception to fail the
+        request.
+
+        :return the WaitRequest
+        """
+        if resource_type not in RESOURCE_TYPES:
+            raise ValueError('Unknown resource type: %s' % resource_type)
+        request = WaitRequest(
+            resource_type, resource_id, is_done, callback=callback)
+        with self._lock:
+            self._pending[resource_type].setdefault(
+                resource_id, []).append(request)
+            if self.background and not self._thread:
+                self._thread = threading.Thread(
+                    target=self._run, name='ResourceWaiter')
+                self._thread.daemon = True
+                self._thread.start()
+        return request
+
+    def cancel(self, request):
+        """ Stop polling for the given request. """
+        with self._lock:
+            requests = self._pending[request.resource_type].get(
+                request.resource_id)
+            if requests and request in requests:
+                requests.remove(request)
+                if not requests:
+                    del self._pending[request.resource_type][
+                        request.resource_id]
+
+    def wait(self, resource_type, resource_id, is_done, timeout=None,
+             timeout_error=None):
+        """ Submit a request and block until it completes.
+
+        :return the resource
+        :raise timeout_error if the timeout expires
+        """
+        request = self.submit(resource_type, resource_id, is_done)
+        if not request.wait(timeout):
+            self.cancel(request)
+            raise timeout_error or BracketError(
+                'Timed out waiting for %s' % resource_id)
+        return request.result()
+
+    def poll(self):
+        """ Describe all pending resources and complete the requests
+        whose resources are done.
+
+        :return the number of requests that are still pending
+        """
+        with self._lock:
+            pending_ids = {
+                t: list(self._pending[t].keys())
+                for t in RESOURCE_TYPES if self._pending[t]
+            }
+
+        for resource_type, ids in pending_ids.iteritems():
+            resources = []
+            try:
+                for i in xrange(0, len(ids), MAX_IDS_PER_CALL):
+                    chunk = ids[i:i + MAX_IDS_PER_CALL]
+                    self.describe_calls[resource_type] += 1
+                    resources.extend(self._describe(resource_type, chunk))
+                self._errors[resource_type] = 0
+            except Exception as e:
+                self._errors[resource_type] += 1
+                log.warn(
+                    'Unable to describe %s resources: %s', resource_type, e)
+                if self._errors[resource_type] >= MAX_DESCRIBE_ERRORS:
+                    self._fail_all(resource_type, e)
+                continue
+
+            for resource in resources:
+                self._update(resource_type, resource)
+
+            if resource_type == SNAPSHOT:
+                self._log_snapshot_progress(resources)
+
+        with self._lock:
+            return sum(
+                len(requests)
+                for t in RESOURCE_TYPES
+                for requests in self._pending[t].values()
+            )
+
+    def _run(self):
+        while True:
+            try:
+                num_pending = self.poll()
+                log.debug('%d wait requests pending', num_pending)
+            except:
+                log.exception('Unexpected error while polling resources')
+
+            with self._lock:
+                if not any(self._pending.values()):
+                    self._thread = None
+                    return
+            util.sleep(self.poll_interval)
+
+    def _describe(self, resource_type, ids):
+        if resource_type == INSTANCE:
+            return self.aws_svc.get_instances(*ids)
+        if resource_type == VOLUME:
+            return self.aws_svc.get_volumes(volume_ids=ids)
+        if resource_type == SNAPSHOT:
+            return self.aws_svc.get_snapshots(*ids)
+        return self.aws_svc.get_images(image_ids=ids)
+
+    def _update(self, resource_type, resource):
+        with self._lock:
+            requests = list(self._pending[resource_type].get(resource.id, []))
+
+        for request in requests:
+            try:
+                if not request.is_done(resource):
+                    continue
+                error = None
+            except Exception as e:
+                error = e
+            self.cancel(request)
+            request._complete(resource=resource, error=error)
+
+    def _fail_all(self, resource_type, error):
+        with self._lock:
+            requests = [
+                r for requests in self._pending[resource_type].values()
+                for r in requests
+            ]
+            self._pending[resource_type] = {}
+            self._errors[resource_type] = 0
+        for request in requests:
+            request._complete(error=error)
+
+    def _log_snapshot_progress(self, snapshots):
+        now = time.time()
+        if now - self._last_progress_log > 60:
+            elements = [
+                '%s: %s' % (str(s.id), str(s.progress))
+                for s in snapshots if s.state != 'completed'
+            ]
+            if elements:
+                log.info(', '.join(elements))
+            self._last_progress_log = now
+
+    def wait_for_instance(self, instance_id, timeout=600, state='running'):
+        """ Wait for an instance to be in the given state.
+
+        :return the Instance object
+        :raises InstanceError if a timeout occurs or the instance
+            unexpectedly goes into an error or terminated state
+        """
+        return self.wait(
+            INSTANCE,
+            instance_id,
+            lambda instance: check_instance_state(instance, state),
+            timeout=timeout,
+            timeout_error=InstanceError(
+                'Timed out waiting for %s to be in the %s state' %
+                (instance_id, state)
+            )
+        )
+
+    def wait_for_volume(self, volume_id, timeout=600.0, state='available'):
+        """ Wait for a volume to be in the given state.
+
+        :return the Volume object
+        :raise VolumeError if the timeout is exceeded
+        """
+        return self.wait(
+            VOLUME,
+            volume_id,
+            lambda volume: volume.state == state,
+            timeout=timeout,
+            timeout_error=VolumeError(
+                'Timed out waiting for %s to be in the %s state' %
+                (volume_id, state)
+            )
+        )
+
+    def wait_for_snapshots(self, snapshot_ids, timeout=None):
+        """ Wait for all of the given snapshots to complete.
+
+        :raise SnapshotError if a snapshot goes into the error state or the
+            timeout expires
+        """
+        def _is_done(snapshot):
+            if snapshot.state == 'error':
+                raise SnapshotError(
+                    'Snapshots in error state: %s.  Cannot continue.' %
+                    str([str(snapshot.id)])
+                )
+            return snapshot.state == 'completed'
+
+        requests = [
+            self.submit(SNAPSHOT, snapshot_id, _is_done)
+            for snapshot_id in snapshot_ids
+        ]
+        start = time.time()
+        try:
+            for request in requests:
+                remaining = None
+                if timeout is not None:
+                    remaining = max(0, start + timeout - time.time())
+                if not request.wait(remaining):
+                    raise SnapshotError(
+                        'Timed out waiting for %s to complete' %
+                        ', '.join(snapshot_ids)
+                    )
+                request.result()
+        finally:
+            for request in requests:
+                self.cancel(request)
+
+    def wait_for_image(self, image_id, timeout=None):
+        """ Wait for an image to become available.
+
+        :return the Image object
+        :raise BracketError if the image goes into the failed state or the
+            timeout expires
+        """
+        return self.wait(
+            IMAGE,
+            image_id,
+            check_image_state,
+            timeout=timeout,
+            timeout_error=BracketError(
+                'Timed out waiting for %s to become available' % image_id)
+        )
+
+    def wait_for_volume_attached(self, instance_id, device, timeout=100):
+        """ Wait until the device appears in the block device mapping of the
+        given instance.
+
+        :return the Instance object
+        """
+        def _is_attached(instance):
+            device_names = boto3_device.get_device_names(
+                instance.block_device_mappings)
+            log.debug('Found devices: %s', device_names)
+            return device in device_names
+
+        return self.wait(
+            INSTANCE,
+            instance_id,
+            _is_attached,
+            timeout=timeout,
+            timeout_error=BracketError(
+                'Timed out waiting for %s to attach to %s' %
+                (device, instance_id)
+            )
+        )
@@ -33,7 +33,7 @@ def get_device_names(block_device_mappings):
 def make_device(device_name=None, virtual_name=None, encrypted=None,
                 delete_on_termination=None, iops=None, snapshot_id=None,
                 volume_size=None, volume_type=None, no_device=None,
-                volume_id=None):
+                volume_id=None, throughput=None):
     """ Return a dictionary that represents a boto3 block device. """
     d = dict()
     ebs = dict()
@@ -59,6 +59,8 @@ def make_device(device_name=None, virtual_name=None, encrypted=None,
         ebs['VolumeType'] = volume_type
     if volume_id:
         ebs['VolumeId'] = volume_id
+    if throughput:
+        ebs['Throughput'] = throughput
 
     d['Ebs'] = ebs
     return d
@@ -71,6 +73,11 @@ def get_volume_id(device):
     return None
 
 
+def is_attached(block_device_mappings, volume_id):
+    """ Return True if the block device mappings reference the volume. """
+    return any(get_volume_id(d) == volume_id for d in block_device_mappings)
+
+
 def get_snapshot_id(device):
     ebs = device.get('Ebs')
     if ebs:
@@ -92,5 +99,6 @@ def make_device_for_image(source_device):
         snapshot_id=source_device.get('SnapshotId'),
         volume_size=source_device.get('VolumeSize'),
         volume_type=source_device.get('VolumeType'),
-        no_device=source_device.get('NoDevice')
+        no_device=source_device.get('NoDevice'),
+        throughput=source_device.get('Throughput')
     )
@@ -0,0 +1,217 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Provisioned performance of the Encryptor's working volumes.
+
+The Encryptor reads the whole unencrypted volume and writes the whole
+encrypted volume once, in large sequential I/Os.  gp2 volumes are limited
+by burst credits when they're small, and by their baseline throughput
+when they're large.  gp3, io1 and io2 volumes let us provision IOPS and
+throughput instead.  The values are chosen from the root volume size, so
+that small volumes aren't overprovisioned and large volumes get close to
+the maximum throughput.
+
+The Encryptor instance type can also be chosen automatically.  Since the
+Encryptor reads one volume and writes another, it needs twice the volume
+throughput in EBS bandwidth.  Small volumes are encrypted quickly on any
+instance type, so they don't need more bandwidth than it takes to finish
+in ENCRYPTION_TARGET_SECONDS.  INSTANCE_TYPES lists the EBS bandwidth of
+the instance types that the Encryptor can run on, and whether they
+require ENA support in the image.
+"""
+
+from brkt_cli.validation import ValidationError
+
+VOLUME_TYPE_GP2 = 'gp2'
+VOLUME_TYPE_GP3 = 'gp3'
+VOLUME_TYPE_IO1 = 'io1'
+VOLUME_TYPE_IO2 = 'io2'
+
+ENCRYPTOR_VOLUME_TYPES = (
+    VOLUME_TYPE_GP2, VOLUME_TYPE_GP3, VOLUME_TYPE_IO1, VOLUME_TYPE_IO2
+)
+
+# Volume types that require the Iops attribute.
+PROVISIONED_IOPS_TYPES = (VOLUME_TYPE_IO1, VOLUME_TYPE_IO2)
+
+# Throughput in MiB/s provisioned per GiB of root volume, and the minimum
+# and maximum throughput that we ask for.
+THROUGHPUT_PER_GIB = 4
+MIN_THROUGHPUT = 125
+MAX_THROUGHPUT = 1000
+
+# The Encryptor does I/O in 256 KiB chunks, so each MiB/s of throughput
+# needs 4 IOPS.
+IOPS_PER_MIB = 4
+
+# Baseline throughput in MiB/s of gp2 volumes up to GP2_LARGE_SIZE GiB,
+# and of larger volumes.
+GP2_THROUGHPUT = 128
+GP2_LARGE_SIZE = 170
+GP2_LARGE_THROUGHPUT = 250
+
+# EBS limits for each volume type: (min IOPS, max IOPS, max IOPS per GiB).
+IOPS_LIMITS = {
+    VOLUME_TYPE_GP3: (3000, 16000, 500),
+    VOLUME_TYPE_IO1: (100, 64000, 50),
+    VOLUME_TYPE_IO2: (100, 64000, 500)
+}
+
+
+def get_provisioned_performance(volume_type, size):
+    """ Return the IOPS and throughput to provision for an Encryptor
+    working volume of the given type and size in GiB.
+
+    :return a tuple of (iops, throughput).  Either value is None if it
+        can't be set for the volume type.  Throughput is in MiB/s, and is
+        only set for gp3.
+    """
+    if volume_type not in IOPS_LIMITS:
+        return None, None
+
+    throughput = size * THROUGHPUT_PER_GIB
+    throughput = max(MIN_THROUGHPUT, min(MAX_THROUGHPUT, throughput))
+
+    min_iops, max_iops, max_iops_per_gib = IOPS_LIMITS[volume_type]
+    iops = throughput * IOPS_PER_MIB
+    iops = min(iops, max_iops, size * max_iops_per_gib)
+    iops = max(iops, min_iops)
+
+    if volume_type != VOLUME_TYPE_GP3:
+        return iops, None
+
+    # gp3 allows 0.25 MiB/s of throughput per provisioned IOPS.
+    throughput = min(throughput, iops / IOPS_PER_MIB)
+    return iops, throughput
+
+
+def get_expected_throughput(volume_type, size):
+    """ Return the throughput in MiB/s that we expect from a volume of the
+    given type and size, or None if it's unknown.
+    """
+    iops, throughput = get_provisioned_performance(volume_type, size)
+    if throughput:
+        return throughput
+    if iops:
+        return iops / IOPS_PER_MIB
+    if volume_type == VOLUME_TYPE_GP2:
+        if size > GP2_LARGE_SIZE:
+            return GP2_LARGE_THROUGHPUT
+        return GP2_THROUGHPUT
+    return None
+
+
+# The value of --encryptor-instance-type that enables automatic sizing.
+AUTO_INSTANCE_TYPE = 'auto'
+
+# Instance type: (vCPUs, baseline EBS bandwidth in Mbps, requires ENA).
+INSTANCE_TYPES = {
+    'c4.large': (2, 500, False),
+    'c4.xlarge': (4, 750, False),
+    'c4.2xlarge': (8, 1000, False),
+    'c4.4xlarge': (16, 2000, False),
+    'c4.8xlarge': (36, 4000, False),
+    'c5.large': (2, 650, True),
+    'c5.xlarge': (4, 1150, True),
+    'c5.2xlarge': (8, 2300, True),
+    'c5.4xlarge': (16, 4750, True),
+    'c5.9xlarge': (36, 9500, True),
+    'c5.18xlarge': (72, 19000, True),
+    'm4.large': (2, 450, False),
+    'm4.xlarge': (4, 750, False),
+    'm4.2xlarge': (8, 1000, False),
+    'm4.4xlarge': (16, 2000, False),
+    'm4.10xlarge': (40, 4000, False),
+    'm4.16xlarge': (64, 10000, True),
+    'm5.large': (2, 650, True),
+    'm5.xlarge': (4, 1150, True),
+    'm5.2xlarge': (8, 2300, True),
+    'm5.4xlarge': (16, 4750, True),
+    'm5.12xlarge': (48, 9500, True),
+    'm5.24xlarge': (96, 19000, True)
+}
+
+# Automatic sizing doesn't ask for more EBS bandwidth than it takes to
+# encrypt the volume in this many seconds.
+ENCRYPTION_TARGET_SECONDS = 600
+
+# Instance types that automatic sizing chooses from, unless the allow-list
+# is configured.
+DEFAULT_AUTO_INSTANCE_TYPES = [
+    'c4.xlarge', 'c4.2xlarge', 'c4.4xlarge', 'c4.8xlarge',
+    'c5.xlarge', 'c5.2xlarge', 'c5.4xlarge', 'c5.9xlarge'
+]
+
+
+def get_ebs_bandwidth(instance_type):
+    """ Return the baseline EBS bandwidth of the instance type in MiB/s,
+    or None if the instance type is unknown.
+    """
+    if instance_type not in INSTANCE_TYPES:
+        return None
+    # Convert megabits per second to mebibytes per second.
+    return INSTANCE_TYPES[instance_type][1] * 1000000.0 / 8 / 1048576
+
+
+def parse_instance_types(instance_types):
+    """ Parse a comma-separated list of instance types.
+
+    :raise ValidationError if an instance type is not in INSTANCE_TYPES
+    """
+    names = [t.strip() for t in instance_types.split(',') if t.strip()]
+    if not names:
+        raise ValidationError('No instance types specified')
+    unknown = [name for name in names if name not in INSTANCE_TYPES]
+    if unknown:
+        raise ValidationError(
+            'Unsupported instance type: %s.  Supported types are %s' % (
+                ', '.join(unknown), ', '.join(sorted(INSTANCE_TYPES)))
+        )
+    return names
+
+
+def choose_instance_type(volume_type, size, ena_support=True,
+                         allowed_types=None):
+    """ Choose the Encryptor instance type for a root volume of the given
+    type and size.  Return the allowed instance type with the fewest vCPUs
+    whose EBS bandwidth covers reading and writing at the expected volume
+    throughput.  If none of them do, return the one with the most EBS
+    bandwidth.
+
+    :param ena_support True if the Encryptor image supports ENA
+    :param allowed_types the instance types to choose from, or None for
+        DEFAULT_AUTO_INSTANCE_TYPES
+    :raise ValidationError if none of the allowed types can be used
+    """
+    candidates = [
+        t for t in allowed_types or DEFAULT_AUTO_INSTANCE_TYPES
+        if t in INSTANCE_TYPES and (ena_support or not INSTANCE_TYPES[t][2])
+    ]
+    if not candidates:
+        raise ValidationError(
+            'None of the allowed encryptor instance types can run an '
+            'image without ENA support'
+        )
+
+    required = min(
+        2 * (get_expected_throughput(volume_type, size) or 0),
+        2 * size * 1024 / ENCRYPTION_TARGET_SECONDS
+    )
+    candidates.sort(
+        key=lambda t: (INSTANCE_TYPES[t][0], get_ebs_bandwidth(t)))
+    for instance_type in candidates:
+        if get_ebs_bandwidth(instance_type) >= required:
+            return instance_type
+    return max(candidates, key=get_ebs_bandwidth)
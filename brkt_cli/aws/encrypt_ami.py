@@ -32,35 +32,64 @@ Overview of the process:
     * Terminate the original guest instance.
     * Delete the unencrypted snapshot.
 
+In guestless mode, the unencrypted guest instance is never launched.  The
+root snapshot is read directly from the guest AMI's block device mapping,
+and the encrypted AMI is registered from the Metavisor root snapshot and
+the encrypted guest snapshot.
+
+If a session journal is passed in, the resources and completed phases are
+recorded in it.  When the process is interrupted, or fails with a network
+error or a transient AWS error, the resources are kept, so that the
+session can be resumed from the last completed phase.
+
+With values.fast_snapshot_restore, Fast Snapshot Restore is enabled on the
+unencrypted root snapshot in the Encryptor's availability zone before the
+Encryptor is launched, so that the Encryptor doesn't wait for EBS to load
+each block from S3 when reading the volume.  It's disabled as soon as the
+Encryptor's volumes are created.
+
 Before running brkt encrypt-ami, set the AWS_ACCESS_KEY_ID and
 AWS_SECRET_ACCESS_KEY environment variables, like you would when
 running the AWS command line utility.
 """
+import calendar
+import copy
 import logging
 import os
+import string
+import threading
+import time
 
 from botocore.exceptions import ClientError
 
 from brkt_cli import encryptor_service, util
-from brkt_cli.aws import aws_service, boto3_device
+from brkt_cli.aws import (
+    aws_service, boto3_device, ebs_performance, session_journal
+)
 from brkt_cli.aws.aws_constants import (
     DEFAULT_DESCRIPTION_ENCRYPTED_IMAGE,
     DESCRIPTION_ENCRYPTOR,
     DESCRIPTION_SNAPSHOT,
+    NAME_ENCRYPTED_DATA_SNAPSHOT,
     NAME_ENCRYPTED_ROOT_SNAPSHOT,
     NAME_ENCRYPTED_ROOT_VOLUME,
     NAME_ENCRYPTOR,
     NAME_METAVISOR_ROOT_SNAPSHOT,
     NAME_METAVISOR_ROOT_VOLUME,
     SUFFIX_ENCRYPTED_IMAGE,
+    TAG_CRYPTO_POLICY,
     TAG_ENCRYPTOR,
     TAG_ENCRYPTOR_AMI,
-    TAG_ENCRYPTOR_SESSION_ID
+    TAG_ENCRYPTOR_SESSION_ID,
+    TAG_SOURCE_AMI
 )
 from brkt_cli.aws.aws_service import (
     clean_up,
     create_encryptor_security_group,
+    disable_fast_snapshot_restore,
+    enable_fast_snapshot_restore,
     enable_sriov_net_support,
+    is_transient_error,
     log_exception_console,
     run_guest_instance,
     snapshot_log_volume,
@@ -71,6 +100,13 @@ from brkt_cli.aws.aws_service import (
     wait_for_snapshots,
     wait_for_volume_attached
 )
+from brkt_cli.aws.session_journal import (
+    PHASE_ENCRYPTED,
+    PHASE_ENCRYPTOR_LAUNCHED,
+    PHASE_GUEST_SNAPSHOT,
+    PHASE_SNAPSHOTTED,
+    log_resume_hint
+)
 from brkt_cli.instance_config import InstanceConfig
 from brkt_cli.util import (
     BracketError,
@@ -79,16 +115,26 @@ from brkt_cli.util import (
     METAVISOR_DISK_SIZE,
     append_suffix,
 )
+from brkt_cli.validation import ValidationError
 
 log = logging.getLogger(__name__)
 
 
-def get_default_tags(session_id, encryptor_ami):
+def get_default_tags(session_id, encryptor_ami, source_ami=None,
+                     crypto_policy=None):
+    """ Return the tags that are set on every resource created by an
+    encryption session.  The source AMI and crypto policy tags identify
+    the AMIs that were encrypted from the same guest AMI.
+    """
     default_tags = {
         TAG_ENCRYPTOR: 'True',
         TAG_ENCRYPTOR_SESSION_ID: session_id,
         TAG_ENCRYPTOR_AMI: encryptor_ami
     }
+    if source_ami:
+        default_tags[TAG_SOURCE_AMI] = source_ami
+    if crypto_policy:
+        default_tags[TAG_CRYPTO_POLICY] = crypto_policy
     return default_tags
 
 
@@ -104,6 +150,27 @@ def _get_description_from_image(image):
     return description
 
 
+def _choose_encryptor_instance_type(aws_svc, values, root_size, vol_type):
+    """ Choose the encryptor instance type from the allowed types, based
+    on the EBS bandwidth that's needed to encrypt the root volume.
+    Instance types that require ENA are only used if the encryptor image
+    supports it.
+    """
+    encryptor_image = aws_svc.get_image(values.encryptor_ami)
+    ena_support = aws_service.has_ena_support(encryptor_image)
+    instance_type = ebs_performance.choose_instance_type(
+        vol_type, root_size, ena_support=ena_support,
+        allowed_types=values.encryptor_instance_types
+    )
+    log.info(
+        'Using %s for the encryptor instance, with %d MiB/s of EBS '
+        'bandwidth for a %d GiB %s volume',
+        instance_type, ebs_performance.get_ebs_bandwidth(instance_type),
+        root_size, vol_type
+    )
+    return instance_type
+
+
 def _run_encryptor_instance(aws_svc, values, snapshot, root_size,
                             placement=None, instance_config=None,
                             vol_type='gp2'):
@@ -111,6 +178,23 @@ def _run_encryptor_instance(aws_svc, values, snapshot, root_size,
     if instance_config is None:
         instance_config = InstanceConfig()
 
+    # Provision IOPS and throughput for gp3, io1 and io2 from the root size.
+    # The same values are valid for the encrypted volume, since it's at
+    # least as large as the root.
+    iops, throughput = ebs_performance.get_provisioned_performance(
+        vol_type, root_size)
+    if iops:
+        log.info(
+            'Using %s encryptor volumes with %d IOPS and %d MiB/s',
+            vol_type, iops,
+            ebs_performance.get_expected_throughput(vol_type, root_size)
+        )
+
+    instance_type = values.encryptor_instance_type
+    if instance_type == ebs_performance.AUTO_INSTANCE_TYPE:
+        instance_type = _choose_encryptor_instance_type(
+            aws_svc, values, root_size, vol_type)
+
     # Use 'sd' names even though AWS maps these to 'xvd'
     # The AWS GUI only exposes 'sd' names, and won't allow
     # the user to attach to an existing 'sd' name in use, but
@@ -118,6 +202,7 @@ def _run_encryptor_instance(aws_svc, values, snapshot, root_size,
 
     guest_unencrypted_root = boto3_device.make_device(
         device_name='/dev/sdf', volume_type=vol_type,
+        iops=iops, throughput=throughput,
         snapshot_id=snapshot, delete_on_termination=True)
 
     log.info('Launching encryptor instance with snapshot %s', snapshot)
@@ -132,6 +217,7 @@ def _run_encryptor_instance(aws_svc, values, snapshot, root_size,
 
     guest_encrypted_root = boto3_device.make_device(
         device_name='/dev/sdg', volume_type=vol_type,
+        iops=iops, throughput=throughput,
         volume_size=guest_encrypted_root_size,
         delete_on_termination=True)
 
@@ -168,7 +254,7 @@ def _run_encryptor_instance(aws_svc, values, snapshot, root_size,
             placement=placement,
             block_device_mappings=bdm,
             subnet_id=values.subnet_id,
-            instance_type=values.encryptor_instance_type,
+            instance_type=instance_type,
             name=NAME_ENCRYPTOR,
             description=DESCRIPTION_ENCRYPTOR % {'image_id': values.ami}
         )
@@ -211,10 +297,8 @@ def _terminate_instance(aws_svc, id, name, terminated_instance_ids):
         log.warn('Could not terminate %s instance: %s', name, e)
 
 
-def _snapshot_encrypted_instance(aws_svc, enc_svc_cls, values,
-                                 encryptor_instance, vol_type='gp2',
-                                 iops=None, encryption_start_timeout=600):
-    # First wait for encryption to complete
+def _wait_for_encryption(aws_svc, enc_svc_cls, values, encryptor_instance,
+                         encryption_start_timeout=600, root_size=None):
     host_ips = []
     if encryptor_instance.public_ip_address:
         host_ips.append(encryptor_instance.public_ip_address)
@@ -233,10 +317,23 @@ def _snapshot_encrypted_instance(aws_svc, enc_svc_cls, values,
     try:
         log.info('Waiting for encryption service on %s (port %s on %s)',
                  encryptor_instance.id, enc_svc.port, ', '.join(host_ips))
-        encryptor_service.wait_for_encryptor_up(
-            enc_svc, Deadline(encryption_start_timeout))
+        launch_time = None
+        if encryptor_instance.launch_time:
+            launch_time = calendar.timegm(
+                encryptor_instance.launch_time.utctimetuple())
+        ready_seconds = encryptor_service.wait_for_encryptor_up(
+            enc_svc, Deadline(encryption_start_timeout),
+            launch_time=launch_time)
+        if launch_time:
+            log.info(
+                'Encryptor %s (%s) was ready %.1f seconds after launch',
+                encryptor_instance.id, encryptor_instance.image_id,
+                ready_seconds
+            )
         log.info('Creating encrypted root drive.')
+        start_time = time.time()
         encryptor_service.wait_for_encryption(enc_svc)
+        _log_throughput(root_size, time.time() - start_time)
     except encryptor_service.EncryptionError as e:
         # Stop the encryptor instance, to make the console log available.
         stop_and_wait(aws_svc, encryptor_instance.id)
@@ -253,6 +350,34 @@ def _snapshot_encrypted_instance(aws_svc, enc_svc_cls, values,
                       'region': aws_svc.region})
         raise
 
+
+def _log_throughput(root_size, seconds):
+    """ Log the encryption throughput, so that runs can be compared. """
+    if not root_size or seconds <= 0:
+        return
+    log.info(
+        'Encrypted %d GiB in %d seconds (%.1f MiB/s)',
+        root_size, seconds, root_size * 1024 / seconds
+    )
+
+
+def _snapshot_encrypted_instance(aws_svc, enc_svc_cls, values,
+                                 encryptor_instance, vol_type='gp2',
+                                 iops=None, encryption_start_timeout=600,
+                                 journal=None, root_size=None):
+    if journal is None:
+        journal = session_journal.SessionJournal(aws_svc.session_id)
+
+    # First wait for encryption to complete.  When resuming a session,
+    # this reattaches to the encryptor's status API.
+    if not journal.is_complete(PHASE_ENCRYPTED):
+        _wait_for_encryption(
+            aws_svc, enc_svc_cls, values, encryptor_instance,
+            encryption_start_timeout=encryption_start_timeout,
+            root_size=root_size
+        )
+        journal.complete_phase(PHASE_ENCRYPTED)
+
     log.info('Encrypted root drive is ready.')
     # The encryptor instance may modify its volume attachments while running,
     # so we update the encryptor instance's local attributes before reading
@@ -271,36 +396,45 @@ def _snapshot_encrypted_instance(aws_svc, enc_svc_cls, values,
     encrypted_dev = boto3_device.get_device(
         encryptor_instance.block_device_mappings, '/dev/sdg')
 
+    # Record the ids of the volumes and snapshot before detaching or
+    # snapshotting, so that a resumed session can find them after they've
+    # been detached from the encryptor.
     if values.single_disk:
-        log.info('Detaching new encrypted root from Encryptor.')
-        new_root_id = boto3_device.get_volume_id(encrypted_dev)
-        aws_svc.detach_volume(new_root_id,
-                              instance_id=encryptor_instance.id,
-                              force=True)
-        aws_service.wait_for_volume(aws_svc, new_root_id)
+        new_root_id = journal.get('encrypted_root_id')
+        if not new_root_id:
+            new_root_id = boto3_device.get_volume_id(encrypted_dev)
+            journal.record(encrypted_root_id=new_root_id)
+        _detach_from_encryptor(
+            aws_svc, encryptor_instance, new_root_id,
+            'Detaching new encrypted root from Encryptor.')
         aws_svc.create_tags(new_root_id, name=NAME_ENCRYPTED_ROOT_VOLUME)
         new_bdm = list()
     else:
-        log.info('Creating snapshot of the encrypted guest disk.')
-        encrypted_snap = aws_svc.create_snapshot(
-            encrypted_dev['Ebs']['VolumeId'],
-            name=NAME_ENCRYPTED_ROOT_SNAPSHOT,
-            description=DESCRIPTION_SNAPSHOT % {'image_id': values.ami})
-        wait_for_snapshots(aws_svc, encrypted_snap.id)
+        encrypted_snap_id = journal.get('encrypted_snapshot_id')
+        if not encrypted_snap_id:
+            log.info('Creating snapshot of the encrypted guest disk.')
+            encrypted_snap = aws_svc.create_snapshot(
+                encrypted_dev['Ebs']['VolumeId'],
+                name=NAME_ENCRYPTED_ROOT_SNAPSHOT,
+                description=DESCRIPTION_SNAPSHOT % {'image_id': values.ami})
+            encrypted_snap_id = encrypted_snap.id
+            journal.record(encrypted_snapshot_id=encrypted_snap_id)
+        wait_for_snapshots(aws_svc, encrypted_snap_id)
         encrypted_dev = boto3_device.make_device(device_name='/dev/sdf',
                                                  volume_type=vol_type,
-                                                 snapshot_id=encrypted_snap.id,
+                                                 snapshot_id=encrypted_snap_id,
                                                  iops=iops,
                                                  delete_on_termination=True)
         new_bdm = [encrypted_dev]
-        log.info('Detaching Metavisor root from Encryptor.')
-        mv_root_dev = boto3_device.get_device(
-            encryptor_instance.block_device_mappings, '/dev/sda1')
-        mv_root_id = boto3_device.get_volume_id(mv_root_dev)
-        aws_svc.detach_volume(mv_root_id,
-                              instance_id=encryptor_instance.id,
-                              force=True)
-        aws_service.wait_for_volume(aws_svc, mv_root_id)
+        mv_root_id = journal.get('encryptor_mv_root_id')
+        if not mv_root_id:
+            mv_root_dev = boto3_device.get_device(
+                encryptor_instance.block_device_mappings, '/dev/sda1')
+            mv_root_id = boto3_device.get_volume_id(mv_root_dev)
+            journal.record(encryptor_mv_root_id=mv_root_id)
+        _detach_from_encryptor(
+            aws_svc, encryptor_instance, mv_root_id,
+            'Detaching Metavisor root from Encryptor.')
         aws_svc.create_tags(mv_root_id, name=NAME_METAVISOR_ROOT_VOLUME)
         new_root_id = mv_root_id
 
@@ -325,6 +459,19 @@ def _snapshot_encrypted_instance(aws_svc, enc_svc_cls, values,
     return new_root_id, new_bdm
 
 
+def _detach_from_encryptor(aws_svc, encryptor_instance, volume_id, message):
+    """ Detach the volume from the encryptor instance, unless a previous
+    run of the session already detached it.
+    """
+    if boto3_device.is_attached(
+            encryptor_instance.block_device_mappings, volume_id):
+        log.info(message)
+        aws_svc.detach_volume(volume_id,
+                              instance_id=encryptor_instance.id,
+                              force=True)
+    aws_service.wait_for_volume(aws_svc, volume_id)
+
+
 def _register_ami(aws_svc, encryptor_instance, name,
                   description, mv_bdm=None, guest_instance=None,
                   mv_root_id=None, vol_type='gp2'):
@@ -372,7 +519,77 @@ def _register_ami(aws_svc, encryptor_instance, name,
         name=NAME_METAVISOR_ROOT_SNAPSHOT,
         description='Test snapshot'
     )
-    aws_svc.create_tags(image.id)
+    return image
+
+
+def _get_guest_root_device(guest_image):
+    """ Return the root device from the guest image's block device mapping.
+
+    :raise BracketError if the root device does not reference a snapshot
+    """
+    bdm = guest_image.block_device_mappings
+    root_device_name = guest_image.root_device_name
+    if root_device_name not in boto3_device.get_device_names(bdm):
+        # try stripping partition id
+        root_device_name = string.rstrip(root_device_name, string.digits)
+
+    root_dev = boto3_device.get_device(bdm, root_device_name)
+    if not root_dev or not boto3_device.get_snapshot_id(root_dev):
+        raise BracketError(
+            'Unable to find the root snapshot of %s' % guest_image.id)
+    return root_dev
+
+
+def _register_ami_from_snapshots(aws_svc, encryptor_instance, guest_image,
+                                 name, description, mv_bdm=None,
+                                 mv_root_id=None, vol_type='gp2'):
+    """ Register the encrypted AMI directly from snapshots, without
+    attaching the Metavisor root to a guest instance.  The guest image's
+    other devices, such as data volumes that weren't encrypted and
+    instance store volumes, are carried over unchanged.
+
+    :return: the Image object
+    """
+    # mv_bdm contains the encrypted guest volume.
+    if not mv_bdm:
+        mv_bdm = list()
+
+    log.info('Creating snapshot of the Metavisor root volume.')
+    mv_root_snap = aws_svc.create_snapshot(
+        mv_root_id,
+        name=NAME_METAVISOR_ROOT_SNAPSHOT,
+        description=DESCRIPTION_SNAPSHOT % {'image_id': guest_image.id})
+    wait_for_snapshots(aws_svc, mv_root_snap.id)
+
+    root_dev = boto3_device.make_device(
+        device_name=guest_image.root_device_name,
+        volume_type=vol_type,
+        snapshot_id=mv_root_snap.id,
+        delete_on_termination=True)
+    bdm = [root_dev] + mv_bdm
+    device_names = set(device['DeviceName'] for device in bdm)
+    root_device_name = guest_image.root_device_name
+    for device in guest_image.block_device_mappings:
+        device_name = device.get('DeviceName')
+        if device_name in device_names or device_name == root_device_name or \
+                device_name == string.rstrip(root_device_name, string.digits):
+            continue
+        bdm.append(copy.deepcopy(device))
+
+    # Enable ENA if either the guest or Metavisor supports it.
+    ena_support = (
+        aws_service.has_ena_support(encryptor_instance) or
+        aws_service.has_ena_support(guest_image)
+    )
+    image_id = aws_svc.register_image(
+        bdm,
+        name=name,
+        description=description,
+        root_device_name=guest_image.root_device_name,
+        ena_support=ena_support,
+        sriov_net_support='simple')
+    image = wait_for_image(aws_svc, image_id)
+    log.info('Registered %s based on the snapshots.', image.id)
     return image
 
 
@@ -381,50 +598,167 @@ def _print_bdm(context, resource):
 
 
 def encrypt(aws_svc, enc_svc_cls, values, instance_config=None,
-            encryption_start_timeout=600):
+            encryption_start_timeout=600, journal=None):
 
-    log.info('Starting session %s to encrypt %s', aws_svc.session_id,
-             values.ami)
+    if journal is None:
+        journal = session_journal.SessionJournal(aws_svc.session_id)
+    if journal.phases:
+        log.info('Resuming session %s to encrypt %s', aws_svc.session_id,
+                 values.ami)
+    else:
+        log.info('Starting session %s to encrypt %s', aws_svc.session_id,
+                 values.ami)
 
     encryptor_instance = None
     snapshot_id = None
     guest_instance = None
     temp_sg_id = None
+    # Resources that were left over from an interrupted phase.
+    stale_instance_ids = []
+    # Data volume encryption runs in the background, and adds the
+    # resources that it creates to these lists.
+    data_volume_encryption = None
+    data_encryptor_ids = []
+    data_snapshot_ids = []
+    data_cancelled = threading.Event()
+    # The snapshot and zone that Fast Snapshot Restore is enabled for.
+    fsr_snapshot_id = journal.get('fsr_snapshot_id')
+    fsr_zone = journal.get('fsr_zone')
+    # Only measure throughput if we see the whole encryption.
+    measure_throughput = not journal.is_complete(PHASE_ENCRYPTOR_LAUNCHED)
 
     # Verify that the guest and encryptor images exist.
-    aws_svc.get_image(values.ami)
+    guest_image = aws_svc.get_image(values.ami)
     aws_svc.get_image(values.encryptor_ami)
     encrypted_image = None
 
+    # Data volumes are in the encrypted AMI if they're encrypted, or if
+    # it's registered from the guest AMI's snapshots.
+    data_devices = _get_data_devices(guest_image)
+    if not values.single_disk and \
+            (values.encrypt_data_volumes or values.guestless):
+        _check_data_devices(data_devices)
+    if not values.encrypt_data_volumes:
+        data_devices = []
+
+    # The Metavisor root is always gp2.  The encryptor's working volumes
+    # use the requested type, and the encrypted guest volume keeps the
+    # type of the guest root volume.
     vol_type = 'gp2'
-
-    log.info('Snapshotting the guest root disk.')
+    encryptor_vol_type = values.encryptor_volume_type or vol_type
+    interrupted = False
 
     try:
-        guest_instance = run_guest_instance(aws_svc, values.ami,
-                                            values.subnet_id,
-                                            values.guest_instance_type)
-        wait_for_instance(aws_svc, guest_instance.id)
-
-        snapshot_id, root_dev, size, snap_type, iops = \
-            snapshot_root_volume(aws_svc, guest_instance, values.ami)
-
-        guest_instance = aws_svc.get_instance(guest_instance.id)
-        encryptor_instance, temp_sg_id = \
-            _run_encryptor_instance(aws_svc=aws_svc, values=values,
-                                    snapshot=snapshot_id, root_size=size,
-                                    placement=guest_instance.placement,
-                                    instance_config=instance_config,
-                                    vol_type=vol_type)
-
-        # Enable ENA if Metavisor supports it.
-        encryptor_ena_support = aws_service.has_ena_support(encryptor_instance)
-        guest_ena_support = aws_service.has_ena_support(guest_instance)
-        log.debug('ENA support: encryptor=%s, guest=%s', encryptor_ena_support,
-                  guest_ena_support)
-        if encryptor_ena_support and not guest_ena_support:
-            aws_svc.modify_instance_attribute(guest_instance.id, 'enaSupport',
-                                              'True')
+        if values.guestless:
+            log.info('Reading the guest root snapshot from %s.', values.ami)
+            root_dev = _get_guest_root_device(guest_image)
+            guest_snapshot_id = boto3_device.get_snapshot_id(root_dev)
+            size = root_dev['Ebs'].get('VolumeSize')
+            if not size:
+                size = aws_svc.get_snapshot(guest_snapshot_id).volume_size
+            snap_type = root_dev['Ebs'].get('VolumeType')
+            iops = None
+            if snap_type in ebs_performance.PROVISIONED_IOPS_TYPES:
+                iops = root_dev['Ebs'].get('Iops')
+        elif journal.is_complete(PHASE_GUEST_SNAPSHOT):
+            guest_instance = aws_svc.get_instance(
+                journal.get('guest_instance_id'))
+            snapshot_id = journal.get('snapshot_id')
+            size = journal.get('size')
+            snap_type = journal.get('snap_type')
+            iops = journal.get('iops')
+            log.info('Using snapshot %s of the guest root disk.', snapshot_id)
+        else:
+            if journal.get('guest_instance_id'):
+                stale_instance_ids.append(journal.get('guest_instance_id'))
+
+            log.info('Snapshotting the guest root disk.')
+            # Data volumes are encrypted from the snapshots in the guest
+            # AMI, so the guest instance doesn't need them.
+            guest_instance = run_guest_instance(
+                aws_svc, values.ami, values.subnet_id,
+                values.guest_instance_type,
+                block_device_mappings=_make_no_device_mappings(data_devices)
+            )
+            journal.record(guest_instance_id=guest_instance.id)
+            wait_for_instance(aws_svc, guest_instance.id)
+
+            snapshot_id, root_dev, size, snap_type, iops = \
+                snapshot_root_volume(aws_svc, guest_instance, values.ami)
+            journal.complete_phase(
+                PHASE_GUEST_SNAPSHOT,
+                snapshot_id=snapshot_id, size=size, snap_type=snap_type,
+                iops=iops)
+            guest_instance = aws_svc.get_instance(guest_instance.id)
+
+        if journal.is_complete(PHASE_ENCRYPTOR_LAUNCHED):
+            encryptor_instance = _get_resumed_encryptor(
+                aws_svc, journal.get('encryptor_instance_id'), journal)
+            temp_sg_id = journal.get('temp_sg_id')
+        else:
+            placement = None
+            snapshot = guest_snapshot_id if values.guestless else snapshot_id
+            if guest_instance:
+                placement = guest_instance.placement
+
+            if values.fast_snapshot_restore and not fsr_zone:
+                zone = _get_encryptor_zone(aws_svc, values, placement)
+                if not zone:
+                    log.warn(
+                        'Unable to determine the availability zone of the '
+                        'encryptor instance.  Specify --subnet to use Fast '
+                        'Snapshot Restore in guestless mode.'
+                    )
+                elif enable_fast_snapshot_restore(aws_svc, snapshot, zone):
+                    fsr_snapshot_id, fsr_zone = snapshot, zone
+                    journal.record(
+                        fsr_snapshot_id=fsr_snapshot_id, fsr_zone=fsr_zone)
+
+            encryptor_instance, temp_sg_id = \
+                _run_encryptor_instance(aws_svc=aws_svc, values=values,
+                                        snapshot=snapshot,
+                                        root_size=size,
+                                        placement=placement,
+                                        instance_config=instance_config,
+                                        vol_type=encryptor_vol_type)
+            journal.complete_phase(
+                PHASE_ENCRYPTOR_LAUNCHED,
+                encryptor_instance_id=encryptor_instance.id,
+                temp_sg_id=temp_sg_id
+            )
+
+        if fsr_zone:
+            # The encryptor's volumes have been created, so Fast Snapshot
+            # Restore is no longer needed.
+            disable_fast_snapshot_restore(aws_svc, fsr_snapshot_id, fsr_zone)
+            fsr_snapshot_id, fsr_zone = None, None
+            journal.record(fsr_snapshot_id=None, fsr_zone=None)
+
+        if data_devices:
+            # Encrypt the data volumes while the root volume is being
+            # encrypted.  The security group is shared with the root
+            # encryptor.
+            data_values = copy.copy(values)
+            data_values.single_disk = False
+            if not data_values.security_group_ids and temp_sg_id:
+                data_values.security_group_ids = [temp_sg_id]
+            placement = guest_instance.placement if guest_instance else None
+            data_volume_encryption = util.BackgroundCall(
+                _encrypt_data_volumes, aws_svc, enc_svc_cls, data_values,
+                data_devices, placement, instance_config, encryptor_vol_type,
+                data_encryptor_ids, data_snapshot_ids, data_cancelled
+            )
+
+        if guest_instance:
+            # Enable ENA if Metavisor supports it.
+            encryptor_ena_support = aws_service.has_ena_support(
+                encryptor_instance)
+            guest_ena_support = aws_service.has_ena_support(guest_instance)
+            log.debug('ENA support: encryptor=%s, guest=%s',
+                      encryptor_ena_support, guest_ena_support)
+            if encryptor_ena_support and not guest_ena_support:
+                aws_svc.modify_instance_attribute(
+                    guest_instance.id, 'enaSupport', 'True')
 
         log.debug('Getting image %s', values.ami)
         image = aws_svc.get_image(values.ami)
@@ -432,74 +766,309 @@ def encrypt(aws_svc, enc_svc_cls, values, instance_config=None,
             raise BracketError("Can't find image %s" % values.ami)
         description = _get_description_from_image(image)
 
-        mv_root_id, mv_bdm = _snapshot_encrypted_instance(
-            aws_svc,
-            enc_svc_cls,
-            values,
-            encryptor_instance,
-            vol_type=vol_type,
-            iops=iops,
-            encryption_start_timeout=encryption_start_timeout)
-
-        guest_instance = aws_svc.get_instance(guest_instance.id)
-
-        enable_sriov_net_support(aws_svc, guest_instance)
-
-        encrypted_image = _register_ami(aws_svc, encryptor_instance,
-                                        values.encrypted_ami_name, description,
-                                        guest_instance=guest_instance,
-                                        mv_root_id=mv_root_id, mv_bdm=mv_bdm,
-                                        vol_type=vol_type)
+        if journal.is_complete(PHASE_SNAPSHOTTED):
+            mv_root_id = journal.get('mv_root_id')
+            mv_bdm = journal.get('mv_bdm')
+        else:
+            mv_root_id, mv_bdm = _snapshot_encrypted_instance(
+                aws_svc,
+                enc_svc_cls,
+                values,
+                encryptor_instance,
+                vol_type=snap_type or vol_type,
+                iops=iops,
+                encryption_start_timeout=encryption_start_timeout,
+                journal=journal,
+                root_size=size if measure_throughput else None)
+            journal.complete_phase(
+                PHASE_SNAPSHOTTED, mv_root_id=mv_root_id, mv_bdm=mv_bdm)
+
+        if data_volume_encryption:
+            log.info('Waiting for data volume encryption to complete.')
+            data_bdm = data_volume_encryption.get()
+            data_volume_encryption = None
+            mv_bdm = list(mv_bdm) + data_bdm
+
+        if values.guestless:
+            encrypted_image = _register_ami_from_snapshots(
+                aws_svc, encryptor_instance, image,
+                values.encrypted_ami_name, description,
+                mv_root_id=mv_root_id, mv_bdm=mv_bdm, vol_type=vol_type)
+        else:
+            guest_instance = aws_svc.get_instance(guest_instance.id)
+
+            enable_sriov_net_support(aws_svc, guest_instance)
+
+            encrypted_image = _register_ami(
+                aws_svc, encryptor_instance, values.encrypted_ami_name,
+                description, guest_instance=guest_instance,
+                mv_root_id=mv_root_id, mv_bdm=mv_bdm, vol_type=vol_type)
         log.info('Created encrypted AMI %s based on %s', encrypted_image.id,
                  values.ami)
         return encrypted_image.id
+    except BaseException as e:
+        keep = bool(journal.path) and (
+            isinstance(e, KeyboardInterrupt) or is_transient_error(e))
+        if isinstance(e, KeyboardInterrupt) or keep:
+            # Don't wait for data volume encryption to complete when the
+            # user presses Ctrl-C.  Cancel it and wait for the encryptors
+            # that are still launching, so that all of their ids are known
+            # before they are cleaned up.
+            data_cancelled.set()
+            if data_volume_encryption:
+                data_volume_encryption.cancel()
+                data_volume_encryption = None
+        if keep:
+            # Leave everything in place, so that the session can be resumed.
+            # Data volumes are encrypted again when the session is resumed,
+            # so their encryptors are terminated.
+            interrupted = True
+            if data_encryptor_ids or data_snapshot_ids:
+                clean_up(
+                    aws_svc,
+                    instance_ids=data_encryptor_ids,
+                    snapshot_ids=data_snapshot_ids
+                )
+            log_resume_hint(journal, e)
+        raise
     finally:
-        instance_ids = []
-        if guest_instance:
-            instance_ids.append(guest_instance.id)
+        if data_volume_encryption and not interrupted:
+            # Don't start any more data volume encryptions, and wait for
+            # the ones in progress, so that we know what to clean up.
+            data_cancelled.set()
+            try:
+                data_volume_encryption.get()
+            except Exception:
+                log.debug('Data volume encryption failed', exc_info=1)
+        if not interrupted:
+            if fsr_zone:
+                disable_fast_snapshot_restore(
+                    aws_svc, fsr_snapshot_id, fsr_zone)
+            _clean_up_session(
+                aws_svc, values,
+                encryptor_instance=encryptor_instance,
+                encrypted_image=encrypted_image,
+                guest_instance=guest_instance,
+                snapshot_id=snapshot_id,
+                temp_sg_id=temp_sg_id,
+                stale_instance_ids=stale_instance_ids,
+                data_encryptor_ids=data_encryptor_ids,
+                data_snapshot_ids=data_snapshot_ids
+            )
+            journal.delete()
+
+
+def _get_data_devices(guest_image):
+    """ Return the devices in the guest image's block device mapping that
+    reference the snapshot of an EBS data volume.
+    """
+    bdm = guest_image.block_device_mappings
+    root_device_name = guest_image.root_device_name
+    devices = []
+    for device in bdm:
+        device_name = device.get('DeviceName')
+        if device_name == root_device_name or \
+                device_name == string.rstrip(root_device_name, string.digits):
+            continue
+        if boto3_device.get_snapshot_id(device):
+            devices.append(device)
+    return devices
+
+
+def _check_data_devices(devices):
+    """ Check that none of the data devices use the device name of the
+    encrypted guest root in a dual disk AMI.
+
+    :raise ValidationError if one does
+    """
+    for device in devices:
+        if device['DeviceName'] in ('/dev/sdf', '/dev/xvdf'):
+            raise ValidationError(
+                'Cannot include the data volume at %s in a dual disk AMI, '
+                'because the encrypted guest root volume uses that device.  '
+                'Use --single-disk.' % device['DeviceName']
+            )
 
-        terminate_encryptor = (
-            encryptor_instance and
-            (encrypted_image or values.terminate_encryptor_on_failure)
-        )
 
-        if terminate_encryptor:
-            instance_ids.append(encryptor_instance.id)
-        elif encryptor_instance:
-            log.info('Not terminating encryptor instance %s',
-                     encryptor_instance.id)
-
-        # Delete volumes explicitly.  They should get cleaned up during
-        # instance deletion, but we've gotten reports that occasionally
-        # volumes can get orphaned.
-        #
-        # We can't do this if we're keeping the encryptor instance around,
-        # since its volumes will still be attached.
-        volume_ids = None
-        if terminate_encryptor:
-            try:
-                volumes = aws_svc.get_volumes(
-                    tag_key=TAG_ENCRYPTOR_SESSION_ID,
-                    tag_value=aws_svc.session_id
-                )
-                volume_ids = [v.id for v in volumes]
-            except ClientError as e:
-                log.warn('Unable to clean up orphaned volumes: %s', e)
-            except:
-                log.exception('Unable to clean up orphaned volumes')
+def _make_no_device_mappings(devices):
+    """ Return a block device mapping that suppresses the given devices
+    when launching an instance.
+    """
+    return [
+        {'DeviceName': device['DeviceName'], 'NoDevice': ''}
+        for device in devices
+    ] or None
+
+
+def _encrypt_data_volumes(aws_svc, enc_svc_cls, values, devices, placement,
+                          instance_config, vol_type, encryptor_ids,
+                          snapshot_ids, cancelled):
+    """ Encrypt the data volumes referenced by the given devices, with
+    one encryptor instance per volume and at most
+    values.data_volume_encryptors running at the same time.  The ids of
+    the encryptor instances and encrypted snapshots are added to
+    encryptor_ids and snapshot_ids as they're created, so that the caller
+    can clean them up.  No more encryptors are launched after the
+    cancelled event is set.  Each volume is encrypted with its own clone
+    of aws_svc, since the volumes are encrypted in separate threads.
+
+    :return the devices for the encrypted AMI's block device mapping
+    """
+    log.info(
+        'Encrypting %d data volumes, %d at a time', len(devices),
+        min(values.data_volume_encryptors, len(devices)))
+    return util.parallel_map(
+        lambda device: _encrypt_data_volume(
+            aws_svc.clone(), enc_svc_cls, values, device, placement,
+            instance_config, vol_type, encryptor_ids, snapshot_ids,
+            cancelled),
+        devices,
+        max_workers=values.data_volume_encryptors
+    )
 
-        sg_ids = []
-        if temp_sg_id and terminate_encryptor:
-            sg_ids.append(temp_sg_id)
 
-        snapshot_ids = []
-        if snapshot_id:
-            snapshot_ids.append(snapshot_id)
+def _encrypt_data_volume(aws_svc, enc_svc_cls, values, device, placement,
+                         instance_config, vol_type, encryptor_ids,
+                         snapshot_ids, cancelled):
+    device_name = device['DeviceName']
+    if cancelled.is_set():
+        raise BracketError(
+            'Canceled encryption of data volume %s' % device_name)
 
-        clean_up(
-            aws_svc,
-            instance_ids=instance_ids,
-            volume_ids=volume_ids,
-            snapshot_ids=snapshot_ids,
-            security_group_ids=sg_ids
+    ebs = device['Ebs']
+    snapshot_id = ebs['SnapshotId']
+    size = ebs.get('VolumeSize')
+    if not size:
+        size = aws_svc.get_snapshot(snapshot_id).volume_size
+
+    log.info('Encrypting data volume %s from %s', device_name, snapshot_id)
+    instance, _ = _run_encryptor_instance(
+        aws_svc, values, snapshot_id, size, placement=placement,
+        instance_config=instance_config, vol_type=vol_type)
+    encryptor_ids.append(instance.id)
+
+    _wait_for_encryption(aws_svc, enc_svc_cls, values, instance,
+                         root_size=size)
+    aws_svc.stop_instance(instance.id)
+    instance = wait_for_instance(aws_svc, instance.id, state='stopped')
+
+    encrypted_dev = boto3_device.get_device(
+        instance.block_device_mappings, '/dev/sdg')
+    encrypted_snap = aws_svc.create_snapshot(
+        boto3_device.get_volume_id(encrypted_dev),
+        name=NAME_ENCRYPTED_DATA_SNAPSHOT,
+        description=DESCRIPTION_SNAPSHOT % {'image_id': values.ami})
+    snapshot_ids.append(encrypted_snap.id)
+    wait_for_snapshots(aws_svc, encrypted_snap.id)
+    log.info('Encrypted data volume %s is ready.', device_name)
+
+    iops = None
+    throughput = None
+    if ebs.get('VolumeType') in ebs_performance.PROVISIONED_IOPS_TYPES:
+        iops = ebs.get('Iops')
+    elif ebs.get('VolumeType') == ebs_performance.VOLUME_TYPE_GP3:
+        iops = ebs.get('Iops')
+        throughput = ebs.get('Throughput')
+    return boto3_device.make_device(
+        device_name=device_name,
+        volume_type=ebs.get('VolumeType'),
+        iops=iops,
+        throughput=throughput,
+        snapshot_id=encrypted_snap.id,
+        delete_on_termination=ebs.get('DeleteOnTermination')
+    )
+
+
+def _get_encryptor_zone(aws_svc, values, placement):
+    """ Return the availability zone that the encryptor instance will be
+    launched in, or None if it's chosen by EC2.
+    """
+    if placement:
+        return placement.get('AvailabilityZone')
+    if values.subnet_id:
+        return aws_svc.get_subnet(values.subnet_id).availability_zone
+    return None
+
+
+def _get_resumed_encryptor(aws_svc, instance_id, journal):
+    """ Return the encryptor instance of a session that is being resumed.
+
+    :raise BracketError if the encryptor instance can't be used
+    """
+    instance = aws_svc.get_instance(instance_id)
+    state = instance.state['Name']
+    log.info('Reattaching to encryptor instance %s (%s).', instance_id, state)
+
+    # The encryptor is stopped after encryption completes.  Before that,
+    # it has to be running for us to read the encryption status.
+    expected_states = ('running',)
+    if journal.is_complete(PHASE_ENCRYPTED):
+        expected_states = ('running', 'stopping', 'stopped')
+    if state not in expected_states:
+        raise BracketError(
+            'Unable to resume session %s: encryptor instance %s is %s' %
+            (aws_svc.session_id, instance_id, state)
         )
+    return instance
+
+
+def _clean_up_session(aws_svc, values, encryptor_instance=None,
+                      encrypted_image=None, guest_instance=None,
+                      snapshot_id=None, temp_sg_id=None,
+                      stale_instance_ids=None, data_encryptor_ids=None,
+                      data_snapshot_ids=None):
+    instance_ids = list(stale_instance_ids or [])
+    if guest_instance:
+        instance_ids.append(guest_instance.id)
+
+    encryptor_ids = list(data_encryptor_ids or [])
+    if encryptor_instance:
+        encryptor_ids.append(encryptor_instance.id)
+    terminate_encryptor = (
+        encryptor_ids and
+        (encrypted_image or values.terminate_encryptor_on_failure)
+    )
+
+    if terminate_encryptor:
+        instance_ids.extend(encryptor_ids)
+    elif encryptor_ids:
+        log.info('Not terminating encryptor instances %s',
+                 ', '.join(encryptor_ids))
+
+    # Delete volumes explicitly.  They should get cleaned up during
+    # instance deletion, but we've gotten reports that occasionally
+    # volumes can get orphaned.
+    #
+    # We can't do this if we're keeping the encryptor instance around,
+    # since its volumes will still be attached.
+    volume_ids = None
+    if terminate_encryptor:
+        try:
+            volumes = aws_svc.get_volumes(
+                tag_key=TAG_ENCRYPTOR_SESSION_ID,
+                tag_value=aws_svc.session_id
+            )
+            volume_ids = [v.id for v in volumes]
+        except ClientError as e:
+            log.warn('Unable to clean up orphaned volumes: %s', e)
+        except:
+            log.exception('Unable to clean up orphaned volumes')
+
+    sg_ids = []
+    if temp_sg_id and terminate_encryptor:
+        sg_ids.append(temp_sg_id)
+
+    snapshot_ids = []
+    if snapshot_id:
+        snapshot_ids.append(snapshot_id)
+    if not encrypted_image:
+        # On success, the encrypted data snapshots are part of the AMI.
+        snapshot_ids.extend(data_snapshot_ids or [])
+
+    clean_up(
+        aws_svc,
+        instance_ids=instance_ids,
+        volume_ids=volume_ids,
+        snapshot_ids=snapshot_ids,
+        security_group_ids=sg_ids
+    )
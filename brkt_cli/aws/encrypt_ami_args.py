@@ -17,7 +17,15 @@ from brkt_cli.util import (
     CRYPTO_GCM,
     CRYPTO_XTS
 )
-from brkt_cli.aws import aws_args
+from brkt_cli.aws import aws_args, ebs_performance
+from brkt_cli.validation import ValidationError, min_int_argument
+
+
+def _parse_instance_types(value):
+    try:
+        return ebs_performance.parse_instance_types(value)
+    except ValidationError as e:
+        raise argparse.ArgumentTypeError(e.message)
 
 
 def setup_encrypt_ami_args(parser, parsed_config):
@@ -39,6 +47,15 @@ def setup_encrypt_ami_args(parser, parsed_config):
         help='Specify the name of the generated encrypted AMI',
         required=False
     )
+    aws_args.add_replicate_region(parser)
+    aws_args.add_resume(parser)
+    add_encrypt_options(parser, parsed_config)
+
+
+def add_encrypt_options(parser, parsed_config):
+    """ Add the options that control how a guest AMI is encrypted.  These
+    are shared by the encrypt and encrypt-batch subcommands.
+    """
     parser.add_argument(
         '--guest-instance-type',
         metavar='TYPE',
@@ -54,9 +71,103 @@ def setup_encrypt_ami_args(parser, parsed_config):
         dest='encryptor_instance_type',
         help=(
             'The instance type to use when running the Bracket encryptor '
-            'instance'),
+            'instance.  Specify "%s" to choose the instance type based on '
+            'the root volume size and the EBS bandwidth of each instance '
+            'type' % ebs_performance.AUTO_INSTANCE_TYPE),
         default='c4.xlarge'
     )
+    parser.add_argument(
+        '--encryptor-instance-types',
+        metavar='TYPES',
+        dest='encryptor_instance_types',
+        type=_parse_instance_types,
+        help=(
+            'Comma-separated list of the instance types that '
+            '--encryptor-instance-type %s chooses from (default: %s)' % (
+                ebs_performance.AUTO_INSTANCE_TYPE,
+                ','.join(ebs_performance.DEFAULT_AUTO_INSTANCE_TYPES))
+        ),
+        default=parsed_config.get_option('aws.encryptor-instance-types')
+    )
+
+    parser.add_argument(
+        '--guestless',
+        dest='guestless',
+        action='store_true',
+        default=False,
+        help=(
+            "Don't launch an instance based on the guest AMI.  Encrypt the "
+            "root snapshot referenced by the AMI and register the encrypted "
+            "AMI directly from snapshots.  Billing product codes from the "
+            "guest AMI are not preserved in this mode"
+        )
+    )
+
+    parser.add_argument(
+        '--skip-if-exists',
+        dest='skip_if_exists',
+        action='store_true',
+        default=False,
+        help=(
+            'If the guest AMI was already encrypted in this region with the '
+            'same encryptor AMI and crypto policy, print the ID of the '
+            'existing encrypted AMI instead of encrypting it again.  '
+            'Lookups are cached in ~/.brkt/encrypted_amis.json'
+        )
+    )
+
+    parser.add_argument(
+        '--encrypt-data-volumes',
+        dest='encrypt_data_volumes',
+        action='store_true',
+        default=False,
+        help=(
+            'Also encrypt the EBS data volumes in the guest AMI, with one '
+            'additional encryptor instance per volume.  By default, only '
+            'the root volume is encrypted'
+        )
+    )
+    parser.add_argument(
+        '--data-volume-encryptors',
+        metavar='N',
+        dest='data_volume_encryptors',
+        type=lambda value: min_int_argument(value, 1),
+        default=4,
+        help=(
+            'The maximum number of encryptor instances that encrypt EBS '
+            'data volumes at the same time, in addition to the one that '
+            'encrypts the root volume'
+        )
+    )
+
+    parser.add_argument(
+        '--fast-snapshot-restore',
+        dest='fast_snapshot_restore',
+        action='store_true',
+        default=False,
+        help=(
+            'Enable EBS Fast Snapshot Restore on the unencrypted root '
+            'snapshot while the encryptor volumes are created.  This '
+            'speeds up encryption of large volumes, and is billed by AWS '
+            'while it is enabled'
+        )
+    )
+
+    parser.add_argument(
+        '--encryptor-volume-type',
+        metavar='TYPE',
+        dest='encryptor_volume_type',
+        choices=ebs_performance.ENCRYPTOR_VOLUME_TYPES,
+        default=ebs_performance.VOLUME_TYPE_GP2,
+        help=(
+            'The EBS volume type of the unencrypted and encrypted volumes '
+            'attached to the encryptor instance (%s).  For gp3, io1 and '
+            'io2, IOPS and throughput are provisioned based on the root '
+            'volume size.  The encrypted AMI keeps the volume type of the '
+            'guest root volume (default: %%(default)s)' %
+            ', '.join(ebs_performance.ENCRYPTOR_VOLUME_TYPES)
+        )
+    )
 
     # Add the --legacy argument, for specifying legacy mode during
     # encryption and update.  This hidden argument is only here for backward
@@ -0,0 +1,198 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Encrypt a batch of AMIs concurrently.
+
+The manifest is a YAML or JSON list.  Each entry is either a guest AMI ID
+or a dictionary with the following keys:
+
+    ami: the guest AMI ID (required)
+    encrypted_ami_name: the name of the encrypted AMI (optional)
+    aws_tags: a dictionary of AWS tags that are set on resources created
+        while encrypting this AMI, in addition to the tags specified on
+        the command line (optional)
+
+Each AMI is encrypted in its own session, with its own AWSService.
+"""
+import logging
+
+import yaml
+
+from brkt_cli import util
+from brkt_cli.aws import aws_service, encrypt_ami
+from brkt_cli.validation import ValidationError
+
+log = logging.getLogger(__name__)
+
+
+class ManifestEntry(object):
+
+    def __init__(self, ami, encrypted_ami_name=None, aws_tags=None):
+        self.ami = ami
+        self.encrypted_ami_name = encrypted_ami_name
+        self.aws_tags = aws_tags or {}
+
+    def __repr__(self):
+        return 'ManifestEntry:%s' % self.ami
+
+
+class EncryptJob(object):
+    """ The state of a single encryption within a batch. """
+
+    def __init__(self, aws_svc, values, instance_config=None):
+        self.aws_svc = aws_svc
+        self.values = values
+        self.instance_config = instance_config
+        self.encrypted_ami_id = None
+        self.error = None
+
+    @property
+    def ami(self):
+        return self.values.ami
+
+    @property
+    def session_id(self):
+        return self.aws_svc.session_id
+
+    def __repr__(self):
+        return 'EncryptJob:%s' % self.ami
+
+
+def _parse_entry(entry):
+    if isinstance(entry, basestring):
+        return ManifestEntry(entry)
+    if not isinstance(entry, dict):
+        raise ValidationError(
+            'Manifest entries must be an AMI ID or a dictionary: %s' % entry)
+
+    unknown_keys = set(entry.keys()) - {'ami', 'encrypted_ami_name',
+                                        'aws_tags'}
+    if unknown_keys:
+        raise ValidationError(
+            'Unknown manifest keys: %s' % ', '.join(sorted(unknown_keys)))
+    if not entry.get('ami'):
+        raise ValidationError('Manifest entry is missing "ami": %s' % entry)
+
+    aws_tags = entry.get('aws_tags') or {}
+    if not isinstance(aws_tags, dict):
+        raise ValidationError(
+            'aws_tags for %s must be a dictionary' % entry['ami'])
+    for key, value in aws_tags.iteritems():
+        aws_service.validate_tag_key(str(key))
+        aws_service.validate_tag_value(str(value))
+
+    return ManifestEntry(
+        entry['ami'],
+        encrypted_ami_name=entry.get('encrypted_ami_name'),
+        aws_tags={str(k): str(v) for k, v in aws_tags.iteritems()}
+    )
+
+
+def parse_manifest(manifest_yaml):
+    """ Parse the contents of a batch manifest.
+
+    :return: a list of ManifestEntry objects
+    :raise ValidationError if the manifest is malformed
+    """
+    try:
+        d = yaml.safe_load(manifest_yaml)
+    except yaml.YAMLError as e:
+        raise ValidationError('Unable to parse manifest: %s' % e)
+
+    if not isinstance(d, list) or not d:
+        raise ValidationError('Manifest must be a non-empty list of AMIs')
+
+    entries = [_parse_entry(entry) for entry in d]
+
+    amis = [entry.ami for entry in entries]
+    duplicates = set(ami for ami in amis if amis.count(ami) > 1)
+    if duplicates:
+        raise ValidationError(
+            'Manifest contains duplicate AMIs: %s' %
+            ', '.join(sorted(duplicates)))
+
+    names = [entry.encrypted_ami_name for entry in entries
+             if entry.encrypted_ami_name]
+    duplicates = set(name for name in names if names.count(name) > 1)
+    if duplicates:
+        raise ValidationError(
+            'Manifest contains duplicate encrypted AMI names: %s' %
+            ', '.join(sorted(duplicates)))
+
+    return entries
+
+
+def read_manifest(path):
+    """ Read and parse the batch manifest at the given path.
+
+    :return: a list of ManifestEntry objects
+    :raise ValidationError if the file can't be read or is malformed
+    """
+    try:
+        with open(path) as f:
+            content = f.read()
+    except IOError as e:
+        log.debug('Unable to read %s: %s', path, e)
+        raise ValidationError('Unable to read %s' % path)
+    return parse_manifest(content)
+
+
+def _run_job(job, enc_svc_cls):
+    try:
+        job.encrypted_ami_id = encrypt_ami.encrypt(
+            aws_svc=job.aws_svc,
+            enc_svc_cls=enc_svc_cls,
+            values=job.values,
+            instance_config=job.instance_config
+        )
+    except Exception as e:
+        log.debug('', exc_info=1)
+        log.error(
+            'Session %s failed to encrypt %s: %s', job.session_id, job.ami, e)
+        job.error = e
+    return job
+
+
+def encrypt_many(jobs, enc_svc_cls, max_parallel=4):
+    """ Run encrypt_ami.encrypt() for each of the given EncryptJobs, with at
+    most max_parallel encryptions running at the same time.  Jobs that
+    already have encrypted_ami_id set, because the AMI was encrypted
+    earlier, are skipped.  A failed encryption does not stop the other
+    jobs.
+
+    :return: the list of jobs, with encrypted_ami_id or error set
+    """
+    pending = [job for job in jobs if not job.encrypted_ami_id]
+    log.info(
+        'Encrypting %d AMIs, %d at a time', len(pending),
+        min(max_parallel, len(pending)))
+    util.parallel_map(
+        lambda job: _run_job(job, enc_svc_cls),
+        pending,
+        max_workers=max_parallel
+    )
+    return jobs
+
+
+def render_results(jobs):
+    """ Render the per-AMI outcome of a batch as a table. """
+    rows = [['AMI', 'SESSION', 'RESULT']]
+    for job in jobs:
+        if job.encrypted_ami_id:
+            result = job.encrypted_ami_id
+        else:
+            result = 'failed: %s' % job.error
+        rows.append([job.ami, job.session_id, result])
+    return util.render_table_rows(rows)
@@ -225,6 +225,7 @@ class Instance(TaggedEC2Object):
         self.client_token = None
         self.eventsSet = None
         self.groups = []
+        self.security_groups = []
         self.platform = None
         self.interfaces = []
         self.hypervisor = None
@@ -336,6 +337,8 @@ class Volume(TaggedEC2Object):
     :ivar volume_type: The type of volume (standard or consistent-iops)
     :ivar iops: If this volume is of type consistent-iops, this is
         the number of IOPS provisioned (10-300).
+    :ivar throughput: The throughput provisioned for a gp3 volume, in
+        MiB/s.
     :ivar encrypted: True if this volume is encrypted.
     """
 
@@ -350,6 +353,7 @@ class Volume(TaggedEC2Object):
         self.zone = None
         self.volume_type = None
         self.iops = None
+        self.throughput = None
         self.encrypted = None
         self.volume_type = 'gp2'
 
@@ -0,0 +1,258 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Client-side rate limiting of EC2 API calls.
+
+EC2 throttles each account with a token bucket per family of API
+actions.  When several encryption sessions run at the same time, each
+one backing off independently after being throttled still produces
+bursts that get throttled again.  A RateLimiter keeps a token bucket
+for each region and action family, shared by all AWSService objects in
+the process.  Every call, and every retry of a throttled call, takes a
+token before it's sent.  When a call is throttled, the rate of its family
+in that region is halved, and it recovers gradually as calls succeed.
+
+The limiter hooks into the botocore event system, so it covers calls
+made through both clients and resources.
+"""
+
+import logging
+import threading
+import time
+
+from brkt_cli import util
+
+log = logging.getLogger(__name__)
+
+DESCRIBE = 'describe'
+MUTATE = 'mutate'
+RUN_INSTANCES = 'run-instances'
+FAMILIES = (DESCRIBE, MUTATE, RUN_INSTANCES)
+
+# (calls per second, burst size) for each action family.  These are
+# somewhat below the default EC2 account limits, which leaves room for
+# other clients in the same account.
+DEFAULT_LIMITS = {
+    DESCRIBE: (15.0, 80),
+    MUTATE: (4.0, 40),
+    RUN_INSTANCES: (1.5, 5)
+}
+
+THROTTLING_ERROR_CODES = (
+    'RequestLimitExceeded', 'Throttling', 'ThrottlingException'
+)
+
+# After a throttling error, don't go below this fraction of the
+# maximum rate.
+MIN_RATE_FRACTION = 0.05
+
+# Each successful call raises the rate by this fraction of the maximum
+# rate, until the maximum is reached.
+RECOVERY_FRACTION = 0.02
+
+
+def get_family(operation_name):
+    """ Return the action family for the given API operation name,
+    for example DescribeInstances.
+    """
+    if operation_name == 'RunInstances':
+        return RUN_INSTANCES
+    if operation_name.startswith(('Describe', 'Get')):
+        return DESCRIBE
+    return MUTATE
+
+
+class TokenBucket(object):
+    """ Allows calls at up to max_rate per second, with bursts of up to
+    capacity calls.  The current rate is lowered when the caller reports
+    throttling.
+    """
+
+    def __init__(self, max_rate, capacity):
+        self.max_rate = float(max_rate)
+        self.min_rate = self.max_rate * MIN_RATE_FRACTION
+        self.rate = self.max_rate
+        self.capacity = capacity
+        self.calls = 0
+        self.throttled_calls = 0
+        self.wait_seconds = 0.0
+        self._tokens = float(capacity)
+        self._last_refill = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(0.0, now - self._last_refill)
+        self._tokens = min(
+            float(self.capacity), self._tokens + elapsed * self.rate)
+        self._last_refill = now
+
+    def acquire(self):
+        """ Take a token, sleeping until one is available.
+
+        :return the number of seconds spent waiting
+        """
+        with self._lock:
+            self._refill(time.time())
+            self.calls += 1
+            # Reserve the token now, so that concurrent callers queue up
+            # behind each other instead of all waking up at once.
+            self._tokens -= 1
+            wait = 0.0
+            if self._tokens < 0:
+                wait = -self._tokens / self.rate
+                self.wait_seconds += wait
+        if wait:
+            util.sleep(wait)
+        return wait
+
+    def throttled(self):
+        """ Halve the rate and drop the remaining burst. """
+        with self._lock:
+            self.throttled_calls += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 0.0)
+            rate = self.rate
+        log.debug('Throttled.  Lowering the rate to %.2f/s', rate)
+
+    def succeeded(self):
+        """ Raise the rate gradually, back toward the maximum. """
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(
+                    self.max_rate,
+                    self.rate + self.max_rate * RECOVERY_FRACTION
+                )
+
+
+class RateLimiter(object):
+    """ Keeps a TokenBucket for each region and action family, since EC2
+    throttles each region separately.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = limits or DEFAULT_LIMITS
+        # Maps (region, family) to the TokenBucket.
+        self.buckets = {}
+        self._lock = threading.Lock()
+        # The family whose throttled call is about to be retried by this
+        # thread, or None.
+        self._local = threading.local()
+
+    def get_bucket(self, region, family):
+        with self._lock:
+            bucket = self.buckets.get((region, family))
+            if not bucket:
+                rate, capacity = self.limits[family]
+                bucket = TokenBucket(rate, capacity)
+                self.buckets[(region, family)] = bucket
+            return bucket
+
+    def install(self, client):
+        """ Rate limit all EC2 calls made by the given boto3 client. """
+        region = client.meta.region_name
+
+        def _before_call(**kwargs):
+            self._before_call(region, **kwargs)
+
+        def _request_created(**kwargs):
+            self._request_created(region, **kwargs)
+
+        def _after_call(**kwargs):
+            self._after_call(region, **kwargs)
+
+        def _needs_retry(**kwargs):
+            return self._needs_retry(region, **kwargs)
+
+        events = client.meta.events
+        events.register('before-call.ec2', _before_call)
+        # Wait before the retry is signed.
+        events.register_first('request-created.ec2', _request_created)
+        events.register('after-call.ec2', _after_call)
+        events.register('needs-retry.ec2', _needs_retry)
+
+    def acquire(self, region, operation_name):
+        return self.get_bucket(region, get_family(operation_name)).acquire()
+
+    def _before_call(self, region, model=None, **kwargs):
+        self._local.retry_family = None
+        wait = self.acquire(region, model.name)
+        if wait:
+            log.debug('Waited %.2f seconds to call %s', wait, model.name)
+
+    def _request_created(self, region, operation_name=None, **kwargs):
+        # Called by botocore before each attempt.  The first attempt
+        # already took a token in _before_call().
+        if getattr(self._local, 'retry_family', None):
+            self._local.retry_family = None
+            self.acquire(region, operation_name)
+
+    def _after_call(self, region, http_response=None, model=None, **kwargs):
+        if http_response is not None and http_response.status_code < 300:
+            self.get_bucket(region, get_family(model.name)).succeeded()
+
+    def _needs_retry(self, region, response=None, operation=None, **kwargs):
+        # Called by botocore after each attempt, including the last one.
+        # Return None so that botocore's retry decision is unchanged.
+        if response is None or operation is None:
+            return None
+        if response[0].status_code < 300:
+            return None
+        if _is_throttling_error(response[1]):
+            # Lower the rate of everything else in the family.  If
+            # botocore retries, the retry takes a token in
+            # _request_created(), so that it's held back too.
+            family = get_family(operation.name)
+            self.get_bucket(region, family).throttled()
+            self._local.retry_family = family
+        return None
+
+    def __str__(self):
+        elements = []
+        with self._lock:
+            buckets = dict(self.buckets)
+        for region in sorted(set(r for r, _ in buckets)):
+            for family in FAMILIES:
+                bucket = buckets.get((region, family))
+                if bucket and bucket.calls:
+                    elements.append(
+                        '%s %s: %d calls, %d throttled, waited %.1f '
+                        'seconds' % (
+                            region, family, bucket.calls,
+                            bucket.throttled_calls, bucket.wait_seconds
+                        )
+                    )
+        return '; '.join(elements) or 'no calls'
+
+
+def _is_throttling_error(parsed):
+    if not parsed:
+        return False
+    code = parsed.get('Error', {}).get('Code')
+    return code in THROTTLING_ERROR_CODES
+
+
+_default_limiter = None
+_default_limiter_lock = threading.Lock()
+
+
+def get_default():
+    """ Return the RateLimiter that is shared by all AWSService objects in
+    this process.
+    """
+    global _default_limiter
+    with _default_limiter_lock:
+        if not _default_limiter:
+            _default_limiter = RateLimiter()
+        return _default_limiter
@@ -0,0 +1,275 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Copy an encrypted AMI to other regions.
+
+When the AMI is available in the source region, it's copied to all of
+the target regions at the same time with CopyImage.  EC2 limits the
+number of concurrent snapshot copies into each destination region, and
+every snapshot referenced by the AMI counts against the limit.  A
+SnapshotCopyLimiter, shared by all of the copies in the process, holds
+back a copy until its snapshots fit under the limit.
+
+The copies are tagged with the default tags of the session, and their
+snapshots get the same Name tags as the snapshots of the source AMI.  If
+a copy fails or times out, the partial copy and its snapshots are
+deleted.
+"""
+
+import logging
+import threading
+
+from brkt_cli import util
+from brkt_cli.aws import aws_service, boto3_device, boto3_tag
+from brkt_cli.util import BracketError, Deadline
+from brkt_cli.validation import ValidationError
+
+log = logging.getLogger(__name__)
+
+# The maximum number of concurrent snapshot copies into a single
+# destination region.
+MAX_CONCURRENT_SNAPSHOT_COPIES = 20
+
+COPY_POLL_SECONDS = 15
+COPY_TIMEOUT = 60 * 60 * 3
+
+
+class SnapshotCopyLimiter(object):
+    """ Limits the number of snapshots that are being copied into each
+    region at the same time.
+    """
+
+    def __init__(self, limit=MAX_CONCURRENT_SNAPSHOT_COPIES):
+        self.limit = limit
+        self.in_use = {}
+        self._cond = threading.Condition()
+
+    def acquire(self, region, count):
+        """ Wait until count more snapshot copies into the region are
+        allowed.  A request for more than the limit waits until no other
+        copies are running.
+
+        :return the number of copies that were acquired, which must be
+            passed to release()
+        """
+        count = min(count, self.limit)
+        with self._cond:
+            while self.in_use.get(region, 0) + count > self.limit:
+                log.debug(
+                    'Waiting for %d snapshot copies to %s', count, region)
+                self._cond.wait()
+            self.in_use[region] = self.in_use.get(region, 0) + count
+        return count
+
+    def release(self, region, count):
+        with self._cond:
+            self.in_use[region] -= count
+            self._cond.notify_all()
+
+
+_default_limiter = None
+_default_limiter_lock = threading.Lock()
+
+
+def get_default_limiter():
+    """ Return the SnapshotCopyLimiter that is shared by all copies in this
+    process.
+    """
+    global _default_limiter
+    with _default_limiter_lock:
+        if not _default_limiter:
+            _default_limiter = SnapshotCopyLimiter()
+        return _default_limiter
+
+
+class Replica(object):
+    """ The outcome of copying an AMI to a single region. """
+
+    def __init__(self, region):
+        self.region = region
+        self.image_id = None
+        self.error = None
+
+    def __repr__(self):
+        return 'Replica:%s' % self.region
+
+
+def validate_regions(source_region, regions, region_names=None):
+    """ Check the list of regions that an AMI will be copied to.
+
+    :param region_names all AWS region names, or None to skip checking
+        that the regions exist
+    :return the regions, without duplicates
+    :raise ValidationError if a region is invalid
+    """
+    unique = []
+    for region in regions or []:
+        if region == source_region:
+            raise ValidationError(
+                'Cannot copy the AMI to the source region %s' % region)
+        if region_names is not None and region not in region_names:
+            raise ValidationError(
+                '%s does not exist.  AWS regions are %s' %
+                (region, ', '.join(region_names))
+            )
+        if region not in unique:
+            unique.append(region)
+    return unique
+
+
+def replicate_image(aws_svc, image_id, regions, connect, limiter=None):
+    """ Copy the image to each of the given regions concurrently.  A
+    failed copy does not stop the others.
+
+    :param aws_svc the service for the source region
+    :param connect a function that takes a region name and returns a
+        BaseAWSService that's connected to that region, with its default
+        tags set
+    :param limiter the SnapshotCopyLimiter, or None for the default
+    :return a list of Replica objects, in the same order as regions
+    """
+    limiter = limiter or get_default_limiter()
+    image = aws_svc.get_image(image_id)
+
+    # Copy the Name tags of the source snapshots to the new ones.
+    snapshot_names = {}
+    for d in image.block_device_mappings:
+        snapshot_id = boto3_device.get_snapshot_id(d)
+        if snapshot_id:
+            snapshot = aws_svc.get_snapshot(snapshot_id)
+            snapshot_names[d['DeviceName']] = \
+                boto3_tag.get_value(snapshot.tags or [], 'Name')
+
+    log.info('Copying %s to %s', image_id, ', '.join(regions))
+    return util.parallel_map(
+        lambda region: _copy_to_region(
+            aws_svc, image, region, connect, limiter, snapshot_names),
+        regions,
+        max_workers=max(len(regions), 1)
+    )
+
+
+def _copy_to_region(aws_svc, image, region, connect, limiter,
+                    snapshot_names):
+    replica = Replica(region)
+    try:
+        dest_svc = connect(region)
+        count = limiter.acquire(region, max(len(snapshot_names), 1))
+        try:
+            replica.image_id = dest_svc.copy_image(
+                aws_svc.region, image.id, image.name,
+                description=image.description
+            )
+            copy = _wait_for_copy(dest_svc, replica.image_id, region)
+        finally:
+            limiter.release(region, count)
+
+        for d in copy.block_device_mappings:
+            snapshot_id = boto3_device.get_snapshot_id(d)
+            if snapshot_id:
+                dest_svc.create_tags(
+                    snapshot_id, name=snapshot_names.get(d['DeviceName']))
+        log.info('%s: %s is available', region, replica.image_id)
+    except Exception as e:
+        log.debug('', exc_info=1)
+        log.error('Unable to copy %s to %s: %s', image.id, region, e)
+        replica.error = e
+        if replica.image_id:
+            _delete_copy(dest_svc, replica.image_id, region)
+            replica.image_id = None
+    return replica
+
+
+def _delete_copy(aws_svc, image_id, region):
+    """ Deregister a partial copy and delete its snapshots.  Errors are
+    logged, since the copy already failed.
+    """
+    try:
+        images = aws_svc.get_images(image_ids=[image_id])
+        snapshot_ids = []
+        if images:
+            snapshot_ids = [
+                boto3_device.get_snapshot_id(d)
+                for d in images[0].block_device_mappings or []
+            ]
+        aws_svc.deregister_image(image_id)
+        for snapshot_id in snapshot_ids:
+            if snapshot_id:
+                aws_svc.delete_snapshot(snapshot_id)
+    except Exception as e:
+        log.debug('', exc_info=1)
+        log.warn('Unable to delete %s in %s: %s', image_id, region, e)
+
+
+def _get_progress(aws_svc, image):
+    """ Return the average progress of the snapshots referenced by the
+    image as a percentage, or None if it's not known yet.
+    """
+    snapshot_ids = [
+        boto3_device.get_snapshot_id(d)
+        for d in image.block_device_mappings or []
+    ]
+    snapshot_ids = [s for s in snapshot_ids if s]
+    if not snapshot_ids:
+        return None
+    snapshots = aws_svc.get_snapshots(*snapshot_ids)
+    if len(snapshots) != len(snapshot_ids):
+        return None
+    total = 0
+    for snapshot in snapshots:
+        total += int((snapshot.progress or '0').rstrip('%') or 0)
+    return total / len(snapshots)
+
+
+def _wait_for_copy(aws_svc, image_id, region, timeout=COPY_TIMEOUT):
+    """ Wait for the copied image to become available, and log the
+    progress of its snapshots.
+
+    :return the Image
+    :raise BracketError if the copy fails or times out
+    """
+    deadline = Deadline(timeout)
+    last_progress = None
+    while True:
+        # get_images() bypasses the cache, so that we see the current
+        # state.  The copy may not be visible right away.
+        images = aws_svc.get_images(image_ids=[image_id])
+        if images:
+            image = images[0]
+            if aws_service.check_image_state(image):
+                return image
+            progress = _get_progress(aws_svc, image)
+            if progress is not None and progress != last_progress:
+                log.info('%s: copying %s, %d%% complete',
+                         region, image_id, progress)
+                last_progress = progress
+        if deadline.is_expired():
+            raise BracketError(
+                'Timed out waiting for %s to be copied to %s' %
+                (image_id, region)
+            )
+        util.sleep(COPY_POLL_SECONDS)
+
+
+def render_results(source_region, image_id, replicas):
+    """ Render the AMI ID in each region as a table. """
+    rows = [['REGION', 'AMI'], [source_region, image_id]]
+    for replica in replicas:
+        if replica.error:
+            result = 'failed: %s' % replica.error
+        else:
+            result = replica.image_id
+        rows.append([replica.region, result])
+    return util.render_table_rows(rows)
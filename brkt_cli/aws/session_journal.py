@@ -0,0 +1,216 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Local journal of the resources created and the phases completed by an
+encrypt or update session.
+
+The journal is written to ~/.brkt/sessions/<session id>.json each time a
+resource is created or a phase completes.  If the process is interrupted,
+or fails with a network error or a transient AWS error, the resources are
+left running and the journal is kept, so that the same command can be run
+with --resume to continue from the last completed phase instead of
+starting over.  The journal is deleted when the session
+finishes or its resources are cleaned up.
+"""
+
+import errno
+import json
+import logging
+import os
+import tempfile
+
+from brkt_cli.aws.aws_constants import TAG_ENCRYPTOR_SESSION_ID
+from brkt_cli.config import CONFIG_DIR
+from brkt_cli.validation import ValidationError
+
+log = logging.getLogger(__name__)
+
+SESSIONS_DIR = os.path.join(CONFIG_DIR, 'sessions')
+
+# Phases of an encrypt or update session, in order.
+PHASE_GUEST_SNAPSHOT = 'guest_snapshot'
+PHASE_ENCRYPTOR_LAUNCHED = 'encryptor_launched'
+PHASE_ENCRYPTED = 'encrypted'
+PHASE_SNAPSHOTTED = 'snapshotted'
+
+
+class SessionJournal(object):
+    """ Records the resources and completed phases of a session.  If path
+    is None, the journal is only kept in memory.
+    """
+
+    def __init__(self, session_id, path=None, data=None):
+        self.session_id = session_id
+        self.path = path
+        self.data = data or {
+            'session_id': session_id,
+            'command': None,
+            'region': None,
+            'values': {},
+            'phases': [],
+            'resources': {}
+        }
+
+    @property
+    def command(self):
+        return self.data['command']
+
+    @property
+    def region(self):
+        return self.data['region']
+
+    @property
+    def phases(self):
+        """ The phases that were completed, in order. """
+        return self.data['phases']
+
+    @property
+    def values(self):
+        """ The command-line values that must not change when the session
+        is resumed.
+        """
+        return self.data['values']
+
+    def get(self, name, default=None):
+        """ Return the recorded value of a resource. """
+        return self.data['resources'].get(name, default)
+
+    def record(self, **resources):
+        """ Record the ids or attributes of resources that were created. """
+        log.debug('Session %s: recording %s', self.session_id, resources)
+        self.data['resources'].update(resources)
+        self.save()
+
+    def is_complete(self, phase):
+        return phase in self.data['phases']
+
+    def complete_phase(self, phase, **resources):
+        """ Mark the phase as complete, along with the resources that it
+        produced.
+        """
+        log.debug('Session %s: completed %s', self.session_id, phase)
+        self.data['resources'].update(resources)
+        if phase not in self.data['phases']:
+            self.data['phases'].append(phase)
+        self.save()
+
+    def save(self):
+        """ Write the journal to disk.  The file is replaced atomically, so
+        that a crash doesn't leave a partial journal behind.
+        """
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory, 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        f = tempfile.NamedTemporaryFile(
+            dir=directory, prefix='.journal-', delete=False)
+        try:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+            f.close()
+            os.rename(f.name, self.path)
+        except:
+            _unlink_noraise(f.name)
+            raise
+
+    def delete(self):
+        if self.path:
+            log.debug('Deleting session journal %s', self.path)
+            _unlink_noraise(self.path)
+
+
+def _unlink_noraise(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            log.warn('Unable to delete %s: %s', path, e)
+
+
+def get_path(session_id, directory=None):
+    return os.path.join(directory or SESSIONS_DIR, '%s.json' % session_id)
+
+
+def create(session_id, command, region, values, directory=None):
+    """ Create and save the journal for a new session.
+
+    :param values: a dictionary of the command-line values that must not
+        change when the session is resumed
+    :return the SessionJournal
+    """
+    journal = SessionJournal(session_id, path=get_path(session_id, directory))
+    journal.data['command'] = command
+    journal.data['region'] = region
+    journal.data['values'] = values
+    journal.save()
+    log.debug('Writing session journal to %s', journal.path)
+    return journal
+
+
+def load(session_id, command, region, directory=None):
+    """ Load the journal of a session that is being resumed.
+
+    :return the SessionJournal
+    :raise ValidationError if there's no journal for the session, or the
+        session was started by another command or in another region
+    """
+    path = get_path(session_id, directory)
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            raise ValidationError(
+                'Unable to find session %s in %s' %
+                (session_id, os.path.dirname(path))
+            )
+        raise
+    except ValueError as e:
+        raise ValidationError('Unable to read %s: %s' % (path, e))
+
+    journal = SessionJournal(session_id, path=path, data=data)
+    if journal.command != command:
+        raise ValidationError(
+            'Session %s was started by %s, not %s' %
+            (session_id, journal.command, command)
+        )
+    if journal.region != region:
+        raise ValidationError(
+            'Session %s was started in %s, not %s' %
+            (session_id, journal.region, region)
+        )
+    return journal
+
+
+def log_resume_hint(journal, exception):
+    """ Tell the user how to resume the session whose resources were kept
+    after the given exception, or how to clean them up.
+    """
+    if isinstance(exception, KeyboardInterrupt):
+        reason = 'Interrupted'
+    else:
+        reason = 'Failed with a transient error: %s' % exception
+    session_id = journal.session_id
+    log.info(
+        '%s.  Keeping the resources for session %s.  Run the same command '
+        'with --resume %s to continue, or terminate the instances tagged '
+        'with %s=%s and delete %s.',
+        reason, session_id, session_id, TAG_ENCRYPTOR_SESSION_ID,
+        session_id, journal.path
+    )
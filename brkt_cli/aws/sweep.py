@@ -0,0 +1,302 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Delete resources that were left behind by sessions that never cleaned up.
+
+Every instance, volume, snapshot and security group that encrypt and
+update create is tagged with the session ID.  If the process is killed,
+the cleanup in encrypt_ami.encrypt() doesn't run, and the resources count
+against the region's limits until they're deleted by hand.
+
+find_sessions() lists the tagged resources in a region with a single
+paginated DescribeTags call, describes them in bulk and groups them by
+session.  A session is orphaned when its newest resource is older than
+the minimum age.  Security groups don't have a creation time, so they
+don't affect the age, and a session that only has security groups left
+is never swept, since there's no way to tell whether it's still running.
+AMIs are never deleted, and snapshots that are
+referenced by an AMI are kept, since they belong to the encrypted AMIs
+that the sessions produced.
+
+sweep() scans all regions concurrently, and deletes the orphans in each
+region with aws_service.clean_up().  It terminates all of the instances
+with one request, and deletes volumes and security groups as soon as the
+instances that use them have terminated.
+"""
+
+import calendar
+import logging
+import time
+
+from brkt_cli import util
+from brkt_cli.aws import aws_service, boto3_device, ebs_performance
+from brkt_cli.aws.aws_constants import TAG_ENCRYPTOR_SESSION_ID
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MIN_AGE_HOURS = 24
+
+# The maximum number of ids that we pass to a single describe call.
+DESCRIBE_BATCH_SIZE = 200
+
+# Instances in these states no longer count against the instance limits.
+GONE_INSTANCE_STATES = ('shutting-down', 'terminated')
+
+
+def _get_timestamp(dt):
+    """ Convert a timestamp from a describe response to seconds since the
+    epoch.  A naive datetime is assumed to be in UTC.
+    """
+    if dt is None:
+        return None
+    return calendar.timegm(dt.utctimetuple())
+
+
+def _get_vcpus(instance_type):
+    if instance_type not in ebs_performance.INSTANCE_TYPES:
+        return 0
+    return ebs_performance.INSTANCE_TYPES[instance_type][0]
+
+
+def _chunks(ids):
+    ids = list(ids)
+    for i in xrange(0, len(ids), DESCRIBE_BATCH_SIZE):
+        yield ids[i:i + DESCRIBE_BATCH_SIZE]
+
+
+class SessionResources(object):
+    """ The resources of a single session in a single region, and the
+    limits that they use.
+    """
+
+    def __init__(self, region, session_id):
+        self.region = region
+        self.session_id = session_id
+        self.instance_ids = []
+        self.volume_ids = []
+        self.snapshot_ids = []
+        self.security_group_ids = []
+        self.vcpus = 0
+        self.volume_gib = 0
+        self.snapshot_gib = 0
+
+        # When the newest resource was created, in seconds since the
+        # epoch, or None if it's not known.
+        self.last_created = None
+
+    def add_timestamp(self, dt):
+        timestamp = _get_timestamp(dt)
+        if timestamp is None:
+            return
+        if self.last_created is None or timestamp > self.last_created:
+            self.last_created = timestamp
+
+    def __repr__(self):
+        return 'SessionResources:%s:%s' % (self.region, self.session_id)
+
+
+def _get_image_snapshot_ids(aws_svc):
+    """ Return the ids of the snapshots that are referenced by the
+    account's AMIs.
+    """
+    snapshot_ids = set()
+    for image in aws_svc.get_images(owner_alias='self'):
+        for d in image.block_device_mappings or []:
+            snapshot_id = boto3_device.get_snapshot_id(d)
+            if snapshot_id:
+                snapshot_ids.add(snapshot_id)
+    return snapshot_ids
+
+
+def find_sessions(aws_svc):
+    """ Find the resources in the service's region that are tagged with a
+    session ID.  Instances that are terminating and snapshots that are
+    referenced by an AMI are skipped.
+
+    :return a dictionary that maps the session ID to SessionResources
+    """
+    ids_by_type = {}
+    session_id_by_resource = {}
+    for tag in aws_svc.get_tagged_resources(TAG_ENCRYPTOR_SESSION_ID):
+        ids_by_type.setdefault(tag['ResourceType'], []).append(
+            tag['ResourceId'])
+        session_id_by_resource[tag['ResourceId']] = tag['Value']
+
+    sessions = {}
+
+    def _get_session(resource_id):
+        session_id = session_id_by_resource[resource_id]
+        if session_id not in sessions:
+            sessions[session_id] = SessionResources(
+                aws_svc.region, session_id)
+        return sessions[session_id]
+
+    for ids in _chunks(ids_by_type.get('instance', [])):
+        for instance in aws_svc.get_instances(*ids):
+            if instance.state['Name'] in GONE_INSTANCE_STATES:
+                continue
+            session = _get_session(instance.id)
+            session.instance_ids.append(instance.id)
+            session.vcpus += _get_vcpus(instance.instance_type)
+            session.add_timestamp(instance.launch_time)
+
+    for ids in _chunks(ids_by_type.get('volume', [])):
+        for volume in aws_svc.get_volumes(volume_ids=ids):
+            session = _get_session(volume.id)
+            session.volume_ids.append(volume.id)
+            session.volume_gib += volume.size or 0
+            session.add_timestamp(volume.create_time)
+
+    snapshot_ids = ids_by_type.get('snapshot', [])
+    if snapshot_ids:
+        image_snapshot_ids = _get_image_snapshot_ids(aws_svc)
+        for ids in _chunks(snapshot_ids):
+            for snapshot in aws_svc.get_snapshots(*ids):
+                if snapshot.id in image_snapshot_ids:
+                    continue
+                session = _get_session(snapshot.id)
+                session.snapshot_ids.append(snapshot.id)
+                session.snapshot_gib += snapshot.volume_size or 0
+                session.add_timestamp(snapshot.start_time)
+
+    for sg_id in ids_by_type.get('security-group', []):
+        _get_session(sg_id).security_group_ids.append(sg_id)
+
+    return sessions
+
+
+def get_orphans(sessions, min_age, now=None):
+    """ Return the sessions whose newest resource was created more than
+    min_age seconds ago, sorted by session ID.  Sessions whose age is not
+    known are skipped.
+    """
+    now = now or time.time()
+    orphans = []
+    for session in sorted(sessions.values(), key=lambda s: s.session_id):
+        if session.last_created is None:
+            log.debug('Skipping session %s in %s, which has no resources '
+                      'with a creation time', session.session_id,
+                      session.region)
+            continue
+        if now - session.last_created < min_age:
+            log.debug('Session %s in %s is still active',
+                      session.session_id, session.region)
+            continue
+        orphans.append(session)
+    return orphans
+
+
+class RegionSweep(object):
+    """ The orphaned sessions that were found in a region. """
+
+    def __init__(self, region):
+        self.region = region
+        self.sessions = []
+        self.error = None
+
+    def total(self, attr):
+        return sum(getattr(s, attr) for s in self.sessions)
+
+    def get_ids(self, attr):
+        return [id for s in self.sessions for id in getattr(s, attr)]
+
+    def count(self, attr):
+        return len(self.get_ids(attr))
+
+    def __repr__(self):
+        return 'RegionSweep:%s' % self.region
+
+
+def sweep_region(region, connect, min_age, dry_run=False, now=None):
+    """ Find the orphaned sessions in the region and delete their
+    resources.  Errors are logged and stored in the result, so that a
+    failure doesn't stop the other regions.
+
+    :param connect a function that takes a region name and returns a
+        BaseAWSService that's connected to that region
+    :param dry_run if True, only find the orphans
+    :return a RegionSweep
+    """
+    result = RegionSweep(region)
+    try:
+        aws_svc = connect(region)
+        result.sessions = get_orphans(
+            find_sessions(aws_svc), min_age, now=now)
+        for session in result.sessions:
+            log.info(
+                '%s: session %s left %d instances, %d volumes, '
+                '%d snapshots and %d security groups',
+                region, session.session_id, len(session.instance_ids),
+                len(session.volume_ids), len(session.snapshot_ids),
+                len(session.security_group_ids)
+            )
+        if result.sessions and not dry_run:
+            aws_service.clean_up(
+                aws_svc,
+                instance_ids=result.get_ids('instance_ids'),
+                volume_ids=result.get_ids('volume_ids'),
+                snapshot_ids=result.get_ids('snapshot_ids'),
+                security_group_ids=result.get_ids('security_group_ids')
+            )
+    except Exception as e:
+        log.debug('', exc_info=1)
+        log.error('Unable to sweep %s: %s', region, e)
+        result.error = e
+    return result
+
+
+def sweep(regions, connect, min_age, dry_run=False, max_parallel=8,
+          now=None):
+    """ Sweep the given regions concurrently.
+
+    :return a list of RegionSweep objects, in the same order as regions
+    """
+    now = now or time.time()
+    return util.parallel_map(
+        lambda region: sweep_region(
+            region, connect, min_age, dry_run=dry_run, now=now),
+        regions,
+        max_workers=max_parallel
+    )
+
+
+def render_summary(results):
+    """ Render the sessions and resources that were deleted in each
+    region, and the limits that they used, as a table.
+    """
+    rows = [[
+        'REGION', 'SESSIONS', 'INSTANCES', 'VCPUS', 'VOLUMES', 'VOLUME_GIB',
+        'SNAPSHOTS', 'SNAPSHOT_GIB', 'SECURITY_GROUPS'
+    ]]
+    totals = [0] * (len(rows[0]) - 1)
+    for result in results:
+        if result.error:
+            row = [result.region, 'failed: %s' % result.error]
+            rows.append(row + [''] * (len(rows[0]) - len(row)))
+            continue
+        values = [
+            len(result.sessions),
+            result.count('instance_ids'),
+            result.total('vcpus'),
+            result.count('volume_ids'),
+            result.total('volume_gib'),
+            result.count('snapshot_ids'),
+            result.total('snapshot_gib'),
+            result.count('security_group_ids')
+        ]
+        totals = [t + v for t, v in zip(totals, values)]
+        rows.append([result.region] + [str(v) for v in values])
+    rows.append(['TOTAL'] + [str(t) for t in totals])
+    return util.render_table_rows(rows)
@@ -0,0 +1,56 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+from brkt_cli.aws import aws_args, sweep
+from brkt_cli.validation import min_int_argument
+
+
+def setup_sweep_args(parser):
+    parser.add_argument(
+        '--region',
+        metavar='NAME',
+        dest='sweep_regions',
+        action='append',
+        help=(
+            'Only delete resources in this region.  Can be specified '
+            'multiple times.  By default, all regions are scanned'
+        )
+    )
+    parser.add_argument(
+        '--min-age',
+        metavar='HOURS',
+        dest='min_age_hours',
+        type=lambda value: min_int_argument(value, 0),
+        default=sweep.DEFAULT_MIN_AGE_HOURS,
+        help=(
+            'Only delete the resources of sessions that have not created '
+            'any resources for this many hours (default: %(default)s)'
+        )
+    )
+    parser.add_argument(
+        '--dry-run',
+        dest='dry_run',
+        action='store_true',
+        default=False,
+        help='Print the summary of orphaned resources without deleting them'
+    )
+    parser.add_argument(
+        '--max-parallel',
+        metavar='N',
+        dest='max_parallel',
+        type=lambda value: min_int_argument(value, 1),
+        default=8,
+        help='The maximum number of regions that are scanned at the same time'
+    )
+    aws_args.add_retry_timeout(parser)
+    aws_args.add_retry_initial_sleep_seconds(parser)
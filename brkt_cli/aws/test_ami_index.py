@@ -0,0 +1,179 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import tempfile
+import unittest
+
+from brkt_cli import util
+from brkt_cli.aws import ami_index, encrypt_ami, encrypt_batch
+from brkt_cli.aws.test_aws_service import build_aws_service
+from brkt_cli.aws.test_encrypt_ami import DummyValues
+from brkt_cli.test_encryptor_service import DummyEncryptorService
+from brkt_cli.util import CRYPTO_GCM, CRYPTO_XTS
+
+
+class DummyClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class TestEncryptedImageIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'brkt', 'encrypted_amis.json')
+        self.clock = DummyClock()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_persist(self):
+        """ Test that entries are written to disk and read back by another
+        index.
+        """
+        index = ami_index.EncryptedImageIndex(self.path, clock=self.clock)
+        self.assertIsNone(index.get('us-west-2', 'ami-1', 'ami-2', 'xts'))
+        index.put('us-west-2', 'ami-1', 'ami-2', 'xts', 'ami-3')
+
+        index = ami_index.EncryptedImageIndex(self.path, clock=self.clock)
+        self.assertEqual(
+            'ami-3', index.get('us-west-2', 'ami-1', 'ami-2', 'xts'))
+        self.assertIsNone(index.get('us-east-1', 'ami-1', 'ami-2', 'xts'))
+        self.assertIsNone(index.get('us-west-2', 'ami-1', 'ami-2', 'gcm'))
+
+    def test_expired(self):
+        index = ami_index.EncryptedImageIndex(
+            self.path, ttl=60, clock=self.clock)
+        index.put('us-west-2', 'ami-1', 'ami-2', 'xts', 'ami-3')
+        self.clock.now += 61
+        self.assertIsNone(index.get('us-west-2', 'ami-1', 'ami-2', 'xts'))
+
+    def test_malformed(self):
+        """ Test that a malformed index file is ignored. """
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('not json')
+        index = ami_index.EncryptedImageIndex(self.path, clock=self.clock)
+        self.assertIsNone(index.get('us-west-2', 'ami-1', 'ami-2', 'xts'))
+        index.put('us-west-2', 'ami-1', 'ami-2', 'xts', 'ami-3')
+        self.assertEqual(
+            'ami-3', index.get('us-west-2', 'ami-1', 'ami-2', 'xts'))
+
+
+class TestFindEncryptedImage(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+        self.aws_svc, self.encryptor_image, self.guest_image = \
+            build_aws_service()
+
+    def _encrypt(self):
+        self.aws_svc.default_tags = encrypt_ami.get_default_tags(
+            'abc', self.encryptor_image.id, source_ami=self.guest_image.id,
+            crypto_policy=CRYPTO_XTS)
+        values = DummyValues(self.encryptor_image.id, self.guest_image.id)
+        return encrypt_ami.encrypt(
+            aws_svc=self.aws_svc,
+            enc_svc_cls=DummyEncryptorService,
+            values=values)
+
+    def test_find_by_tags(self):
+        """ Test that an encrypted AMI is found by its tags, and only when
+        the encryptor AMI and crypto policy match.
+        """
+        self.assertIsNone(ami_index.find_encrypted_image(
+            self.aws_svc, self.guest_image.id, self.encryptor_image.id,
+            CRYPTO_XTS))
+        encrypted_id = self._encrypt()
+
+        self.assertEqual(
+            encrypted_id,
+            ami_index.find_encrypted_image(
+                self.aws_svc, self.guest_image.id, self.encryptor_image.id,
+                CRYPTO_XTS)
+        )
+        self.assertIsNone(ami_index.find_encrypted_image(
+            self.aws_svc, self.guest_image.id, self.encryptor_image.id,
+            CRYPTO_GCM))
+        self.assertIsNone(ami_index.find_encrypted_image(
+            self.aws_svc, self.guest_image.id, 'ami-other', CRYPTO_XTS))
+
+    def test_index(self):
+        """ Test that a result found by tags is stored in the index, and
+        that later lookups don't search by tags.
+        """
+        encrypted_id = self._encrypt()
+        index = ami_index.EncryptedImageIndex(path=None)
+        ami_index.find_encrypted_image(
+            self.aws_svc, self.guest_image.id, self.encryptor_image.id,
+            CRYPTO_XTS, index=index)
+
+        def get_images(**kwargs):
+            self.fail('get_images() should not be called')
+        self.aws_svc.get_images = get_images
+
+        self.assertEqual(
+            encrypted_id,
+            ami_index.find_encrypted_image(
+                self.aws_svc, self.guest_image.id, self.encryptor_image.id,
+                CRYPTO_XTS, index=index)
+        )
+
+    def test_index_image_deregistered(self):
+        """ Test that an index entry for an AMI that no longer exists is
+        removed, and that the lookup falls back to tags.
+        """
+        index = ami_index.EncryptedImageIndex(path=None)
+        index.put(self.aws_svc.region, self.guest_image.id,
+                  self.encryptor_image.id, CRYPTO_XTS, 'ami-deregistered')
+        self.assertIsNone(ami_index.find_encrypted_image(
+            self.aws_svc, self.guest_image.id, self.encryptor_image.id,
+            CRYPTO_XTS, index=index))
+        self.assertEqual({}, index.entries)
+
+        encrypted_id = self._encrypt()
+        self.assertEqual(
+            encrypted_id,
+            ami_index.find_encrypted_image(
+                self.aws_svc, self.guest_image.id, self.encryptor_image.id,
+                CRYPTO_XTS, index=index)
+        )
+
+        # An AMI that is no longer available is also removed.
+        self.aws_svc.get_image(encrypted_id).state = 'failed'
+        self.assertIsNone(ami_index.find_encrypted_image(
+            self.aws_svc, self.guest_image.id, self.encryptor_image.id,
+            CRYPTO_XTS, index=index))
+        self.assertEqual({}, index.entries)
+
+    def test_encrypt_many_skips_existing(self):
+        """ Test that encrypt_many() doesn't encrypt jobs that already
+        have an encrypted AMI.
+        """
+        values = DummyValues(self.encryptor_image.id, self.guest_image.id)
+        job = encrypt_batch.EncryptJob(self.aws_svc, values)
+        job.encrypted_ami_id = 'ami-existing'
+
+        def run_instance_callback(args):
+            self.fail('No instances should be launched')
+        self.aws_svc.run_instance_callback = run_instance_callback
+
+        jobs = encrypt_batch.encrypt_many([job], DummyEncryptorService)
+        self.assertEqual('ami-existing', jobs[0].encrypted_ami_id)
+        self.assertIsNone(jobs[0].error)
@@ -117,6 +117,78 @@ class TestValidation(unittest.TestCase):
                 encrypted_ami_name=guest_image.name
             )
 
+    def test_all_failures_reported(self):
+        """ Test that validation runs every check and reports all of the
+        failures together.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        guest_image.name = 'My image'
+        encryptor_image.name = 'foobar'
+
+        with self.assertRaises(ValidationError) as cm:
+            brkt_cli.aws._validate(
+                aws_svc,
+                encryptor_image.id,
+                encrypted_ami_name=guest_image.name,
+                instance_type='t2.nano'
+            )
+        message = str(cm.exception)
+        self.assertIn('Found 3 problems', message)
+        self.assertIn('You already own an image named My image', message)
+        self.assertIn('Unsupported instance type t2.nano', message)
+        self.assertIn('is not a Bracket Encryptor image', message)
+
+    def test_run_validations(self):
+        # Results are returned in order.
+        self.assertEqual(
+            [1, 2],
+            brkt_cli.aws._run_validations([lambda: 1, lambda: 2])
+        )
+
+        # A single failure is raised unchanged.
+        def _fail():
+            raise ValidationError('Bad value')
+
+        with self.assertRaises(ValidationError) as cm:
+            brkt_cli.aws._run_validations([lambda: 1, _fail])
+        self.assertEqual('Bad value', str(cm.exception))
+
+        # Client errors are reported as validation errors.
+        def _client_error():
+            raise test_aws_service.new_client_error(
+                'InvalidKeyPair.NotFound', 'No key pair')
+
+        with self.assertRaises(ValidationError):
+            brkt_cli.aws._run_validations(
+                [brkt_cli.aws._check(_client_error)])
+
+        # Unexpected errors take precedence over validation errors.
+        def _unexpected():
+            raise test_aws_service.TestException()
+
+        with self.assertRaises(test_aws_service.TestException):
+            brkt_cli.aws._run_validations([_fail, _unexpected])
+
+    def test_check_clones_service(self):
+        """ Test that each check gets its own clone of the AWS service. """
+        aws_svc = test_aws_service.DummyAWSService()
+        clones = []
+
+        def clone():
+            svc = test_aws_service.DummyAWSService()
+            clones.append(svc)
+            return svc
+        aws_svc.clone = clone
+
+        results = brkt_cli.aws._run_validations([
+            brkt_cli.aws._check(lambda svc, value: (svc, value), aws_svc, 1),
+            brkt_cli.aws._check(lambda svc: svc, aws_svc)
+        ])
+        self.assertEqual(2, len(clones))
+        svc, value = results[0]
+        self.assertEqual(1, value)
+        self.assertEqual(set(clones), set([svc, results[1]]))
+
     def test_detect_double_encryption(self):
         """ Test that we disallow encryption of an already encrypted AMI.
         """
@@ -201,6 +273,18 @@ class TestValidation(unittest.TestCase):
         with self.assertRaises(ValidationError):
             brkt_cli.aws._validate_encryptor_ami(aws_svc, id)
 
+    def test_get_encryptor_image_no_validate(self):
+        """ Test that a missing encryptor AMI is reported as a
+        ValidationError when validation is disabled.
+        """
+        aws_svc = test_aws_service.DummyAWSService()
+        values = DummyValues()
+        values.validate = False
+        values.encryptor_ami = new_id()
+        aws_svc.images[values.encryptor_ami] = None
+        with self.assertRaises(ValidationError):
+            brkt_cli.aws._get_encryptor_image(aws_svc, values)
+
     def test_detect_valid_ntp_server(self):
         """ Test that we allow only valid host names or IPv4 addresses to
             to be configured as ntp servers.
@@ -0,0 +1,124 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import time
+import unittest
+
+import brkt_cli.util
+from brkt_cli.aws import aws_cache, aws_service
+
+
+class LoadCounter(object):
+    """ Simulates a boto3 resource that counts its load() calls. """
+
+    def __init__(self, resource_id):
+        self.id = resource_id
+        self.name = resource_id
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+
+
+class DummyEC2Resource(object):
+
+    def __init__(self):
+        self.images = {}
+
+    def Image(self, image_id):
+        return self.images.setdefault(image_id, LoadCounter(image_id))
+
+
+class DummyEC2Client(object):
+
+    def create_tags(self, **kwargs):
+        pass
+
+
+class TestResourceCache(unittest.TestCase):
+
+    def test_get_or_load(self):
+        cache = aws_cache.ResourceCache()
+        self.assertEqual('a', cache.get_or_load('ami-1', lambda: 'a'))
+        self.assertEqual('a', cache.get_or_load('ami-1', lambda: 'b'))
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+        # None is not cached.
+        self.assertIsNone(cache.get_or_load('ami-2', lambda: None))
+        self.assertEqual('c', cache.get_or_load('ami-2', lambda: 'c'))
+
+    def test_invalidate(self):
+        cache = aws_cache.ResourceCache()
+        cache.put('i-1', 'a')
+        cache.put('vol-1', 'b')
+        cache.invalidate('i-1', 'i-2')
+        self.assertIsNone(cache.get('i-1'))
+        self.assertEqual('b', cache.get('vol-1'))
+
+    def test_expiration(self):
+        cache = aws_cache.ResourceCache(ttl=0.01)
+        cache.put('i-1', 'a')
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('i-1'))
+
+    def test_disabled(self):
+        cache = aws_cache.ResourceCache(ttl=0)
+        cache.put('i-1', 'a')
+        self.assertIsNone(cache.get('i-1'))
+
+
+class TestAWSServiceCache(unittest.TestCase):
+
+    def setUp(self):
+        brkt_cli.util.SLEEP_ENABLED = False
+        self.aws_svc = aws_service.AWSService('abc')
+        self.aws_svc.ec2 = DummyEC2Resource()
+        self.aws_svc.ec2client = DummyEC2Client()
+
+    def test_get_image(self):
+        """ Test that repeated lookups of an image load it once, and that
+        tagging the image invalidates the cached copy.
+        """
+        for _ in xrange(3):
+            image = self.aws_svc.get_image('ami-1')
+        self.assertEqual(1, image.loads)
+        self.assertEqual(2, self.aws_svc.cache.hits)
+        self.assertEqual(1, self.aws_svc.cache.misses)
+
+        self.aws_svc.create_tags('ami-1', name='test')
+        self.aws_svc.get_image('ami-1')
+        self.assertEqual(2, image.loads)
+
+    def test_clone(self):
+        """ Test that a cloned service has its own EC2 client, and shares
+        the cache with the original.
+        """
+        self.aws_svc.connect('us-west-2')
+        self.aws_svc.default_tags = {'BrktEncryptorSessionID': 'abc'}
+        clone = self.aws_svc.clone()
+        self.assertEqual('abc', clone.session_id)
+        self.assertEqual('us-west-2', clone.region)
+        self.assertEqual(self.aws_svc.default_tags, clone.default_tags)
+        self.assertIs(self.aws_svc.cache, clone.cache)
+        self.assertIs(self.aws_svc.limiter, clone.limiter)
+        self.assertIsNot(self.aws_svc.ec2client, clone.ec2client)
+        self.assertIsNot(self.aws_svc.ec2, clone.ec2)
+        self.assertIsNot(self.aws_svc.boto_session, clone.boto_session)
+
+    def test_wait_refreshes(self):
+        """ Test that polling for state bypasses the cache. """
+        image = self.aws_svc.get_image('ami-1')
+        image.state = 'available'
+        aws_service.wait_for_image(self.aws_svc, 'ami-1')
+        self.assertEqual(2, image.loads)
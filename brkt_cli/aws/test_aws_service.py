@@ -13,6 +13,7 @@
 # limitations under the License.
 import logging
 import ssl
+import threading
 import unittest
 import uuid
 
@@ -62,6 +63,7 @@ class RunInstanceArgs(object):
         self.user_data = None
         self.instance = None
         self.instance_profile_name = None
+        self.block_device_mappings = None
 
 
 class DummyAWSService(aws_service.BaseAWSService):
@@ -78,6 +80,8 @@ class DummyAWSService(aws_service.BaseAWSService):
         self.tagged_volumes = []
         self.subnets = {}
         self.security_groups = {}
+        self.fast_snapshot_restores = {}
+        self.peers = {}
         self.region = 'us-west-2'
         self.regions = [
             RegionInfo(name='us-west-2'),
@@ -103,6 +107,7 @@ class DummyAWSService(aws_service.BaseAWSService):
         self.create_tags_callback = None
         self.terminate_instance_callback = None
         self.delete_security_group_callback = None
+        self.copy_image_callback = None
 
         self.default_tags = encrypt_ami.get_default_tags(
             new_id(), 'ami-' + new_id())
@@ -133,6 +138,10 @@ class DummyAWSService(aws_service.BaseAWSService):
         instance.state['Code'] = 0
         instance.placement = placement or {'AvailabilityZone': 'us-west-2a'}
         instance.type = instance_type
+        instance.instance_type = instance_type
+        instance.security_groups = [
+            {'GroupId': sg_id} for sg_id in security_group_ids or []
+        ]
 
         # Create volumes based on block device data from the image.
         image = self.get_image(image_id)
@@ -163,9 +172,10 @@ class DummyAWSService(aws_service.BaseAWSService):
             args.user_data = user_data
             args.instance = instance
             args.instance_profile_name = instance_profile_name
+            args.block_device_mappings = block_device_mappings
             self.run_instance_callback(args)
 
-        self.create_tags(instance.id, name=name, description=description)
+        self._apply_tags(instance, name=name, description=description)
 
         return instance
 
@@ -187,22 +197,65 @@ class DummyAWSService(aws_service.BaseAWSService):
                 self.transition_to_running[instance_id] = True
         return instance
 
-    def create_tags(self, resource_id, name=None, description=None):
-        if self.create_tags_callback:
-            self.create_tags_callback(resource_id, name, description)
+    def get_instances(self, *instance_ids):
+        return [
+            self.get_instance(id) for id in instance_ids
+            if id in self.instances
+        ]
 
-        for resources in (
-            self.instances, self.images, self.snapshots, self.volumes
+    def get_instances_by_tags(self, tags):
+        instances = []
+        for instance in self.instances.values():
+            if instance.state['Name'] in ('shutting-down', 'terminated'):
+                continue
+            instance_tags = boto3_tag.tags_to_dict(instance.tags or [])
+            if all(instance_tags.get(k) == v for k, v in tags.iteritems()):
+                instances.append(instance)
+        return instances
+
+    def create_tags(self, resource_id, name=None, description=None):
+        if isinstance(resource_id, basestring):
+            resource_ids = [resource_id]
+        else:
+            resource_ids = list(resource_id)
+        for resource_id in resource_ids:
+            if self.create_tags_callback:
+                self.create_tags_callback(resource_id, name, description)
+            for resources in (
+                self.instances, self.images, self.snapshots, self.volumes,
+                self.security_groups
+            ):
+                if resource_id in resources:
+                    self._apply_tags(
+                        resources[resource_id], name, description)
+
+    def get_tagged_resources(self, tag_key):
+        resources = []
+        for resource_type, d in (
+            ('instance', self.instances),
+            ('image', self.images),
+            ('snapshot', self.snapshots),
+            ('volume', self.volumes),
+            ('security-group', self.security_groups)
         ):
-            if resource_id in resources:
-                r = resources[resource_id]
-                for key, value in self.default_tags.iteritems():
-                    boto3_tag.set_value(r.tags, key, value)
-                if name:
-                    boto3_tag.set_value(r.tags, 'Name', name)
-                if description:
-                    boto3_tag.set_value(r.tags, 'Description', description)
-        pass
+            for resource_id, resource in d.iteritems():
+                value = boto3_tag.get_value(resource.tags or [], tag_key)
+                if value is not None:
+                    resources.append({
+                        'ResourceId': resource_id,
+                        'ResourceType': resource_type,
+                        'Value': value
+                    })
+        return resources
+
+    def _apply_tags(self, resource, name=None, description=None):
+        """ Simulate tagging a resource when it's created. """
+        for key, value in self.default_tags.iteritems():
+            boto3_tag.set_value(resource.tags, key, value)
+        if name:
+            boto3_tag.set_value(resource.tags, 'Name', name)
+        if description:
+            boto3_tag.set_value(resource.tags, 'Description', description)
 
     def stop_instance(self, instance_id):
         instance = self.instances[instance_id]
@@ -213,6 +266,10 @@ class DummyAWSService(aws_service.BaseAWSService):
         instance.state['Name'] = 'stopped'
         return instance
 
+    def stop_instances(self, *instance_ids):
+        for instance_id in instance_ids:
+            self.stop_instance(instance_id)
+
     def start_instance(self, instance_id):
         instance = self.instances[instance_id]
         instance.state['Code'] = 16
@@ -228,20 +285,32 @@ class DummyAWSService(aws_service.BaseAWSService):
         instance.state['Name'] = 'terminated'
         return instance
 
+    def terminate_instances(self, *instance_ids):
+        for instance_id in instance_ids:
+            self.terminate_instance(instance_id)
+
     def get_volume(self, volume_id):
         volume = self.volumes[volume_id]
         if self.get_volume_callback:
             self.get_volume_callback(volume)
         return volume
 
-    def get_volumes(self, tag_key=None, tag_value=None):
+    def get_volumes(self, tag_key=None, tag_value=None, volume_ids=None):
+        if volume_ids:
+            return [
+                self.get_volume(id) for id in volume_ids
+                if id in self.volumes
+            ]
         if tag_key and tag_value:
             return self.tagged_volumes
         else:
             return []
 
     def get_snapshots(self, *snapshot_ids):
-        return [self.get_snapshot(id) for id in snapshot_ids]
+        return [
+            self.get_snapshot(id) for id in snapshot_ids
+            if id in self.snapshots
+        ]
 
     def get_snapshot(self, snapshot_id):
         snapshot = self.snapshots[snapshot_id]
@@ -265,6 +334,7 @@ class DummyAWSService(aws_service.BaseAWSService):
         snapshot = Snapshot()
         snapshot.id = 'snap-' + new_id()
         snapshot.state = 'pending'
+        self._apply_tags(snapshot, name=name)
         self.snapshots[snapshot.id] = snapshot
 
         if self.create_snapshot_callback:
@@ -314,10 +384,12 @@ class DummyAWSService(aws_service.BaseAWSService):
             if 'SnapshotId' not in device['Ebs']:
                 snapshot = Snapshot()
                 snapshot.id = 'snap-' + new_id()
+                self._apply_tags(snapshot)
                 self.snapshots[snapshot.id] = snapshot
                 device['Ebs']['SnapshotId'] = snapshot.id
 
         image.block_device_mappings = bdm
+        self._apply_tags(image)
 
         self.images[image.id] = image
         return image
@@ -328,6 +400,7 @@ class DummyAWSService(aws_service.BaseAWSService):
         volume.size = size
         volume.zone = zone
         volume.state = 'available'
+        self._apply_tags(volume)
         self.volumes[volume.id] = volume
         return volume
 
@@ -346,7 +419,10 @@ class DummyAWSService(aws_service.BaseAWSService):
     def register_image(self,
                        block_device_mappings,
                        name=None,
-                       description=None):
+                       description=None,
+                       root_device_name='/dev/sda1',
+                       ena_support=None,
+                       sriov_net_support=None):
         image = Image()
         image.id = 'ami-' + new_id()
         image.block_device_mappings = block_device_mappings
@@ -354,15 +430,46 @@ class DummyAWSService(aws_service.BaseAWSService):
         image.name = name
         image.description = description
         image.virtualization_type = 'hvm'
-        image.root_device_name = '/dev/sda1'
+        image.root_device_name = root_device_name
         image.root_device_type = 'ebs'
         image.hypervisor = 'xen'
+        image.ena_support = bool(ena_support)
+        image.sriov_net_support = sriov_net_support
+        self._apply_tags(image)
         self.images[image.id] = image
         return image.id
 
     def wait_for_image(self, image_id):
         pass
 
+    def copy_image(self, source_region, source_image_id, name,
+                   description=None):
+        if self.copy_image_callback:
+            self.copy_image_callback(source_region, source_image_id)
+
+        # Copy the image from the service registered for the source region
+        # in self.peers.
+        source = self.peers[source_region].get_image(source_image_id)
+        bdm = []
+        for d in source.block_device_mappings:
+            d = boto3_device.make_device(
+                device_name=d['DeviceName'],
+                volume_type=d['Ebs'].get('VolumeType'),
+                volume_size=d['Ebs'].get('VolumeSize')
+            )
+            snapshot = Snapshot()
+            snapshot.id = 'snap-' + new_id()
+            snapshot.state = 'completed'
+            snapshot.progress = '100%'
+            self.snapshots[snapshot.id] = snapshot
+            d['Ebs']['SnapshotId'] = snapshot.id
+            bdm.append(d)
+
+        image_id = self.register_image(
+            bdm, name=name, description=description,
+            root_device_name=source.root_device_name)
+        return image_id
+
     def get_image(self, image_id, retry=False):
         image = self.images.get(image_id)
         if image:
@@ -371,13 +478,23 @@ class DummyAWSService(aws_service.BaseAWSService):
             e = new_client_error('InvalidAMIID.NotFound')
             raise e
 
-    def get_images(self, name=None, owner_alias=None, product_code=None):
-        # Only filtering by name is currently supported.
+    def get_images(self, name=None, owner_alias=None, product_code=None,
+                   image_ids=None, tags=None):
+        # Only filtering by name, id or tags is currently supported.
+        if not (image_ids or name or tags):
+            return self.images.values()
         images = []
+        if image_ids:
+            images = [self.images[id] for id in image_ids if id in self.images]
         if name:
             for i in self.images.values():
                 if i.name == name:
                     images.append(i)
+        if tags:
+            for i in self.images.values():
+                image_tags = boto3_tag.tags_to_dict(i.tags or [])
+                if all(image_tags.get(k) == v for k, v in tags.iteritems()):
+                    images.append(i)
         return images
 
     def delete_snapshot(self, snapshot_id):
@@ -385,12 +502,16 @@ class DummyAWSService(aws_service.BaseAWSService):
         if self.delete_snapshot_callback:
             self.delete_snapshot_callback(snapshot_id)
 
+    def deregister_image(self, image_id):
+        del(self.images[image_id])
+
     def create_security_group(self, name, description, vpc_id=None):
         if self.create_security_group_callback:
             self.create_security_group_callback(vpc_id)
         sg = SecurityGroup()
         sg.id = 'sg-%s' % new_id()
         sg.vpc_id = vpc_id or self.default_vpc.id
+        self._apply_tags(sg, name=name, description=description)
         self.security_groups[sg.id] = sg
         return sg
 
@@ -400,7 +521,7 @@ class DummyAWSService(aws_service.BaseAWSService):
     def delete_security_group(self, sg_id):
         if self.delete_security_group_callback:
             self.delete_security_group_callback(sg_id)
-        pass
+        self.security_groups.pop(sg_id, None)
 
     def get_key_pair(self, keyname):
         kp = KeyPair()
@@ -431,6 +552,22 @@ class DummyAWSService(aws_service.BaseAWSService):
 
         return None
 
+    def enable_fast_snapshot_restore(self, snapshot_id, zone):
+        self.fast_snapshot_restores[(snapshot_id, zone)] = 'enabling'
+
+    def disable_fast_snapshot_restore(self, snapshot_id, zone):
+        self.fast_snapshot_restores[(snapshot_id, zone)] = 'disabled'
+
+    def get_fast_snapshot_restore_state(self, snapshot_id, zone):
+        """ Simulate Fast Snapshot Restore being enabled after the first
+        call.
+        """
+        key = (snapshot_id, zone)
+        state = self.fast_snapshot_restores.get(key)
+        if state == 'enabling':
+            self.fast_snapshot_restores[key] = 'enabled'
+        return state
+
     def retry(self, function, error_code_regexp=None, timeout=None):
         return aws_service.retry_boto(
             function,
@@ -467,7 +604,7 @@ def build_aws_service():
     aws_svc.snapshots[guest_snap.id] = guest_snap
 
     guest_dev = boto3_device.make_device(
-        device_name='/dev/sda1', snapshot_id=guest_snap.id)
+        device_name='/dev/sda1', snapshot_id=guest_snap.id, volume_size=8)
     id = aws_svc.register_image(
         name='Guest image', block_device_mappings=[guest_dev])
     guest_image = aws_svc.get_image(id)
@@ -602,6 +739,200 @@ class TestCustomTags(unittest.TestCase):
             aws_service.validate_tag_value('aws:foobar')
 
 
+class RecordingEC2Client(object):
+    """ Records the parameters of EC2 API calls. """
+
+    def __init__(self):
+        self.calls = []
+
+    def create_tags(self, **kwargs):
+        self.calls.append(('create_tags', kwargs))
+
+    def create_volume(self, **kwargs):
+        self.calls.append(('create_volume', kwargs))
+        return {'VolumeId': 'vol-1'}
+
+
+class TestTagging(unittest.TestCase):
+
+    def setUp(self):
+        self.aws_svc = aws_service.AWSService(
+            'abc', default_tags={'BrktEncryptorSessionID': 'abc'})
+        self.aws_svc.ec2client = RecordingEC2Client()
+
+    def test_tag_on_create(self):
+        """ Test that tags are passed to the create call, instead of
+        being applied with a separate CreateTags call.
+        """
+        self.aws_svc.get_volume = lambda volume_id: volume_id
+        self.aws_svc.create_volume(8, 'us-west-2a')
+        self.assertEqual(1, len(self.aws_svc.ec2client.calls))
+        api, kwargs = self.aws_svc.ec2client.calls[0]
+        self.assertEqual('create_volume', api)
+        self.assertEqual(
+            [{
+                'ResourceType': 'volume',
+                'Tags': [{'Key': 'BrktEncryptorSessionID', 'Value': 'abc'}]
+            }],
+            kwargs['TagSpecifications']
+        )
+
+    def test_tag_specifications(self):
+        specs = self.aws_svc._make_tag_specifications(
+            instance=self.aws_svc._get_tags(name='encryptor'),
+            security_group={}
+        )
+        self.assertEqual(1, len(specs))
+        self.assertEqual('instance', specs[0]['ResourceType'])
+        self.assertEqual(
+            {'BrktEncryptorSessionID': 'abc', 'Name': 'encryptor'},
+            boto3_tag.tags_to_dict(specs[0]['Tags'])
+        )
+
+        self.aws_svc.default_tags = {}
+        self.assertIsNone(self.aws_svc._make_tag_specifications(
+            volume=self.aws_svc._get_tags()))
+
+    def test_multiple_resources(self):
+        """ Test that a list of resources is tagged with a single call. """
+        self.aws_svc.create_tags(['vol-1', 'vol-2'], name='test')
+        self.assertEqual(1, len(self.aws_svc.ec2client.calls))
+        api, kwargs = self.aws_svc.ec2client.calls[0]
+        self.assertEqual(['vol-1', 'vol-2'], kwargs['Resources'])
+
+
+class TestCleanUp(unittest.TestCase):
+
+    def setUp(self):
+        brkt_cli.util.SLEEP_ENABLED = False
+
+    def test_single_terminate_call(self):
+        """ Test that instances are terminated with one request and that
+        all resources are deleted.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        instances = [aws_svc.run_instance(guest_image.id) for _ in xrange(3)]
+        instance_ids = [i.id for i in instances]
+        volume_ids = [
+            boto3_device.get_volume_id(i.block_device_mappings[0])
+            for i in instances
+        ]
+        snapshot = aws_svc.create_snapshot(volume_ids[0])
+
+        terminate_calls = []
+        terminate_instances = aws_svc.terminate_instances
+
+        def _terminate_instances(*ids):
+            terminate_calls.append(ids)
+            terminate_instances(*ids)
+        aws_svc.terminate_instances = _terminate_instances
+
+        aws_service.clean_up(
+            aws_svc,
+            instance_ids=instance_ids,
+            volume_ids=volume_ids,
+            snapshot_ids=[snapshot.id]
+        )
+        self.assertEqual([tuple(instance_ids)], terminate_calls)
+        for instance in instances:
+            self.assertEqual('terminated', instance.state['Name'])
+        for volume_id in volume_ids:
+            self.assertNotIn(volume_id, aws_svc.volumes)
+        self.assertNotIn(snapshot.id, aws_svc.snapshots)
+
+    def test_release_dependents_early(self):
+        """ Test that a volume is deleted as soon as the instance that
+        uses it has terminated, without waiting for other instances.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        sg = aws_svc.create_security_group('test', 'test')
+        fast = aws_svc.run_instance(guest_image.id)
+        slow = aws_svc.run_instance(
+            guest_image.id, security_group_ids=[sg.id])
+        volume_id = boto3_device.get_volume_id(fast.block_device_mappings[0])
+        unused_volume_id = boto3_device.get_volume_id(
+            slow.block_device_mappings[0])
+        del slow.block_device_mappings[:]
+
+        # The slow instance terminates on the fourth describe call.
+        num_describes = [0]
+        get_instances = aws_svc.get_instances
+
+        def _get_instances(*ids):
+            num_describes[0] += 1
+            if num_describes[0] < 4:
+                slow.state['Name'] = 'shutting-down'
+            else:
+                slow.state['Name'] = 'terminated'
+            return get_instances(*ids)
+        aws_svc.get_instances = _get_instances
+
+        deleted = {}
+        delete_volume = aws_svc.delete_volume
+
+        def _delete_volume(id):
+            deleted[id] = num_describes[0]
+            delete_volume(id)
+        aws_svc.delete_volume = _delete_volume
+        aws_svc.delete_security_group_callback = \
+            lambda id: deleted.__setitem__(id, num_describes[0])
+
+        aws_service.clean_up(
+            aws_svc,
+            instance_ids=[fast.id, slow.id],
+            volume_ids=[volume_id, unused_volume_id],
+            security_group_ids=[sg.id]
+        )
+
+        # The unused volume is deleted before polling starts.  The fast
+        # instance's volume is deleted after the first poll.
+        self.assertEqual(
+            {unused_volume_id: 1, volume_id: 2, sg.id: 4}, deleted)
+
+    def test_deletes_use_clones(self):
+        """ Test that the concurrent deletes use a clone of the service
+        in each thread.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        volume_ids = [
+            aws_svc.create_volume(8, 'us-west-2a').id for _ in xrange(4)]
+        clone_threads = []
+
+        def clone():
+            clone_threads.append(threading.current_thread())
+            return aws_svc
+        aws_svc.clone = clone
+
+        delete_threads = set()
+        delete_volume = aws_svc.delete_volume
+
+        def _delete_volume(id):
+            delete_threads.add(threading.current_thread())
+            delete_volume(id)
+        aws_svc.delete_volume = _delete_volume
+
+        aws_service.clean_up(aws_svc, volume_ids=volume_ids)
+        for volume_id in volume_ids:
+            self.assertNotIn(volume_id, aws_svc.volumes)
+        # One clone per thread.
+        self.assertEqual(len(clone_threads), len(set(clone_threads)))
+        self.assertEqual(delete_threads, set(clone_threads))
+
+    def test_terminate_fallback(self):
+        """ Test that we terminate instances one at a time when the batch
+        request fails.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        instance = aws_svc.run_instance(guest_image.id)
+
+        def _terminate_instances(*ids):
+            raise new_client_error('InvalidInstanceID.NotFound')
+        aws_svc.terminate_instances = _terminate_instances
+
+        aws_service.clean_up(aws_svc, instance_ids=[instance.id, 'i-bogus'])
+        self.assertEqual('terminated', instance.state['Name'])
+
+
 class TestVolume(unittest.TestCase):
 
     def setUp(self):
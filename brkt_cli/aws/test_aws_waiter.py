@@ -0,0 +1,169 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+from brkt_cli import util
+from brkt_cli.aws import aws_service, aws_waiter
+from brkt_cli.aws.model import Volume
+from brkt_cli.aws.test_aws_service import (
+    build_aws_service, new_client_error, new_id
+)
+
+
+def _is_running(instance):
+    return aws_service.check_instance_state(instance, 'running')
+
+
+class TestResourceWaiter(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+        self.aws_svc, _, self.guest_image = build_aws_service()
+
+    def test_batched_describe(self):
+        """ Test that pending resources of the same type are described
+        with a single call per poll.
+        """
+        waiter = aws_waiter.ResourceWaiter(self.aws_svc, background=False)
+        requests = []
+        for _ in xrange(3):
+            instance = self.aws_svc.run_instance(self.guest_image.id)
+            requests.append(
+                waiter.submit(aws_waiter.INSTANCE, instance.id, _is_running))
+        snapshot = self.aws_svc.create_snapshot('vol-1')
+        snapshot_request = waiter.submit(
+            aws_waiter.SNAPSHOT, snapshot.id,
+            lambda s: s.state == 'completed'
+        )
+
+        # Instances and snapshots transition on the second describe.
+        self.assertEqual(4, waiter.poll())
+        self.assertFalse(any(r.done() for r in requests))
+        self.assertEqual(0, waiter.poll())
+
+        self.assertTrue(all(r.done() for r in requests))
+        self.assertEqual('running', requests[0].result().state['Name'])
+        self.assertEqual('completed', snapshot_request.result().state)
+        self.assertEqual(2, waiter.describe_calls[aws_waiter.INSTANCE])
+        self.assertEqual(2, waiter.describe_calls[aws_waiter.SNAPSHOT])
+        self.assertEqual(0, waiter.describe_calls[aws_waiter.VOLUME])
+
+    def test_callback(self):
+        waiter = aws_waiter.ResourceWaiter(self.aws_svc, background=False)
+        instance = self.aws_svc.run_instance(self.guest_image.id)
+        completed = []
+        waiter.submit(
+            aws_waiter.INSTANCE, instance.id, _is_running,
+            callback=completed.append
+        )
+        waiter.poll()
+        waiter.poll()
+        self.assertEqual(1, len(completed))
+        self.assertEqual(instance, completed[0].resource)
+
+    def test_error_state(self):
+        """ Test that an exception raised by the state check completes
+        the request with that exception.
+        """
+        waiter = aws_waiter.ResourceWaiter(self.aws_svc, background=False)
+        instance = self.aws_svc.run_instance(self.guest_image.id)
+        instance.state['Name'] = 'error'
+        request = waiter.submit(aws_waiter.INSTANCE, instance.id, _is_running)
+        self.assertEqual(0, waiter.poll())
+        with self.assertRaises(aws_service.InstanceError):
+            request.result()
+
+    def test_not_visible_yet(self):
+        """ Test that a resource that isn't returned by describe stays
+        pending.
+        """
+        waiter = aws_waiter.ResourceWaiter(self.aws_svc, background=False)
+        request = waiter.submit(
+            aws_waiter.IMAGE, 'ami-' + new_id(),
+            aws_service.check_image_state
+        )
+        self.assertEqual(1, waiter.poll())
+        self.assertFalse(request.done())
+
+    def test_describe_errors(self):
+        """ Test that pending requests fail after repeated describe
+        errors.
+        """
+        waiter = aws_waiter.ResourceWaiter(self.aws_svc, background=False)
+
+        def get_instances(*instance_ids):
+            raise new_client_error('UnauthorizedOperation')
+        self.aws_svc.get_instances = get_instances
+
+        request = waiter.submit(aws_waiter.INSTANCE, 'i-1', _is_running)
+        for _ in xrange(aws_waiter.MAX_DESCRIBE_ERRORS - 1):
+            waiter.poll()
+        self.assertFalse(request.done())
+        self.assertEqual(0, waiter.poll())
+        with self.assertRaises(Exception):
+            request.result()
+
+    def test_wait_for_instance(self):
+        """ Test that the aws_service waiters delegate to the attached
+        waiter.
+        """
+        waiter = aws_waiter.ResourceWaiter(self.aws_svc)
+        self.aws_svc.waiter = waiter
+        instance = self.aws_svc.run_instance(self.guest_image.id)
+        result = aws_service.wait_for_instance(self.aws_svc, instance.id)
+        self.assertEqual(instance, result)
+        self.assertEqual(2, waiter.describe_calls[aws_waiter.INSTANCE])
+
+        snapshot = self.aws_svc.create_snapshot('vol-1')
+        aws_service.wait_for_snapshots(self.aws_svc, snapshot.id)
+        self.assertEqual('completed', snapshot.state)
+
+    def test_timeout(self):
+        waiter = aws_waiter.ResourceWaiter(self.aws_svc)
+        volume = Volume()
+        volume.id = 'vol-' + new_id()
+        volume.state = 'detaching'
+        self.aws_svc.volumes[volume.id] = volume
+
+        with self.assertRaises(aws_service.VolumeError):
+            waiter.wait_for_volume(volume.id, timeout=0.1)
+        self.assertEqual(0, waiter.poll())
+
+    def test_image_and_snapshot_timeout(self):
+        """ Test that waits for images and snapshots time out with the same
+        errors as the polling loops.
+        """
+        waiter = aws_waiter.ResourceWaiter(self.aws_svc)
+        image_id = 'ami-' + new_id()
+        with self.assertRaises(util.BracketError):
+            waiter.wait_for_image(image_id, timeout=0.1)
+
+        snapshot_id = 'snap-' + new_id()
+        with self.assertRaises(aws_service.SnapshotError):
+            waiter.wait_for_snapshots([snapshot_id], timeout=0.1)
+        self.assertEqual(0, waiter.poll())
+
+        self.aws_svc.waiter = waiter
+        saved = aws_service.WAIT_MAX_ATTEMPTS
+        aws_service.WAIT_MAX_ATTEMPTS = 0
+        try:
+            with self.assertRaises(aws_service.SnapshotError):
+                aws_service.wait_for_snapshots(self.aws_svc, snapshot_id)
+            self.aws_svc.waiter = None
+            with self.assertRaises(util.BracketError):
+                aws_service.wait_for_image(self.aws_svc, image_id)
+            with self.assertRaises(aws_service.SnapshotError):
+                aws_service.wait_for_snapshots(self.aws_svc, snapshot_id)
+        finally:
+            aws_service.WAIT_MAX_ATTEMPTS = saved
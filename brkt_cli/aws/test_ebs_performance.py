@@ -0,0 +1,127 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+from brkt_cli.aws import ebs_performance
+from brkt_cli.validation import ValidationError
+
+
+class TestProvisionedPerformance(unittest.TestCase):
+
+    def test_gp2(self):
+        self.assertEqual(
+            (None, None),
+            ebs_performance.get_provisioned_performance('gp2', 100)
+        )
+        self.assertEqual(
+            128, ebs_performance.get_expected_throughput('gp2', 100))
+        self.assertEqual(
+            250, ebs_performance.get_expected_throughput('gp2', 500))
+
+    def test_gp3(self):
+        """ Test that gp3 throughput scales with the volume size, within
+        the gp3 limits.
+        """
+        self.assertEqual(
+            (3000, 125),
+            ebs_performance.get_provisioned_performance('gp3', 8)
+        )
+        self.assertEqual(
+            (3000, 400),
+            ebs_performance.get_provisioned_performance('gp3', 100)
+        )
+        self.assertEqual(
+            (4000, 1000),
+            ebs_performance.get_provisioned_performance('gp3', 1000)
+        )
+
+    def test_io1(self):
+        """ Test that io1 IOPS are limited to 50 per GiB. """
+        self.assertEqual(
+            (400, None),
+            ebs_performance.get_provisioned_performance('io1', 8)
+        )
+        self.assertEqual(
+            100, ebs_performance.get_expected_throughput('io1', 8))
+        self.assertEqual(
+            (4000, None),
+            ebs_performance.get_provisioned_performance('io1', 1000)
+        )
+
+    def test_io2(self):
+        self.assertEqual(
+            (500, None),
+            ebs_performance.get_provisioned_performance('io2', 1)
+        )
+        self.assertEqual(
+            (1600, None),
+            ebs_performance.get_provisioned_performance('io2', 100)
+        )
+
+
+class TestChooseInstanceType(unittest.TestCase):
+
+    def test_ebs_bandwidth(self):
+        """ Test that the EBS bandwidth is converted from Mbps to MiB/s. """
+        self.assertAlmostEqual(
+            476.837, ebs_performance.get_ebs_bandwidth('c4.8xlarge'),
+            places=3
+        )
+        self.assertIsNone(ebs_performance.get_ebs_bandwidth('t2.nano'))
+
+    def test_sized_to_volume(self):
+        """ Test that the smallest instance type with enough EBS bandwidth
+        for the volume is chosen.
+        """
+        self.assertEqual(
+            'c4.xlarge', ebs_performance.choose_instance_type('gp2', 8))
+        self.assertEqual(
+            'c5.2xlarge', ebs_performance.choose_instance_type('gp2', 100))
+        self.assertEqual(
+            'c5.4xlarge', ebs_performance.choose_instance_type('gp2', 500))
+        self.assertEqual(
+            'c5.9xlarge', ebs_performance.choose_instance_type('gp3', 500))
+
+    def test_ena_support(self):
+        """ Test that instance types that require ENA are skipped when the
+        encryptor image doesn't support it.
+        """
+        self.assertEqual(
+            'c4.8xlarge',
+            ebs_performance.choose_instance_type(
+                'gp2', 500, ena_support=False)
+        )
+        with self.assertRaises(ValidationError):
+            ebs_performance.choose_instance_type(
+                'gp2', 8, ena_support=False, allowed_types=['c5.large'])
+
+    def test_allowed_types(self):
+        """ Test that the instance type is limited to the allow-list, and
+        that the largest allowed type is used if none are big enough.
+        """
+        self.assertEqual(
+            'm4.2xlarge',
+            ebs_performance.choose_instance_type(
+                'gp3', 1000, allowed_types=['m4.large', 'm4.2xlarge'])
+        )
+
+    def test_parse_instance_types(self):
+        self.assertEqual(
+            ['c4.xlarge', 'c5.xlarge'],
+            ebs_performance.parse_instance_types('c4.xlarge, c5.xlarge')
+        )
+        with self.assertRaises(ValidationError):
+            ebs_performance.parse_instance_types('c4.xlarge,t2.nano')
+        with self.assertRaises(ValidationError):
+            ebs_performance.parse_instance_types(',')
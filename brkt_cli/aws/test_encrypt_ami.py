@@ -14,6 +14,7 @@
 import email
 import json
 import os
+import threading
 import unittest
 
 import brkt_cli
@@ -22,8 +23,12 @@ import brkt_cli.util
 from brkt_cli import ValidationError, encryptor_service
 from brkt_cli.aws import (
     aws_service, encrypt_ami, update_ami, test_aws_service,
-    boto3_device)
-from brkt_cli.aws.aws_constants import TAG_ENCRYPTOR_SESSION_ID
+    boto3_device, boto3_tag)
+from brkt_cli.aws.aws_constants import (
+    NAME_ENCRYPTED_DATA_SNAPSHOT,
+    NAME_ENCRYPTED_ROOT_SNAPSHOT,
+    TAG_ENCRYPTOR_SESSION_ID
+)
 from brkt_cli.aws.model import Subnet, Volume
 from brkt_cli.aws.test_aws_service import build_aws_service
 from brkt_cli.instance_config import (
@@ -36,6 +41,7 @@ from brkt_cli.test_encryptor_service import (
     FailedEncryptionService
 )
 from brkt_cli.util import (
+    BracketError,
     CRYPTO_GCM,
     CRYPTO_XTS
 )
@@ -78,10 +84,16 @@ class DummyValues():
         self.ami = guest
         self.ca_cert = None
         self.crypto = CRYPTO_XTS
+        self.data_volume_encryptors = 4
         self.encrypted_ami_name = None
+        self.encrypt_data_volumes = True
         self.encryptor_ami = encryptor
         self.encryptor_instance_type = None
+        self.encryptor_instance_types = None
+        self.encryptor_volume_type = 'gp2'
+        self.fast_snapshot_restore = False
         self.guest_instance_type = None
+        self.guestless = False
         self.ntp_servers = None
         self.proxies = None
         self.proxy_config_file = None
@@ -115,6 +127,32 @@ class TestRunEncryption(unittest.TestCase):
         self.assertEqual(len(dev_names), 2)
         self.assertTrue('/dev/sda1' in dev_names)
 
+    def test_guestless(self):
+        """ Test that guestless mode encrypts the root snapshot of the
+        guest AMI without launching a guest instance, and that the guest
+        snapshot is not deleted.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        values = DummyValues(encryptor_image.id, guest_image.id)
+        values.guestless = True
+        guest_snapshot_id = boto3_device.get_snapshot_id(
+            guest_image.block_device_mappings[0])
+
+        def run_instance_callback(args):
+            self.assertEqual(encryptor_image.id, args.image_id)
+
+        aws_svc.run_instance_callback = run_instance_callback
+        encrypted_ami_id = encrypt_ami.encrypt(
+            aws_svc=aws_svc,
+            enc_svc_cls=DummyEncryptorService,
+            values=values)
+
+        image = aws_svc.get_image(encrypted_ami_id)
+        dev_names = boto3_device.get_device_names(image.block_device_mappings)
+        self.assertEqual(['/dev/sda1', '/dev/sdf'], sorted(dev_names))
+        self.assertEqual('simple', image.sriov_net_support)
+        self.assertIn(guest_snapshot_id, aws_svc.snapshots)
+
     def test_encryption_error_console_output_available(self):
         """ Test that when an encryption failure occurs, we write the
             console log to a temp file.
@@ -359,6 +397,27 @@ class TestRunEncryption(unittest.TestCase):
             enc_svc_cls=DummyEncryptorService,
             values=values)
 
+    def test_encryptor_instance_type_auto(self):
+        """ Test that the encryptor instance type is chosen from the
+        allow-list when the instance type is auto.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        values = DummyValues(encryptor_image.id, guest_image.id)
+        values.encryptor_instance_type = 'auto'
+        values.encryptor_instance_types = ['m4.large', 'm4.xlarge']
+        self.instance_type = None
+
+        def run_instance_callback(args):
+            if args.image_id == encryptor_image.id:
+                self.instance_type = args.instance_type
+
+        aws_svc.run_instance_callback = run_instance_callback
+        encrypt_ami.encrypt(
+            aws_svc=aws_svc,
+            enc_svc_cls=DummyEncryptorService,
+            values=values)
+        self.assertEqual('m4.large', self.instance_type)
+
     def test_terminate_guest(self):
         """ Test that we terminate the guest instance if an exception is
             raised while waiting for it to come up.
@@ -422,6 +481,292 @@ class TestRunEncryption(unittest.TestCase):
                 aws_svc, guest_instance, guest_image.id)
         self.assertTrue(self.snapshot_was_deleted)
 
+    def test_encryptor_volume_type(self):
+        """ Test that the encryptor volumes are provisioned with the
+        requested volume type, and that the encrypted AMI keeps the
+        volume type of the guest root volume.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        values = DummyValues(encryptor_image.id, guest_image.id)
+        values.encryptor_volume_type = 'gp3'
+        self.encryptor_bdm = None
+
+        def run_instance_callback(args):
+            if args.image_id == guest_image.id:
+                for volume_id in aws_svc.volumes:
+                    volume = aws_svc.volumes[volume_id]
+                    volume.volume_type = 'io1'
+                    volume.iops = 400
+            else:
+                self.encryptor_bdm = args.block_device_mappings
+
+        aws_svc.run_instance_callback = run_instance_callback
+        encrypted_ami_id = encrypt_ami.encrypt(
+            aws_svc=aws_svc,
+            enc_svc_cls=DummyEncryptorService,
+            values=values
+        )
+
+        for device_name in ('/dev/sdf', '/dev/sdg'):
+            ebs = boto3_device.get_device(
+                self.encryptor_bdm, device_name)['Ebs']
+            self.assertEqual('gp3', ebs['VolumeType'])
+            self.assertEqual(3000, ebs['Iops'])
+            self.assertEqual(125, ebs['Throughput'])
+
+        image = aws_svc.get_image(encrypted_ami_id)
+        ebs = boto3_device.get_device(
+            image.block_device_mappings, '/dev/sdf')['Ebs']
+        self.assertEqual('io1', ebs['VolumeType'])
+        self.assertEqual(400, ebs['Iops'])
+        self.assertNotIn('Throughput', ebs)
+
+    def _add_data_volume(self, aws_svc, guest_image, device_name='/dev/sdb',
+                         volume_type='io1', iops=1000, throughput=None):
+        """ Add a data volume to the guest image, and return its
+        snapshot.
+        """
+        snapshot = aws_svc.create_snapshot('vol-1')
+        guest_image.block_device_mappings.append(
+            boto3_device.make_device(
+                device_name=device_name, snapshot_id=snapshot.id,
+                volume_size=100, volume_type=volume_type, iops=iops,
+                throughput=throughput, delete_on_termination=True)
+        )
+        return snapshot
+
+    def _test_encrypt_data_volumes(self, guestless):
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        data_snapshot = self._add_data_volume(aws_svc, guest_image)
+        self._add_data_volume(
+            aws_svc, guest_image, device_name='/dev/sdc', volume_type='gp3',
+            iops=4000, throughput=250)
+        values = DummyValues(encryptor_image.id, guest_image.id)
+        values.guestless = guestless
+        self.encryptor_ids = []
+        self.terminated = []
+
+        def run_instance_callback(args):
+            if args.image_id == encryptor_image.id:
+                self.encryptor_ids.append(args.instance.id)
+
+        def terminate_instance_callback(instance_id):
+            self.terminated.append(instance_id)
+
+        aws_svc.run_instance_callback = run_instance_callback
+        aws_svc.terminate_instance_callback = terminate_instance_callback
+        encrypted_ami_id = encrypt_ami.encrypt(
+            aws_svc=aws_svc,
+            enc_svc_cls=DummyEncryptorService,
+            values=values
+        )
+
+        # The root and data volumes are encrypted by separate encryptors.
+        self.assertEqual(3, len(self.encryptor_ids))
+        for instance_id in self.encryptor_ids:
+            self.assertIn(instance_id, self.terminated)
+
+        image = aws_svc.get_image(encrypted_ami_id)
+        data_dev = boto3_device.get_device(
+            image.block_device_mappings, '/dev/sdb')
+        snapshot_id = boto3_device.get_snapshot_id(data_dev)
+        self.assertNotEqual(data_snapshot.id, snapshot_id)
+        self.assertEqual(
+            NAME_ENCRYPTED_DATA_SNAPSHOT,
+            boto3_tag.get_value(aws_svc.get_snapshot(snapshot_id).tags, 'Name')
+        )
+        self.assertEqual('io1', data_dev['Ebs']['VolumeType'])
+        self.assertEqual(1000, data_dev['Ebs']['Iops'])
+
+        gp3_dev = boto3_device.get_device(
+            image.block_device_mappings, '/dev/sdc')
+        self.assertEqual('gp3', gp3_dev['Ebs']['VolumeType'])
+        self.assertEqual(4000, gp3_dev['Ebs']['Iops'])
+        self.assertEqual(250, gp3_dev['Ebs']['Throughput'])
+
+    def test_encrypt_data_volumes(self):
+        """ Test that data volumes in the guest AMI are encrypted by
+        additional encryptor instances, and that the encrypted AMI
+        references the encrypted snapshots.
+        """
+        self._test_encrypt_data_volumes(guestless=False)
+
+    def test_encrypt_data_volumes_guestless(self):
+        self._test_encrypt_data_volumes(guestless=True)
+
+    def test_no_encrypt_data_volumes(self):
+        """ Test that only the root volume is encrypted when
+        encrypt_data_volumes is False.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        self._add_data_volume(aws_svc, guest_image)
+        values = DummyValues(encryptor_image.id, guest_image.id)
+        values.encrypt_data_volumes = False
+        self.encryptor_ids = []
+
+        def run_instance_callback(args):
+            if args.image_id == encryptor_image.id:
+                self.encryptor_ids.append(args.instance.id)
+
+        aws_svc.run_instance_callback = run_instance_callback
+        encrypt_ami.encrypt(
+            aws_svc=aws_svc,
+            enc_svc_cls=DummyEncryptorService,
+            values=values
+        )
+        self.assertEqual(1, len(self.encryptor_ids))
+
+    def test_guestless_keeps_data_volumes(self):
+        """ Test that a guestless encryption carries the data volumes of
+        the guest AMI into the encrypted AMI when they aren't encrypted.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        data_snapshot = self._add_data_volume(aws_svc, guest_image)
+        values = DummyValues(encryptor_image.id, guest_image.id)
+        values.guestless = True
+        values.encrypt_data_volumes = False
+        encrypted_ami_id = encrypt_ami.encrypt(
+            aws_svc=aws_svc,
+            enc_svc_cls=DummyEncryptorService,
+            values=values
+        )
+        image = aws_svc.get_image(encrypted_ami_id)
+        data_dev = boto3_device.get_device(
+            image.block_device_mappings, '/dev/sdb')
+        self.assertEqual(
+            data_snapshot.id, boto3_device.get_snapshot_id(data_dev))
+        self.assertEqual('io1', data_dev['Ebs']['VolumeType'])
+
+    def test_data_volume_at_guest_root_device(self):
+        """ Test that a data volume at /dev/sdf is rejected before anything
+        is launched in dual disk mode, since the encrypted guest root
+        uses that device.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        snapshot = aws_svc.create_snapshot('vol-1')
+        guest_image.block_device_mappings.append(
+            boto3_device.make_device(
+                device_name='/dev/sdf', snapshot_id=snapshot.id,
+                volume_size=100)
+        )
+        values = DummyValues(encryptor_image.id, guest_image.id)
+
+        def run_instance_callback(args):
+            self.fail('No instances should be launched')
+
+        aws_svc.run_instance_callback = run_instance_callback
+        with self.assertRaises(ValidationError):
+            encrypt_ami.encrypt(
+                aws_svc=aws_svc,
+                enc_svc_cls=DummyEncryptorService,
+                values=values
+            )
+
+    def test_data_volume_encryption_failure(self):
+        """ Test that the encrypted data snapshots are deleted when
+        encryption of the root volume fails.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        self._add_data_volume(aws_svc, guest_image)
+        values = DummyValues(encryptor_image.id, guest_image.id)
+        self.data_snapshot_ids = []
+        self.deleted = []
+        data_snapshot_created = threading.Event()
+
+        def create_snapshot_callback(volume_id, snapshot):
+            name = boto3_tag.get_value(snapshot.tags, 'Name')
+            if name == NAME_ENCRYPTED_DATA_SNAPSHOT:
+                self.data_snapshot_ids.append(snapshot.id)
+                data_snapshot_created.set()
+            elif name == NAME_ENCRYPTED_ROOT_SNAPSHOT:
+                data_snapshot_created.wait(10)
+                raise TestException()
+
+        def delete_snapshot_callback(snapshot_id):
+            self.deleted.append(snapshot_id)
+
+        aws_svc.create_snapshot_callback = create_snapshot_callback
+        aws_svc.delete_snapshot_callback = delete_snapshot_callback
+        with self.assertRaises(TestException):
+            encrypt_ami.encrypt(
+                aws_svc=aws_svc,
+                enc_svc_cls=DummyEncryptorService,
+                values=values
+            )
+        self.assertEqual(1, len(self.data_snapshot_ids))
+        self.assertIn(self.data_snapshot_ids[0], self.deleted)
+
+    def test_fast_snapshot_restore(self):
+        """ Test that Fast Snapshot Restore is enabled for the guest root
+        snapshot before the encryptor is launched, and disabled once the
+        encryptor's volumes are created.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        values = DummyValues(encryptor_image.id, guest_image.id)
+        values.fast_snapshot_restore = True
+        self.states = []
+
+        def run_instance_callback(args):
+            if args.image_id == encryptor_image.id:
+                self.states.extend(aws_svc.fast_snapshot_restores.values())
+
+        aws_svc.run_instance_callback = run_instance_callback
+        encrypt_ami.encrypt(
+            aws_svc=aws_svc,
+            enc_svc_cls=DummyEncryptorService,
+            values=values
+        )
+        self.assertEqual(['enabled'], self.states)
+        self.assertEqual(
+            ['disabled'], aws_svc.fast_snapshot_restores.values())
+
+    def test_fast_snapshot_restore_unavailable(self):
+        """ Test that encryption continues when Fast Snapshot Restore
+        can't be enabled.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        values = DummyValues(encryptor_image.id, guest_image.id)
+        values.fast_snapshot_restore = True
+
+        def enable_fast_snapshot_restore(snapshot_id, zone):
+            raise BracketError('Not supported')
+
+        aws_svc.enable_fast_snapshot_restore = enable_fast_snapshot_restore
+        encrypted_ami_id = encrypt_ami.encrypt(
+            aws_svc=aws_svc,
+            enc_svc_cls=DummyEncryptorService,
+            values=values
+        )
+        self.assertIsNotNone(encrypted_ami_id)
+        self.assertEqual({}, aws_svc.fast_snapshot_restores)
+
+    def test_fast_snapshot_restore_already_enabled(self):
+        """ Test that guestless mode doesn't disable Fast Snapshot Restore
+        that was already enabled for the guest snapshot.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        subnet = Subnet()
+        subnet.id = 'subnet-1'
+        subnet.availability_zone = 'us-west-2a'
+        aws_svc.subnets[subnet.id] = subnet
+
+        values = DummyValues(encryptor_image.id, guest_image.id)
+        values.guestless = True
+        values.fast_snapshot_restore = True
+        values.subnet_id = subnet.id
+        guest_snapshot_id = boto3_device.get_snapshot_id(
+            guest_image.block_device_mappings[0])
+        key = (guest_snapshot_id, subnet.availability_zone)
+        aws_svc.fast_snapshot_restores[key] = 'enabled'
+
+        encrypted_ami_id = encrypt_ami.encrypt(
+            aws_svc=aws_svc,
+            enc_svc_cls=DummyEncryptorService,
+            values=values
+        )
+        self.assertIsNotNone(encrypted_ami_id)
+        self.assertEqual('enabled', aws_svc.fast_snapshot_restores[key])
+
     def test_no_terminate_encryptor_on_failure(self):
         """ Test that when terminate_encryptor_on_failure=False, we terminate
             the encryptor only when encryption succeeds.
@@ -0,0 +1,115 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+from brkt_cli import util
+from brkt_cli.aws import encrypt_batch
+from brkt_cli.aws.test_aws_service import build_aws_service
+from brkt_cli.aws.test_encrypt_ami import DummyValues
+from brkt_cli.test_encryptor_service import DummyEncryptorService
+from brkt_cli.validation import ValidationError
+
+
+class TestException(Exception):
+    pass
+
+
+class TestManifest(unittest.TestCase):
+
+    def test_parse_manifest(self):
+        manifest = '''
+- ami-1
+- ami: ami-2
+  encrypted_ami_name: Encrypted 2
+  aws_tags:
+    env: prod
+'''
+        entries = encrypt_batch.parse_manifest(manifest)
+        self.assertEqual(['ami-1', 'ami-2'], [e.ami for e in entries])
+        self.assertIsNone(entries[0].encrypted_ami_name)
+        self.assertEqual({}, entries[0].aws_tags)
+        self.assertEqual('Encrypted 2', entries[1].encrypted_ami_name)
+        self.assertEqual({'env': 'prod'}, entries[1].aws_tags)
+
+    def test_parse_json_manifest(self):
+        entries = encrypt_batch.parse_manifest(
+            '["ami-1", {"ami": "ami-2"}]')
+        self.assertEqual(['ami-1', 'ami-2'], [e.ami for e in entries])
+
+    def test_invalid_manifest(self):
+        invalid = [
+            '',
+            'ami-1',
+            '[]',
+            '- [ami-1]',
+            '- encrypted_ami_name: foo',
+            '- {ami: ami-1, color: blue}',
+            '- {ami: ami-1, aws_tags: [a, b]}',
+            '- {ami: ami-1, aws_tags: {"aws:foo": bar}}',
+            '- ami-1\n- ami-1',
+            '- {ami: ami-1, encrypted_ami_name: x}\n'
+            '- {ami: ami-2, encrypted_ami_name: x}',
+        ]
+        for manifest in invalid:
+            with self.assertRaises(ValidationError):
+                encrypt_batch.parse_manifest(manifest)
+
+
+def _make_job():
+    aws_svc, encryptor_image, guest_image = build_aws_service()
+    values = DummyValues(encryptor_image.id, guest_image.id)
+    return encrypt_batch.EncryptJob(aws_svc, values)
+
+
+class TestEncryptMany(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+
+    def test_encrypt_many(self):
+        jobs = [_make_job() for _ in range(5)]
+        results = encrypt_batch.encrypt_many(
+            jobs, DummyEncryptorService, max_parallel=2)
+
+        self.assertEqual(jobs, results)
+        for job in jobs:
+            self.assertIsNone(job.error)
+            image = job.aws_svc.get_image(job.encrypted_ami_id)
+            self.assertEqual('available', image.state)
+
+        table = encrypt_batch.render_results(jobs)
+        lines = table.split('\n')
+        self.assertEqual(6, len(lines))
+        self.assertTrue(lines[0].startswith('AMI'))
+        for job, line in zip(jobs, lines[1:]):
+            self.assertIn(job.session_id, line)
+            self.assertIn(job.encrypted_ami_id, line)
+
+    def test_failure_does_not_stop_batch(self):
+        jobs = [_make_job() for _ in range(3)]
+
+        def run_instance_callback(args):
+            raise TestException('Test')
+
+        jobs[1].aws_svc.run_instance_callback = run_instance_callback
+        encrypt_batch.encrypt_many(
+            jobs, DummyEncryptorService, max_parallel=2)
+
+        self.assertIsNotNone(jobs[0].encrypted_ami_id)
+        self.assertIsNone(jobs[1].encrypted_ami_id)
+        self.assertIsInstance(jobs[1].error, TestException)
+        self.assertIsNotNone(jobs[2].encrypted_ami_id)
+
+        lines = encrypt_batch.render_results(jobs).split('\n')
+        self.assertIn('failed: Test', lines[2])
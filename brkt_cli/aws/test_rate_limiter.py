@@ -0,0 +1,185 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+import boto3
+from botocore.stub import Stubber
+
+import brkt_cli.util
+from brkt_cli.aws import rate_limiter
+from brkt_cli.aws.rate_limiter import (
+    DESCRIBE, FAMILIES, MUTATE, RUN_INSTANCES, RateLimiter, TokenBucket
+)
+
+
+class DummyHTTPResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class DummyOperationModel(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        brkt_cli.util.SLEEP_ENABLED = False
+
+    def test_burst(self):
+        """ Test that calls within the burst size don't wait, and that
+        the next call waits for a token.
+        """
+        bucket = TokenBucket(2.0, 3)
+        for _ in xrange(3):
+            self.assertEqual(0, bucket.acquire())
+        self.assertGreater(bucket.acquire(), 0)
+        self.assertGreater(bucket.wait_seconds, 0)
+        self.assertEqual(4, bucket.calls)
+
+    def test_throttled(self):
+        """ Test that throttling halves the rate down to the minimum, and
+        that successful calls raise it back to the maximum.
+        """
+        bucket = TokenBucket(10.0, 10)
+        bucket.throttled()
+        self.assertEqual(5.0, bucket.rate)
+        for _ in xrange(10):
+            bucket.throttled()
+        self.assertEqual(bucket.min_rate, bucket.rate)
+        self.assertGreater(bucket.acquire(), 0)
+
+        for _ in xrange(100):
+            bucket.succeeded()
+        self.assertEqual(10.0, bucket.rate)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        brkt_cli.util.SLEEP_ENABLED = False
+
+    def test_get_family(self):
+        self.assertEqual(
+            DESCRIBE, rate_limiter.get_family('DescribeInstances'))
+        self.assertEqual(
+            DESCRIBE, rate_limiter.get_family('GetConsoleOutput'))
+        self.assertEqual(MUTATE, rate_limiter.get_family('CreateTags'))
+        self.assertEqual(
+            RUN_INSTANCES, rate_limiter.get_family('RunInstances'))
+
+    def test_install(self):
+        """ Test that successful calls made by a boto3 client raise the
+        rate of their family.
+        """
+        limiter = RateLimiter()
+        client = boto3.client('ec2', region_name='us-west-2')
+        limiter.install(client)
+        for family in FAMILIES:
+            limiter.get_bucket('us-west-2', family).throttled()
+
+        with Stubber(client) as stubber:
+            stubber.add_response('describe_regions', {'Regions': []})
+            stubber.add_response('create_tags', {})
+            client.describe_regions()
+            client.create_tags(
+                Resources=['i-1'], Tags=[{'Key': 'a', 'Value': 'b'}])
+
+        for family in (DESCRIBE, MUTATE):
+            bucket = limiter.get_bucket('us-west-2', family)
+            self.assertGreater(bucket.rate, bucket.max_rate / 2)
+        bucket = limiter.get_bucket('us-west-2', RUN_INSTANCES)
+        self.assertEqual(bucket.max_rate / 2, bucket.rate)
+
+    def test_before_call(self):
+        limiter = RateLimiter()
+        limiter._before_call(
+            'us-west-2', model=DummyOperationModel('DescribeVolumes'))
+        limiter._before_call(
+            'us-west-2', model=DummyOperationModel('RunInstances'))
+        limiter._before_call(
+            'us-east-1', model=DummyOperationModel('DescribeVolumes'))
+        self.assertEqual(1, limiter.get_bucket('us-west-2', DESCRIBE).calls)
+        self.assertEqual(
+            1, limiter.get_bucket('us-west-2', RUN_INSTANCES).calls)
+        self.assertEqual(0, limiter.get_bucket('us-west-2', MUTATE).calls)
+        self.assertEqual(1, limiter.get_bucket('us-east-1', DESCRIBE).calls)
+
+    def test_throttling_error(self):
+        """ Test that a throttling error lowers the rate of the family
+        that was throttled.
+        """
+        limiter = RateLimiter()
+        response = (
+            DummyHTTPResponse(503),
+            {'Error': {'Code': 'RequestLimitExceeded'}}
+        )
+        self.assertIsNone(limiter._needs_retry(
+            'us-west-2',
+            response=response,
+            operation=DummyOperationModel('RunInstances')
+        ))
+        bucket = limiter.get_bucket('us-west-2', RUN_INSTANCES)
+        self.assertLess(bucket.rate, bucket.max_rate)
+        self.assertEqual(1, bucket.throttled_calls)
+        describe = limiter.get_bucket('us-west-2', DESCRIBE)
+        self.assertEqual(describe.max_rate, describe.rate)
+
+        # Other regions aren't affected.
+        bucket = limiter.get_bucket('us-east-1', RUN_INSTANCES)
+        self.assertEqual(bucket.max_rate, bucket.rate)
+
+        # Other errors don't affect the rate.
+        response = (
+            DummyHTTPResponse(400),
+            {'Error': {'Code': 'InvalidInstanceID.NotFound'}}
+        )
+        limiter._needs_retry(
+            'us-west-2',
+            response=response,
+            operation=DummyOperationModel('DescribeInstances')
+        )
+        self.assertEqual(0, describe.throttled_calls)
+
+    def test_retry_takes_token(self):
+        """ Test that only a throttled call that is retried takes another
+        token, and that the final attempt doesn't.
+        """
+        limiter = RateLimiter()
+        bucket = limiter.get_bucket('us-west-2', MUTATE)
+        response = (
+            DummyHTTPResponse(503),
+            {'Error': {'Code': 'RequestLimitExceeded'}}
+        )
+        operation = DummyOperationModel('CreateTags')
+
+        # The first attempt takes a token before the call.
+        limiter._before_call('us-west-2', model=operation)
+        limiter._request_created('us-west-2', operation_name='CreateTags')
+        self.assertEqual(1, bucket.calls)
+
+        # botocore retries the throttled attempt.
+        limiter._needs_retry('us-west-2', response=response,
+                             operation=operation)
+        limiter._request_created('us-west-2', operation_name='CreateTags')
+        self.assertEqual(2, bucket.calls)
+
+        # The final attempt is throttled, and botocore gives up.  The next
+        # call only takes its own token.
+        limiter._needs_retry('us-west-2', response=response,
+                             operation=operation)
+        limiter._before_call('us-west-2', model=operation)
+        limiter._request_created('us-west-2', operation_name='CreateTags')
+        self.assertEqual(3, bucket.calls)
@@ -0,0 +1,160 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import unittest
+
+from brkt_cli import util
+from brkt_cli.aws import boto3_device, boto3_tag, encrypt_ami, replicate
+from brkt_cli.aws.aws_constants import (
+    NAME_ENCRYPTED_ROOT_SNAPSHOT, TAG_ENCRYPTOR_SESSION_ID
+)
+from brkt_cli.aws.test_aws_service import DummyAWSService, build_aws_service
+from brkt_cli.aws.test_encrypt_ami import DummyValues
+from brkt_cli.test_encryptor_service import DummyEncryptorService
+from brkt_cli.validation import ValidationError
+
+REGIONS = ['us-east-1', 'eu-west-1', 'ap-south-1']
+
+
+class TestException(Exception):
+    pass
+
+
+class TestReplicate(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+        self.aws_svc, encryptor_image, guest_image = build_aws_service()
+        values = DummyValues(encryptor_image.id, guest_image.id)
+        self.image_id = encrypt_ami.encrypt(
+            aws_svc=self.aws_svc,
+            enc_svc_cls=DummyEncryptorService,
+            values=values)
+
+        self.region_svcs = {}
+
+    def _connect(self, region):
+        svc = DummyAWSService()
+        svc.region = region
+        svc.default_tags = self.aws_svc.default_tags
+        svc.peers[self.aws_svc.region] = self.aws_svc
+        self.region_svcs[region] = svc
+        return svc
+
+    def test_replicate_image(self):
+        """ Test that the image is copied to every region, and that the
+        copies and their snapshots are tagged.
+        """
+        replicas = replicate.replicate_image(
+            self.aws_svc, self.image_id, REGIONS, self._connect)
+        self.assertEqual(REGIONS, [r.region for r in replicas])
+
+        session_id = self.aws_svc.default_tags[TAG_ENCRYPTOR_SESSION_ID]
+        for replica in replicas:
+            self.assertIsNone(replica.error)
+            svc = self.region_svcs[replica.region]
+            image = svc.get_image(replica.image_id)
+            self.assertEqual(
+                session_id,
+                boto3_tag.get_value(image.tags, TAG_ENCRYPTOR_SESSION_ID)
+            )
+            guest_dev = boto3_device.get_device(
+                image.block_device_mappings, '/dev/sdf')
+            snapshot = svc.get_snapshot(guest_dev['Ebs']['SnapshotId'])
+            self.assertEqual(
+                NAME_ENCRYPTED_ROOT_SNAPSHOT,
+                boto3_tag.get_value(snapshot.tags, 'Name')
+            )
+
+        table = replicate.render_results('us-west-2', self.image_id, replicas)
+        self.assertEqual(5, len(table.split('\n')))
+
+    def test_failure_does_not_stop_others(self):
+        def copy_image_callback(source_region, source_image_id):
+            raise TestException('Test')
+
+        def _connect(region):
+            svc = self._connect(region)
+            if region == 'eu-west-1':
+                svc.copy_image_callback = copy_image_callback
+            return svc
+
+        replicas = replicate.replicate_image(
+            self.aws_svc, self.image_id, REGIONS, _connect)
+        self.assertIsNotNone(replicas[0].image_id)
+        self.assertIsInstance(replicas[1].error, TestException)
+        self.assertIsNotNone(replicas[2].image_id)
+
+        table = replicate.render_results('us-west-2', self.image_id, replicas)
+        self.assertIn('failed: Test', table)
+
+    def test_partial_copy_deleted(self):
+        """ Test that a copy that fails after CopyImage is deregistered,
+        and that its snapshots are deleted.
+        """
+        def _connect(region):
+            svc = self._connect(region)
+
+            def get_images(**kwargs):
+                images = DummyAWSService.get_images(svc, **kwargs)
+                for image in images:
+                    image.state = 'failed'
+                return images
+            svc.get_images = get_images
+            return svc
+
+        replicas = replicate.replicate_image(
+            self.aws_svc, self.image_id, REGIONS[:1], _connect)
+        self.assertIsNotNone(replicas[0].error)
+        self.assertIsNone(replicas[0].image_id)
+        svc = self.region_svcs[REGIONS[0]]
+        self.assertEqual({}, svc.images)
+        self.assertEqual({}, svc.snapshots)
+
+    def test_validate_regions(self):
+        self.assertEqual(
+            ['us-east-1', 'eu-west-1'],
+            replicate.validate_regions(
+                'us-west-2', ['us-east-1', 'eu-west-1', 'us-east-1'])
+        )
+        with self.assertRaises(ValidationError):
+            replicate.validate_regions('us-west-2', ['us-west-2'])
+        with self.assertRaises(ValidationError):
+            replicate.validate_regions(
+                'us-west-2', ['mars-1'], region_names=REGIONS)
+
+
+class TestSnapshotCopyLimiter(unittest.TestCase):
+
+    def test_limit(self):
+        """ Test that copies into a region wait until there's room under
+        the limit, and that other regions aren't affected.
+        """
+        limiter = replicate.SnapshotCopyLimiter(limit=3)
+        self.assertEqual(2, limiter.acquire('us-east-1', 2))
+        self.assertEqual(3, limiter.acquire('eu-west-1', 5))
+
+        acquired = threading.Event()
+
+        def _acquire():
+            limiter.acquire('us-east-1', 2)
+            acquired.set()
+
+        t = threading.Thread(target=_acquire)
+        t.start()
+        self.assertFalse(acquired.wait(0.05))
+        limiter.release('us-east-1', 2)
+        t.join(5)
+        self.assertTrue(acquired.is_set())
+        self.assertEqual(2, limiter.in_use['us-east-1'])
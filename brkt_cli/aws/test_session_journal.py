@@ -0,0 +1,411 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from botocore.exceptions import ClientError
+
+import brkt_cli.util
+from brkt_cli import encryptor_service
+from brkt_cli.aws import (
+    boto3_device, encrypt_ami, session_journal, test_update_ami
+)
+from brkt_cli.aws.session_journal import (
+    PHASE_ENCRYPTED,
+    PHASE_ENCRYPTOR_LAUNCHED,
+    PHASE_GUEST_SNAPSHOT
+)
+from brkt_cli.aws.test_aws_service import build_aws_service
+from brkt_cli.aws.test_encrypt_ami import DummyValues
+from brkt_cli.aws.update_ami import update_ami
+from brkt_cli.test_encryptor_service import DummyEncryptorService
+from brkt_cli.validation import ValidationError
+
+
+class InterruptedEncryptorService(DummyEncryptorService):
+    """ Simulates the user pressing Ctrl-C while encryption is in
+    progress.
+    """
+    def get_status(self):
+        raise KeyboardInterrupt()
+
+
+class DataVolumeInterruptedService(DummyEncryptorService):
+    """ Simulates the user pressing Ctrl-C while the root volume is
+    encrypted, as soon as a data volume encryptor is launched.
+    """
+    data_encryptor_launched = None
+
+    def get_status(self):
+        if isinstance(threading.current_thread(), threading._MainThread):
+            self.data_encryptor_launched.wait(10)
+            raise KeyboardInterrupt()
+        return {
+            'state': encryptor_service.ENCRYPT_ENCRYPTING,
+            'percent_complete': 0
+        }
+
+
+class TestSessionJournal(unittest.TestCase):
+
+    def setUp(self):
+        brkt_cli.util.SLEEP_ENABLED = False
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_and_load(self):
+        journal = session_journal.create(
+            'abc', 'encrypt', 'us-west-2', {'ami': 'ami-1'},
+            directory=self.directory
+        )
+        journal.record(guest_instance_id='i-1')
+        journal.complete_phase(PHASE_GUEST_SNAPSHOT, snapshot_id='snap-1')
+
+        journal = session_journal.load(
+            'abc', 'encrypt', 'us-west-2', directory=self.directory)
+        self.assertEqual({'ami': 'ami-1'}, journal.values)
+        self.assertEqual('i-1', journal.get('guest_instance_id'))
+        self.assertEqual('snap-1', journal.get('snapshot_id'))
+        self.assertTrue(journal.is_complete(PHASE_GUEST_SNAPSHOT))
+        self.assertFalse(journal.is_complete(PHASE_ENCRYPTOR_LAUNCHED))
+
+        journal.delete()
+        self.assertFalse(os.path.exists(journal.path))
+
+    def test_load_validation(self):
+        session_journal.create(
+            'abc', 'encrypt', 'us-west-2', {}, directory=self.directory)
+        with self.assertRaises(ValidationError):
+            session_journal.load(
+                'abc', 'update', 'us-west-2', directory=self.directory)
+        with self.assertRaises(ValidationError):
+            session_journal.load(
+                'abc', 'encrypt', 'us-east-1', directory=self.directory)
+        with self.assertRaises(ValidationError):
+            session_journal.load(
+                'xyz', 'encrypt', 'us-west-2', directory=self.directory)
+
+    def test_resume_encrypt(self):
+        """ Test that an interrupted encryption keeps its resources and
+        journal, and that resuming reattaches to the running encryptor
+        instead of launching a new one.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        values = DummyValues(encryptor_image.id, guest_image.id)
+        journal = session_journal.create(
+            aws_svc.session_id, 'encrypt', 'us-west-2', {},
+            directory=self.directory
+        )
+
+        self.launched = []
+        self.terminated = []
+
+        def run_instance_callback(args):
+            self.launched.append(args.image_id)
+
+        def terminate_instance_callback(instance_id):
+            self.terminated.append(instance_id)
+
+        aws_svc.run_instance_callback = run_instance_callback
+        aws_svc.terminate_instance_callback = terminate_instance_callback
+
+        with self.assertRaises(KeyboardInterrupt):
+            encrypt_ami.encrypt(
+                aws_svc=aws_svc,
+                enc_svc_cls=InterruptedEncryptorService,
+                values=values,
+                journal=journal
+            )
+        self.assertEqual([], self.terminated)
+        self.assertEqual(
+            [guest_image.id, encryptor_image.id], self.launched)
+
+        journal = session_journal.load(
+            aws_svc.session_id, 'encrypt', 'us-west-2',
+            directory=self.directory
+        )
+        self.assertTrue(journal.is_complete(PHASE_ENCRYPTOR_LAUNCHED))
+        encryptor_id = journal.get('encryptor_instance_id')
+
+        encrypted_ami_id = encrypt_ami.encrypt(
+            aws_svc=aws_svc,
+            enc_svc_cls=DummyEncryptorService,
+            values=values,
+            journal=journal
+        )
+        self.assertIsNotNone(encrypted_ami_id)
+        self.assertEqual(
+            [guest_image.id, encryptor_image.id], self.launched)
+        self.assertIn(encryptor_id, self.terminated)
+        self.assertFalse(os.path.exists(journal.path))
+
+    def test_interrupt_data_volume_encryption(self):
+        """ Test that a data volume encryptor that is still launching is
+        terminated when the session is interrupted, and that the root
+        encryptor is kept.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        snapshot = aws_svc.create_snapshot('vol-1')
+        guest_image.block_device_mappings.append(
+            boto3_device.make_device(
+                device_name='/dev/sdb', snapshot_id=snapshot.id,
+                volume_size=100, delete_on_termination=True)
+        )
+        values = DummyValues(encryptor_image.id, guest_image.id)
+        journal = session_journal.create(
+            aws_svc.session_id, 'encrypt', 'us-west-2', {},
+            directory=self.directory
+        )
+        launched = threading.Event()
+        DataVolumeInterruptedService.data_encryptor_launched = launched
+        self.encryptor_ids = []
+        self.terminated = []
+
+        def run_instance_callback(args):
+            if args.image_id == encryptor_image.id:
+                self.encryptor_ids.append(args.instance.id)
+                if len(self.encryptor_ids) == 2:
+                    launched.set()
+
+        def terminate_instance_callback(instance_id):
+            self.terminated.append(instance_id)
+
+        aws_svc.run_instance_callback = run_instance_callback
+        aws_svc.terminate_instance_callback = terminate_instance_callback
+
+        with self.assertRaises(KeyboardInterrupt):
+            encrypt_ami.encrypt(
+                aws_svc=aws_svc,
+                enc_svc_cls=DataVolumeInterruptedService,
+                values=values,
+                journal=journal
+            )
+        self.assertEqual(2, len(self.encryptor_ids))
+        root_encryptor_id = journal.get('encryptor_instance_id')
+        data_encryptor_ids = [
+            instance_id for instance_id in self.encryptor_ids
+            if instance_id != root_encryptor_id
+        ]
+        self.assertEqual(data_encryptor_ids, self.terminated)
+
+    def _interrupt_on_tag(self, aws_svc, name, error=None):
+        """ Raise KeyboardInterrupt, or the given error, when a volume is
+        tagged with the given name after it's detached.  The volume was
+        already tagged when the encryptor was launched.
+        """
+        self.tagged = []
+
+        def create_tags_callback(resource_id, tag_name, description):
+            if tag_name == name:
+                self.tagged.append(resource_id)
+                if len(self.tagged) == 2:
+                    raise error or KeyboardInterrupt()
+
+        aws_svc.create_tags_callback = create_tags_callback
+
+    def _record_calls(self, aws_svc):
+        self.launched = []
+        self.snapshotted = []
+
+        def run_instance_callback(args):
+            self.launched.append(args.image_id)
+
+        def create_snapshot_callback(volume_id, snapshot):
+            self.snapshotted.append(volume_id)
+
+        aws_svc.run_instance_callback = run_instance_callback
+        aws_svc.create_snapshot_callback = create_snapshot_callback
+
+    def _test_resume_encrypt_after_detach(self, single_disk, tag_name):
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        values = DummyValues(encryptor_image.id, guest_image.id)
+        values.single_disk = single_disk
+        journal = session_journal.create(
+            aws_svc.session_id, 'encrypt', 'us-west-2', {},
+            directory=self.directory
+        )
+        self._record_calls(aws_svc)
+        self._interrupt_on_tag(aws_svc, tag_name)
+
+        with self.assertRaises(KeyboardInterrupt):
+            encrypt_ami.encrypt(
+                aws_svc=aws_svc,
+                enc_svc_cls=DummyEncryptorService,
+                values=values,
+                journal=journal
+            )
+        journal = session_journal.load(
+            aws_svc.session_id, 'encrypt', 'us-west-2',
+            directory=self.directory
+        )
+        self.assertTrue(journal.is_complete(PHASE_ENCRYPTED))
+        snapshotted = list(self.snapshotted)
+
+        encrypted_ami_id = encrypt_ami.encrypt(
+            aws_svc=aws_svc,
+            enc_svc_cls=DummyEncryptorService,
+            values=values,
+            journal=journal
+        )
+        self.assertIsNotNone(encrypted_ami_id)
+        # The resumed session doesn't launch instances or snapshot the
+        # encrypted volume again.
+        self.assertEqual(
+            [guest_image.id, encryptor_image.id], self.launched)
+        self.assertEqual(snapshotted, self.snapshotted)
+        self.assertFalse(os.path.exists(journal.path))
+
+    def test_resume_encrypt_single_disk_after_detach(self):
+        """ Test resuming a single disk encryption after the encrypted
+        root volume was detached from the encryptor.
+        """
+        self._test_resume_encrypt_after_detach(
+            True, encrypt_ami.NAME_ENCRYPTED_ROOT_VOLUME)
+
+    def test_resume_encrypt_dual_disk_after_detach(self):
+        """ Test resuming a dual disk encryption after the encrypted guest
+        volume was snapshotted and the Metavisor root was detached.
+        """
+        self._test_resume_encrypt_after_detach(
+            False, encrypt_ami.NAME_METAVISOR_ROOT_VOLUME)
+
+    def _encrypt_with_error(self, error_code):
+        """ Run a dual disk encryption that fails with the given AWS error
+        code after the Metavisor root is detached.
+
+        :return the journal
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        values = DummyValues(encryptor_image.id, guest_image.id)
+        journal = session_journal.create(
+            aws_svc.session_id, 'encrypt', 'us-west-2', {},
+            directory=self.directory
+        )
+        self.terminated = []
+
+        def terminate_instance_callback(instance_id):
+            self.terminated.append(instance_id)
+
+        aws_svc.terminate_instance_callback = terminate_instance_callback
+        error = ClientError(
+            {'Error': {'Code': error_code, 'Message': 'Failed'}},
+            'CreateTags'
+        )
+        self._interrupt_on_tag(
+            aws_svc, encrypt_ami.NAME_METAVISOR_ROOT_VOLUME, error=error)
+
+        with self.assertRaises(ClientError):
+            encrypt_ami.encrypt(
+                aws_svc=aws_svc,
+                enc_svc_cls=DummyEncryptorService,
+                values=values,
+                journal=journal
+            )
+        return journal
+
+    def test_transient_error_keeps_resources(self):
+        """ Test that the resources and journal are kept when encryption
+        fails with a transient AWS error, so that it can be resumed.
+        """
+        journal = self._encrypt_with_error('InternalError')
+        self.assertEqual([], self.terminated)
+        self.assertTrue(os.path.exists(journal.path))
+
+    def test_error_cleans_up(self):
+        """ Test that the resources and journal are deleted when encryption
+        fails with an error that isn't transient.
+        """
+        journal = self._encrypt_with_error('InvalidParameterValue')
+        self.assertIn(journal.get('encryptor_instance_id'), self.terminated)
+        self.assertFalse(os.path.exists(journal.path))
+
+    def _encrypt_for_update(self):
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        values = DummyValues(encryptor_image.id, guest_image.id)
+        encrypted_ami_id = encrypt_ami.encrypt(
+            aws_svc=aws_svc,
+            enc_svc_cls=DummyEncryptorService,
+            values=values
+        )
+        values = test_update_ami.DummyValues(
+            encryptor_image.id, encrypted_ami_id)
+        journal = session_journal.create(
+            aws_svc.session_id, 'update', 'us-west-2', {},
+            directory=self.directory
+        )
+        self._record_calls(aws_svc)
+        return aws_svc, values, journal
+
+    def test_resume_update(self):
+        """ Test that resuming an interrupted update reattaches to the
+        updater and reuses the snapshot of the encrypted guest.
+        """
+        aws_svc, values, journal = self._encrypt_for_update()
+        with self.assertRaises(KeyboardInterrupt):
+            update_ami(
+                aws_svc,
+                InterruptedEncryptorService,
+                values,
+                journal=journal
+            )
+        launched = list(self.launched)
+        snapshotted = list(self.snapshotted)
+        self.assertEqual([values.ami, values.encryptor_ami], launched)
+
+        journal = session_journal.load(
+            aws_svc.session_id, 'update', 'us-west-2',
+            directory=self.directory
+        )
+        self.assertTrue(journal.is_complete(PHASE_ENCRYPTOR_LAUNCHED))
+        updated_ami_id = update_ami(
+            aws_svc, DummyEncryptorService, values, journal=journal)
+        self.assertIsNotNone(updated_ami_id)
+        self.assertEqual(launched, self.launched)
+        self.assertEqual(snapshotted, self.snapshotted)
+        self.assertFalse(os.path.exists(journal.path))
+
+    def test_resume_update_after_attach(self):
+        """ Test resuming an update after the new Metavisor root was moved
+        from the updater to the guest instance.
+        """
+        aws_svc, values, journal = self._encrypt_for_update()
+        attach_volume = aws_svc.attach_volume
+        attached = []
+
+        def attach_and_interrupt(vol_id, instance_id, device_name):
+            attach_volume(vol_id, instance_id, device_name)
+            if not attached:
+                attached.append(vol_id)
+                raise KeyboardInterrupt()
+
+        aws_svc.attach_volume = attach_and_interrupt
+        with self.assertRaises(KeyboardInterrupt):
+            update_ami(
+                aws_svc, DummyEncryptorService, values, journal=journal)
+
+        journal = session_journal.load(
+            aws_svc.session_id, 'update', 'us-west-2',
+            directory=self.directory
+        )
+        self.assertEqual(attached[0], journal.get('new_mv_vol_id'))
+        updated_ami_id = update_ami(
+            aws_svc, DummyEncryptorService, values, journal=journal)
+        self.assertIsNotNone(updated_ami_id)
+        self.assertEqual(1, len(attached))
+        self.assertFalse(os.path.exists(journal.path))
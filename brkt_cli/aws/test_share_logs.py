@@ -51,6 +51,9 @@ class ShareLogsTestService(share_logs.ShareLogsService):
         self.ec2client = EC2Client()
         self.ec2 = EC2()
 
+    def clone(self):
+        return self
+
     def get_instance(self, instance_id):
         instance = Instance()
         instance.state['Name'] = 'running'
@@ -0,0 +1,160 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import datetime
+import unittest
+
+from brkt_cli import util
+from brkt_cli.aws import boto3_device, encrypt_ami, sweep
+from brkt_cli.aws.test_aws_service import DummyAWSService, build_aws_service
+
+NOW = datetime.datetime(2017, 6, 1, 12, 0, 0)
+ONE_DAY = 60 * 60 * 24
+
+
+def _make_session(aws_svc, session_id, created):
+    """ Simulate a session that was killed before it cleaned up. """
+    aws_svc.default_tags = encrypt_ami.get_default_tags(
+        session_id, 'ami-encryptor')
+    sg = aws_svc.create_security_group('Bracket Encryptor', 'test')
+    instance = aws_svc.run_instance(
+        aws_svc.guest_image_id, security_group_ids=[sg.id],
+        instance_type='c4.xlarge')
+    instance.launch_time = created
+    volume = aws_svc.create_volume(100, 'us-west-2a')
+    volume.create_time = created
+    snapshot = aws_svc.create_snapshot(volume.id)
+    snapshot.start_time = created
+    snapshot.volume_size = 100
+    aws_svc.default_tags = {}
+    return instance, volume, snapshot, sg
+
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+        self.aws_svc, _, guest_image = build_aws_service()
+        self.aws_svc.default_tags = {}
+        self.aws_svc.guest_image_id = guest_image.id
+        self.now = sweep._get_timestamp(NOW)
+
+    def test_find_sessions(self):
+        """ Test that resources are grouped by session, and that the limits
+        they use are counted.
+        """
+        instance, volume, snapshot, sg = _make_session(
+            self.aws_svc, 'old', NOW - datetime.timedelta(days=2))
+        sessions = sweep.find_sessions(self.aws_svc)
+        self.assertEqual(['old'], sessions.keys())
+
+        session = sessions['old']
+        self.assertEqual([instance.id], session.instance_ids)
+        self.assertEqual([volume.id], session.volume_ids)
+        self.assertEqual([snapshot.id], session.snapshot_ids)
+        self.assertEqual([sg.id], session.security_group_ids)
+        self.assertEqual(4, session.vcpus)
+        self.assertEqual(100, session.volume_gib)
+        self.assertEqual(100, session.snapshot_gib)
+
+    def test_image_snapshots_are_kept(self):
+        """ Test that snapshots referenced by an AMI are not orphans. """
+        _, _, snapshot, _ = _make_session(
+            self.aws_svc, 'old', NOW - datetime.timedelta(days=2))
+        self.aws_svc.register_image(
+            [boto3_device.make_device(
+                device_name='/dev/sda1', snapshot_id=snapshot.id)],
+            name='encrypted'
+        )
+        sessions = sweep.find_sessions(self.aws_svc)
+        self.assertEqual([], sessions['old'].snapshot_ids)
+
+    def test_terminated_instances_are_skipped(self):
+        instance, _, _, _ = _make_session(
+            self.aws_svc, 'old', NOW - datetime.timedelta(days=2))
+        self.aws_svc.terminate_instance(instance.id)
+        sessions = sweep.find_sessions(self.aws_svc)
+        self.assertEqual([], sessions['old'].instance_ids)
+        self.assertEqual(0, sessions['old'].vcpus)
+
+    def test_sweep(self):
+        """ Test that the resources of old sessions are deleted, and that
+        recent sessions are left alone.
+        """
+        instance, volume, snapshot, sg = _make_session(
+            self.aws_svc, 'old', NOW - datetime.timedelta(days=2))
+        new_instance, new_volume, new_snapshot, new_sg = _make_session(
+            self.aws_svc, 'new', NOW - datetime.timedelta(hours=1))
+
+        other_svc = DummyAWSService()
+        svcs = {'us-west-2': self.aws_svc, 'eu-west-1': other_svc}
+        results = sweep.sweep(
+            ['us-west-2', 'eu-west-1'], svcs.get, ONE_DAY, now=self.now)
+        self.assertEqual(['old'], [s.session_id for s in results[0].sessions])
+        self.assertEqual([], results[1].sessions)
+
+        self.assertEqual(
+            'terminated', self.aws_svc.instances[instance.id].state['Name'])
+        self.assertNotIn(volume.id, self.aws_svc.volumes)
+        self.assertNotIn(snapshot.id, self.aws_svc.snapshots)
+        self.assertNotIn(sg.id, self.aws_svc.security_groups)
+
+        self.assertEqual(
+            'pending', self.aws_svc.instances[new_instance.id].state['Name'])
+        self.assertIn(new_volume.id, self.aws_svc.volumes)
+        self.assertIn(new_snapshot.id, self.aws_svc.snapshots)
+        self.assertIn(new_sg.id, self.aws_svc.security_groups)
+
+        table = sweep.render_summary(results)
+        self.assertIn('us-west-2', table)
+        self.assertIn('TOTAL', table)
+
+    def test_unknown_age_is_skipped(self):
+        """ Test that a session that only has security groups left is not
+        swept, since its age is not known.
+        """
+        self.aws_svc.default_tags = encrypt_ami.get_default_tags(
+            'sg-only', 'ami-encryptor')
+        sg = self.aws_svc.create_security_group('Bracket Encryptor', 'test')
+        self.aws_svc.default_tags = {}
+
+        sessions = sweep.find_sessions(self.aws_svc)
+        self.assertIsNone(sessions['sg-only'].last_created)
+        self.assertEqual(
+            [], sweep.get_orphans(sessions, ONE_DAY, now=self.now))
+
+        sweep.sweep(
+            ['us-west-2'], lambda region: self.aws_svc, ONE_DAY, now=self.now)
+        self.assertIn(sg.id, self.aws_svc.security_groups)
+
+    def test_dry_run(self):
+        _, volume, _, _ = _make_session(
+            self.aws_svc, 'old', NOW - datetime.timedelta(days=2))
+        results = sweep.sweep(
+            ['us-west-2'], lambda region: self.aws_svc, ONE_DAY,
+            dry_run=True, now=self.now)
+        self.assertEqual(1, len(results[0].sessions))
+        self.assertIn(volume.id, self.aws_svc.volumes)
+
+    def test_region_error(self):
+        """ Test that a failure in one region doesn't stop the others. """
+        def connect(region):
+            if region == 'eu-west-1':
+                raise Exception('boom')
+            return self.aws_svc
+
+        results = sweep.sweep(
+            ['us-west-2', 'eu-west-1'], connect, ONE_DAY, now=self.now)
+        self.assertIsNone(results[0].error)
+        self.assertIsNotNone(results[1].error)
+        self.assertIn('failed: boom', sweep.render_summary(results))
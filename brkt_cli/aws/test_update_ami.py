@@ -19,9 +19,10 @@ from brkt_cli import encryptor_service
 from brkt_cli import util
 
 from brkt_cli.aws import (
-    encrypt_ami, test_aws_service, update_ami
+    boto3_device, encrypt_ami, test_aws_service, update_ami
 )
 from brkt_cli.aws.test_aws_service import build_aws_service
+from brkt_cli.aws.update_ami import _make_image_bdm
 from brkt_cli.test_encryptor_service import (
     DummyEncryptorService,
     FailedEncryptionService
@@ -34,10 +35,16 @@ class DummyValues():
         self.ami = guest
         self.ca_cert = None
         self.crypto = CRYPTO_XTS
+        self.data_volume_encryptors = 4
         self.encrypted_ami_name = None
+        self.encrypt_data_volumes = True
         self.encryptor_ami = encryptor
         self.encryptor_instance_type = None
+        self.encryptor_instance_types = None
+        self.encryptor_volume_type = 'gp2'
+        self.fast_snapshot_restore = False
         self.guest_instance_type = None
+        self.guestless = False
         self.ntp_servers = None
         self.proxies = None
         self.proxy_config_file = None
@@ -233,3 +240,113 @@ class TestRunUpdate(unittest.TestCase):
             values=values)
 
         self.assertTrue(self.encrypted_instance.ena_support)
+
+    def test_make_image_bdm_gp3(self):
+        """ Test that the IOPS and throughput of gp3 volumes are carried
+        over to the block device mapping of the updated image.
+        """
+        aws_svc, _, guest_image = build_aws_service()
+        root_dev = guest_image.block_device_mappings[0]
+        root_dev['Ebs'].update(
+            {'VolumeType': 'gp3', 'Iops': 4000, 'Throughput': 250})
+        guest_image.block_device_mappings.append(
+            boto3_device.make_device(
+                device_name='/dev/sdb',
+                snapshot_id=aws_svc.create_snapshot('vol-1').id,
+                volume_size=8)
+        )
+        instance = aws_svc.run_instance(guest_image.id)
+        data_dev = boto3_device.get_device(
+            instance.block_device_mappings, '/dev/sdb')
+        volume = aws_svc.get_volume(boto3_device.get_volume_id(data_dev))
+        volume.volume_type = 'gp3'
+        volume.iops = 5000
+        volume.throughput = 500
+
+        bdm = _make_image_bdm(
+            aws_svc, instance, snap_dev='/dev/sda1', snap_type='gp3',
+            image=guest_image)
+        root_ebs = boto3_device.get_device(bdm, '/dev/sda1')['Ebs']
+        self.assertEqual(4000, root_ebs['Iops'])
+        self.assertEqual(250, root_ebs['Throughput'])
+        data_ebs = boto3_device.get_device(bdm, '/dev/sdb')['Ebs']
+        self.assertEqual('gp3', data_ebs['VolumeType'])
+        self.assertEqual(5000, data_ebs['Iops'])
+        self.assertEqual(500, data_ebs['Throughput'])
+
+    def test_guestless(self):
+        """ Test that guestless mode registers the updated AMI from
+        snapshots, without launching the encrypted guest.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        values = DummyValues(encryptor_image.id, guest_image.id)
+
+        encrypted_ami_id = encrypt_ami.encrypt(
+            aws_svc=aws_svc,
+            enc_svc_cls=DummyEncryptorService,
+            values=values)
+        encrypted_image = aws_svc.get_image(encrypted_ami_id)
+
+        values = DummyValues(encryptor_image.id, encrypted_ami_id)
+        values.guestless = True
+
+        def run_instance_callback(args):
+            self.assertNotEqual(encrypted_ami_id, args.image_id)
+
+        aws_svc.run_instance_callback = run_instance_callback
+
+        ami_id = update_ami(
+            aws_svc=aws_svc,
+            enc_svc_class=DummyEncryptorService,
+            values=values)
+
+        # The guest root snapshot is reused, and the Metavisor root is
+        # replaced.
+        image = aws_svc.get_image(ami_id)
+        old_bdm = encrypted_image.block_device_mappings
+        new_bdm = image.block_device_mappings
+        self.assertEqual(
+            boto3_device.get_device(old_bdm, '/dev/sdf')['Ebs']['SnapshotId'],
+            boto3_device.get_device(new_bdm, '/dev/sdf')['Ebs']['SnapshotId']
+        )
+        self.assertNotEqual(
+            boto3_device.get_device(old_bdm, '/dev/sda1')['Ebs']['SnapshotId'],
+            boto3_device.get_device(new_bdm, '/dev/sda1')['Ebs']['SnapshotId']
+        )
+
+    def test_guestless_root_without_partition(self):
+        """ Test that guestless mode finds the Metavisor root when the AMI
+        maps it to the root device name without the partition number.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        values = DummyValues(encryptor_image.id, guest_image.id)
+
+        encrypted_ami_id = encrypt_ami.encrypt(
+            aws_svc=aws_svc,
+            enc_svc_cls=DummyEncryptorService,
+            values=values)
+        encrypted_image = aws_svc.get_image(encrypted_ami_id)
+        old_mv_root = boto3_device.get_device(
+            encrypted_image.block_device_mappings, '/dev/sda1')
+        for d in encrypted_image.block_device_mappings:
+            if d['DeviceName'] == '/dev/sda1':
+                d['DeviceName'] = '/dev/sda'
+
+        values = DummyValues(encryptor_image.id, encrypted_ami_id)
+        values.guestless = True
+        ami_id = update_ami(
+            aws_svc=aws_svc,
+            enc_svc_class=DummyEncryptorService,
+            values=values)
+
+        image = aws_svc.get_image(ami_id)
+        self.assertEqual(
+            ['/dev/sda', '/dev/sdf'],
+            sorted(boto3_device.get_device_names(image.block_device_mappings))
+        )
+        new_mv_root = boto3_device.get_device(
+            image.block_device_mappings, '/dev/sda')
+        self.assertNotEqual(
+            old_mv_root['Ebs']['SnapshotId'],
+            new_mv_root['Ebs']['SnapshotId']
+        )
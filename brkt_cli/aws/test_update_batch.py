@@ -0,0 +1,183 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+from brkt_cli import util
+from brkt_cli.aws import (
+    boto3_device, boto3_tag, encrypt_ami, encrypt_batch, update_batch
+)
+from brkt_cli.aws.aws_constants import (
+    NAME_METAVISOR_ROOT_SNAPSHOT,
+    TAG_CRYPTO_POLICY
+)
+from brkt_cli.aws.test_aws_service import build_aws_service
+from brkt_cli.aws.test_update_ami import DummyValues
+from brkt_cli.aws.update_ami import GUEST_ROOT_DEVICE_NAME
+from brkt_cli.test_encryptor_service import DummyEncryptorService
+
+
+class TestException(Exception):
+    pass
+
+
+class TestUpdateMany(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+        self.aws_svc, self.encryptor_image, guest_image = build_aws_service()
+
+        # Encrypt a few AMIs that share the same AWSService, so that the
+        # jobs can see each other's resources.
+        self.jobs = []
+        for _ in range(3):
+            values = DummyValues(self.encryptor_image.id, guest_image.id)
+            encrypted_ami_id = encrypt_ami.encrypt(
+                aws_svc=self.aws_svc,
+                enc_svc_cls=DummyEncryptorService,
+                values=values)
+            values = DummyValues(self.encryptor_image.id, encrypted_ami_id)
+            values.encrypted_ami_name = 'Updated %s' % encrypted_ami_id
+            self.jobs.append(update_batch.UpdateJob(self.aws_svc, values))
+
+    def test_shared_metavisor_root(self):
+        """ Test that the updater runs once for the whole batch, and that
+        the shared Metavisor root snapshot is deleted afterwards.
+        """
+        self.encryptor_launches = 0
+        self.snapshot_ids = []
+
+        def run_instance_callback(args):
+            if args.image_id == self.encryptor_image.id:
+                self.encryptor_launches += 1
+
+        def create_snapshot_callback(volume_id, snapshot):
+            name = boto3_tag.get_value(snapshot.tags, 'Name')
+            if name == NAME_METAVISOR_ROOT_SNAPSHOT:
+                self.snapshot_ids.append(snapshot.id)
+
+        self.aws_svc.run_instance_callback = run_instance_callback
+        self.aws_svc.create_snapshot_callback = create_snapshot_callback
+
+        results = update_batch.update_many(
+            self.aws_svc, self.jobs, DummyEncryptorService, max_parallel=2)
+
+        self.assertEqual(self.jobs, results)
+        self.assertEqual(1, self.encryptor_launches)
+        for job in self.jobs:
+            self.assertIsNone(job.error)
+            self.assertFalse(job.single_disk)
+            image = self.aws_svc.get_image(job.encrypted_ami_id)
+            self.assertEqual('available', image.state)
+            self.assertEqual(2, len(image.block_device_mappings))
+
+        self.assertEqual(1, len(self.snapshot_ids))
+        self.assertNotIn(self.snapshot_ids[0], self.aws_svc.snapshots)
+
+        lines = encrypt_batch.render_results(self.jobs).split('\n')
+        self.assertEqual(4, len(lines))
+
+    def test_guestless(self):
+        """ Test that none of the encrypted guests are launched in
+        guestless mode.
+        """
+        encrypted_amis = [job.ami for job in self.jobs]
+
+        def run_instance_callback(args):
+            self.assertNotIn(args.image_id, encrypted_amis)
+
+        self.aws_svc.run_instance_callback = run_instance_callback
+        for job in self.jobs:
+            job.values.guestless = True
+        update_batch.update_many(
+            self.aws_svc, self.jobs, DummyEncryptorService)
+        # All of the updated AMIs reference the shared snapshot.
+        snapshot_ids = set()
+        for job in self.jobs:
+            self.assertIsNone(job.error)
+            image = self.aws_svc.get_image(job.encrypted_ami_id)
+            mv_root_dev = boto3_device.get_device(
+                image.block_device_mappings, '/dev/sda1')
+            snapshot_ids.add(mv_root_dev['Ebs']['SnapshotId'])
+        self.assertEqual(1, len(snapshot_ids))
+        self.assertIn(snapshot_ids.pop(), self.aws_svc.snapshots)
+
+    def test_metavisor_root_per_crypto_policy(self):
+        """ Test that AMIs with different crypto policies don't share a
+        Metavisor root, and that AMIs with the same policy do.
+        """
+        self.encryptor_launches = 0
+
+        def run_instance_callback(args):
+            if args.image_id == self.encryptor_image.id:
+                self.encryptor_launches += 1
+
+        self.aws_svc.run_instance_callback = run_instance_callback
+        for job, policy in zip(self.jobs, ['gcm', 'xts', 'gcm']):
+            image = self.aws_svc.get_image(job.ami)
+            image.tags.append({'Key': TAG_CRYPTO_POLICY, 'Value': policy})
+
+        update_batch.update_many(
+            self.aws_svc, self.jobs, DummyEncryptorService)
+        self.assertEqual(2, self.encryptor_launches)
+        for job in self.jobs:
+            self.assertIsNone(job.error)
+
+    def test_guestless_failure(self):
+        """ Test that the shared snapshot is deleted if none of the
+        guestless updates succeeded.
+        """
+        self.snapshot_ids = []
+
+        def create_snapshot_callback(volume_id, snapshot):
+            name = boto3_tag.get_value(snapshot.tags, 'Name')
+            if name == NAME_METAVISOR_ROOT_SNAPSHOT:
+                self.snapshot_ids.append(snapshot.id)
+
+        def register_image(*args, **kwargs):
+            raise TestException('Test')
+
+        self.aws_svc.create_snapshot_callback = create_snapshot_callback
+        self.aws_svc.register_image = register_image
+        for job in self.jobs:
+            job.values.guestless = True
+        update_batch.update_many(
+            self.aws_svc, self.jobs, DummyEncryptorService)
+        for job in self.jobs:
+            self.assertIsInstance(job.error, TestException)
+        self.assertEqual(1, len(self.snapshot_ids))
+        self.assertNotIn(self.snapshot_ids[0], self.aws_svc.snapshots)
+
+    def test_build_failure(self):
+        """ Test that every job fails if the Metavisor root can't be
+        built.
+        """
+        def run_instance_callback(args):
+            if args.image_id == self.encryptor_image.id:
+                raise TestException('Test')
+
+        self.aws_svc.run_instance_callback = run_instance_callback
+        update_batch.update_many(
+            self.aws_svc, self.jobs, DummyEncryptorService)
+        for job in self.jobs:
+            self.assertIsNone(job.encrypted_ami_id)
+            self.assertIsInstance(job.error, TestException)
+
+    def test_is_single_disk_image(self):
+        image = self.aws_svc.get_image(self.jobs[0].ami)
+        self.assertFalse(update_batch.is_single_disk_image(image))
+        image.block_device_mappings = [
+            d for d in image.block_device_mappings
+            if d['DeviceName'] != GUEST_ROOT_DEVICE_NAME
+        ]
+        self.assertTrue(update_batch.is_single_disk_image(image))
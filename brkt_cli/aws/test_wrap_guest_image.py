@@ -13,13 +13,14 @@
 # limitations under the License.
 import email
 import json
+import threading
 import unittest
 import zlib
 
 import brkt_cli
 import brkt_cli.aws
 import brkt_cli.util
-from brkt_cli.aws import wrap_image
+from brkt_cli.aws import boto3_device, wrap_image
 from brkt_cli.aws.model import Subnet
 from brkt_cli.aws.test_aws_service import build_aws_service
 from brkt_cli.instance_config import (
@@ -192,6 +193,226 @@ class TestRunEncryption(unittest.TestCase):
         )
 
 
+class TestWrapInstance(unittest.TestCase):
+
+    def setUp(self):
+        brkt_cli.util.SLEEP_ENABLED = False
+        self.aws_svc, self.encryptor_image, self.guest_image = \
+            build_aws_service()
+        self.instance = self.aws_svc.run_instance(self.guest_image.id)
+        self.instance.instance_type = 'm4.large'
+
+    def test_volume_created_while_stopping(self):
+        """ Test that the Metavisor root volume is created before the
+        instance finishes stopping, and that the phase timings and
+        downtime are recorded.
+        """
+        volume_created = threading.Event()
+        self.stopped_after_create = None
+
+        def stop_instance(instance_id):
+            instance = self.aws_svc.instances[instance_id]
+            instance.state['Name'] = 'stopping'
+            instance.state['Code'] = 64
+            return instance
+
+        def get_instance_callback(instance):
+            if instance.state['Name'] != 'stopping':
+                return
+            # Keep the instance stopping until the volume is created.  Give
+            # up after a while, so that a regression fails instead of
+            # hanging.
+            volume_created.wait(10)
+            self.stopped_after_create = volume_created.is_set()
+            instance.state['Name'] = 'stopped'
+            instance.state['Code'] = 80
+
+        create_volume = self.aws_svc.create_volume
+
+        def _create_volume(*args, **kwargs):
+            volume = create_volume(*args, **kwargs)
+            volume_created.set()
+            return volume
+
+        self.aws_svc.stop_instance = stop_instance
+        self.aws_svc.get_instance_callback = get_instance_callback
+        self.aws_svc.create_volume = _create_volume
+
+        job = wrap_image.WrapJob(self.instance.id)
+        instance = wrap_image.wrap_instance(
+            self.aws_svc, self.instance.id, self.encryptor_image.id, job=job)
+        self.assertTrue(self.stopped_after_create)
+        self.assertEqual('running', instance.state['Name'])
+
+        phases = [phase for phase, _ in job.timings]
+        for phase in ('stop instance', 'create Metavisor root volume',
+                      'move guest root volume',
+                      'attach Metavisor root volume'):
+            self.assertIn(phase, phases)
+        self.assertIsNotNone(job.downtime)
+        self.assertGreaterEqual(job.downtime, 0)
+
+    def test_downtime_not_restarted(self):
+        job = wrap_image.WrapJob('i-123')
+        self.assertIsNone(job.downtime)
+        job.stop_time = 100.0
+        self.assertIsNone(job.downtime)
+        job.start_time = 142.5
+        self.assertEqual(42.5, job.downtime)
+
+
+class TestWrapFleet(unittest.TestCase):
+
+    def setUp(self):
+        brkt_cli.util.SLEEP_ENABLED = False
+        self.aws_svc, self.encryptor_image, self.guest_image = \
+            build_aws_service()
+
+        self.stop_calls = []
+        stop_instances = self.aws_svc.stop_instances
+
+        def _stop_instances(*instance_ids):
+            self.stop_calls.append(instance_ids)
+            stop_instances(*instance_ids)
+        self.aws_svc.stop_instances = _stop_instances
+
+    def test_wrap_instances(self):
+        """ Test that instances are stopped with a single request and
+        wrapped, and that an instance that can't be wrapped doesn't stop
+        the others.
+        """
+        instance_ids = []
+        for _ in xrange(3):
+            instance = self.aws_svc.run_instance(self.guest_image.id)
+            instance.instance_type = 'm4.large'
+            instance_ids.append(instance.id)
+        self.aws_svc.instances[instance_ids[1]].instance_type = 't2.nano'
+
+        jobs = wrap_image.wrap_instances(
+            self.aws_svc, instance_ids, self.encryptor_image.id)
+        self.assertEqual(instance_ids, [job.instance_id for job in jobs])
+        self.assertEqual([(instance_ids[0], instance_ids[2])], self.stop_calls)
+
+        self.assertIsNone(jobs[0].error)
+        self.assertIsNotNone(jobs[1].error)
+        self.assertIsNone(jobs[2].error)
+        for job in (jobs[0], jobs[2]):
+            instance = self.aws_svc.get_instance(job.instance_id)
+            self.assertEqual('running', instance.state['Name'])
+            self.assertIsNotNone(boto3_device.get_device(
+                instance.block_device_mappings, '/dev/sdf'))
+
+        table = wrap_image.render_results(jobs)
+        self.assertIn('wrapped', table)
+        self.assertIn('failed: Unsupported instance type t2.nano', table)
+        self.assertIsNotNone(jobs[0].downtime)
+        self.assertIsNone(jobs[1].downtime)
+        self.assertIn('DOWNTIME', table)
+
+    def test_volume_create_failure(self):
+        """ Test that an instance whose Metavisor root volume can't be
+        created is started again, and that an instance that can't be
+        started is reported as stopped.
+        """
+        instance_ids = []
+        for _ in xrange(3):
+            instance = self.aws_svc.run_instance(self.guest_image.id)
+            instance.instance_type = 'm4.large'
+            instance_ids.append(instance.id)
+
+        start_instance = self.aws_svc.start_instance
+
+        def create_volume(*args, **kwargs):
+            raise TestException('Volume limit exceeded')
+
+        def _start_instance(instance_id):
+            if instance_id == instance_ids[2]:
+                raise TestException('Insufficient capacity')
+            return start_instance(instance_id)
+
+        self.aws_svc.create_volume = create_volume
+        self.aws_svc.start_instance = _start_instance
+        jobs = wrap_image.wrap_instances(
+            self.aws_svc, instance_ids, self.encryptor_image.id)
+
+        for job in jobs:
+            self.assertIsInstance(job.error, TestException)
+        for job in jobs[:2]:
+            self.assertFalse(job.left_stopped)
+            instance = self.aws_svc.get_instance(job.instance_id)
+            self.assertEqual('running', instance.state['Name'])
+        self.assertTrue(jobs[2].left_stopped)
+        instance = self.aws_svc.get_instance(instance_ids[2])
+        self.assertEqual('stopped', instance.state['Name'])
+
+        table = wrap_image.render_results(jobs)
+        self.assertIn('failed: Volume limit exceeded', table)
+        self.assertIn('stopped, not wrapped: Volume limit exceeded', table)
+
+    def test_swap_failure(self):
+        """ Test that an instance whose volume swap fails gets its guest
+        root volume back and is started again, and that the Metavisor
+        root volume is deleted.
+        """
+        instance = self.aws_svc.run_instance(self.guest_image.id)
+        instance.instance_type = 'm4.large'
+        guest_root_dev = boto3_device.get_device(
+            instance.block_device_mappings, instance.root_device_name)
+        guest_vol_id = boto3_device.get_volume_id(guest_root_dev)
+
+        attach_volume = self.aws_svc.attach_volume
+        self.mv_root_vol_ids = []
+
+        def _attach_volume(vol_id, instance_id, device_name):
+            if device_name == instance.root_device_name and \
+                    vol_id != guest_vol_id:
+                self.mv_root_vol_ids.append(vol_id)
+                raise TestException('Attach failed')
+            return attach_volume(vol_id, instance_id, device_name)
+
+        self.aws_svc.attach_volume = _attach_volume
+        jobs = wrap_image.wrap_instances(
+            self.aws_svc, [instance.id], self.encryptor_image.id)
+        self.assertIsInstance(jobs[0].error, TestException)
+        self.assertFalse(jobs[0].left_stopped)
+
+        instance = self.aws_svc.get_instance(instance.id)
+        self.assertEqual('running', instance.state['Name'])
+        root_dev = boto3_device.get_device(
+            instance.block_device_mappings, instance.root_device_name)
+        self.assertEqual(guest_vol_id, boto3_device.get_volume_id(root_dev))
+        self.assertIsNone(boto3_device.get_device(
+            instance.block_device_mappings, '/dev/sdf'))
+        self.assertIn(guest_vol_id, self.aws_svc.volumes)
+        self.assertEqual(1, len(self.mv_root_vol_ids))
+        self.assertNotIn(self.mv_root_vol_ids[0], self.aws_svc.volumes)
+
+    def test_launch_wrapped_images(self):
+        """ Test that a failed launch doesn't stop the other instances,
+        and that the temporary security group is kept for them.
+        """
+        launches = []
+
+        def run_instance_callback(args):
+            launches.append(args)
+            if len(launches) == 2:
+                raise TestException('Launch failed')
+            args.instance.instance_type = 'm4.large'
+
+        self.aws_svc.run_instance_callback = run_instance_callback
+        jobs = wrap_image.launch_wrapped_images(
+            self.aws_svc, self.guest_image.id, self.encryptor_image.id, 3,
+            max_parallel=1)
+        self.assertEqual(3, len(jobs))
+        self.assertEqual(1, len([job for job in jobs if job.error]))
+        self.assertEqual(1, len(self.stop_calls))
+        self.assertEqual(1, len(self.aws_svc.security_groups))
+        for job in jobs:
+            if not job.error:
+                instance = self.aws_svc.get_instance(job.instance_id)
+                self.assertEqual('running', instance.state['Name'])
+
+
 class TestBrktEnv(unittest.TestCase):
 
     def setUp(self):
@@ -16,6 +16,12 @@
 Create an encrypted AMI (with new metavisor) based
 on an existing encrypted AMI.
 
+In guestless mode, the encrypted guest instance is never launched.  The
+updater runs against the root snapshot referenced by the encrypted AMI,
+and the updated AMI is registered from the new Metavisor root snapshot
+and the existing guest snapshots.  Billing product codes from the
+encrypted AMI are not preserved in this mode.
+
 Before running brkt updaet-encrypted-ami, set the AWS_ACCESS_KEY_ID and
 AWS_SECRET_ACCESS_KEY environment variables, like you would when
 running the AWS command line utility.
@@ -25,10 +31,13 @@ import json
 import logging
 import os
 
-from brkt_cli.aws import boto3_device, aws_service
+from brkt_cli.aws import (
+    boto3_device, aws_service, ebs_performance, session_journal
+)
 from brkt_cli.aws.aws_constants import (
     DESCRIPTION_GUEST_CREATOR,
     DESCRIPTION_METAVISOR_UPDATER,
+    DESCRIPTION_SNAPSHOT,
     NAME_ENCRYPTED_ROOT_SNAPSHOT,
     NAME_GUEST_CREATOR,
     NAME_METAVISOR_ROOT_SNAPSHOT,
@@ -36,12 +45,22 @@ from brkt_cli.aws.aws_constants import (
 from brkt_cli.aws.aws_service import (
     clean_up,
     create_encryptor_security_group,
+    is_transient_error,
     log_exception_console,
     snapshot_root_volume,
     stop_and_wait,
     wait_for_image,
     wait_for_instance,
+    wait_for_snapshots,
+    wait_for_volume,
     wait_for_volume_attached)
+from brkt_cli.aws.encrypt_ami import _get_guest_root_device
+from brkt_cli.aws.session_journal import (
+    PHASE_ENCRYPTED,
+    PHASE_ENCRYPTOR_LAUNCHED,
+    PHASE_GUEST_SNAPSHOT,
+    log_resume_hint
+)
 from brkt_cli.encryptor_service import (
     encryptor_did_single_disk,
     wait_for_encryptor_up,
@@ -51,7 +70,7 @@ from brkt_cli.instance_config import (
     InstanceConfig,
     INSTANCE_UPDATER_MODE,
 )
-from brkt_cli.util import Deadline
+from brkt_cli.util import BracketError, Deadline
 
 log = logging.getLogger(__name__)
 
@@ -59,21 +78,37 @@ MV_ROOT_DEVICE_NAME = '/dev/sda1'
 GUEST_ROOT_DEVICE_NAME = '/dev/sdf'
 
 
-def update_ami(aws_svc, enc_svc_class, values, instance_config=None):
+def update_ami(aws_svc, enc_svc_class, values, instance_config=None,
+               journal=None):
+    """ Update the encrypted AMI with a new Metavisor.  If a session
+    journal is passed in, the resources and completed phases are recorded
+    in it, so that an update that is interrupted or fails with a
+    transient error can be resumed.
+
+    :return the id of the updated AMI
+    """
     encrypted_guest = None
+    guest_image = None
     updater = None
     new_mv_vol_id = None
     temp_sg_id = None
     snap_id = None
+    interrupted = False
 
     if instance_config is None:
         instance_config = InstanceConfig(mode=INSTANCE_UPDATER_MODE)
+    if journal is None:
+        journal = session_journal.SessionJournal(aws_svc.session_id)
 
     try:
         instance_config.brkt_config['status_port'] = values.status_port
 
-        log.info("Starting update of %s with %s", values.ami,
-                 values.encryptor_ami)
+        if journal.phases:
+            log.info("Resuming update of %s with %s", values.ami,
+                     values.encryptor_ami)
+        else:
+            log.info("Starting update of %s with %s", values.ami,
+                     values.encryptor_ami)
 
         # Step 1. Launch encrypted guest AMI
         # Use 'updater' mode to avoid chain loading the guest
@@ -81,29 +116,47 @@ def update_ami(aws_svc, enc_svc_class, values, instance_config=None):
         # base to create a new AMI and preserve license
         # information embedded in the guest AMI
 
-        description = DESCRIPTION_GUEST_CREATOR % {'image_id': values.ami}
-        encrypted_guest = aws_svc.run_instance(
-            values.ami,
-            instance_type=values.guest_instance_type,
-            ebs_optimized=False,
-            subnet_id=values.subnet_id,
-            user_data=json.dumps(instance_config.brkt_config),
-            name=NAME_GUEST_CREATOR,
-            description=description)
-        encrypted_guest = wait_for_instance(aws_svc, encrypted_guest.id)
-        mv_root_device_name = encrypted_guest.root_device_name
-
-        log.info("Launched encrypted guest %s", encrypted_guest.id)
+        if values.guestless:
+            # Run the updater against the root snapshot referenced by the
+            # AMI, instead of a snapshot of a running guest.
+            guest_image = aws_svc.get_image(values.ami)
+            root_dev = _get_guest_root_device(guest_image)
+            image_snap_id = root_dev['Ebs']['SnapshotId']
+            log.info("Using snapshot %s of encrypted guest root",
+                     image_snap_id)
+        elif journal.is_complete(PHASE_GUEST_SNAPSHOT):
+            encrypted_guest = aws_svc.get_instance(
+                journal.get('encrypted_guest_id'))
+            snap_id, snap_dev, snap_size, snap_type, snap_iops = \
+                journal.get('snapshot')
+            image_snap_id = snap_id
+            log.info("Using snapshot %s of encrypted guest root", snap_id)
+        else:
+            if journal.get('encrypted_guest_id'):
+                # Left over from an interrupted session.
+                aws_svc.terminate_instance(journal.get('encrypted_guest_id'))
+
+            encrypted_guest = _run_encrypted_guest(
+                aws_svc, values, instance_config,
+                on_launch=lambda instance: journal.record(
+                    encrypted_guest_id=instance.id)
+            )
 
-        # Step 2. Create a disk device of the root file system of the
-        # encrypted guest's root disk by making a snapshot of the
-        # root disk of the instance just launched. This disk will have
-        # the metavisor on it.  Use gp2 for fast burst I/O.
+            # Step 2. Create a disk device of the root file system of the
+            # encrypted guest's root disk by making a snapshot of the
+            # root disk of the instance just launched. This disk will have
+            # the metavisor on it.  Use gp2 for fast burst I/O.
 
-        snap = snapshot_root_volume(aws_svc, encrypted_guest, values.ami)
-        snap_id, snap_dev, snap_size, snap_type, snap_iops = snap
+            snap = snapshot_root_volume(aws_svc, encrypted_guest, values.ami)
+            snap_id, snap_dev, snap_size, snap_type, snap_iops = snap
+            journal.complete_phase(PHASE_GUEST_SNAPSHOT, snapshot=snap)
 
-        log.info("Created snapshot %s of encrypted guest root", snap_id)
+            log.info("Created snapshot %s of encrypted guest root", snap_id)
+            image_snap_id = snap_id
+        if guest_image:
+            mv_root_device_name = root_dev['DeviceName']
+        else:
+            mv_root_device_name = encrypted_guest.root_device_name
 
         # Step 3. Run updater in same zone as guest so we can swap
         # volumes.  Attach the snapshot as an additional disk.
@@ -111,135 +164,77 @@ def update_ami(aws_svc, enc_svc_class, values, instance_config=None):
         guest_encrypted_root = boto3_device.make_device(
             device_name='/dev/sdf',
             volume_type='gp2',
-            snapshot_id=snap_id,
+            snapshot_id=image_snap_id,
             delete_on_termination=True)
 
-        # If the user didn't specify a security group, create a temporary
-        # security group that allows brkt-cli to get status from the updater.
-        run_instance = aws_svc.run_instance
-        if not values.security_group_ids:
-            vpc_id = None
-            if values.subnet_id:
-                subnet = aws_svc.get_subnet(values.subnet_id)
-                vpc_id = subnet.vpc_id
-            temp_sg_id = create_encryptor_security_group(
-                aws_svc, vpc_id=vpc_id, status_port=values.status_port).id
-            values.security_group_ids = [temp_sg_id]
-
-            # Wrap with a retry, to handle eventual consistency issues with
-            # the newly-created group.
-            run_instance = aws_svc.retry(
-                aws_svc.run_instance,
-                error_code_regexp='InvalidGroup\.NotFound')
-
-        updater = run_instance(
-            values.encryptor_ami,
-            instance_type=values.updater_instance_type,
-            user_data=instance_config.make_userdata(),
-            ebs_optimized=False,
-            subnet_id=values.subnet_id,
-            placement=encrypted_guest.placement,
-            security_group_ids=values.security_group_ids,
-            block_device_mappings=[guest_encrypted_root],
-            name=NAME_METAVISOR_UPDATER,
-            description=DESCRIPTION_METAVISOR_UPDATER)
-        updater = wait_for_instance(aws_svc, updater.id)
-
-        log.info("Launched updater %s with snapshot %s", updater.id, snap_id)
+        if journal.is_complete(PHASE_ENCRYPTOR_LAUNCHED):
+            temp_sg_id = journal.get('temp_sg_id')
+            updater = _get_resumed_updater(
+                aws_svc, journal.get('updater_id'), journal)
+        else:
+            placement = None
+            if encrypted_guest:
+                placement = encrypted_guest.placement
+            updater, temp_sg_id = _run_updater_instance(
+                aws_svc, values, instance_config, placement,
+                guest_encrypted_root)
+            journal.complete_phase(
+                PHASE_ENCRYPTOR_LAUNCHED,
+                updater_id=updater.id,
+                temp_sg_id=temp_sg_id
+            )
+
+        log.info("Launched updater %s with snapshot %s", updater.id,
+                 image_snap_id)
 
         # Enable ENA if Metavisor supports it.
         updater_ena_support = aws_service.has_ena_support(updater)
-        guest_ena_support = aws_service.has_ena_support(encrypted_guest)
+        guest_ena_support = aws_service.has_ena_support(
+            encrypted_guest or guest_image)
         log.debug(
             'ENA support: updater=%s, guest=%s',
             updater_ena_support,
             guest_ena_support
         )
-        if updater_ena_support and not guest_ena_support:
+        if updater_ena_support and not guest_ena_support and \
+                encrypted_guest:
             aws_svc.modify_instance_attribute(
                 encrypted_guest.id,
                 'enaSupport',
                 'True'
             )
 
-        host_ips = []
-        if updater.public_ip_address:
-            host_ips.append(updater.public_ip_address)
-        if updater.private_ip_address:
-            host_ips.append(updater.private_ip_address)
-            log.info('Adding %s to NO_PROXY environment variable' %
-                     updater.private_ip_address)
-            if os.environ.get('NO_PROXY'):
-                os.environ['NO_PROXY'] += "," + \
-                    updater.private_ip_address
-            else:
-                os.environ['NO_PROXY'] = updater.private_ip_address
-
         # Step 4. Wait for the updater to complete.
-        enc_svc = enc_svc_class(host_ips, port=values.status_port)
-        log.info('Waiting for updater service on %s (port %s on %s)',
-                 updater.id, enc_svc.port, ', '.join(host_ips))
-        try:
-            wait_for_encryptor_up(enc_svc, Deadline(600))
-        except:
-            log.error('Unable to connect to encryptor instance.')
-            raise
-        try:
-            wait_for_encryption(enc_svc)
-        except Exception as e:
-            # Stop the updater instance, to make the console log available.
-            stop_and_wait(aws_svc, updater.id)
-            log_exception_console(aws_svc, e, updater.id)
-            raise
-
-        single_disk = encryptor_did_single_disk(enc_svc)
+        if journal.is_complete(PHASE_ENCRYPTED):
+            single_disk = journal.get('single_disk')
+        else:
+            single_disk = _wait_for_updater(
+                aws_svc, enc_svc_class, values, updater)
+            journal.complete_phase(PHASE_ENCRYPTED, single_disk=single_disk)
 
         aws_svc.stop_instance(updater.id)
         updater = wait_for_instance(aws_svc, updater.id, state="stopped")
 
-        guest_bdm = encrypted_guest.block_device_mappings
-        updater_bdm = updater.block_device_mappings
-        new_bdm = list()
-
-        # Step 5. Create block device mappings for the new image.  Preserve
-        # volume properties that may get reset to their defaults while
-        # updating block device mappings.
-        for d in guest_bdm:
-            new_dev = boto3_device.make_device_for_image(d)
-            name = d['DeviceName']
-            # Preserve volume type
-            if name == snap_dev:
-                vol_type = snap_type
-                vol_iops = snap_iops
-            else:
-                vol = aws_svc.get_volume(d['Ebs']['VolumeId'])
-                vol_type = vol.volume_type
-                vol_iops = vol.iops
-            new_dev['Ebs']['VolumeType'] = vol_type
-            # io1 volumes must have the Iops attribute set
-            if vol_type == 'io1':
-                new_dev['Ebs']['Iops'] = vol_iops
-            if name == mv_root_device_name:
-                new_dev['Ebs']['DeleteOnTermination'] = True
-            new_bdm.append(new_dev)
-
-        if single_disk:
-            # Step 6. Detach the Metavisor root from the updater instance.
-            log.info('Detaching boot volume from %s', updater.id)
-            new_mv_dev = boto3_device.get_device(updater_bdm,
-                                                 GUEST_ROOT_DEVICE_NAME)
-            new_mv_vol_id = new_mv_dev['Ebs']['VolumeId']
-            aws_svc.detach_volume(new_mv_vol_id, instance_id=updater.id,
-                                  force=True)
-
-            # Step 7. Attach new boot disk to guest instance.
-            log.info('Attaching new metavisor boot disk %s to %s',
-                     new_mv_vol_id, encrypted_guest.id)
-            aws_svc.attach_volume(new_mv_vol_id, encrypted_guest.id,
-                                  mv_root_device_name)
-            encrypted_guest = wait_for_volume_attached(aws_svc,
-                                                       encrypted_guest.id,
-                                                       mv_root_device_name)
+        # Step 5. Create block device mappings for the new image.
+        if not values.guestless:
+            new_bdm = _make_image_bdm(
+                aws_svc, encrypted_guest, snap_dev=snap_dev,
+                snap_type=snap_type, snap_iops=snap_iops,
+                image=aws_svc.get_image(values.ami))
+
+        if values.guestless:
+            # Steps 6-8. Register the new AMI from the new Metavisor root
+            # snapshot and the existing guest snapshots.
+            image = _register_updated_image(
+                aws_svc, values, guest_image, updater, single_disk,
+                ena_support=updater_ena_support or guest_ena_support
+            )
+        elif single_disk:
+            # Steps 6-7. Move the Metavisor root from the updater instance
+            # to the guest instance.
+            new_mv_vol_id, encrypted_guest = _move_metavisor_root(
+                aws_svc, journal, updater, GUEST_ROOT_DEVICE_NAME,
+                encrypted_guest, mv_root_device_name)
 
             # Step 8. Create new AMI.
             log.info("Creating new AMI")
@@ -251,22 +246,11 @@ def update_ami(aws_svc, enc_svc_class, values, instance_config=None):
                                          block_device_mappings=new_bdm)
             image = wait_for_image(aws_svc, image.id)
         else:
-            # Step 6. Detach the Metavisor root from the updater instance.
-            log.info('Detaching boot volume from %s', updater.id)
-            new_mv_dev = boto3_device.get_device(updater_bdm,
-                                                 MV_ROOT_DEVICE_NAME)
-            new_mv_vol_id = new_mv_dev['Ebs']['VolumeId']
-            aws_svc.detach_volume(new_mv_vol_id, instance_id=updater.id,
-                                  force=True)
-
-            # Step 7. Attach new boot disk to guest instance.
-            log.info('Attaching new metavisor boot disk %s to %s',
-                     new_mv_vol_id, encrypted_guest.id)
-            aws_svc.attach_volume(new_mv_vol_id, encrypted_guest.id,
-                                  mv_root_device_name)
-            encrypted_guest = wait_for_volume_attached(aws_svc,
-                                                       encrypted_guest.id,
-                                                       mv_root_device_name)
+            # Steps 6-7. Move the Metavisor root from the updater instance
+            # to the guest instance.
+            new_mv_vol_id, encrypted_guest = _move_metavisor_root(
+                aws_svc, journal, updater, MV_ROOT_DEVICE_NAME,
+                encrypted_guest, mv_root_device_name)
 
             # Step 8. Create new AMI.
             log.info("Creating new AMI")
@@ -290,27 +274,509 @@ def update_ami(aws_svc, enc_svc_class, values, instance_config=None):
         if mv_root_dev:
             aws_svc.create_tags(mv_root_dev['Ebs']['SnapshotId'],
                                 name=NAME_METAVISOR_ROOT_SNAPSHOT)
-        aws_svc.create_tags(image.id)
         return image.id
+    except BaseException as e:
+        if journal.path and (
+                isinstance(e, KeyboardInterrupt) or is_transient_error(e)):
+            # Leave everything in place, so that the session can be resumed.
+            interrupted = True
+            log_resume_hint(journal, e)
+        raise
+    finally:
+        if not interrupted:
+            _clean_up_session(
+                aws_svc,
+                snap_id=snap_id,
+                encrypted_guest=encrypted_guest,
+                updater=updater,
+                new_mv_vol_id=new_mv_vol_id,
+                temp_sg_id=temp_sg_id
+            )
+            journal.delete()
 
+
+def build_metavisor_root(aws_svc, enc_svc_class, values,
+                         instance_config=None):
+    """ Run the updater once against values.ami, and snapshot the new
+    Metavisor root volume that it writes.  The Metavisor root only
+    depends on the encryptor AMI, so the snapshot can be swapped into any
+    other dual disk encrypted AMI with update_ami_with_metavisor_root().
+
+    :return the id of the Metavisor root snapshot
+    :raise BracketError if values.ami is a single disk AMI
+    """
+    encrypted_guest = None
+    updater = None
+    temp_sg_id = None
+    snap_id = None
+
+    if instance_config is None:
+        instance_config = InstanceConfig(mode=INSTANCE_UPDATER_MODE)
+
+    try:
+        instance_config.brkt_config['status_port'] = values.status_port
+        log.info('Building Metavisor root from %s with %s', values.ami,
+                 values.encryptor_ami)
+
+        placement = None
+        if values.guestless:
+            guest_image = aws_svc.get_image(values.ami)
+            root_dev = _get_guest_root_device(guest_image)
+            image_snap_id = root_dev['Ebs']['SnapshotId']
+        else:
+            encrypted_guest = _run_encrypted_guest(
+                aws_svc, values, instance_config)
+            placement = encrypted_guest.placement
+            snap_id = snapshot_root_volume(
+                aws_svc, encrypted_guest, values.ami)[0]
+            image_snap_id = snap_id
+        guest_encrypted_root = boto3_device.make_device(
+            device_name='/dev/sdf',
+            volume_type='gp2',
+            snapshot_id=image_snap_id,
+            delete_on_termination=True)
+        updater, temp_sg_id = _run_updater_instance(
+            aws_svc, values, instance_config, placement,
+            guest_encrypted_root)
+        log.info("Launched updater %s with snapshot %s", updater.id,
+                 image_snap_id)
+
+        if _wait_for_updater(aws_svc, enc_svc_class, values, updater):
+            raise BracketError(
+                'Unable to build a shared Metavisor root from single disk '
+                'AMI %s' % values.ami
+            )
+
+        aws_svc.stop_instance(updater.id)
+        updater = wait_for_instance(aws_svc, updater.id, state="stopped")
+        mv_dev = boto3_device.get_device(
+            updater.block_device_mappings, MV_ROOT_DEVICE_NAME)
+        snapshot = aws_svc.create_snapshot(
+            mv_dev['Ebs']['VolumeId'],
+            name=NAME_METAVISOR_ROOT_SNAPSHOT,
+            description=DESCRIPTION_SNAPSHOT % {
+                'image_id': values.encryptor_ami
+            }
+        )
+        wait_for_snapshots(aws_svc, snapshot.id)
+        log.info('Created Metavisor root snapshot %s', snapshot.id)
+        return snapshot.id
+    finally:
+        _clean_up_session(
+            aws_svc,
+            snap_id=snap_id,
+            encrypted_guest=encrypted_guest,
+            updater=updater,
+            temp_sg_id=temp_sg_id
+        )
+
+
+def update_ami_with_metavisor_root(aws_svc, values, mv_root_snapshot_id,
+                                   instance_config=None, ena_support=False):
+    """ Update the dual disk encrypted AMI by replacing its Metavisor root
+    with a volume created from the snapshot returned by
+    build_metavisor_root().  The encrypted guest root is left untouched,
+    so the updater doesn't need to run.  In guestless mode, the updated
+    AMI is registered from the snapshots, without launching the guest.
+
+    :param ena_support True if the new Metavisor supports ENA
+    :return the id of the updated AMI
+    """
+    encrypted_guest = None
+    new_mv_vol_id = None
+
+    if instance_config is None:
+        instance_config = InstanceConfig(mode=INSTANCE_UPDATER_MODE)
+
+    try:
+        log.info('Starting update of %s with Metavisor root %s', values.ami,
+                 mv_root_snapshot_id)
+        if values.guestless:
+            guest_image = aws_svc.get_image(values.ami)
+            ena_support = ena_support or \
+                aws_service.has_ena_support(guest_image)
+            image = _register_image_with_root(
+                aws_svc, values, guest_image, mv_root_snapshot_id,
+                ena_support=ena_support
+            )
+            return image.id
+
+        encrypted_guest = _run_encrypted_guest(
+            aws_svc, values, instance_config)
+        mv_root_device_name = encrypted_guest.root_device_name
+        if not boto3_device.get_device(
+                encrypted_guest.block_device_mappings,
+                GUEST_ROOT_DEVICE_NAME):
+            raise BracketError(
+                '%s is a single disk AMI.  Its Metavisor root can\'t be '
+                'replaced.' % values.ami
+            )
+        if ena_support and not aws_service.has_ena_support(encrypted_guest):
+            aws_svc.modify_instance_attribute(
+                encrypted_guest.id, 'enaSupport', 'True')
+
+        aws_svc.stop_instance(encrypted_guest.id)
+        encrypted_guest = wait_for_instance(
+            aws_svc, encrypted_guest.id, state='stopped')
+
+        # Swap the old Metavisor root for a volume created from the
+        # shared snapshot.
+        old_mv_dev = boto3_device.get_device(
+            encrypted_guest.block_device_mappings, mv_root_device_name)
+        old_mv_vol_id = old_mv_dev['Ebs']['VolumeId']
+        aws_svc.detach_volume(
+            old_mv_vol_id, instance_id=encrypted_guest.id, force=True)
+        wait_for_volume(aws_svc, old_mv_vol_id)
+        aws_svc.delete_volume(old_mv_vol_id)
+
+        snapshot = aws_svc.get_snapshot(mv_root_snapshot_id)
+        new_mv_vol = aws_svc.create_volume(
+            snapshot.volume_size,
+            encrypted_guest.placement['AvailabilityZone'],
+            snapshot_id=mv_root_snapshot_id,
+            volume_type='gp2'
+        )
+        new_mv_vol_id = new_mv_vol.id
+        wait_for_volume(aws_svc, new_mv_vol_id)
+        log.info('Attaching new metavisor boot disk %s to %s',
+                 new_mv_vol_id, encrypted_guest.id)
+        aws_svc.attach_volume(new_mv_vol_id, encrypted_guest.id,
+                              mv_root_device_name)
+        encrypted_guest = wait_for_volume_attached(
+            aws_svc, encrypted_guest.id, mv_root_device_name)
+
+        new_bdm = _make_image_bdm(aws_svc, encrypted_guest)
+        log.info("Creating new AMI")
+        guest_image = aws_svc.get_image(values.ami)
+        image = aws_svc.create_image(encrypted_guest.id,
+                                     values.encrypted_ami_name,
+                                     description=guest_image.description,
+                                     no_reboot=True,
+                                     block_device_mappings=new_bdm)
+        image = wait_for_image(aws_svc, image.id)
+
+        guest_dev = boto3_device.get_device(image.block_device_mappings,
+                                            GUEST_ROOT_DEVICE_NAME)
+        aws_svc.create_tags(guest_dev['Ebs']['SnapshotId'],
+                            name=NAME_ENCRYPTED_ROOT_SNAPSHOT)
+        mv_root_dev = boto3_device.get_device(image.block_device_mappings,
+                                              mv_root_device_name)
+        aws_svc.create_tags(mv_root_dev['Ebs']['SnapshotId'],
+                            name=NAME_METAVISOR_ROOT_SNAPSHOT)
+        return image.id
     finally:
-        if snap_id:
-            aws_svc.delete_snapshot(snap_id)
-
-        instance_ids = set()
-        volume_ids = set()
-        sg_ids = set()
-
-        if encrypted_guest:
-            instance_ids.add(encrypted_guest.id)
-        if updater:
-            instance_ids.add(updater.id)
-        if new_mv_vol_id:
-            volume_ids.add(new_mv_vol_id)
-        if temp_sg_id:
-            sg_ids.add(temp_sg_id)
-
-        clean_up(aws_svc,
-                 instance_ids=instance_ids,
-                 volume_ids=volume_ids,
-                 security_group_ids=sg_ids)
+        _clean_up_session(
+            aws_svc,
+            encrypted_guest=encrypted_guest,
+            new_mv_vol_id=new_mv_vol_id
+        )
+
+
+def _run_encrypted_guest(aws_svc, values, instance_config, on_launch=None):
+    """ Launch the encrypted guest AMI in updater mode, so that it doesn't
+    chain load the guest, and wait for it to start.
+
+    :param on_launch called with the Instance before waiting for it
+    """
+    description = DESCRIPTION_GUEST_CREATOR % {
+        'image_id': values.ami
+    }
+    encrypted_guest = aws_svc.run_instance(
+        values.ami,
+        instance_type=values.guest_instance_type,
+        ebs_optimized=False,
+        subnet_id=values.subnet_id,
+        user_data=json.dumps(instance_config.brkt_config),
+        name=NAME_GUEST_CREATOR,
+        description=description)
+    if on_launch:
+        on_launch(encrypted_guest)
+    encrypted_guest = wait_for_instance(aws_svc, encrypted_guest.id)
+
+    log.info("Launched encrypted guest %s", encrypted_guest.id)
+    return encrypted_guest
+
+
+def _wait_for_updater(aws_svc, enc_svc_class, values, updater):
+    """ Wait for the updater to finish writing the new Metavisor root.
+
+    :return True if the updater wrote the Metavisor to the guest root
+        volume (single disk mode)
+    """
+    host_ips = []
+    if updater.public_ip_address:
+        host_ips.append(updater.public_ip_address)
+    if updater.private_ip_address:
+        host_ips.append(updater.private_ip_address)
+        log.info('Adding %s to NO_PROXY environment variable' %
+                 updater.private_ip_address)
+        if os.environ.get('NO_PROXY'):
+            os.environ['NO_PROXY'] += "," + \
+                updater.private_ip_address
+        else:
+            os.environ['NO_PROXY'] = updater.private_ip_address
+
+    enc_svc = enc_svc_class(host_ips, port=values.status_port)
+    log.info('Waiting for updater service on %s (port %s on %s)',
+             updater.id, enc_svc.port, ', '.join(host_ips))
+    try:
+        wait_for_encryptor_up(enc_svc, Deadline(600))
+    except:
+        log.error('Unable to connect to encryptor instance.')
+        raise
+    try:
+        wait_for_encryption(enc_svc)
+    except Exception as e:
+        # Stop the updater instance, to make the console log
+        # available.
+        stop_and_wait(aws_svc, updater.id)
+        log_exception_console(aws_svc, e, updater.id)
+        raise
+
+    return encryptor_did_single_disk(enc_svc)
+
+
+def _make_image_bdm(aws_svc, encrypted_guest, snap_dev=None, snap_type=None,
+                    snap_iops=None, image=None):
+    """ Return the block device mappings for the new image.  Preserve
+    volume properties that may get reset to their defaults while
+    updating block device mappings.
+
+    :param snap_dev the name of the device whose volume was snapshotted
+        and deleted, or None
+    :param image the encrypted AMI.  If the snapshotted volume is gp3, its
+        IOPS and throughput are read from the AMI's mapping for snap_dev
+    """
+    mv_root_device_name = encrypted_guest.root_device_name
+    new_bdm = list()
+    for d in encrypted_guest.block_device_mappings:
+        new_dev = boto3_device.make_device_for_image(d)
+        name = d['DeviceName']
+        # Preserve volume type
+        vol_throughput = None
+        if name == snap_dev:
+            vol_type = snap_type
+            vol_iops = snap_iops
+            image_dev = None
+            if image:
+                image_dev = boto3_device.get_device(
+                    image.block_device_mappings, snap_dev)
+            if vol_type == ebs_performance.VOLUME_TYPE_GP3 and image_dev:
+                vol_iops = image_dev['Ebs'].get('Iops')
+                vol_throughput = image_dev['Ebs'].get('Throughput')
+        else:
+            vol = aws_svc.get_volume(d['Ebs']['VolumeId'])
+            vol_type = vol.volume_type
+            vol_iops = vol.iops
+            vol_throughput = vol.throughput
+        new_dev['Ebs']['VolumeType'] = vol_type
+        # io1 and io2 volumes must have the Iops attribute set.  gp3
+        # volumes would get the baseline IOPS and throughput without them.
+        if vol_type in ebs_performance.PROVISIONED_IOPS_TYPES:
+            new_dev['Ebs']['Iops'] = vol_iops
+        elif vol_type == ebs_performance.VOLUME_TYPE_GP3:
+            if vol_iops:
+                new_dev['Ebs']['Iops'] = vol_iops
+            if vol_throughput:
+                new_dev['Ebs']['Throughput'] = vol_throughput
+        if name == mv_root_device_name:
+            new_dev['Ebs']['DeleteOnTermination'] = True
+        new_bdm.append(new_dev)
+    return new_bdm
+
+
+def _register_updated_image(aws_svc, values, guest_image, updater,
+                            single_disk, ena_support=False):
+    """ Snapshot the Metavisor root that the updater wrote, and register
+    the updated AMI from that snapshot and the other snapshots referenced
+    by the encrypted guest AMI.
+
+    :return the Image
+    """
+    if single_disk:
+        device_name = GUEST_ROOT_DEVICE_NAME
+    else:
+        device_name = MV_ROOT_DEVICE_NAME
+    new_mv_dev = boto3_device.get_device(
+        updater.block_device_mappings, device_name)
+    snapshot = aws_svc.create_snapshot(
+        new_mv_dev['Ebs']['VolumeId'],
+        name=NAME_METAVISOR_ROOT_SNAPSHOT,
+        description=DESCRIPTION_SNAPSHOT % {'image_id': values.ami}
+    )
+    try:
+        wait_for_snapshots(aws_svc, snapshot.id)
+        return _register_image_with_root(
+            aws_svc, values, guest_image, snapshot.id, ena_support)
+    except:
+        aws_svc.delete_snapshot(snapshot.id)
+        raise
+
+
+def _register_image_with_root(aws_svc, values, guest_image,
+                              mv_root_snapshot_id, ena_support=False):
+    """ Register the updated AMI from the given Metavisor root snapshot and
+    the other snapshots referenced by the encrypted guest AMI.
+
+    :return the Image
+    """
+    root_device_name = _get_guest_root_device(guest_image)['DeviceName']
+    new_bdm = []
+    for d in guest_image.block_device_mappings:
+        ebs = d.get('Ebs')
+        if not ebs:
+            # Ephemeral or suppressed device.
+            new_bdm.append(dict(d))
+        elif d['DeviceName'] == root_device_name:
+            new_bdm.append(boto3_device.make_device(
+                device_name=d['DeviceName'],
+                snapshot_id=mv_root_snapshot_id,
+                volume_type='gp2',
+                delete_on_termination=True
+            ))
+        else:
+            new_bdm.append(boto3_device.make_device(
+                device_name=d['DeviceName'],
+                snapshot_id=ebs.get('SnapshotId'),
+                volume_size=ebs.get('VolumeSize'),
+                volume_type=ebs.get('VolumeType'),
+                iops=ebs.get('Iops'),
+                throughput=ebs.get('Throughput'),
+                delete_on_termination=ebs.get('DeleteOnTermination')
+            ))
+
+    log.info('Registering new AMI')
+    image_id = aws_svc.register_image(
+        new_bdm,
+        name=values.encrypted_ami_name,
+        description=guest_image.description,
+        root_device_name=guest_image.root_device_name,
+        ena_support=ena_support,
+        sriov_net_support='simple')
+    return wait_for_image(aws_svc, image_id)
+
+
+def _run_updater_instance(aws_svc, values, instance_config, placement,
+                          guest_encrypted_root):
+    """ Launch the updater instance with the guest root snapshot attached.
+
+    :param placement the placement of the encrypted guest, so that the
+        updater runs in the same zone, or None
+
+    :return a tuple of the Instance and the id of the temporary security
+        group, or None if the user specified security groups
+    """
+    temp_sg_id = None
+    security_group_ids = values.security_group_ids
+
+    # If the user didn't specify a security group, create a temporary
+    # security group that allows brkt-cli to get status from the updater.
+    run_instance = aws_svc.run_instance
+    if not security_group_ids:
+        vpc_id = None
+        if values.subnet_id:
+            subnet = aws_svc.get_subnet(values.subnet_id)
+            vpc_id = subnet.vpc_id
+        temp_sg_id = create_encryptor_security_group(
+            aws_svc, vpc_id=vpc_id, status_port=values.status_port).id
+        security_group_ids = [temp_sg_id]
+
+        # Wrap with a retry, to handle eventual consistency issues with
+        # the newly-created group.
+        run_instance = aws_svc.retry(
+            aws_svc.run_instance,
+            error_code_regexp='InvalidGroup\.NotFound')
+
+    updater = run_instance(
+        values.encryptor_ami,
+        instance_type=values.updater_instance_type,
+        user_data=instance_config.make_userdata(),
+        ebs_optimized=False,
+        subnet_id=values.subnet_id,
+        placement=placement,
+        security_group_ids=security_group_ids,
+        block_device_mappings=[guest_encrypted_root],
+        name=NAME_METAVISOR_UPDATER,
+        description=DESCRIPTION_METAVISOR_UPDATER)
+    updater = wait_for_instance(aws_svc, updater.id)
+    return updater, temp_sg_id
+
+
+def _move_metavisor_root(aws_svc, journal, updater, updater_device_name,
+                         encrypted_guest, guest_device_name):
+    """ Detach the new Metavisor root from the updater instance and attach
+    it to the encrypted guest instance.  The volume id is recorded before
+    it's detached, so that a resumed session can find the volume and skip
+    the steps that already completed.
+
+    :return a tuple of the volume id and the updated guest Instance
+    """
+    new_mv_vol_id = journal.get('new_mv_vol_id')
+    if not new_mv_vol_id:
+        new_mv_dev = boto3_device.get_device(
+            updater.block_device_mappings, updater_device_name)
+        new_mv_vol_id = boto3_device.get_volume_id(new_mv_dev)
+        journal.record(new_mv_vol_id=new_mv_vol_id)
+
+    # Step 6. Detach the Metavisor root from the updater instance.
+    if boto3_device.is_attached(updater.block_device_mappings, new_mv_vol_id):
+        log.info('Detaching boot volume from %s', updater.id)
+        aws_svc.detach_volume(new_mv_vol_id, instance_id=updater.id,
+                              force=True)
+
+    # Step 7. Attach new boot disk to guest instance.
+    encrypted_guest = aws_svc.get_instance(encrypted_guest.id)
+    if not boto3_device.is_attached(
+            encrypted_guest.block_device_mappings, new_mv_vol_id):
+        log.info('Attaching new metavisor boot disk %s to %s',
+                 new_mv_vol_id, encrypted_guest.id)
+        aws_svc.attach_volume(new_mv_vol_id, encrypted_guest.id,
+                              guest_device_name)
+    encrypted_guest = wait_for_volume_attached(aws_svc,
+                                               encrypted_guest.id,
+                                               guest_device_name)
+    return new_mv_vol_id, encrypted_guest
+
+
+def _get_resumed_updater(aws_svc, instance_id, journal):
+    """ Return the updater instance of a session that is being resumed.
+
+    :raise BracketError if the updater instance can't be used
+    """
+    instance = aws_svc.get_instance(instance_id)
+    state = instance.state['Name']
+    log.info('Reattaching to updater instance %s (%s).', instance_id, state)
+
+    expected_states = ('running',)
+    if journal.is_complete(PHASE_ENCRYPTED):
+        expected_states = ('running', 'stopping', 'stopped')
+    if state not in expected_states:
+        raise BracketError(
+            'Unable to resume session %s: updater instance %s is %s' %
+            (aws_svc.session_id, instance_id, state)
+        )
+    return instance
+
+
+def _clean_up_session(aws_svc, snap_id=None, encrypted_guest=None,
+                      updater=None, new_mv_vol_id=None, temp_sg_id=None):
+    if snap_id:
+        aws_svc.delete_snapshot(snap_id)
+
+    instance_ids = set()
+    volume_ids = set()
+    sg_ids = set()
+
+    if encrypted_guest:
+        instance_ids.add(encrypted_guest.id)
+    if updater:
+        instance_ids.add(updater.id)
+    if new_mv_vol_id:
+        volume_ids.add(new_mv_vol_id)
+    if temp_sg_id:
+        sg_ids.add(temp_sg_id)
+
+    clean_up(aws_svc,
+             instance_ids=instance_ids,
+             volume_ids=volume_ids,
+             security_group_ids=sg_ids)
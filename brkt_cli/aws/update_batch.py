@@ -0,0 +1,199 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Update a batch of encrypted AMIs with a new Metavisor.
+
+The manifest has the same format as the encrypt-batch manifest.
+encrypted_ami_name is the name of the updated AMI.
+
+The new Metavisor root volume only depends on the encryptor AMI, the
+region and the crypto policy, so it is the same for every dual disk AMI
+that shares them.  Instead of running the updater once per AMI, the
+Metavisor root is built once for each combination, by running the
+updater against the first matching dual disk AMI, and snapshotted.  Each AMI is
+then updated in its own session by swapping in a volume created from
+that snapshot, which only takes an instance launch and a CreateImage
+call.  Single disk AMIs keep the Metavisor on the guest root volume, so
+they're updated individually with update_ami().
+"""
+import logging
+
+from brkt_cli import util
+from brkt_cli.aws import aws_service, boto3_device, boto3_tag, encrypt_batch
+from brkt_cli.aws.aws_constants import TAG_CRYPTO_POLICY
+from brkt_cli.aws.update_ami import (
+    GUEST_ROOT_DEVICE_NAME,
+    build_metavisor_root,
+    update_ami,
+    update_ami_with_metavisor_root
+)
+
+log = logging.getLogger(__name__)
+
+
+class UpdateJob(encrypt_batch.EncryptJob):
+    """ The state of a single update within a batch.  encrypted_ami_id is
+    set to the id of the updated AMI.
+    """
+
+    def __init__(self, aws_svc, values, instance_config=None):
+        super(UpdateJob, self).__init__(
+            aws_svc, values, instance_config=instance_config)
+        self.single_disk = False
+
+    def __repr__(self):
+        return 'UpdateJob:%s' % self.ami
+
+
+def is_single_disk_image(image):
+    """ Return True if the encrypted image has the Metavisor and the
+    guest on the same volume.
+    """
+    return not boto3_device.get_device(
+        image.block_device_mappings, GUEST_ROOT_DEVICE_NAME)
+
+
+def _run_job(job, enc_svc_cls, mv_root_snapshot_id, ena_support):
+    try:
+        if job.single_disk:
+            job.encrypted_ami_id = update_ami(
+                job.aws_svc,
+                enc_svc_cls,
+                job.values,
+                instance_config=job.instance_config
+            )
+        else:
+            job.encrypted_ami_id = update_ami_with_metavisor_root(
+                job.aws_svc,
+                job.values,
+                mv_root_snapshot_id,
+                instance_config=job.instance_config,
+                ena_support=ena_support
+            )
+    except Exception as e:
+        log.debug('', exc_info=1)
+        log.error(
+            'Session %s failed to update %s: %s', job.session_id, job.ami, e)
+        job.error = e
+    return job
+
+
+def _get_build_key(job, image):
+    """ Return the key that identifies which Metavisor root the job can
+    use: the encryptor AMI, the region and the crypto policy of the
+    encrypted AMI.
+    """
+    return (
+        job.values.encryptor_ami,
+        job.aws_svc.region,
+        boto3_tag.get_value(image.tags, TAG_CRYPTO_POLICY)
+    )
+
+
+class _MetavisorRoot(object):
+    """ A shared Metavisor root snapshot, and the jobs that use it. """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.snapshot_id = None
+        self.ena_support = False
+        self.aws_svc = None
+
+
+def _build_metavisor_root(aws_svc, mv_root, enc_svc_cls):
+    """ Build the Metavisor root for the given jobs with aws_svc, or with
+    the first job's AWSService if it's in a different region.  If the
+    build fails, the error is set on every job.
+    """
+    reference = mv_root.jobs[0]
+    if aws_svc.region != reference.aws_svc.region:
+        aws_svc = reference.aws_svc
+    mv_root.aws_svc = aws_svc
+    try:
+        mv_root.snapshot_id = build_metavisor_root(
+            aws_svc,
+            enc_svc_cls,
+            reference.values,
+            instance_config=reference.instance_config
+        )
+        mv_image = aws_svc.get_image(reference.values.encryptor_ami)
+        mv_root.ena_support = aws_service.has_ena_support(mv_image)
+    except Exception as e:
+        log.debug('', exc_info=1)
+        log.error('Unable to build the Metavisor root: %s', e)
+        for job in mv_root.jobs:
+            job.error = e
+
+
+def _delete_metavisor_root(mv_root):
+    """ Delete the shared snapshot, unless an updated AMI was registered
+    from it in guestless mode.
+    """
+    if not mv_root.snapshot_id:
+        return
+    for job in mv_root.jobs:
+        if job.values.guestless and job.encrypted_ami_id:
+            log.info(
+                'Keeping Metavisor root snapshot %s, which is used by %s',
+                mv_root.snapshot_id, job.encrypted_ami_id)
+            return
+    mv_root.aws_svc.delete_snapshot(mv_root.snapshot_id)
+
+
+def update_many(aws_svc, jobs, enc_svc_cls, max_parallel=4):
+    """ Update each of the given UpdateJobs, with at most max_parallel
+    updates running at the same time.  Dual disk jobs that have the same
+    encryptor AMI, region and crypto policy share a Metavisor root, which
+    is built with aws_svc and deleted when all updates are done, unless
+    an updated AMI was registered from it in guestless mode.  A failed
+    update does not stop the other jobs.
+
+    :return: the list of jobs, with encrypted_ami_id or error set
+    """
+    mv_roots = []
+    mv_root_by_key = {}
+    mv_root_by_job = {}
+    for job in jobs:
+        image = job.aws_svc.get_image(job.ami)
+        job.single_disk = is_single_disk_image(image)
+        if job.single_disk:
+            continue
+        key = _get_build_key(job, image)
+        if key not in mv_root_by_key:
+            mv_root_by_key[key] = _MetavisorRoot([])
+            mv_roots.append(mv_root_by_key[key])
+        mv_root_by_key[key].jobs.append(job)
+        mv_root_by_job[job] = mv_root_by_key[key]
+
+    try:
+        for mv_root in mv_roots:
+            _build_metavisor_root(aws_svc, mv_root, enc_svc_cls)
+
+        def _run(job):
+            mv_root = mv_root_by_job.get(job)
+            if not mv_root:
+                return _run_job(job, enc_svc_cls, None, False)
+            return _run_job(
+                job, enc_svc_cls, mv_root.snapshot_id, mv_root.ena_support)
+
+        runnable = [job for job in jobs if not job.error]
+        log.info(
+            'Updating %d AMIs, %d at a time', len(runnable),
+            min(max_parallel, len(runnable)))
+        util.parallel_map(_run, runnable, max_workers=max_parallel)
+    finally:
+        for mv_root in mv_roots:
+            _delete_metavisor_root(mv_root)
+    return jobs
@@ -0,0 +1,36 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+from brkt_cli.aws import update_encrypted_ami_args
+from brkt_cli.validation import min_int_argument
+
+
+def setup_update_batch_args(parser, parsed_config):
+    parser.add_argument(
+        'manifest',
+        metavar='PATH',
+        help=(
+            'YAML or JSON file with the list of encrypted AMIs to update.  '
+            'Each entry is an AMI ID, or a dictionary with the "ami", '
+            '"encrypted_ami_name" and "aws_tags" keys'
+        )
+    )
+    parser.add_argument(
+        '--max-parallel',
+        metavar='N',
+        dest='max_parallel',
+        type=lambda value: min_int_argument(value, 1),
+        default=4,
+        help='The maximum number of AMIs that are updated at the same time'
+    )
+    update_encrypted_ami_args.add_update_options(parser, parsed_config)
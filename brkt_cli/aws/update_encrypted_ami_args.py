@@ -28,6 +28,28 @@ def setup_update_encrypted_ami(parser, parsed_config):
         help='Specify the name of the generated encrypted AMI',
         required=False
     )
+    add_update_options(parser, parsed_config)
+    aws_args.add_replicate_region(parser)
+    aws_args.add_resume(parser)
+
+
+def add_update_options(parser, parsed_config):
+    """ Add the options that are shared by update-encrypted-ami and
+    update-batch.
+    """
+    parser.add_argument(
+        '--guestless',
+        dest='guestless',
+        action='store_true',
+        default=False,
+        help=(
+            "Don't launch an instance based on the encrypted AMI.  Run the "
+            "updater against the root snapshot referenced by the AMI and "
+            "register the updated AMI directly from snapshots.  Billing "
+            "product codes from the encrypted AMI are not preserved in this "
+            "mode"
+        )
+    )
     parser.add_argument(
         '--guest-instance-type',
         metavar='TYPE',
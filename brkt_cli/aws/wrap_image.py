@@ -31,10 +31,13 @@ AWS_SECRET_ACCESS_KEY environment variables, like you would when
 running the AWS command line utility.
 """
 
+import contextlib
 import logging
+import time
 
 from brkt_cli.user_data import gzip_user_data
 
+from brkt_cli import util
 from brkt_cli.aws import aws_service, boto3_device
 from brkt_cli.aws.aws_service import (
     EBS_OPTIMIZED_INSTANCES, wait_for_instance, clean_up,
@@ -55,6 +58,10 @@ NAME_WRAPPED_IMAGE_SUFFIX = ' (wrapped %(nonce)s)'
 
 INSTANCE_NAME_MAX_LENGTH = 128
 
+# The maximum number of Metavisor root volumes that are created at the same
+# time when wrapping a fleet of instances.
+MAX_CONCURRENT_VOLUME_CREATES = 16
+
 log = logging.getLogger(__name__)
 
 
@@ -89,7 +96,6 @@ def create_instance_security_group(aws_svc, vpc_id=None):
         log.error('Failed adding security group rule to %s: %s', sg.id, e)
         clean_up(aws_svc, security_group_ids=[sg.id])
 
-    aws_svc.create_tags(sg.id, name=sg_name, description=sg_desc)
     return sg
 
 
@@ -106,19 +112,31 @@ def _get_metavisor_root_device(aws_svc, metavisor_ami):
     return mv_image_root_dev
 
 
-def launch_wrapped_image(aws_svc, image_id, metavisor_ami,
-                         wrapped_instance_name=None, subnet_id=None,
-                         security_group_ids=None, instance_type='m4.large',
-                         instance_config=None, iam=None):
+def _get_guest_image(aws_svc, image_id):
     # If the guest already has /dev/sdf mounted, don't try to put the guest
     # root there.
     guest_image = aws_svc.get_image(image_id)
-    bdm = list(guest_image.block_device_mappings)
-    if boto3_device.get_device(bdm, '/dev/sdf'):
+    if boto3_device.get_device(guest_image.block_device_mappings, '/dev/sdf'):
         raise ValidationError(
             'Cannot wrap %s because it has a block device at /dev/sdf' %
             image_id
         )
+    return guest_image
+
+
+def _create_temp_security_group(aws_svc, subnet_id=None):
+    vpc_id = None
+    if subnet_id:
+        subnet = aws_svc.get_subnet(subnet_id)
+        vpc_id = subnet.vpc_id
+    return create_instance_security_group(aws_svc, vpc_id=vpc_id)
+
+
+def launch_wrapped_image(aws_svc, image_id, metavisor_ami,
+                         wrapped_instance_name=None, subnet_id=None,
+                         security_group_ids=None, instance_type='m4.large',
+                         instance_config=None, iam=None):
+    guest_image = _get_guest_image(aws_svc, image_id)
 
     # Verify that we have access to the Metavisor AMI and snapshot before
     # launching the guest instance.
@@ -134,12 +152,8 @@ def launch_wrapped_image(aws_svc, image_id, metavisor_ami,
     try:
         log.info('Running guest instance.')
         if not security_group_ids:
-            vpc_id = None
-            if subnet_id:
-                subnet = aws_svc.get_subnet(subnet_id)
-                vpc_id = subnet.vpc_id
-            temp_sg = create_instance_security_group(
-                aws_svc, vpc_id=vpc_id)
+            temp_sg = _create_temp_security_group(
+                aws_svc, subnet_id=subnet_id)
             security_group_ids = [temp_sg.id]
 
         instance = aws_svc.run_instance(
@@ -174,9 +188,57 @@ def launch_wrapped_image(aws_svc, image_id, metavisor_ami,
     return instance
 
 
-def wrap_instance(aws_svc, instance_id, metavisor_ami, instance_config=None):
-    instance = aws_svc.get_instance(instance_id)
-
+class WrapJob(object):
+    """ The state of wrapping a single instance. """
+
+    def __init__(self, instance_id):
+        self.instance_id = instance_id
+        self.instance = None
+        self.mv_root_vol = None
+        self.guest_root_vol = None
+        self.error = None
+
+        # True if the instance was stopped and couldn't be started again.
+        self.left_stopped = False
+
+        # (phase, seconds) for each phase that ran, in order.
+        self.timings = []
+
+        # When the instance was asked to stop and when it was started
+        # again, in seconds since the epoch.
+        self.stop_time = None
+        self.start_time = None
+
+    @property
+    def downtime(self):
+        """ Return the number of seconds between the stop and start
+        requests, or None if the instance wasn't restarted.
+        """
+        if self.stop_time is None or self.start_time is None:
+            return None
+        return self.start_time - self.stop_time
+
+    @contextlib.contextmanager
+    def timed(self, phase):
+        """ Record how long the body of the with statement takes. """
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.timings.append((phase, elapsed))
+            log.info(
+                '%s: %s took %.1f seconds', self.instance_id, phase, elapsed)
+
+    def __repr__(self):
+        return 'WrapJob:%s' % self.instance_id
+
+
+def _check_instance(instance):
+    """ Check that the instance can be wrapped.
+
+    :raise ValidationError if it can't
+    """
     if instance.instance_type == 't2.nano' or \
         instance.instance_type == 't1.micro':
         raise ValidationError(
@@ -188,107 +250,394 @@ def wrap_instance(aws_svc, instance_id, metavisor_ami, instance_config=None):
     if boto3_device.get_device(instance.block_device_mappings, '/dev/sdf'):
         raise ValidationError(
             'Cannot wrap %s because it has a block device at /dev/sdf' %
-            instance_id
+            instance.id
         )
 
-    mv_image_root_dev = _get_metavisor_root_device(aws_svc, metavisor_ami)
-    guest_root_vol = None
-    mv_root_vol = None
-    completed = False
 
-    try:
-        aws_svc.stop_instance(instance.id)
-        instance = wait_for_instance(aws_svc, instance.id, state='stopped')
+def _make_user_data(instance_config):
+    if instance_config is None:
+        instance_config = InstanceConfig()
+    instance_config.brkt_config['allow_unencrypted_guest'] = True
+    return instance_config.make_userdata()
 
-        if instance_config is None:
-            instance_config = InstanceConfig()
-        instance_config.brkt_config['allow_unencrypted_guest'] = True
-        user_data = instance_config.make_userdata()
 
-        aws_svc.modify_instance_attribute(
-            instance.id, 'userData', gzip_user_data(user_data))
-
-        log.info('Creating Metavisor root volume.')
-        mv_root_vol = aws_svc.create_volume(
+def _create_metavisor_root_volume(aws_svc, job, mv_image_root_dev):
+    log.info('Creating Metavisor root volume for %s.', job.instance_id)
+    with job.timed('create Metavisor root volume'):
+        job.mv_root_vol = aws_svc.create_volume(
             size=mv_image_root_dev['Ebs']['VolumeSize'],
-            zone=instance.placement['AvailabilityZone'],
+            zone=job.instance.placement['AvailabilityZone'],
             snapshot_id=mv_image_root_dev['Ebs']['SnapshotId'],
             volume_type='gp2'
         )
 
-        log.info(
-            'Moving guest root volume from %s to /dev/sdf.',
-            instance.root_device_name
-        )
+
+def _swap_root_volumes(aws_svc, job, metavisor_ami, user_data):
+    """ Move the guest root volume of the stopped instance to /dev/sdf,
+    attach the Metavisor root volume in its place and start the instance.
+    """
+    instance = job.instance
+    log.info(
+        'Moving guest root volume from %s to /dev/sdf.',
+        instance.root_device_name
+    )
+    with job.timed('move guest root volume'):
         guest_root_dev = boto3_device.get_device(
             instance.block_device_mappings, instance.root_device_name)
-        guest_root_vol = aws_svc.detach_volume(
+        job.guest_root_vol = aws_svc.detach_volume(
             guest_root_dev['Ebs']['VolumeId'], instance.id)
-        guest_root_vol = aws_service.wait_for_volume(
-            aws_svc, guest_root_vol.id)
-        aws_svc.attach_volume(guest_root_vol.id, instance.id, '/dev/sdf')
+        job.guest_root_vol = aws_service.wait_for_volume(
+            aws_svc, job.guest_root_vol.id)
+        aws_svc.attach_volume(
+            job.guest_root_vol.id, instance.id, '/dev/sdf')
 
-        log.info('Attaching Metavisor root volume.')
-        mv_root_vol = aws_service.wait_for_volume(aws_svc, mv_root_vol.id)
+    log.info('Attaching Metavisor root volume.')
+    with job.timed('attach Metavisor root volume'):
+        job.mv_root_vol = aws_service.wait_for_volume(
+            aws_svc, job.mv_root_vol.id)
         aws_svc.attach_volume(
-            mv_root_vol.id, instance.id, instance.root_device_name)
+            job.mv_root_vol.id, instance.id, instance.root_device_name)
 
         log.info('Waiting for Metavisor and guest root volumes to attach.')
         aws_service.wait_for_volume_attached(
             aws_svc, instance.id, instance.root_device_name)
-        aws_service.wait_for_volume_attached(aws_svc, instance.id, '/dev/sdf')
+        aws_service.wait_for_volume_attached(
+            aws_svc, instance.id, '/dev/sdf')
 
-        # Create guest and metavisor device mappings to be deleted on termination
-        guest_device = boto3_device.make_device(
-            device_name='/dev/sdf',
-            delete_on_termination=True
-        )
-        metavisor_device = boto3_device.make_device(
-            device_name=instance.root_device_name,
-            delete_on_termination=True
-        )
+    # Create guest and metavisor device mappings to be deleted on termination
+    guest_device = boto3_device.make_device(
+        device_name='/dev/sdf',
+        delete_on_termination=True
+    )
+    metavisor_device = boto3_device.make_device(
+        device_name=instance.root_device_name,
+        delete_on_termination=True
+    )
 
-        # Enable sriovNetSupport
-        enable_sriov_net_support(aws_svc, instance)
-
-        # Enable ENA with Metavisor supports it
-        mv_image = aws_svc.get_image(metavisor_ami)
-        mv_ena_support = aws_service.has_ena_support(mv_image)
-        guest_ena_support = aws_service.has_ena_support(instance)
-        log.debug(
-            'ENA support: metavisor=%s, guest=%s',
-            mv_ena_support,
-            guest_ena_support
-        )
-        if mv_ena_support and not guest_ena_support:
-            aws_svc.modify_instance_attribute(
-                instance.id,
-                'enaSupport',
-                'True'
-            )
+    # Enable sriovNetSupport
+    enable_sriov_net_support(aws_svc, instance)
 
-        log.info('Starting wrapped instance.')
-        instance = aws_svc.start_instance(instance.id)
-        # Re-attached volumes lose their DeleteOnTermination Settings
-        # Modify instance attributes to mark the guest root and
-        # metavisor volumes to get terminated on instance termination
+    # Enable ENA with Metavisor supports it
+    mv_image = aws_svc.get_image(metavisor_ami)
+    mv_ena_support = aws_service.has_ena_support(mv_image)
+    guest_ena_support = aws_service.has_ena_support(instance)
+    log.debug(
+        'ENA support: metavisor=%s, guest=%s',
+        mv_ena_support,
+        guest_ena_support
+    )
+    if mv_ena_support and not guest_ena_support:
         aws_svc.modify_instance_attribute(
-            instance.id, 'blockDeviceMappings',
-            [metavisor_device, guest_device]
+            instance.id,
+            'enaSupport',
+            'True'
         )
+
+    # Set the user data last, so that the guest's own user data is only
+    # replaced if the swap succeeded.
+    aws_svc.modify_instance_attribute(
+        instance.id, 'userData', gzip_user_data(user_data))
+
+    log.info('Starting wrapped instance.')
+    job.instance = aws_svc.start_instance(instance.id)
+    job.start_time = time.time()
+    log.info(
+        '%s was down for %.1f seconds', instance.id, job.downtime)
+    # Re-attached volumes lose their DeleteOnTermination Settings
+    # Modify instance attributes to mark the guest root and
+    # metavisor volumes to get terminated on instance termination
+    aws_svc.modify_instance_attribute(
+        instance.id, 'blockDeviceMappings',
+        [metavisor_device, guest_device]
+    )
+
+
+def _restore_instance(aws_svc, job):
+    """ Undo a partial wrap.  If the guest root volume was moved, move it
+    back to the root device.  Delete the Metavisor root volume and start
+    the instance again.  The guest root volume is never deleted.  An
+    instance that was already started with the Metavisor is left alone.
+    """
+    if job.start_time is not None:
+        return
+
+    instance = aws_svc.get_instance(job.instance_id)
+    mv_root_vol_id = job.mv_root_vol.id if job.mv_root_vol else None
+    if job.guest_root_vol:
+        guest_vol_id = job.guest_root_vol.id
+        root_dev = boto3_device.get_device(
+            instance.block_device_mappings, instance.root_device_name)
+        if not root_dev or \
+                boto3_device.get_volume_id(root_dev) != guest_vol_id:
+            log.info('Moving guest root volume %s back to %s.',
+                     guest_vol_id, instance.root_device_name)
+            for vol_id in (mv_root_vol_id, guest_vol_id):
+                if vol_id and boto3_device.is_attached(
+                        instance.block_device_mappings, vol_id):
+                    aws_svc.detach_volume(vol_id, instance.id)
+                    aws_service.wait_for_volume(aws_svc, vol_id)
+            aws_svc.attach_volume(
+                guest_vol_id, instance.id, instance.root_device_name)
+            aws_service.wait_for_volume_attached(
+                aws_svc, instance.id, instance.root_device_name)
+            instance = aws_svc.get_instance(job.instance_id)
+
+    if mv_root_vol_id and not boto3_device.is_attached(
+            instance.block_device_mappings, mv_root_vol_id):
+        clean_up(aws_svc, volume_ids=[mv_root_vol_id])
+    if job.stop_time is not None:
+        _restart_instance(aws_svc, job)
+
+
+def _wait_for_stop(aws_svc, job):
+    with job.timed('stop instance'):
+        return wait_for_instance(aws_svc, job.instance_id, state='stopped')
+
+
+def wrap_instance(aws_svc, instance_id, metavisor_ami, instance_config=None,
+                  job=None):
+    """ Wrap a single instance.  The Metavisor root volume is created and
+    the user data is generated while the instance stops, so the instance
+    is only down for the volume swap.  The timings of each phase and the
+    downtime are logged, and recorded in job if one is passed in.
+
+    :return the wrapped instance
+    """
+    job = job or WrapJob(instance_id)
+    job.instance = aws_svc.get_instance(instance_id)
+    _check_instance(job.instance)
+
+    mv_image_root_dev = _get_metavisor_root_device(aws_svc, metavisor_ami)
+    completed = False
+
+    try:
+        job.stop_time = time.time()
+        aws_svc.stop_instance(instance_id)
+
+        # Creating the Metavisor root volume only depends on the
+        # availability zone, so do it while the instance stops.
+        stop_call = util.BackgroundCall(
+            _wait_for_stop, aws_svc.clone(), job)
+        try:
+            user_data = _make_user_data(instance_config)
+            _create_metavisor_root_volume(aws_svc, job, mv_image_root_dev)
+            with job.timed('wait for Metavisor root volume'):
+                job.mv_root_vol = aws_service.wait_for_volume(
+                    aws_svc, job.mv_root_vol.id)
+        finally:
+            stopped_instance = stop_call.get()
+        job.instance = stopped_instance
+
+        _swap_root_volumes(aws_svc, job, metavisor_ami, user_data)
         completed = True
     finally:
         if not completed:
-            volume_ids = []
-            if mv_root_vol:
-                volume_ids.append(mv_root_vol.id)
-            if guest_root_vol:
-                volume_ids.append(guest_root_vol.id)
+            _restore_instance(aws_svc, job)
 
-            clean_up(
-                aws_svc,
-                volume_ids=volume_ids
+    log.info('Done.')
+    return job.instance
+
+
+def _fail_job(job, e):
+    log.debug('', exc_info=1)
+    log.error('Unable to wrap %s: %s', job.instance_id, e)
+    job.error = e
+
+
+def _create_volume_for_job(aws_svc, job, mv_image_root_dev):
+    try:
+        _create_metavisor_root_volume(aws_svc, job, mv_image_root_dev)
+    except Exception as e:
+        _fail_job(job, e)
+    return job
+
+
+def _restart_instance(aws_svc, job):
+    """ Start an instance that was stopped but won't be wrapped.  If it
+    can't be started, left_stopped is set on the job.
+    """
+    try:
+        instance = aws_svc.get_instance(job.instance_id)
+        if instance.state['Name'] in ('pending', 'running'):
+            return job
+        _wait_for_stop(aws_svc, job)
+        job.instance = aws_svc.start_instance(job.instance_id)
+        job.start_time = time.time()
+        log.info('Restarted %s without wrapping it.', job.instance_id)
+    except Exception as e:
+        log.debug('', exc_info=1)
+        log.error('Unable to restart %s: %s', job.instance_id, e)
+        job.left_stopped = True
+    return job
+
+
+def _wrap_stopped_instance(aws_svc, job, metavisor_ami, user_data):
+    try:
+        job.instance = _wait_for_stop(aws_svc, job)
+        _swap_root_volumes(aws_svc, job, metavisor_ami, user_data)
+        log.info('Wrapped %s.', job.instance_id)
+    except Exception as e:
+        _fail_job(job, e)
+        try:
+            _restore_instance(aws_svc, job)
+        except Exception as e:
+            log.debug('', exc_info=1)
+            log.error('Unable to restore %s: %s', job.instance_id, e)
+            job.left_stopped = True
+    return job
+
+
+def wrap_instances(aws_svc, instance_ids, metavisor_ami, instance_config=None,
+                   max_parallel=8):
+    """ Wrap many instances at the same time.  The instances are validated
+    with a single describe call and stopped with a single request.  The
+    Metavisor root volumes are all created while the instances stop, and
+    the volume swaps run with at most max_parallel instances at a time.
+    If a ResourceWaiter is attached to aws_svc, the waits for the
+    instances and volumes are batched.  Each worker thread uses its own
+    clone of aws_svc.  A failure does not stop the other instances.
+    Instances whose Metavisor root volume can't be created are
+    started again without being wrapped.
+
+    :return a list of WrapJobs, in the same order as instance_ids, with
+        error set for the instances that failed
+    """
+    jobs = [WrapJob(instance_id) for instance_id in instance_ids]
+    mv_image_root_dev = _get_metavisor_root_device(aws_svc, metavisor_ami)
+    user_data = _make_user_data(instance_config)
+
+    instances = dict((i.id, i) for i in aws_svc.get_instances(*instance_ids))
+    for job in jobs:
+        job.instance = instances.get(job.instance_id)
+        try:
+            if not job.instance:
+                raise ValidationError(
+                    'No instance with id %s' % job.instance_id)
+            _check_instance(job.instance)
+        except ValidationError as e:
+            _fail_job(job, e)
+
+    pending = [job for job in jobs if not job.error]
+    if not pending:
+        return jobs
+    try:
+        stop_time = time.time()
+        aws_svc.stop_instances(*[job.instance_id for job in pending])
+        for job in pending:
+            job.stop_time = stop_time
+    except Exception as e:
+        for job in pending:
+            _fail_job(job, e)
+        return jobs
+
+    util.parallel_map(
+        lambda job: _create_volume_for_job(
+            aws_svc.clone(), job, mv_image_root_dev),
+        pending,
+        max_workers=MAX_CONCURRENT_VOLUME_CREATES
+    )
+    failed = [job for job in pending if job.error]
+    if failed:
+        util.parallel_map(
+            lambda job: _restart_instance(aws_svc.clone(), job),
+            failed,
+            max_workers=max_parallel
+        )
+    pending = [job for job in pending if not job.error]
+    log.info(
+        'Wrapping %d instances, %d at a time', len(pending),
+        min(max_parallel, len(pending)))
+    util.parallel_map(
+        lambda job: _wrap_stopped_instance(
+            aws_svc.clone(), job, metavisor_ami, user_data),
+        pending,
+        max_workers=max_parallel
+    )
+    return jobs
+
+
+def launch_wrapped_images(aws_svc, image_id, metavisor_ami, count,
+                          wrapped_instance_name=None, subnet_id=None,
+                          security_group_ids=None, instance_type='m4.large',
+                          instance_config=None, iam=None, max_parallel=8):
+    """ Launch count instances of the guest image and wrap them with
+    wrap_instances().  Instances that fail to launch or wrap are
+    terminated.
+
+    :return a list of WrapJobs.  instance_id is None for the instances
+        that failed to launch.
+    """
+    guest_image = _get_guest_image(aws_svc, image_id)
+    _get_metavisor_root_device(aws_svc, metavisor_ami)
+    if not wrapped_instance_name:
+        wrapped_instance_name = get_name_from_image(guest_image)
+
+    temp_sg = None
+    if not security_group_ids:
+        temp_sg = _create_temp_security_group(aws_svc, subnet_id=subnet_id)
+        security_group_ids = [temp_sg.id]
+
+    def _launch(_):
+        job = WrapJob(None)
+        svc = aws_svc.clone()
+        try:
+            instance = svc.run_instance(
+                image_id,
+                subnet_id=subnet_id,
+                instance_type=instance_type,
+                ebs_optimized=instance_type in EBS_OPTIMIZED_INSTANCES,
+                security_group_ids=security_group_ids,
+                name=wrapped_instance_name,
+                instance_profile_name=iam
             )
+            job.instance_id = instance.id
+            wait_for_instance(svc, instance.id)
+        except Exception as e:
+            _fail_job(job, e)
+        return job
+
+    log.info('Running %d guest instances.', count)
+    jobs = []
+    completed = False
+    try:
+        jobs = util.parallel_map(
+            _launch, xrange(count), max_workers=max_parallel)
+        running_ids = [job.instance_id for job in jobs if not job.error]
+        if running_ids:
+            wrapped = wrap_instances(
+                aws_svc, running_ids, metavisor_ami,
+                instance_config=instance_config, max_parallel=max_parallel)
+            jobs = [job for job in jobs if job.error] + wrapped
+        completed = True
+    finally:
+        failed_ids = [
+            job.instance_id for job in jobs
+            if job.instance_id and (job.error or not completed)
+        ]
+        sg_ids = []
+        if temp_sg and (
+                not completed or all(job.error for job in jobs)):
+            sg_ids.append(temp_sg.id)
+        if failed_ids or sg_ids:
+            clean_up(
+                aws_svc, instance_ids=failed_ids, security_group_ids=sg_ids)
+    return jobs
 
-    log.info('Done.')
-    return instance
+
+def render_results(jobs):
+    """ Render the per-instance outcome and downtime of a fleet as a
+    table.
+    """
+    rows = [['INSTANCE', 'DOWNTIME', 'RESULT']]
+    for job in jobs:
+        if job.error and job.left_stopped:
+            result = 'stopped, not wrapped: %s' % job.error
+        elif job.error:
+            result = 'failed: %s' % job.error
+        else:
+            result = 'wrapped'
+        downtime = '-'
+        if job.downtime is not None:
+            downtime = '%.1fs' % job.downtime
+        rows.append([job.instance_id or '-', downtime, result])
+    return util.render_table_rows(rows)
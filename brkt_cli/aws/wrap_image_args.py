@@ -13,6 +13,7 @@
 # limitations under the License.
 
 from brkt_cli.aws import aws_args
+from brkt_cli.validation import min_int_argument
 
 
 def setup_wrap_image_args(parser, parsed_config):
@@ -41,6 +42,25 @@ def setup_wrap_image_args(parser, parsed_config):
         help='The instance type to use when launching the wrapped image',
         default='m4.large'
     )
+    parser.add_argument(
+        '--count',
+        metavar='N',
+        dest='count',
+        type=lambda value: min_int_argument(value, 1),
+        default=1,
+        help='The number of wrapped instances to launch (default: 1)'
+    )
+    parser.add_argument(
+        '--max-parallel',
+        metavar='N',
+        dest='max_parallel',
+        type=lambda value: min_int_argument(value, 1),
+        default=8,
+        help=(
+            'When launching more than one instance, the maximum number of '
+            'instances that are launched or wrapped at the same time'
+        )
+    )
     aws_args.add_no_validate(parser)
     aws_args.add_region(parser, parsed_config)
     aws_args.add_security_group(parser, parsed_config)
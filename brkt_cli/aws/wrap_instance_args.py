@@ -13,13 +13,39 @@
 # limitations under the License.
 
 from brkt_cli.aws import aws_args
+from brkt_cli.validation import min_int_argument
 
 
 def setup_wrap_instance_args(parser, parsed_config):
     parser.add_argument(
-        'instance_id',
+        'instance_ids',
         metavar='ID',
-        help='The ID of the instance that will be wrapped with Metavisor'
+        nargs='*',
+        help=(
+            'The ID of the instance that will be wrapped with Metavisor.  '
+            'Specify more than one ID to wrap a fleet of instances'
+        )
+    )
+    parser.add_argument(
+        '--instance-tag',
+        metavar='KEY=VALUE',
+        dest='instance_tags',
+        action='append',
+        help=(
+            'Wrap all instances that have this tag.  Can be specified '
+            'multiple times, and instances must have all of the tags'
+        )
+    )
+    parser.add_argument(
+        '--max-parallel',
+        metavar='N',
+        dest='max_parallel',
+        type=lambda value: min_int_argument(value, 1),
+        default=8,
+        help=(
+            'When wrapping more than one instance, the maximum number of '
+            'instances whose volumes are swapped at the same time'
+        )
     )
     parser.add_argument(
         '--wrapped-instance-name',
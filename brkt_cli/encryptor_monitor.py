@@ -0,0 +1,273 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Watch the status of many encryptors at the same time.
+
+wait_for_encryption() blocks a thread on its own polling loop for each
+encryptor.  An EncryptorMonitor polls any number of encryptors with one
+scheduler thread and a small fixed pool of worker threads that make the
+status requests.
+
+The scheduler keeps a heap of encryptors ordered by the time of their
+next poll.  Each encryptor has at most one request in flight, and the
+polling interval adapts to its estimated time remaining, like
+wait_for_encryption().  Requests are spaced out so that the monitor
+never sends more than max_requests_per_second in total.
+
+Subscribers are called with an EncryptorEvent when the state of an
+encryptor changes, after every successful status request, and when it
+finishes or fails.  They are called from the worker threads.
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from brkt_cli.encryptor_service import (
+    ENCRYPT_FAILED,
+    ENCRYPT_SUCCESSFUL,
+    ENCRYPTION_PROGRESS_TIMEOUT,
+    EncryptionError,
+    ProgressTracker,
+    _handle_failure_code,
+    get_poll_interval
+)
+
+log = logging.getLogger(__name__)
+
+EVENT_STATE_CHANGED = 'state_changed'
+EVENT_PROGRESS = 'progress'
+EVENT_FINISHED = 'finished'
+EVENT_FAILED = 'failed'
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_REQUESTS_PER_SECOND = 20.0
+
+# The number of consecutive failed status requests after which we assume
+# that the encryptor has crashed.
+MAX_ERRORS = 10
+
+# How long wait() blocks at a time, so that KeyboardInterrupt is delivered.
+_WAIT_INTERVAL = 1
+
+
+class EncryptorEvent(object):
+
+    def __init__(self, name, event_type, progress=None, error=None):
+        self.name = name
+        self.event_type = event_type
+        # The EncryptionProgress after the latest status request, or None.
+        self.progress = progress
+        # The exception, for EVENT_FAILED.
+        self.error = error
+
+    def __repr__(self):
+        return 'EncryptorEvent:%s:%s' % (self.name, self.event_type)
+
+
+class Watch(object):
+    """ The state of a single encryptor that's watched by the monitor. """
+
+    def __init__(self, name, enc_svc, progress_timeout):
+        self.name = name
+        self.enc_svc = enc_svc
+        self.tracker = ProgressTracker(progress_timeout)
+        self.progress = None
+        self.error = None
+        self.err_count = 0
+        self.done = threading.Event()
+
+    def __repr__(self):
+        return 'Watch:%s' % self.name
+
+
+class EncryptorMonitor(object):
+    """ Polls the status API of many encryptors from one scheduler thread
+    and max_workers worker threads.  Call close() when done.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS,
+                 max_requests_per_second=DEFAULT_MAX_REQUESTS_PER_SECOND,
+                 progress_timeout=ENCRYPTION_PROGRESS_TIMEOUT,
+                 poll_interval=get_poll_interval):
+        """
+        :param poll_interval a function that takes whether the state
+            changed and the ETA, and returns the number of seconds until
+            the next poll
+        """
+        self.progress_timeout = progress_timeout
+        self.poll_interval = poll_interval
+        self.requests = 0
+        self._min_spacing = 1.0 / max_requests_per_second
+        self._next_dispatch = 0
+        self._heap = []
+        self._counter = itertools.count()
+        self._watches = {}
+        self._subscribers = []
+        self._closed = False
+        self._cond = threading.Condition()
+        self._pool = ThreadPool(max_workers)
+        self._scheduler = threading.Thread(target=self._run)
+        self._scheduler.daemon = True
+        self._scheduler.start()
+
+    def subscribe(self, callback):
+        """ Call callback with an EncryptorEvent for every event. """
+        with self._cond:
+            self._subscribers.append(callback)
+
+    def watch(self, name, enc_svc):
+        """ Start polling the given encryptor service.
+
+        :return the Watch, which can be passed to wait()
+        """
+        watch = Watch(name, enc_svc, self.progress_timeout)
+        with self._cond:
+            if name in self._watches:
+                raise ValueError('Already watching %s' % name)
+            self._watches[name] = watch
+        log.debug('Watching encryptor %s', name)
+        self._schedule(watch, 0)
+        return watch
+
+    def wait(self, watch, timeout=None):
+        """ Wait for the encryptor to finish.
+
+        :return the final EncryptionProgress
+        :raise EncryptionError if encryption failed
+        """
+        start = time.time()
+        while not watch.done.is_set():
+            if timeout is not None and time.time() - start >= timeout:
+                raise EncryptionError(
+                    'Timed out waiting for encryptor %s' % watch.name)
+            watch.done.wait(_WAIT_INTERVAL)
+        if watch.error:
+            raise watch.error
+        return watch.progress
+
+    def wait_all(self):
+        """ Wait for all encryptors to finish or fail.
+
+        :return a dictionary that maps the name to the Watch
+        """
+        with self._cond:
+            watches = dict(self._watches)
+        for watch in watches.values():
+            while not watch.done.is_set():
+                watch.done.wait(_WAIT_INTERVAL)
+        return watches
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._scheduler.join()
+        self._pool.close()
+        self._pool.join()
+
+    def _schedule(self, watch, delay):
+        with self._cond:
+            heapq.heappush(
+                self._heap, (time.time() + delay, next(self._counter), watch))
+            self._cond.notify()
+
+    def _run(self):
+        """ Dispatch each encryptor's poll to the worker pool when it's
+        due, without exceeding the request rate.
+        """
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if self._heap:
+                        due = max(self._heap[0][0], self._next_dispatch)
+                        wait = due - time.time()
+                        if wait <= 0:
+                            break
+                        self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+                if self._closed:
+                    return
+                _, _, watch = heapq.heappop(self._heap)
+                self._next_dispatch = \
+                    max(time.time(), self._next_dispatch) + self._min_spacing
+                self.requests += 1
+            self._pool.apply_async(self._poll, (watch,))
+
+    def _publish(self, event):
+        with self._cond:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception:
+                log.exception('Subscriber failed to handle %s', event)
+
+    def _finish(self, watch, error=None):
+        watch.error = error
+        if error:
+            log.debug('Encryptor %s failed: %s', watch.name, error)
+            event_type = EVENT_FAILED
+        else:
+            event_type = EVENT_FINISHED
+        self._publish(EncryptorEvent(
+            watch.name, event_type, progress=watch.progress, error=error))
+        watch.done.set()
+
+    def _poll(self, watch):
+        try:
+            status = watch.enc_svc.get_status()
+            watch.err_count = 0
+        except Exception as e:
+            watch.err_count += 1
+            log.debug(
+                'Failed getting status of encryptor %s: %s', watch.name, e)
+            if watch.err_count >= MAX_ERRORS:
+                self._finish(
+                    watch, EncryptionError('Encryption service unavailable'))
+            else:
+                self._schedule(watch, self.poll_interval(False, None))
+            return
+
+        try:
+            watch.progress, state_changed = watch.tracker.update(status)
+            if state_changed:
+                self._publish(EncryptorEvent(
+                    watch.name, EVENT_STATE_CHANGED, progress=watch.progress))
+            self._publish(EncryptorEvent(
+                watch.name, EVENT_PROGRESS, progress=watch.progress))
+
+            if watch.progress.state == ENCRYPT_SUCCESSFUL:
+                self._finish(watch)
+                return
+            if watch.progress.state == ENCRYPT_FAILED:
+                log.error(
+                    'Encryptor %s status: %s', watch.name, json.dumps(status))
+                _handle_failure_code(status.get('failure_code'))
+        except EncryptionError as e:
+            self._finish(watch, e)
+            return
+        except Exception as e:
+            log.debug('', exc_info=1)
+            self._finish(watch, e)
+            return
+
+        self._schedule(
+            watch, self.poll_interval(state_changed, watch.progress.eta))
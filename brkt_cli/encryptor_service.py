@@ -13,10 +13,19 @@
 # limitations under the License.
 
 import abc
+import collections
+import errno
+import httplib
 import json
 import logging
+import Queue
+import random
+import select
+import socket
+import threading
 import time
-import urllib2
+import urllib
+import urlparse
 
 from brkt_cli import validation
 from brkt_cli.util import (
@@ -34,6 +43,28 @@ ENCRYPT_FAILED = 'failed'
 ENCRYPT_ENCRYPTING = 'encrypting'
 ENCRYPTOR_STATUS_PORT = 80
 
+# Bounds on the number of seconds between status requests while waiting
+# for encryption.  DEFAULT_POLL_INTERVAL is used until the time remaining
+# can be estimated.
+MIN_POLL_INTERVAL = 2
+DEFAULT_POLL_INTERVAL = 10
+MAX_POLL_INTERVAL = 30
+
+# The weight of the newest sample in the throughput estimate.
+THROUGHPUT_EWMA_ALPHA = 0.3
+
+# While waiting for the encryptor to boot, the status port is probed with
+# TCP connects.  The interval starts at PROBE_INITIAL_INTERVAL and grows by
+# PROBE_BACKOFF up to PROBE_MAX_INTERVAL.  Each sleep is a random fraction
+# of the interval, so that many sessions don't probe in lockstep.  Hosts
+# that are reached through an HTTP proxy aren't probed, since the connect
+# would go to the proxy.  Their readiness is only checked with status
+# requests.
+PROBE_INITIAL_INTERVAL = 0.5
+PROBE_MAX_INTERVAL = 2.0
+PROBE_BACKOFF = 1.5
+PROBE_TIMEOUT = 1.0
+
 FAILURE_CODE_AWS_PERMISSIONS = 'insufficient_aws_permissions'
 FAILURE_CODE_GET_YETI_CONFIG = 'failed_get_yeti_config'
 FAILURE_CODE_INVALID_NTP_SERVERS = 'invalid_ntp_servers'
@@ -45,6 +76,13 @@ FAILURE_CODE_FORBIDDEN_YETI = 'forbidden_yeti'
 FAILURE_CODE_TERMINAL_YETI_ERROR = 'terminal_yeti_error_'
 FAILURE_CODE_UNSUPPORTED_GUEST = 'unsupported_guest'
 
+# The number of recent status request latencies that are kept.
+LATENCY_SAMPLES = 100
+
+# How long to wait for the result of a host race.  Every request has its
+# own timeout, so this is only a backstop.
+_RACE_WAIT_TIMEOUT = 60 * 60
+
 log = logging.getLogger(__name__)
 
 
@@ -58,28 +96,206 @@ class UnsupportedGuestError(BracketError):
     pass
 
 
+def _get_proxy(hostname):
+    """ Return the (host, port) of the HTTP proxy to use for requests to
+    hostname, or None to connect directly.
+    """
+    proxy = urllib.getproxies().get('http')
+    if not proxy or urllib.proxy_bypass(hostname):
+        return None
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    parsed = urlparse.urlparse(proxy)
+    return parsed.hostname, parsed.port or 80
+
+
 class BaseEncryptorService(object):
+    """ Talks to the status API of a single encryptor instance.
+
+    The encryptor may be reachable at more than one address, for example
+    its public and private IPs.  The first request is sent to all of them
+    at the same time, and the first host that responds is used for all
+    requests that follow, over a single keep-alive connection.  The hosts
+    are only raced again after a request to that host fails.
+    """
     __metaclass__ = abc.ABCMeta
 
     def __init__(self, hostnames, port=ENCRYPTOR_STATUS_PORT):
         self.hostnames = hostnames
         self.port = port
 
-    def fetch(self, path, timeout_secs=2):
-        exceptions_by_host = {}
-        for hostname in self.hostnames:
-            url = 'http://%s:%d%s' % (hostname, self.port, path)
+        # The host that responded first, and the connection to it.
+        self.host = None
+        self._conn = None
+        self._url_prefix = ''
+
+        # The number of calls to fetch(), and the latencies of recent
+        # successful requests, in seconds.
+        self.requests = 0
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    def _connect(self, hostname, timeout_secs):
+        """ Return a connection to the host, and the prefix for request
+        paths.  Requests go through the HTTP proxy from the environment,
+        unless no_proxy says to bypass it, like urllib2 does.
+        """
+        proxy = _get_proxy(hostname)
+        if not proxy:
+            conn = httplib.HTTPConnection(
+                hostname, self.port, timeout=timeout_secs)
+            return conn, ''
+        conn = httplib.HTTPConnection(
+            proxy[0], proxy[1], timeout=timeout_secs)
+        return conn, 'http://%s:%d' % (hostname, self.port)
+
+    def _request(self, conn, path, url_prefix=''):
+        """ Send a GET request over the given connection.
+
+        :return the response body
+        :raise IOError or httplib.HTTPException if the request fails
+        """
+        start = time.time()
+        conn.request('GET', url_prefix + path)
+        response = conn.getresponse()
+        data = response.read()
+        if response.status != httplib.OK:
+            raise IOError(
+                'GET %s returned %d %s' %
+                (path, response.status, response.reason)
+            )
+        elapsed = time.time() - start
+        self.latencies.append(elapsed)
+        log.debug('GET %s from %s took %.3f seconds', path, conn.host, elapsed)
+        return data
+
+    def _race(self, path, timeout_secs):
+        """ Send the request to all hosts at the same time.  The first host
+        that responds becomes the pinned host.
+
+        :return the response body
+        :raise EncryptorConnectionError if none of the hosts respond
+        """
+        results = Queue.Queue()
+        lock = threading.Lock()
+        winner = []
+
+        def _try_host(hostname):
+            conn, url_prefix = self._connect(hostname, timeout_secs)
             try:
-                r = urllib2.urlopen(url, timeout=timeout_secs)
-                data = r.read()
-                self.hostnames = [hostname]
-                return data
-            except IOError as e:
+                data = self._request(conn, path, url_prefix)
+            except (IOError, httplib.HTTPException) as e:
+                conn.close()
+                results.put((hostname, None, e))
+                return
+            with lock:
+                won = not winner
+                if won:
+                    winner.append((hostname, conn, url_prefix))
+            if not won:
+                conn.close()
+            results.put((hostname, data, None))
+
+        hostnames = list(self.hostnames)
+        if len(hostnames) == 1:
+            _try_host(hostnames[0])
+        else:
+            for hostname in hostnames:
+                t = threading.Thread(target=_try_host, args=(hostname,))
+                t.daemon = True
+                t.start()
+
+        exceptions_by_host = {}
+        for _ in hostnames:
+            # Wait with a timeout, so that KeyboardInterrupt is delivered.
+            hostname, data, e = results.get(True, _RACE_WAIT_TIMEOUT)
+            if e:
                 log.debug('Unable to connect to %s:%s - %s', hostname,
                           self.port, e)
-            exceptions_by_host[hostname] = e
+                exceptions_by_host[hostname] = e
+                continue
+            self.host, self._conn, self._url_prefix = winner[0]
+            log.debug('Using %s:%d for encryptor status', self.host, self.port)
+            return data
         raise EncryptorConnectionError(self.port, exceptions_by_host)
 
+    def fetch(self, path, timeout_secs=2):
+        self.requests += 1
+        if self._conn:
+            try:
+                return self._request(self._conn, path, self._url_prefix)
+            except (IOError, httplib.HTTPException) as e:
+                log.debug(
+                    'Request to %s:%d failed: %s', self.host, self.port, e)
+                self.close()
+        return self._race(path, timeout_secs)
+
+    def probe(self, timeout=PROBE_TIMEOUT):
+        """ Check whether the status port accepts TCP connections, on all
+        hosts at the same time.  Hosts that are reached through an HTTP
+        proxy can't be probed, and are reported as open.
+
+        :return the first host that accepted the connection, or None
+        """
+        pending = {}
+        try:
+            for hostname in self.hostnames:
+                if _get_proxy(hostname):
+                    return hostname
+                try:
+                    family, socktype, proto, _, address = \
+                        socket.getaddrinfo(
+                            hostname, self.port, 0, socket.SOCK_STREAM)[0]
+                    sock = socket.socket(family, socktype, proto)
+                except socket.error as e:
+                    log.debug('Unable to probe %s: %s', hostname, e)
+                    continue
+                sock.setblocking(0)
+                err = sock.connect_ex(address)
+                if err == 0:
+                    sock.close()
+                    return hostname
+                if err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    pending[sock] = hostname
+                else:
+                    sock.close()
+
+            deadline = time.time() + timeout
+            while pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                _, writable, _ = select.select([], pending.keys(), [],
+                                               remaining)
+                for sock in writable:
+                    hostname = pending.pop(sock)
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    sock.close()
+                    if err == 0:
+                        return hostname
+            return None
+        finally:
+            for sock in pending:
+                sock.close()
+
+    def close(self):
+        """ Close the connection to the pinned host. """
+        if self._conn:
+            self._conn.close()
+        self.host = None
+        self._conn = None
+        self._url_prefix = ''
+
+    def get_latency_summary(self):
+        """ Return a tuple of the number of recent requests, and their
+        median and maximum latency in seconds, or None if no requests have
+        succeeded.
+        """
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return (
+            len(latencies), latencies[len(latencies) / 2], latencies[-1])
+
     @abc.abstractmethod
     def is_encryptor_up(self):
         pass
@@ -107,6 +323,15 @@ class EncryptorConnectionError(Exception):
 class EncryptorService(BaseEncryptorService):
 
     def is_encryptor_up(self):
+        # A TCP connect is much cheaper than a status request, and fails
+        # quickly while the encryptor is booting.  If the encryptor is
+        # reached through a proxy, probe() reports the port as open, and
+        # every check is a status request.
+        hostname = self.probe()
+        if not hostname:
+            log.debug('Status port %d is not open yet', self.port)
+            return False
+        log.debug('Status port %d is open on %s', self.port, hostname)
         try:
             self.get_status()
             log.debug("Successfully got encryptor status")
@@ -128,16 +353,28 @@ class EncryptorService(BaseEncryptorService):
         return info
 
 
-def wait_for_encryptor_up(enc_svc, deadline):
+def wait_for_encryptor_up(enc_svc, deadline, launch_time=None):
+    """ Wait for the encryptor's status API to respond.  The readiness
+    checks start out a fraction of a second apart, and back off to
+    PROBE_MAX_INTERVAL.  When the encryptor is reached through an HTTP
+    proxy, each check is a full status request instead of a TCP probe.
+
+    :param launch_time when the encryptor instance was launched, in
+        seconds since the epoch
+    :return the number of seconds between launch_time and the status API
+        becoming ready, or the number of seconds waited if launch_time is
+        not specified
+    """
     start = time.time()
+    interval = PROBE_INITIAL_INTERVAL
     while not deadline.is_expired():
         if enc_svc.is_encryptor_up():
+            now = time.time()
             log.debug(
-                'Encryption service is up after %.1f seconds',
-                time.time() - start
-            )
-            return
-        sleep(5)
+                'Encryption service is up after %.1f seconds', now - start)
+            return now - (launch_time or start)
+        sleep(random.uniform(interval / 2, interval))
+        interval = min(interval * PROBE_BACKOFF, PROBE_MAX_INTERVAL)
     raise EncryptionError(
         'Unable to contact encryptor instance at %s, port %d.' %
         (', '.join(enc_svc.hostnames), enc_svc.port)
@@ -188,15 +425,164 @@ def _handle_failure_code(failure_code):
     raise EncryptionError(msg)
 
 
+class ThroughputEstimator(object):
+    """ Keeps an exponentially weighted moving average of the rate at which
+    the encryptor writes bytes, based on successive bytes_written samples.
+    """
+
+    def __init__(self, alpha=THROUGHPUT_EWMA_ALPHA):
+        self.alpha = alpha
+        # Bytes per second, or None until there are two samples that
+        # show progress.
+        self.rate = None
+        self._last_sample = None
+
+    def add_sample(self, timestamp, bytes_written):
+        if self._last_sample:
+            last_timestamp, last_bytes = self._last_sample
+            elapsed = timestamp - last_timestamp
+            if elapsed <= 0 or bytes_written < last_bytes:
+                # A duplicate sample, or the counter was reset when the
+                # state changed.  Start over from this sample.
+                self._last_sample = (timestamp, bytes_written)
+                return
+            rate = (bytes_written - last_bytes) / elapsed
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate = self.alpha * rate + (1 - self.alpha) * self.rate
+        self._last_sample = (timestamp, bytes_written)
+
+    def get_eta(self, bytes_written, bytes_total):
+        """ Return the estimated number of seconds until bytes_total bytes
+        have been written, or None if it can't be estimated yet.
+        """
+        if not self.rate or not bytes_total:
+            return None
+        return max(0, bytes_total - bytes_written) / self.rate
+
+
+class EncryptionProgress(object):
+    """ A snapshot of the encryptor's progress, as passed to the progress
+    callback of wait_for_encryption().
+    """
+
+    def __init__(self, state, percent_complete, bytes_written=0,
+                 bytes_total=None, throughput=None, eta=None, elapsed=0):
+        self.state = state
+        self.percent_complete = percent_complete
+        self.bytes_written = bytes_written
+        self.bytes_total = bytes_total
+        # Bytes per second, or None if not known yet.
+        self.throughput = throughput
+        # Seconds until completion, or None if not known yet.
+        self.eta = eta
+        # Seconds since wait_for_encryption() was called.
+        self.elapsed = elapsed
+
+    def describe(self):
+        """ Return a human-readable summary of the throughput and ETA. """
+        if self.throughput is None:
+            return 'throughput unknown'
+        msg = '%.1f MB/s' % (self.throughput / (1024 * 1024))
+        if self.eta is not None:
+            msg += ', %d seconds remaining' % self.eta
+        return msg
+
+    def __repr__(self):
+        return 'EncryptionProgress:%s:%.2f' % (
+            self.state, self.percent_complete)
+
+
+def get_poll_interval(state_changed, eta):
+    """ Return the number of seconds to wait before the next status
+    request.  Poll quickly right after the state changes and when the
+    encryption is about to finish, and slowly in the middle of a long
+    encryption.
+    """
+    if state_changed:
+        return MIN_POLL_INTERVAL
+    if eta is None:
+        return DEFAULT_POLL_INTERVAL
+    interval = min(eta / 4, MAX_POLL_INTERVAL)
+    return max(MIN_POLL_INTERVAL, interval)
+
+
+class ProgressTracker(object):
+    """ Follows the status of a single encryptor across status requests.
+    Detects stalls and state changes, and estimates the throughput and
+    time remaining.
+    """
+
+    def __init__(self, progress_timeout=ENCRYPTION_PROGRESS_TIMEOUT):
+        self.progress_timeout = progress_timeout
+        self.start_time = time.time()
+        self.state = ''
+        self._last_progress = 0
+        self._progress_deadline = Deadline(progress_timeout)
+        self._estimator = ThroughputEstimator()
+
+    def update(self, status, now=None):
+        """ Process the result of a status request.
+
+        :return a tuple of the EncryptionProgress, and whether the state
+            changed since the last update
+        :raise EncryptionError if there's been no progress for longer than
+            progress_timeout seconds
+        """
+        now = now or time.time()
+        state = status['state']
+        # For image updates, there is no bytes_written
+        bytes_written = status.get('bytes_written', 0)
+        bytes_total = status.get('bytes_total')
+
+        # Make sure that encryption progress hasn't stalled.
+        if self._progress_deadline.is_expired():
+            raise EncryptionError(
+                'Waited for encryption progress for longer than %s seconds' %
+                self.progress_timeout
+            )
+        state_changed = state != self.state
+        if bytes_written > self._last_progress or state_changed:
+            self._last_progress = bytes_written
+            self.state = state
+            self._progress_deadline = Deadline(self.progress_timeout)
+
+        if state_changed:
+            # Downloading and encrypting run at different rates.
+            self._estimator = ThroughputEstimator()
+        self._estimator.add_sample(now, bytes_written)
+        progress = EncryptionProgress(
+            state,
+            status['percent_complete'],
+            bytes_written=bytes_written,
+            bytes_total=bytes_total,
+            throughput=self._estimator.rate,
+            eta=self._estimator.get_eta(bytes_written, bytes_total),
+            elapsed=now - self.start_time
+        )
+        if state == ENCRYPT_SUCCESSFUL:
+            if progress.elapsed > 0 and bytes_written:
+                progress.throughput = bytes_written / progress.elapsed
+            progress.eta = 0
+        return progress, state_changed
+
+
 def wait_for_encryption(enc_svc,
-                        progress_timeout=ENCRYPTION_PROGRESS_TIMEOUT):
+                        progress_timeout=ENCRYPTION_PROGRESS_TIMEOUT,
+                        progress_callback=None):
+    """ Wait for the encryptor to finish.  The polling interval adapts to
+    the estimated time remaining.
+
+    :param progress_callback a function that's called with an
+        EncryptionProgress after every status request
+    :return the final EncryptionProgress
+    :raise EncryptionError if encryption fails or stalls
+    """
     err_count = 0
     max_errs = 10
-    start_time = time.time()
-    last_log_time = start_time
-    progress_deadline = Deadline(progress_timeout)
-    last_progress = 0
-    last_state = ''
+    tracker = ProgressTracker(progress_timeout)
+    last_log_time = tracker.start_time
 
     while err_count < max_errs:
         try:
@@ -206,25 +592,15 @@ def wait_for_encryption(enc_svc,
             log.warn("Failed getting encryption status: %s", e)
             log.warn("Retrying. . .")
             err_count += 1
-            sleep(10)
+            sleep(DEFAULT_POLL_INTERVAL)
             continue
 
         state = status['state']
         percent_complete = status['percent_complete']
-        # For image updates, there is no bytes_written
-        bytes_written = status.get('bytes_written', 0)
         log.debug('state=%s, percent_complete=%.2f', state, percent_complete)
-
-        # Make sure that encryption progress hasn't stalled.
-        if progress_deadline.is_expired():
-            raise EncryptionError(
-                'Waited for encryption progress for longer than %s seconds' %
-                progress_timeout
-            )
-        if bytes_written > last_progress or state != last_state:
-            last_progress = bytes_written
-            last_state = state
-            progress_deadline = Deadline(progress_timeout)
+        progress, state_changed = tracker.update(status)
+        if progress_callback:
+            progress_callback(progress)
 
         # Log progress once a minute.
         now = time.time()
@@ -236,17 +612,25 @@ def wait_for_encryption(enc_svc,
                 if state == ENCRYPT_DOWNLOADING:
                     state_display = 'Download from cloud storage'
                 log.info(
-                    '%s is %.2f%% complete', state_display, percent_complete)
+                    '%s is %.2f%% complete (%s)', state_display,
+                    percent_complete, progress.describe())
             last_log_time = now
 
         if state == ENCRYPT_SUCCESSFUL:
-            log.info('Encrypted root drive created.')
-            return
+            log.info(
+                'Encrypted root drive created in %d seconds (%s).',
+                progress.elapsed, progress.describe())
+            summary = enc_svc.get_latency_summary()
+            if summary:
+                log.debug(
+                    'Status requests: count=%d, median=%.3fs, max=%.3fs',
+                    *summary)
+            return progress
         elif state == ENCRYPT_FAILED:
             log.error('Encryption status: %s', json.dumps(status))
             _handle_failure_code(status.get('failure_code'))
 
-        sleep(10)
+        sleep(get_poll_interval(state_changed, progress.eta))
     # We've failed to get encryption status for _max_errs_ consecutive tries.
     # Assume that the server has crashed.
     raise EncryptionError('Encryption service unavailable')
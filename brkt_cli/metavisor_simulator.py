@@ -0,0 +1,302 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Emulate the Metavisor status API on the local host.
+
+Each SimulatedEncryptor follows a script of states, for example initial,
+downloading and encrypting, and then finishes or fails with a failure
+code.  While encrypting, bytes_written grows at a configurable rate.
+Faults can be injected on each request: added latency, connection resets
+and stalls, where the server holds the request without responding.
+
+MetavisorSimulator serves each encryptor on its own port on 127.0.0.1,
+with the same endpoints as the Metavisor: the status at / and
+/single_disk.  It's used by the unit tests and by
+bench_status_polling.py, which runs it in a separate process:
+
+    python -m brkt_cli.metavisor_simulator --count 200
+
+prints one JSON line with the port and expected finish time of each
+encryptor, and serves until stdin is closed.
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import logging
+import random
+import socket
+import SocketServer
+import struct
+import sys
+import threading
+import time
+
+from brkt_cli.encryptor_service import (
+    ENCRYPT_DOWNLOADING,
+    ENCRYPT_ENCRYPTING,
+    ENCRYPT_FAILED,
+    ENCRYPT_INITIALIZING,
+    ENCRYPT_SUCCESSFUL
+)
+
+log = logging.getLogger(__name__)
+
+DEFAULT_STEPS = (
+    (ENCRYPT_INITIALIZING, 1.0),
+    (ENCRYPT_DOWNLOADING, 1.0),
+    # The duration of encryption is bytes_total / bytes_per_second.
+    (ENCRYPT_ENCRYPTING, None)
+)
+DEFAULT_BYTES_TOTAL = 8 * 1024 * 1024 * 1024
+DEFAULT_BYTES_PER_SECOND = 100 * 1024 * 1024
+
+
+class SimulatedEncryptor(object):
+    """ The scripted state of one encryptor.  The script starts when
+    start() is called.
+    """
+
+    def __init__(self, steps=DEFAULT_STEPS, bytes_total=DEFAULT_BYTES_TOTAL,
+                 bytes_per_second=DEFAULT_BYTES_PER_SECOND,
+                 failure_code=None, single_disk=True, latency=0,
+                 reset_probability=0, stall_probability=0, stall_seconds=5,
+                 seed=None, clock=time):
+        """
+        :param steps a sequence of (state, seconds) tuples.  If seconds is
+            None, the step lasts until bytes_total bytes have been written
+        :param failure_code if not None, the encryptor fails with this
+            code after the last step, instead of finishing
+        :param latency seconds added to every response
+        :param reset_probability the probability that a request is
+            answered with a TCP reset
+        :param stall_probability the probability that the server holds a
+            request for stall_seconds and then closes the connection
+        """
+        self.steps = list(steps)
+        self.bytes_total = bytes_total
+        self.bytes_per_second = float(bytes_per_second)
+        self.failure_code = failure_code
+        self.single_disk = single_disk
+        self.latency = latency
+        self.reset_probability = reset_probability
+        self.stall_probability = stall_probability
+        self.stall_seconds = stall_seconds
+        self.clock = clock
+        self.start_time = None
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.start_time = self.clock.time()
+
+    def _get_duration(self, seconds):
+        if seconds is None:
+            return self.bytes_total / self.bytes_per_second
+        return seconds
+
+    @property
+    def duration(self):
+        """ The number of seconds from start() until the final state. """
+        return sum(self._get_duration(seconds) for _, seconds in self.steps)
+
+    @property
+    def finish_time(self):
+        """ When the encryptor reaches the final state, in seconds since
+        the epoch, or None if it hasn't been started.
+        """
+        if self.start_time is None:
+            return None
+        return self.start_time + self.duration
+
+    def get_status(self, now=None):
+        """ Return the status dictionary, as served by the Metavisor. """
+        now = now or self.clock.time()
+        elapsed = now - (self.start_time or now)
+        bytes_written = 0
+        for state, seconds in self.steps:
+            duration = self._get_duration(seconds)
+            if state == ENCRYPT_ENCRYPTING:
+                bytes_written = min(
+                    self.bytes_total,
+                    int(max(0, elapsed) * self.bytes_per_second)
+                )
+            if elapsed < duration:
+                return {
+                    'state': state,
+                    'bytes_written': bytes_written,
+                    'bytes_total': self.bytes_total
+                }
+            elapsed -= duration
+
+        status = {
+            'state': ENCRYPT_SUCCESSFUL,
+            'bytes_written': self.bytes_total,
+            'bytes_total': self.bytes_total
+        }
+        if self.failure_code:
+            status['state'] = ENCRYPT_FAILED
+            status['bytes_written'] = bytes_written
+            status['failure_code'] = self.failure_code
+        return status
+
+    def choose_fault(self):
+        """ Return 'reset', 'stall' or None for the next request. """
+        with self._lock:
+            self.requests += 1
+            r = self._random.random()
+        if r < self.reset_probability:
+            return 'reset'
+        if r < self.reset_probability + self.stall_probability:
+            return 'stall'
+        return None
+
+
+class _StatusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _reset(self):
+        # Closing with a zero linger timeout sends RST instead of FIN.
+        self.connection.setsockopt(
+            socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.close_connection = 1
+
+    def do_GET(self):
+        encryptor = self.server.encryptor
+        fault = encryptor.choose_fault()
+        if fault == 'reset':
+            self._reset()
+            return
+        if fault == 'stall':
+            time.sleep(encryptor.stall_seconds)
+            self.close_connection = 1
+            return
+        if encryptor.latency:
+            time.sleep(encryptor.latency)
+
+        if self.path == '/':
+            body = json.dumps(encryptor.get_status())
+        elif self.path == '/single_disk':
+            body = str(encryptor.single_disk)
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        log.debug(fmt, *args)
+
+
+class _StatusServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, encryptor):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), _StatusHandler)
+        self.encryptor = encryptor
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class MetavisorSimulator(object):
+    """ Serves the status API of each SimulatedEncryptor on its own port
+    on 127.0.0.1.
+    """
+
+    def __init__(self):
+        self.servers = []
+
+    def add(self, encryptor):
+        """ Start serving the encryptor, and start its script.
+
+        :return the port number
+        """
+        server = _StatusServer(encryptor)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.servers.append(server)
+        encryptor.start()
+        return server.port
+
+    def shutdown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Emulate the Metavisor status API of many encryptors.')
+    parser.add_argument('--count', type=int, default=100)
+    parser.add_argument(
+        '--encrypt-seconds', type=float, default=60,
+        help='The average duration of encryption')
+    parser.add_argument(
+        '--spread', type=float, default=0.5,
+        help='Vary the encryption duration by up to this fraction')
+    parser.add_argument(
+        '--failure-rate', type=float, default=0,
+        help='The fraction of encryptors that fail')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--reset-probability', type=float, default=0)
+    parser.add_argument('--stall-probability', type=float, default=0)
+    parser.add_argument('--stall-seconds', type=float, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    values = parser.parse_args(args)
+
+    rand = random.Random(values.seed)
+    simulator = MetavisorSimulator()
+    encryptors = []
+    for i in xrange(values.count):
+        seconds = values.encrypt_seconds * (
+            1 + rand.uniform(-values.spread, values.spread))
+        failure_code = None
+        if rand.random() < values.failure_rate:
+            failure_code = 'simulated_failure'
+        encryptor = SimulatedEncryptor(
+            bytes_per_second=DEFAULT_BYTES_TOTAL / seconds,
+            failure_code=failure_code,
+            latency=values.latency,
+            reset_probability=values.reset_probability,
+            stall_probability=values.stall_probability,
+            stall_seconds=values.stall_seconds,
+            seed=values.seed + i
+        )
+        port = simulator.add(encryptor)
+        encryptors.append({
+            'port': port,
+            'finish_time': encryptor.finish_time,
+            'failure_code': failure_code
+        })
+
+    sys.stdout.write(json.dumps({'encryptors': encryptors}) + '\n')
+    sys.stdout.flush()
+    # Serve until the parent closes stdin.
+    sys.stdin.read()
+    simulator.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
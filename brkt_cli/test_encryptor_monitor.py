@@ -0,0 +1,124 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import time
+import unittest
+
+from brkt_cli import encryptor_monitor, encryptor_service
+from brkt_cli.test_encryptor_service import DummyEncryptorService
+
+
+class FailingEncryptorService(DummyEncryptorService):
+
+    def __init__(self, failure_code):
+        super(FailingEncryptorService, self).__init__()
+        self.failure_code = failure_code
+
+    def get_status(self):
+        return {
+            'state': encryptor_service.ENCRYPT_FAILED,
+            'failure_code': self.failure_code,
+            'percent_complete': 0,
+            'bytes_written': 0
+        }
+
+
+class UnreachableEncryptorService(DummyEncryptorService):
+
+    def get_status(self):
+        raise IOError('Connection refused')
+
+
+def _no_wait(state_changed, eta):
+    return 0
+
+
+class TestEncryptorMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        self.monitor = encryptor_monitor.EncryptorMonitor(
+            max_requests_per_second=10000, poll_interval=_no_wait)
+        self.monitor.subscribe(self.events.append)
+
+    def tearDown(self):
+        self.monitor.close()
+
+    def _get_events(self, name):
+        return [e.event_type for e in self.events if e.name == name]
+
+    def test_many_encryptors(self):
+        """ Test that many encryptors are watched with a fixed number of
+        threads, and that each one publishes its events in order.
+        """
+        threads_before = threading.active_count()
+        watches = [
+            self.monitor.watch('enc-%d' % i, DummyEncryptorService())
+            for i in xrange(100)
+        ]
+        self.assertLessEqual(
+            threading.active_count() - threads_before,
+            encryptor_monitor.DEFAULT_MAX_WORKERS + 1
+        )
+
+        for watch in watches:
+            progress = self.monitor.wait(watch, timeout=10)
+            self.assertEqual(
+                encryptor_service.ENCRYPT_SUCCESSFUL, progress.state)
+        self.assertEqual(100 * 6, self.monitor.requests)
+
+        events = self._get_events('enc-0')
+        self.assertEqual(encryptor_monitor.EVENT_STATE_CHANGED, events[0])
+        self.assertEqual(encryptor_monitor.EVENT_FINISHED, events[-1])
+        self.assertEqual(
+            6, events.count(encryptor_monitor.EVENT_PROGRESS))
+
+    def test_failure_code(self):
+        """ Test that the failure code is mapped to the same exception as
+        wait_for_encryption() raises.
+        """
+        watch = self.monitor.watch(
+            'enc', FailingEncryptorService(
+                encryptor_service.FAILURE_CODE_UNSUPPORTED_GUEST))
+        with self.assertRaises(encryptor_service.UnsupportedGuestError):
+            self.monitor.wait(watch, timeout=10)
+        self.assertEqual(encryptor_monitor.EVENT_FAILED,
+                         self._get_events('enc')[-1])
+
+    def test_unreachable(self):
+        watch = self.monitor.watch('enc', UnreachableEncryptorService())
+        with self.assertRaisesRegexp(
+                encryptor_service.EncryptionError, 'unavailable'):
+            self.monitor.wait(watch, timeout=10)
+        self.assertEqual(encryptor_monitor.MAX_ERRORS, self.monitor.requests)
+
+    def test_request_rate(self):
+        """ Test that requests are spaced out to respect the rate limit. """
+        self.monitor.close()
+        self.monitor = encryptor_monitor.EncryptorMonitor(
+            max_requests_per_second=100, poll_interval=_no_wait)
+        start = time.time()
+        watches = [
+            self.monitor.watch('enc-%d' % i, DummyEncryptorService())
+            for i in xrange(3)
+        ]
+        self.monitor.wait_all()
+        self.assertTrue(all(w.done.is_set() for w in watches))
+        self.assertEqual(18, self.monitor.requests)
+        self.assertGreaterEqual(time.time() - start, 17 / 100.0)
+
+    def test_duplicate_name(self):
+        self.monitor.watch('enc', DummyEncryptorService())
+        with self.assertRaises(ValueError):
+            self.monitor.watch('enc', DummyEncryptorService())
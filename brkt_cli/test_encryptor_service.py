@@ -11,6 +11,13 @@
 # CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and
 # limitations under the License.
+import BaseHTTPServer
+import json
+import os
+import socket
+import SocketServer
+import threading
+import time
 import unittest
 
 import brkt_cli
@@ -71,11 +78,173 @@ class FailedEncryptionService(encryptor_service.BaseEncryptorService):
         }
 
 
+class StatusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves the encryptor status over keep-alive connections. """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        body = json.dumps({
+            'state': encryptor_service.ENCRYPT_ENCRYPTING,
+            'bytes_written': 50,
+            'bytes_total': 100
+        })
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StatusServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), StatusHandler)
+        self.connections = 0
+        self.paths = []
+
+
+class BrokenConnection(object):
+    host = '127.0.0.1'
+
+    def request(self, method, path):
+        raise socket.error('Connection reset by peer')
+
+    def close(self):
+        pass
+
+
+PROXY_VARIABLES = ('http_proxy', 'HTTP_PROXY', 'no_proxy', 'NO_PROXY')
+
+
+class TestStatusConnection(unittest.TestCase):
+
+    def setUp(self):
+        # Don't send the test requests through the proxy of the
+        # environment that runs the tests.
+        self.saved_environ = dict(
+            (k, os.environ.pop(k)) for k in PROXY_VARIABLES
+            if k in os.environ
+        )
+        self.server = StatusServer()
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for k in PROXY_VARIABLES:
+            os.environ.pop(k, None)
+        os.environ.update(self.saved_environ)
+
+    def test_keep_alive(self):
+        """ Test that successive requests reuse one connection, and that
+        their latency is recorded.
+        """
+        svc = encryptor_service.EncryptorService(
+            ['127.0.0.1'], port=self.port)
+        for _ in xrange(3):
+            self.assertEqual(50, svc.get_status()['percent_complete'])
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual('127.0.0.1', svc.host)
+        count, median, max_latency = svc.get_latency_summary()
+        self.assertEqual(3, count)
+        self.assertLessEqual(median, max_latency)
+        svc.close()
+
+    def test_race(self):
+        """ Test that an unreachable host doesn't stop the request from
+        succeeding, and that the hosts are raced again after a failure.
+        """
+        svc = encryptor_service.EncryptorService(
+            ['127.0.0.2', '127.0.0.1'], port=self.port)
+        svc.get_status()
+        self.assertEqual('127.0.0.1', svc.host)
+
+        svc._conn.close()
+        svc._conn = BrokenConnection()
+        svc.get_status()
+        self.assertEqual('127.0.0.1', svc.host)
+        self.assertEqual(2, self.server.connections)
+        svc.close()
+
+    def test_proxy(self):
+        """ Test that requests go through the HTTP proxy, unless the host
+        is listed in no_proxy.
+        """
+        os.environ['http_proxy'] = 'http://127.0.0.1:%d' % self.port
+        svc = encryptor_service.EncryptorService(
+            ['encryptor.example.com'], port=8000)
+        svc.get_status()
+        svc.close()
+        self.assertEqual(
+            ['http://encryptor.example.com:8000/'], self.server.paths)
+
+        os.environ['no_proxy'] = '127.0.0.1'
+        svc = encryptor_service.EncryptorService(
+            ['127.0.0.1'], port=self.port)
+        svc.get_status()
+        svc.close()
+        self.assertEqual('/', self.server.paths[-1])
+
+    def test_probe(self):
+        """ Test that the TCP probe finds the host that's listening. """
+        svc = encryptor_service.EncryptorService(
+            ['127.0.0.2', '127.0.0.1'], port=self.port)
+        self.assertEqual('127.0.0.1', svc.probe())
+        self.assertEqual([], self.server.paths)
+
+        svc = encryptor_service.EncryptorService(['127.0.0.2'], port=self.port)
+        self.assertIsNone(svc.probe())
+        self.assertFalse(svc.is_encryptor_up())
+        self.assertIsNone(svc.get_latency_summary())
+
+    def test_probe_proxy(self):
+        """ Test that a host that's reached through the proxy isn't probed,
+        and that its readiness is checked with a status request.
+        """
+        os.environ['http_proxy'] = 'http://127.0.0.1:%d' % self.port
+        svc = encryptor_service.EncryptorService(
+            ['encryptor.example.com'], port=8000)
+        self.assertEqual('encryptor.example.com', svc.probe())
+        self.assertEqual([], self.server.paths)
+        self.assertTrue(svc.is_encryptor_up())
+        self.assertEqual(
+            ['http://encryptor.example.com:8000/'], self.server.paths)
+        svc.close()
+
+    def test_no_hosts_reachable(self):
+        svc = encryptor_service.EncryptorService(
+            ['127.0.0.2', '127.0.0.3'], port=self.port)
+        with self.assertRaises(encryptor_service.EncryptorConnectionError):
+            svc.get_status()
+        self.assertIsNone(svc.get_latency_summary())
+        self.assertFalse(svc.is_encryptor_up())
+
+
 class TestEncryptionService(unittest.TestCase):
 
     def setUp(self):
         brkt_cli.util.SLEEP_ENABLED = False
 
+    def test_ready_time(self):
+        """ Test that the time from launch to ready is returned. """
+        svc = DummyEncryptorService()
+        ready = encryptor_service.wait_for_encryptor_up(
+            svc, brkt_cli.util.Deadline(60), launch_time=time.time() - 30)
+        self.assertGreaterEqual(ready, 30)
+        self.assertLess(ready, 60)
+
     def test_service_fails_to_come_up(self):
         svc = DummyEncryptorService()
         deadline = ExpiredDeadline()
@@ -150,3 +319,58 @@ class TestEncryptionService(unittest.TestCase):
         for failure_code in failure_codes:
             with self.assertRaises(encryptor_service.EncryptionError):
                 encryptor_service._handle_failure_code(failure_code)
+
+
+class TestAdaptivePolling(unittest.TestCase):
+
+    def setUp(self):
+        brkt_cli.util.SLEEP_ENABLED = False
+
+    def test_throughput_estimate(self):
+        estimator = encryptor_service.ThroughputEstimator(alpha=0.5)
+        self.assertIsNone(estimator.get_eta(0, 1000))
+        estimator.add_sample(100, 0)
+        estimator.add_sample(110, 100)
+        self.assertEqual(10, estimator.rate)
+        estimator.add_sample(120, 400)
+        self.assertEqual(20, estimator.rate)
+        self.assertEqual(30, estimator.get_eta(400, 1000))
+        self.assertIsNone(estimator.get_eta(400, None))
+
+        # Duplicate samples and counter resets don't affect the rate.
+        estimator.add_sample(120, 400)
+        estimator.add_sample(130, 0)
+        self.assertEqual(20, estimator.rate)
+
+    def test_poll_interval(self):
+        get_poll_interval = encryptor_service.get_poll_interval
+        self.assertEqual(
+            encryptor_service.MIN_POLL_INTERVAL, get_poll_interval(True, 600))
+        self.assertEqual(
+            encryptor_service.DEFAULT_POLL_INTERVAL,
+            get_poll_interval(False, None)
+        )
+        self.assertEqual(
+            encryptor_service.MAX_POLL_INTERVAL,
+            get_poll_interval(False, 3600)
+        )
+        self.assertEqual(
+            encryptor_service.MIN_POLL_INTERVAL, get_poll_interval(False, 1))
+        self.assertEqual(5, get_poll_interval(False, 20))
+
+    def test_progress_callback(self):
+        """ Test that the callback is called after every status request,
+        and that the final progress is returned.
+        """
+        progress = []
+        svc = DummyEncryptorService()
+        result = encryptor_service.wait_for_encryption(
+            svc, progress_callback=progress.append)
+        self.assertEqual(6, len(progress))
+        self.assertEqual(
+            [0, 20, 40, 60, 80, 100],
+            [p.percent_complete for p in progress]
+        )
+        self.assertIs(progress[-1], result)
+        self.assertEqual(encryptor_service.ENCRYPT_SUCCESSFUL, result.state)
+        self.assertEqual(0, result.eta)
@@ -0,0 +1,166 @@
+# Copyright 2017 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import os
+import unittest
+
+import brkt_cli.util
+from brkt_cli import encryptor_monitor, encryptor_service
+from brkt_cli.metavisor_simulator import (
+    MetavisorSimulator,
+    SimulatedEncryptor
+)
+from brkt_cli.test_encryptor_service import PROXY_VARIABLES
+
+MB = 1024 * 1024
+
+
+class DummyClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class TestSimulatedEncryptor(unittest.TestCase):
+
+    def test_script(self):
+        """ Test that the encryptor follows its script, and that
+        bytes_written grows at the configured rate.
+        """
+        clock = DummyClock()
+        encryptor = SimulatedEncryptor(
+            bytes_total=100 * MB, bytes_per_second=10 * MB, clock=clock)
+        encryptor.start()
+        self.assertEqual(12, encryptor.duration)
+        self.assertEqual(1012, encryptor.finish_time)
+
+        expected = [
+            (0.5, encryptor_service.ENCRYPT_INITIALIZING, 0),
+            (1.5, encryptor_service.ENCRYPT_DOWNLOADING, 0),
+            (7, encryptor_service.ENCRYPT_ENCRYPTING, 50 * MB),
+            (20, encryptor_service.ENCRYPT_SUCCESSFUL, 100 * MB),
+        ]
+        for elapsed, state, bytes_written in expected:
+            clock.now = 1000 + elapsed
+            status = encryptor.get_status()
+            self.assertEqual(state, status['state'])
+            self.assertEqual(bytes_written, status['bytes_written'])
+            self.assertEqual(100 * MB, status['bytes_total'])
+
+    def test_failure(self):
+        clock = DummyClock()
+        encryptor = SimulatedEncryptor(
+            steps=[(encryptor_service.ENCRYPT_INITIALIZING, 1)],
+            failure_code=encryptor_service.FAILURE_CODE_AWS_PERMISSIONS,
+            clock=clock
+        )
+        encryptor.start()
+        clock.now += 2
+        status = encryptor.get_status()
+        self.assertEqual(encryptor_service.ENCRYPT_FAILED, status['state'])
+        self.assertEqual(
+            encryptor_service.FAILURE_CODE_AWS_PERMISSIONS,
+            status['failure_code']
+        )
+
+    def test_faults(self):
+        encryptor = SimulatedEncryptor(reset_probability=1)
+        self.assertEqual('reset', encryptor.choose_fault())
+        encryptor = SimulatedEncryptor(stall_probability=1)
+        self.assertEqual('stall', encryptor.choose_fault())
+        encryptor = SimulatedEncryptor()
+        self.assertIsNone(encryptor.choose_fault())
+        self.assertEqual(1, encryptor.requests)
+
+
+class TestMetavisorSimulator(unittest.TestCase):
+    """ Poll simulated encryptors over HTTP. """
+
+    def setUp(self):
+        brkt_cli.util.SLEEP_ENABLED = False
+        self.saved_environ = dict(
+            (k, os.environ.pop(k)) for k in PROXY_VARIABLES
+            if k in os.environ
+        )
+        self.simulator = MetavisorSimulator()
+
+    def tearDown(self):
+        self.simulator.shutdown()
+        os.environ.update(self.saved_environ)
+
+    def _add(self, **kwargs):
+        kwargs.setdefault('steps', [
+            (encryptor_service.ENCRYPT_DOWNLOADING, 0.05),
+            (encryptor_service.ENCRYPT_ENCRYPTING, None)
+        ])
+        kwargs.setdefault('bytes_total', 10 * MB)
+        kwargs.setdefault('bytes_per_second', 100 * MB)
+        port = self.simulator.add(SimulatedEncryptor(**kwargs))
+        return encryptor_service.EncryptorService(['127.0.0.1'], port=port)
+
+    def test_wait_for_encryption(self):
+        svc = self._add()
+        self.assertTrue(svc.is_encryptor_up())
+        progress = encryptor_service.wait_for_encryption(svc)
+        self.assertEqual(encryptor_service.ENCRYPT_SUCCESSFUL, progress.state)
+        self.assertTrue(encryptor_service.encryptor_did_single_disk(svc))
+        svc.close()
+
+    def test_failure_code(self):
+        svc = self._add(
+            failure_code=encryptor_service.FAILURE_CODE_UNSUPPORTED_GUEST)
+        with self.assertRaises(encryptor_service.UnsupportedGuestError):
+            encryptor_service.wait_for_encryption(svc)
+        svc.close()
+
+    def test_connection_reset(self):
+        svc = self._add(reset_probability=1)
+        with self.assertRaises(encryptor_service.EncryptorConnectionError):
+            svc.get_status()
+
+    def test_stall(self):
+        """ Test that a stalled request times out. """
+        svc = self._add(stall_probability=1, stall_seconds=0.5)
+        with self.assertRaises(encryptor_service.EncryptorConnectionError):
+            svc.fetch('/', timeout_secs=0.1)
+
+    def test_latency(self):
+        svc = self._add(latency=0.05)
+        svc.get_status()
+        self.assertGreaterEqual(svc.latencies[0], 0.05)
+        svc.close()
+
+    def test_monitor(self):
+        """ Test that the monitor watches several simulated encryptors,
+        including one that fails.
+        """
+        monitor = encryptor_monitor.EncryptorMonitor(
+            max_requests_per_second=1000, poll_interval=lambda *args: 0.01)
+        services = [self._add() for _ in xrange(5)]
+        services.append(self._add(
+            failure_code=encryptor_service.FAILURE_CODE_NET_ROUTE_TIMEOUT))
+        for i, svc in enumerate(services):
+            monitor.watch(i, svc)
+        watches = monitor.wait_all()
+        monitor.close()
+
+        self.assertEqual(6, len(watches))
+        for i in xrange(5):
+            self.assertIsNone(watches[i].error)
+        self.assertIsInstance(
+            watches[5].error, encryptor_service.EncryptionError)
+        for svc in services:
+            svc.close()
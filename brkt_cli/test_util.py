@@ -12,8 +12,10 @@
 # License for the specific language governing permissions and
 # limitations under the License.
 from datetime import datetime, timedelta
+import threading
 import time
 import unittest
+from multiprocessing.pool import ThreadPool
 
 import iso8601
 
@@ -193,3 +195,125 @@ class TestTimestamp(unittest.TestCase):
         )
         with self.assertRaises(ValidationError):
             util.parse_duration('10')
+
+
+class TestParallelMap(unittest.TestCase):
+
+    def test_results_in_order(self):
+        self.assertEqual(
+            [0, 2, 4, 6, 8],
+            util.parallel_map(lambda x: x * 2, range(5), max_workers=3)
+        )
+        self.assertEqual([], util.parallel_map(lambda x: x, []))
+
+    def test_max_workers(self):
+        """ Test that no more than max_workers calls run at the same time.
+        """
+        lock = threading.Lock()
+        state = {'running': 0, 'max_running': 0}
+
+        def f(x):
+            with lock:
+                state['running'] += 1
+                state['max_running'] = max(
+                    state['max_running'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+            return x
+
+        util.parallel_map(f, range(20), max_workers=4)
+        self.assertTrue(1 < state['max_running'] <= 4)
+
+    def test_exception(self):
+        """ Test that the exception is raised after all calls complete. """
+        completed = []
+
+        def f(x):
+            if x == 0:
+                raise ValueError('Test')
+            time.sleep(0.01)
+            completed.append(x)
+
+        with self.assertRaises(ValueError):
+            util.parallel_map(f, range(5), max_workers=5)
+        self.assertEqual([1, 2, 3, 4], sorted(completed))
+
+
+    def test_cancel(self):
+        """ Test that cancelling the workers lets them finish their cleanup,
+        and that queued calls don't start.
+        """
+        started = []
+        cleaned_up = []
+        running = threading.Semaphore(0)
+
+        def f(x):
+            started.append(x)
+            running.release()
+            try:
+                while True:
+                    util.sleep(0.01)
+            finally:
+                # Cleanup can sleep and use its own workers.
+                util.sleep(0.01)
+                util.parallel_map(lambda y: util.sleep(0.01), range(2))
+                cleaned_up.append(x)
+
+        pool = ThreadPool(2)
+        async_results = [
+            pool.apply_async(util._call_in_worker, (f, (x,), False))
+            for x in range(3)
+        ]
+        running.acquire()
+        running.acquire()
+        util._wait_for_cleanup(pool, async_results)
+
+        self.assertEqual([0, 1], sorted(started))
+        self.assertEqual([0, 1], sorted(cleaned_up))
+        for async_result in async_results:
+            with self.assertRaises(util.CancelledError):
+                util._get_result(async_result)
+
+        # The next call isn't affected.
+        self.assertEqual(
+            [0, 1],
+            util.parallel_map(lambda x: util.sleep(0) or x, [0, 1])
+        )
+
+    def test_cancel_other_threads(self):
+        """ Test that threads that weren't started by parallel_map() or
+        BackgroundCall aren't cancelled.
+        """
+        errors = []
+
+        def f():
+            try:
+                util.sleep(0.01)
+            except BaseException as e:
+                errors.append(e)
+
+        util._cancel_event.set()
+        try:
+            t = threading.Thread(target=f)
+            t.start()
+            t.join()
+            util.sleep(0.01)
+        finally:
+            util._cancel_event.clear()
+        self.assertEqual([], errors)
+
+
+class TestBackgroundCall(unittest.TestCase):
+
+    def test_get(self):
+        call = util.BackgroundCall(lambda x, y: x + y, 1, 2)
+        self.assertEqual(3, call.get())
+
+    def test_exception(self):
+        def f():
+            raise ValueError('Test')
+
+        call = util.BackgroundCall(f)
+        with self.assertRaises(ValueError):
+            call.get()
@@ -16,9 +16,11 @@ import base64
 import json
 import logging
 import re
+import threading
 import time
 import uuid
 from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 
 import iso8601
 
@@ -27,6 +29,10 @@ from brkt_cli.validation import ValidationError
 SLEEP_ENABLED = True
 MAX_BACKOFF_SECS = 10
 
+# Used when waiting on a thread pool.  Python 2 only delivers
+# KeyboardInterrupt to a thread that's blocked with a timeout.
+_POOL_WAIT_TIMEOUT = 60 * 60 * 24 * 365
+
 # Supported crypto options for the disks
 CRYPTO_GCM = 'gcm'
 CRYPTO_XTS = 'xts'
@@ -36,11 +42,24 @@ METAVISOR_DISK_SIZE = 6
 
 log = logging.getLogger(__name__)
 
+# Set while parallel_map() or BackgroundCall waits for its workers to
+# clean up after KeyboardInterrupt.
+_cancel_event = threading.Event()
+_thread_state = threading.local()
+
 
 class BracketError(Exception):
     pass
 
 
+class CancelledError(KeyboardInterrupt):
+    """ Raised in a worker thread when the main thread was interrupted.
+    It's a KeyboardInterrupt, so that the worker handles it like Ctrl-C
+    and runs its cleanup.
+    """
+    pass
+
+
 class Deadline(object):
     """Convenience class for bounding how long execution takes."""
 
@@ -69,11 +88,104 @@ class RetryExceptionChecker(object):
         pass
 
 
+class _WorkerCancelled(Exception):
+    """ Carries KeyboardInterrupt or CancelledError out of a pool worker.
+    The pool only passes Exception subclasses back to the caller.
+    """
+    pass
+
+
+def _is_cancellable():
+    """ Return True if this thread is running a call for parallel_map() or
+    BackgroundCall and hasn't been cancelled yet.  Other threads, such as
+    the main thread and daemon threads that poll for resource state, are
+    never cancelled.  Once a worker has been cancelled, it sleeps
+    normally, so that its cleanup can wait for resources to be deleted.
+    """
+    return (
+        getattr(_thread_state, 'worker', False) and
+        not getattr(_thread_state, 'cancelled', False)
+    )
+
+
+def check_cancelled():
+    """ Raise CancelledError in a worker thread if the main thread was
+    interrupted.  The error is only raised once in each call.
+    """
+    if _cancel_event.is_set() and _is_cancellable():
+        _thread_state.cancelled = True
+        raise CancelledError()
+
+
 def sleep(seconds):
-    if SLEEP_ENABLED:
+    check_cancelled()
+    if not SLEEP_ENABLED:
+        return
+    if _is_cancellable():
+        # Wake up as soon as the main thread is interrupted.
+        _cancel_event.wait(seconds)
+        check_cancelled()
+    else:
         time.sleep(seconds)
 
 
+def _wait_for_cleanup(pool, async_results):
+    """ Called after KeyboardInterrupt.  Cancel the workers and wait for
+    them to clean up.  A second KeyboardInterrupt stops waiting.
+    """
+    log.warn(
+        'Interrupted.  Waiting for background tasks to clean up.  Press '
+        'Ctrl-C again to exit immediately.')
+    _cancel_event.set()
+    pool.close()
+    try:
+        for async_result in async_results:
+            async_result.wait(_POOL_WAIT_TIMEOUT)
+        pool.join()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        _cancel_event.clear()
+
+
+def _call_in_worker(function, args, exempt):
+    """ Call function in a worker thread of parallel_map() or
+    BackgroundCall.
+
+    :param exempt True if the caller is a worker that's already cleaning
+        up after being cancelled, and this call is part of the cleanup
+    """
+    _thread_state.worker = True
+    _thread_state.cancelled = exempt
+    try:
+        # Don't start work that was queued before the interrupt.
+        check_cancelled()
+        return function(*args)
+    except KeyboardInterrupt:
+        # The pool only passes Exception subclasses back to the caller.
+        # Any other exception kills the worker thread, and the caller
+        # waits forever for the result.
+        raise _WorkerCancelled()
+    finally:
+        _thread_state.worker = False
+        _thread_state.cancelled = False
+
+
+def _get_result(async_result):
+    try:
+        return async_result.get()
+    except _WorkerCancelled:
+        if getattr(_thread_state, 'worker', False):
+            # A nested call was cancelled, so this worker is cleaning up.
+            _thread_state.cancelled = True
+        raise CancelledError()
+
+
+def _is_exempt():
+    return getattr(_thread_state, 'cancelled', False)
+
+
 def retry(function, on=None, exception_checker=None, timeout=15.0,
           initial_sleep_seconds=0.25):
     """ Retry the given function until it completes successfully.  Before
@@ -116,6 +228,78 @@ def retry(function, on=None, exception_checker=None, timeout=15.0,
     return _wrapped
 
 
+def parallel_map(function, items, max_workers=8):
+    """ Call function once for each item, using a pool of at most
+    max_workers threads.
+
+    If the caller is interrupted with KeyboardInterrupt, CancelledError is
+    raised in the workers the next time they call sleep(), so that they
+    can clean up.  The KeyboardInterrupt is re-raised after they finish.
+
+    :return: the results, in the same order as items
+    :raise the first exception raised by function, after all of the
+        calls have completed
+    """
+    items = list(items)
+    if not items:
+        return []
+    if max_workers < 1:
+        raise ValueError('max_workers must be at least 1')
+    if len(items) == 1:
+        # Starting and stopping a pool takes longer than most calls.
+        return [function(items[0])]
+
+    pool = ThreadPool(min(max_workers, len(items)))
+    async_results = []
+    try:
+        for item in items:
+            async_results.append(pool.apply_async(
+                _call_in_worker, (function, (item,), _is_exempt())))
+        pool.close()
+        for async_result in async_results:
+            async_result.wait(_POOL_WAIT_TIMEOUT)
+    except KeyboardInterrupt:
+        _wait_for_cleanup(pool, async_results)
+        raise
+    pool.join()
+    return [_get_result(async_result) for async_result in async_results]
+
+
+class BackgroundCall(object):
+    """ Calls a function in a background thread.  Call get() to wait for
+    the function to return.  If get() is interrupted, the function is
+    cancelled like the workers of parallel_map().
+    """
+
+    def __init__(self, function, *args):
+        self._pool = ThreadPool(1)
+        self._async_result = self._pool.apply_async(
+            _call_in_worker, (function, args, _is_exempt()))
+        self._pool.close()
+
+    def get(self):
+        """ Wait for the function to return.
+
+        :return the value returned by the function
+        :raise the exception raised by the function
+        """
+        try:
+            # Wait with a timeout, so that KeyboardInterrupt is delivered.
+            self._async_result.wait(_POOL_WAIT_TIMEOUT)
+        except KeyboardInterrupt:
+            _wait_for_cleanup(self._pool, [self._async_result])
+            raise
+        self._pool.join()
+        return _get_result(self._async_result)
+
+    def cancel(self):
+        """ Cancel the function, like get() does when it's interrupted,
+        and wait for it to clean up.  The result is discarded.
+        """
+        if not self._async_result.ready():
+            _wait_for_cleanup(self._pool, [self._async_result])
+
+
 def get_domain_from_brkt_env(brkt_env):
     """Return the domain string from the api_host in the brkt_env. """
 
@@ -58,7 +58,7 @@ setup(
         'brkt_cli.make_user_data'
     ],
     install_requires=[
-        'boto3>=1.4.4',
+        'boto3>=1.16.0',
         'google-api-python-client>=1.5.0',
         'iso8601>=0.1.11',
         'oauth2client<3,>= 2.0.0',